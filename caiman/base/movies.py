@@ -24,6 +24,7 @@ import numpy as np
 import os
 from PIL import Image  # $ pip install pillow
 import pylab as pl
+import queue
 import scipy.ndimage
 import scipy
 from scipy.io import loadmat
@@ -34,6 +35,7 @@ from sklearn.cluster import KMeans
 from sklearn.decomposition import NMF, IncrementalPCA, FastICA
 from sklearn.metrics.pairwise import euclidean_distances
 import sys
+import threading
 import tifffile
 from tqdm import tqdm
 from typing import Any, Dict, List, Tuple, Union
@@ -1712,6 +1714,11 @@ def load(file_name: Union[str, List[str]],
             logging.debug('mmap')
             return movie(images, fr=fr)
 
+        elif extension == '.cmmap':
+            Yr, dims, T = load_memmap(file_name)
+            images = Yr.read_box([slice(None)] * len(dims), slice(None) if subindices is None else subindices)
+            return movie(images.astype(outtype), fr=fr)
+
         elif extension == '.sbx':
             logging.debug('sbx')
             if subindices is not None:
@@ -2135,93 +2142,259 @@ def rolling_window(ndarr, window_size, stride):
            yield ndarr[:,i+stride:]
 
 
-def load_iter(file_name, subindices=None, var_name_hdf5: str = 'mov'):
+def load_iter(file_name, subindices=None, var_name_hdf5: str = 'mov', outtype=None,
+              batch_size: int = 32, read_ahead: int = 2):
     """
-    load iterator over movie from file. Supports a variety of formats. tif, hdf5, avi.
+    load iterator over movie from file. Supports the same formats as load.
+
+    The frames are read in batches by a background thread (see load_iter_batches).
 
     Args:
         file_name: string
-            name of file. Possible extensions are tif, avi and hdf5
+            name of file. Possible extensions are tif, avi, hdf5, nwb, mat, npy, mmap, cmmap, sbx...
 
         subindices: iterable indexes
             for loading only a portion of the movie
 
+        outtype: The data type of the frames, None keeps the one of the file
+
+        batch_size: int
+            number of frames read at once
+
+        read_ahead: int
+            number of batches read in advance, 0 to read synchronously
+
     Returns:
         iter: iterator over movie
 
     Raises:
-        Exception 'Subindices not implemented'
+        Exception 'File not found!'
+    """
+    for batch in load_iter_batches(file_name, subindices=subindices, var_name_hdf5=var_name_hdf5,
+                                   outtype=outtype, batch_size=batch_size, read_ahead=read_ahead):
+        for frame in batch:
+            yield frame
 
-        Exception 'sima module unavailable'
 
-        Exception 'Unknown file type'
+def load_iter_batches(file_name, subindices=None, var_name_hdf5: str = 'mov', outtype=np.float32,
+                      batch_size: int = 32, read_ahead: int = 2):
+    """
+    load iterator over contiguous blocks of frames, prefetched by a background thread
 
+    Args:
+        file_name: string
+            name of file. Possible extensions are tif, avi, hdf5, nwb, mat, npy, mmap, cmmap, sbx...
+
+        subindices: slice, range or array of int
+            for loading only a portion of the movie
+
+        outtype: The data type of the blocks, None keeps the one of the file
+
+        batch_size: int
+            (maximum) number of frames of each block
+
+        read_ahead: int
+            number of blocks read in advance while the previous ones are processed,
+            0 to read synchronously in the calling thread
+
+    Returns:
+        iter: iterator over C contiguous arrays of shape (frames x dims)
+
+    Raises:
         Exception 'File not found!'
     """
-    if os.path.exists(file_name):
-        extension = os.path.splitext(file_name)[1].lower()
-        if extension in ('.tif', '.tiff', '.btf'):
-            Y = tifffile.TiffFile(file_name).pages
-            if subindices is not None:
-                if type(subindices) is range:
-                    subindices = slice(subindices.start, subindices.stop, subindices.step)
-                Y = Y[subindices]
-            for y in Y:
-                yield y.asarray()
-        elif extension == '.avi':
-            cap = cv2.VideoCapture(file_name)
+    if not os.path.exists(file_name):
+        logging.error(f"File request:[{file_name}] not found!")
+        raise Exception('File not found!')
+
+    def read_batches():
+        n_frames, read, close = _open_frame_reader(file_name, var_name_hdf5)
+        try:
             if subindices is None:
-                while True:
-                    ret, frame = cap.read()
-                    if ret:
-                        yield frame[..., 0]
-                    else:
-                        cap.release()
-                        return
-                        #raise StopIteration
+                indices = range(n_frames)
+            elif isinstance(subindices, (slice, range)):
+                indices = range(n_frames)[subindices] if isinstance(subindices, slice) else subindices
             else:
-                if type(subindices) is slice:
-                    subindices = range(
-                        subindices.start,
-                        int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) if subindices.stop is None else subindices.stop,
-                        1 if subindices.step is None else subindices.step)
-                t = 0
-                for ind in subindices:
-#                    cap.set(1, ind)
-#                    ret, frame = cap.read()
-#                    if ret:
-#                        yield frame[..., 0]
-#                    else:
-#                        raise StopIteration
-                    while t <= ind:
-                        ret, frame = cap.read()
-                        t += 1
-                    if ret:
-                        yield frame[..., 0]
-                    else:
-                        return
-                        #raise StopIteration
-                cap.release()
+                indices = np.asarray(subindices)
+                if indices.dtype == bool:
+                    indices = np.where(indices)[0]
+            for i in range(0, len(indices), batch_size):
+                batch = read(indices[i:i + batch_size])
+                if len(batch):
+                    yield np.ascontiguousarray(batch, dtype=outtype)
+                if len(batch) < len(indices[i:i + batch_size]):
+                    return    # the end of the file was reached early, see the avi reader
+        finally:
+            close()
+
+    if read_ahead <= 0:
+        for batch in read_batches():
+            yield batch
+        return
+
+    batches: queue.Queue = queue.Queue(maxsize=read_ahead)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        # gives up when the consumer is gone
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
+    def producer():
+        try:
+            for batch in read_batches():
+                if not put(batch):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
                 return
-                #raise StopIteration
-        elif extension in ('.hdf5', '.h5', '.mat'):
-            with h5py.File(file_name, "r") as f:
-                Y = f.get(var_name_hdf5)
-                if subindices is None:
-                    for y in Y:
-                        yield y
-                else:
-                    if type(subindices) is slice:
-                        subindices = range(subindices.start,
-                                           len(Y) if subindices.stop is None else subindices.stop,
-                                           1 if subindices.step is None else subindices.step)
-                    for ind in subindices:
-                        yield Y[ind]
-        else:  # fall back to memory inefficient version
-            for y in load(file_name, var_name_hdf5=var_name_hdf5,
-                          subindices=subindices):
-                yield y
-    else:
-        logging.error(f"File request:[{file_name}] not found!")
-        raise Exception('File not found!')
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        stop.set()
+
+
+def _as_slice(indices):
+    """slice equivalent to a range or an evenly spaced increasing array of indices, or None"""
+    if isinstance(indices, range):
+        if indices.step > 0 and len(indices) > 0:
+            return slice(indices.start, indices[-1] + 1, indices.step)
+        return None
+    if len(indices) == 1:
+        return slice(int(indices[0]), int(indices[0]) + 1)
+    steps = np.diff(indices)
+    if len(indices) > 0 and steps[0] > 0 and np.all(steps == steps[0]):
+        return slice(int(indices[0]), int(indices[-1]) + 1, int(steps[0]))
+    return None
+
+
+def _open_frame_reader(file_name, var_name_hdf5='mov'):
+    """
+    open a movie file for reading frames by index
+
+    Returns:
+        n_frames: int
+            number of frames in the file
+
+        read: function
+            read(indices) returns the frames at the indices (a range or an array of int)
+
+        close: function
+            releases the file
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.mat':
+        byte_stream, file_opened = scipy.io.matlab.mio._open_file(file_name, appendmat=False)
+        try:
+            mjv, mnv = scipy.io.matlab.mio.get_matfile_version(byte_stream)
+        finally:
+            if file_opened:
+                byte_stream.close()
+        if mjv == 2:
+            extension = '.h5'
+
+    def read_covering(array, indices):
+        # reads a slice when possible, otherwise the covering range
+        sl = _as_slice(indices)
+        if sl is not None:
+            return array[sl]
+        indices = np.asarray(indices)
+        return np.asarray(array[indices.min():indices.max() + 1])[indices - indices.min()]
+
+    if extension in ('.tif', '.tiff', '.btf'):
+        tffl = tifffile.TiffFile(file_name)
+        shape = tffl.series[0].shape
+        n_frames = shape[0] if len(shape) > 2 else 1
+        if len(tffl.pages) == n_frames and n_frames > 1:
+            def read(indices):
+                return np.reshape(tffl.asarray(key=list(indices)), (len(indices),) + tuple(shape[1:]))
+        else:
+            # all the frames in a single page: decode everything once
+            Y = tffl.asarray().reshape((n_frames,) + tuple(shape[-2:]) if n_frames == 1 else shape)
+
+            def read(indices):
+                return Y[np.asarray(indices)]
+        return n_frames, read, tffl.close
+
+    elif extension == '.avi':
+        cap = cv2.VideoCapture(file_name)
+        n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        position = [0]
+
+        def read(indices):
+            frames = []
+            for ind in indices:
+                if ind != position[0]:
+                    if 0 < ind - position[0] <= 4:
+                        for _ in range(ind - position[0]):
+                            cap.grab()
+                    else:
+                        cap.set(cv2.CAP_PROP_POS_FRAMES, ind)
+                ret, frame = cap.read()
+                if not ret:
+                    # the frame count of the header can be larger than the frames in the file
+                    logging.warning('Could not read frame {0} of {1}, which reports {2} frames: '
+                                    'stopping there'.format(ind, file_name, n_frames))
+                    break
+                frames.append(frame[..., 0])
+                position[0] = ind + 1
+            return np.array(frames)
+        return n_frames, read, cap.release
+
+    elif extension in ('.hdf5', '.h5', '.nwb'):
+        f = h5py.File(file_name, "r")
+        fkeys = list(f.keys())
+        if len(fkeys) == 1:
+            var_name_hdf5 = fkeys[0]
+        Y = f[var_name_hdf5]['data'] if extension == '.nwb' else f[var_name_hdf5]
+
+        def read(indices):
+            batch = read_covering(Y, indices)
+            # same as the squeeze in load, but keeping the frame axis
+            return batch.reshape((len(batch),) + tuple(d for d in batch.shape[1:] if d != 1))
+        return Y.shape[0], read, f.close
+
+    elif extension in ('.mmap', '.cmmap'):
+        Yr, dims, T = load_memmap(file_name)
+        if extension == '.cmmap':
+            def read(indices):
+                return Yr.read_box([slice(None)] * len(dims), indices)
+            return T, read, Yr.close
+        images = np.reshape(Yr.T, [T] + list(dims), order='F')
+        return T, lambda indices: read_covering(images, indices), lambda: None
+
+    elif extension == '.npy':
+        Y = np.load(file_name, mmap_mode='r')
+        if Y.ndim == 2:
+            Y = Y[np.newaxis]
+        return Y.shape[0], lambda indices: read_covering(Y, indices), lambda: None
+
+    elif extension == '.sbx':
+        from ..source_extraction.cnmf.utilities import get_file_size
+        _, n_frames = get_file_size(file_name)
+
+        def read(indices):
+            sl = _as_slice(indices)
+            if sl is not None:
+                return sbxreadskip(file_name[:-4], sl)
+            indices = np.asarray(indices)
+            return sbxreadskip(file_name[:-4], slice(indices.min(), indices.max() + 1))[indices - indices.min()]
+        return n_frames, read, lambda: None
+
+    else:  # fall back to memory inefficient version
+        Y = load(file_name, var_name_hdf5=var_name_hdf5)
+        return len(Y), lambda indices: Y[np.asarray(indices)], lambda: None
@@ -36,6 +36,7 @@ import time
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 from .mmapping import load_memmap
+from .shared_multiprocessing import SharedMemoryPool, is_local_pool
 
 logger = logging.getLogger(__name__)
 
@@ -295,7 +296,7 @@ def stop_server(ipcluster: str = 'ipcluster', pdir: str = None, profile: str = N
         dview: Undocumented
 
     """
-    if 'multiprocessing' in str(type(dview)):
+    if is_local_pool(dview):
         dview.terminate()
     else:
         logger.info("Stopping cluster...")
@@ -369,16 +370,18 @@ def setup_cluster(backend: str = 'multiprocessing',
     """Setup and/or restart a parallel cluster.
     Args:
         backend: str
-            'multiprocessing' [alias 'local'], 'ipyparallel', and 'SLURM'
+            'multiprocessing' [alias 'local'], 'shared_memory', 'ipyparallel', and 'SLURM'
             ipyparallel and SLURM backends try to restart if cluster running.
             backend='multiprocessing' raises an exception if a cluster is running.
+            backend='shared_memory' is a local multiprocessing pool that can publish
+            large read-only arrays in shared memory instead of pickling them in every task
         ignore_preexisting: bool
             If True, ignores the existence of an already running multiprocessing
             pool, which is usually indicative of a previously-started CaImAn cluster
 
     Returns:
         c: ipyparallel.Client object; only used for ipyparallel and SLURM backends, else None
-        dview: ipyparallel dview object, or for multiprocessing: Pool object
+        dview: ipyparallel dview object, or for multiprocessing: Pool object, or for shared_memory: SharedMemoryPool object
         n_processes: number of workers in dview. None means guess at number of machine cores.
     """
 
@@ -414,7 +417,7 @@ def setup_cluster(backend: str = 'multiprocessing',
             logger.info(f'Started ipyparallel cluster: Using {len(c)} processes')
             dview = c[:len(c)]
 
-        elif (backend == 'multiprocessing') or (backend == 'local'):
+        elif backend in ('multiprocessing', 'local', 'shared_memory'):
             if len(multiprocessing.active_children()) > 0:
                 if ignore_preexisting:
                     logger.warn('Found an existing multiprocessing pool. '
@@ -438,7 +441,10 @@ def setup_cluster(backend: str = 'multiprocessing',
                     pass
             c = None
 
-            dview = Pool(n_processes, maxtasksperchild=maxtasksperchild)
+            if backend == 'shared_memory':
+                dview = SharedMemoryPool(n_processes, maxtasksperchild=maxtasksperchild)
+            else:
+                dview = Pool(n_processes, maxtasksperchild=maxtasksperchild)
         else:
             raise Exception('Unknown Backend')
 
@@ -18,11 +18,13 @@ import tensorflow as tf
 import scipy
 from scipy.sparse import csc_matrix
 from scipy.stats import norm
-from typing import Any, List, Tuple, Union
+from typing import Any, Dict, List, Tuple, Union
 import warnings
 
 from caiman.paths import caiman_datadir
+from .shared_multiprocessing import is_local_pool
 from .utils.stats import mode_robust, mode_robust_fast
+from .utils.numpy_cnn import NumpySequential
 from .utils.utils import load_graph
 
 try:
@@ -95,11 +97,8 @@ def compute_event_exceptionality(traces: np.ndarray,
         # compute 25 percentile
         ff1 = np.sort(ff1, axis=1)
         ff1[ff1 == 0] = np.nan
-        Ns = np.round(np.sum(ff1 > 0, 1) * .5)
-        iqr_h = np.zeros(traces.shape[0])
-
-        for idx, _ in enumerate(ff1):
-            iqr_h[idx] = ff1[idx, -Ns[idx]]
+        Ns = np.round(np.sum(ff1 > 0, 1) * .5).astype(int)
+        iqr_h = np.take_along_axis(ff1, (-Ns[:, None]) % T, axis=1)[:, 0]
 
         # approximate standard deviation as iqr/1.349
         sd_r = 2 * iqr_h / 1.349
@@ -267,75 +266,166 @@ def classify_components_ep(Y, A, C, b, f, Athresh=0.1, Npeaks=5, tB=-3, tA=10, t
 #%%
 
 
+# classifiers loaded by this process, see load_CNN_model
+_loaded_models: Dict[Tuple[str, str], Any] = {}
+
+
+class _KerasModel(object):
+    """ Keras model called directly on each batch, model.predict has a large overhead per call """
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict(self, x: np.ndarray, batch_size: int = 32, verbose: int = 0) -> np.ndarray:
+        if not tf.executing_eagerly():
+            return self.model.predict(x, batch_size=batch_size, verbose=verbose)
+        return np.concatenate([np.asarray(self.model(x[i:i + batch_size], training=False))
+                               for i in range(0, max(len(x), 1), batch_size)], 0)
+
+
+class _GraphModel(object):
+    """ frozen tensorflow graph with the predict() method of a Keras model """
+
+    def __init__(self, model_file: str):
+        graph = load_graph(model_file)
+        self.tf_in = [op for op in graph.get_operations() if op.type == 'Placeholder'][0].outputs[0]
+        self.tf_out = graph.get_tensor_by_name('prefix/output_node0:0')
+        self.session = tf.compat.v1.Session(graph=graph)
+
+    def predict(self, x: np.ndarray, batch_size: int = 32, verbose: int = 0) -> np.ndarray:
+        return self.session.run(self.tf_out, feed_dict={self.tf_in: x})
+
+
+def load_CNN_model(model_name: str = os.path.join(caiman_datadir(), 'model', 'cnn_model'),
+                   runtime: str = 'auto'):
+    """ load a component classifier, once per process
+
+    Args:
+        model_name: str
+            path of the model without extension, absolute or relative to caiman_datadir().
+            The Keras model is model_name.json and model_name.h5, the frozen graph model_name.h5.pb
+
+        runtime: str
+            'keras', 'numpy' (NumpySequential, without tensorflow, fastest for a few crops),
+            'tensorflow' (frozen graph) or 'auto': keras, otherwise numpy if the
+            architecture is supported, otherwise the frozen graph
+
+    Returns:
+        model: object with the predict(x, batch_size, verbose) method of a Keras model
+
+    Raises:
+        FileNotFoundError 'File for requested model not found'
+    """
+    if os.path.isfile(os.path.join(caiman_datadir(), model_name + ".json")) or \
+            os.path.isfile(os.path.join(caiman_datadir(), model_name + ".h5.pb")):
+        model_name = os.path.join(caiman_datadir(), model_name)
+    key = (os.path.abspath(model_name), runtime)
+    if key in _loaded_models:
+        return _loaded_models[key]
+
+    model_file, model_weights = model_name + ".json", model_name + ".h5"
+    has_keras = os.path.isfile(model_file) and os.path.isfile(model_weights)
+    model = None
+    if runtime in ('auto', 'keras') and has_keras:
+        os.environ["KERAS_BACKEND"] = "tensorflow"
+        from tensorflow.keras.models import model_from_json
+        try:
+            with open(model_file, 'r') as json_file:
+                model = _KerasModel(model_from_json(json_file.read()))
+            model.model.load_weights(model_weights)
+            logging.info('Using Keras for ' + model_file)
+        except Exception:
+            if runtime == 'keras':
+                raise
+            logging.warning('Keras could not load ' + model_file, exc_info=True)
+            model = None
+    if model is None and runtime in ('auto', 'numpy') and has_keras:
+        try:
+            model = NumpySequential(model_file, model_weights)
+            logging.info('Using the NumPy runtime for ' + model_file)
+        except NotImplementedError:
+            if runtime == 'numpy':
+                raise
+    if model is None and runtime in ('auto', 'tensorflow') and os.path.isfile(model_name + ".h5.pb"):
+        model = _GraphModel(model_name + ".h5.pb")
+        logging.info('Using Tensorflow for ' + model_name + ".h5.pb")
+    if model is None:
+        raise FileNotFoundError("File for requested model {} not found".format(model_name))
+    _loaded_models[key] = model
+    return model
+
+
+def crop_components(A, dims, half_crop, patch_size: int = 50) -> np.ndarray:
+    """ crops of the spatial components around their centers of mass, for the CNN classifier
+
+    Args:
+        A: scipy.sparse matrix
+            spatial components, pixels (in F order) x components
+
+        dims: tuple
+            dimensions of the field of view
+
+        half_crop: tuple
+            half size of the crop in each dimension
+
+        patch_size: int
+            size of the (square) crops after resizing
+
+    Returns:
+        final_crops: np.ndarray
+            components x patch_size x patch_size crops, with unit norm before resizing
+            (zero for empty components)
+    """
+    A = csc_matrix(A)
+    A.sum_duplicates()
+    dims = np.array(dims)
+    K = A.shape[1]
+    comp = np.repeat(np.arange(K), np.diff(A.indptr))
+    px = np.unravel_index(A.indices, dims, order='F')
+    mass = np.bincount(comp, A.data, K)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        coms = np.stack([np.bincount(comp, A.data * p, K) for p in px], 1) / mass[:, None]
+    coms[mass == 0] = half_crop    # empty components, their crops are zero
+    coms = np.minimum(np.maximum(coms, half_crop), dims - half_crop).astype(int)
+    # position of each pixel in the crop of its component
+    pos = [p - coms[comp, i] + half_crop[i] for i, p in enumerate(px)]
+    keep = np.all([(q >= 0) & (q < 2 * h) for q, h in zip(pos, half_crop)], 0)
+    crops = np.zeros((K, 2 * half_crop[0], 2 * half_crop[1]))
+    crops[comp[keep], pos[0][keep], pos[1][keep]] = A.data[keep]
+    norm = np.sqrt((crops ** 2).sum((1, 2)))
+    crops[norm > 0] /= norm[norm > 0, None, None]
+    # cv2.resize is linear and separable, rows and columns are resized with one product each
+    Ry = cv2.resize(np.eye(2 * half_crop[0]), (2 * half_crop[0], patch_size))
+    Rx = cv2.resize(np.eye(2 * half_crop[1]), (patch_size, 2 * half_crop[1]))
+    return np.matmul(np.matmul(Ry, crops), Rx)
+
+
 def evaluate_components_CNN(A,
                             dims,
                             gSig,
                             model_name: str = os.path.join(caiman_datadir(), 'model', 'cnn_model'),
                             patch_size: int = 50,
                             loaded_model=None,
-                            isGPU: bool = False) -> Tuple[Any, np.array]:
+                            isGPU: bool = False,
+                            runtime: str = 'auto',
+                            batch_size: int = 256) -> Tuple[Any, np.array]:
     """ evaluate component quality using a CNN network
 
+    The model is loaded once per process (see load_CNN_model) unless loaded_model is given,
+    and the crops are classified batch_size at a time.
     """
 
     import os
     if not isGPU:
         os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
-    try:
-        os.environ["KERAS_BACKEND"] = "tensorflow"
-        from tensorflow.keras.models import model_from_json
-        use_keras = True
-        logging.info('Using Keras')
-    except (ModuleNotFoundError):
-        use_keras = False
-        logging.info('Using Tensorflow')
 
     if loaded_model is None:
-        if use_keras:
-            if os.path.isfile(os.path.join(caiman_datadir(), model_name + ".json")):
-                model_file = os.path.join(caiman_datadir(), model_name + ".json")
-                model_weights = os.path.join(caiman_datadir(), model_name + ".h5")
-            elif os.path.isfile(model_name + ".json"):
-                model_file = model_name + ".json"
-                model_weights = model_name + ".h5"
-            else:
-                raise FileNotFoundError("File for requested model {} not found".format(model_name))
-            with open(model_file, 'r') as json_file:
-                print('USING MODEL:' + model_file)
-                loaded_model_json = json_file.read()
-
-            loaded_model = model_from_json(loaded_model_json)
-            loaded_model.load_weights(model_name + '.h5')
-            #loaded_model.compile('sgd', 'mse')
-        else:
-            if os.path.isfile(os.path.join(caiman_datadir(), model_name + ".h5.pb")):
-                model_file = os.path.join(caiman_datadir(), model_name + ".h5.pb")
-            elif os.path.isfile(model_name + ".h5.pb"):
-                model_file = model_name + ".h5.pb"
-            else:
-                raise FileNotFoundError("File for requested model {} not found".format(model_name))
-            loaded_model = load_graph(model_file)
-
+        loaded_model = load_CNN_model(model_name, runtime=runtime)
         logging.debug("Loaded model from disk")
 
     half_crop = np.minimum(gSig[0] * 4 + 1, patch_size), np.minimum(gSig[1] * 4 + 1, patch_size)
-    dims = np.array(dims)
-    coms = [scipy.ndimage.center_of_mass(mm.toarray().reshape(dims, order='F')) for mm in A.tocsc().T]
-    coms = np.maximum(coms, half_crop)
-    coms = np.array([np.minimum(cms, dims - half_crop) for cms in coms]).astype(np.int)
-    crop_imgs = [
-        mm.toarray().reshape(dims, order='F')[com[0] - half_crop[0]:com[0] + half_crop[0], com[1] -
-                                              half_crop[1]:com[1] + half_crop[1]] for mm, com in zip(A.tocsc().T, coms)
-    ]
-    final_crops = np.array([cv2.resize(im / np.linalg.norm(im), (patch_size, patch_size)) for im in crop_imgs])
-    if use_keras:
-        predictions = loaded_model.predict(final_crops[:, :, :, np.newaxis], batch_size=32, verbose=1)
-    else:
-        tf_in = loaded_model.get_tensor_by_name('prefix/conv2d_20_input:0')
-        tf_out = loaded_model.get_tensor_by_name('prefix/output_node0:0')
-        with tf.Session(graph=loaded_model) as sess:
-            predictions = sess.run(tf_out, feed_dict={tf_in: final_crops[:, :, :, np.newaxis]})
-            sess.close()
+    final_crops = crop_components(A, dims, half_crop, patch_size)
+    predictions = loaded_model.predict(final_crops[:, :, :, np.newaxis], batch_size=batch_size, verbose=0)
 
     return predictions, final_crops
 
@@ -343,6 +433,33 @@ def evaluate_components_CNN(A,
 #%%
 
 
+def remove_baseline_fast(traces: np.ndarray) -> np.ndarray:
+    """ subtract in place a rolling 8th percentile baseline from the traces (K x T) and return them """
+    T = np.shape(traces)[-1]
+    downsampfact = np.minimum(old_div(T, 5), 800)
+    elm_missing = int(np.ceil(T * 1.0 / downsampfact) * downsampfact - T)
+    padbefore = int(np.floor(old_div(elm_missing, 2.0)))
+    padafter = int(np.ceil(old_div(elm_missing, 2.0)))
+    tr_tmp = np.pad(traces.T, ((padbefore, padafter), (0, 0)), mode='reflect')
+    numFramesNew, num_traces = np.shape(tr_tmp)
+    # compute baseline quickly
+    logging.debug("binning data ...")
+    tr_BL = np.reshape(tr_tmp, (downsampfact, numFramesNew // downsampfact, num_traces), order='F')
+    tr_BL = np.percentile(tr_BL, 8, axis=0)
+    logging.debug("interpolating data ...")
+    logging.debug(tr_BL.shape)
+    tr_BL = scipy.ndimage.zoom(np.array(tr_BL, dtype=np.float32), [downsampfact, 1],
+                               order=3,
+                               mode='constant',
+                               cval=0.0,
+                               prefilter=True)
+    if padafter == 0:
+        traces -= tr_BL.T
+    else:
+        traces -= tr_BL[padbefore:-padafter].T
+    return traces
+
+
 def evaluate_components(Y: np.ndarray,
                         traces: np.ndarray,
                         A,
@@ -438,36 +555,7 @@ def evaluate_components(Y: np.ndarray,
 
     logging.debug('Removing Baseline')
     if remove_baseline:
-        num_samps_bl = np.minimum(old_div(np.shape(traces)[-1], 5), 800)
-        slow_baseline = False
-        if slow_baseline:
-
-            traces = traces - \
-                scipy.ndimage.percentile_filter(
-                    traces, 8, size=[1, num_samps_bl])
-
-        else:                                                                                # fast baseline removal
-            downsampfact = num_samps_bl
-            elm_missing = int(np.ceil(T * 1.0 / downsampfact) * downsampfact - T)
-            padbefore = int(np.floor(old_div(elm_missing, 2.0)))
-            padafter = int(np.ceil(old_div(elm_missing, 2.0)))
-            tr_tmp = np.pad(traces.T, ((padbefore, padafter), (0, 0)), mode='reflect')
-            numFramesNew, num_traces = np.shape(tr_tmp)
-                                                                                             #% compute baseline quickly
-            logging.debug("binning data ...")
-            tr_BL = np.reshape(tr_tmp, (downsampfact, numFramesNew // downsampfact, num_traces), order='F')
-            tr_BL = np.percentile(tr_BL, 8, axis=0)
-            logging.debug("interpolating data ...")
-            logging.debug(tr_BL.shape)
-            tr_BL = scipy.ndimage.zoom(np.array(tr_BL, dtype=np.float32), [downsampfact, 1],
-                                       order=3,
-                                       mode='constant',
-                                       cval=0.0,
-                                       prefilter=True)
-            if padafter == 0:
-                traces -= tr_BL.T
-            else:
-                traces -= tr_BL[padbefore:-padafter].T
+        remove_baseline_fast(traces)
 
     logging.debug('Computing event exceptionality')
     fitness_raw, erfc_raw, _, _ = compute_event_exceptionality(traces,
@@ -509,6 +597,152 @@ def evaluate_components_placeholder(params):
     return fitness_raw, fitness_delta, [], [], r_values, significant_samples
 
 
+def _pearson_r(x: np.ndarray, y: np.ndarray) -> float:
+    """ correlation coefficient as in scipy.stats.pearsonr, without the p-value """
+    xm = x.astype(np.float64) - x.mean(dtype=np.float64)
+    ym = y.astype(np.float64) - y.mean(dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = np.dot(xm / np.linalg.norm(xm), ym / np.linalg.norm(ym))
+    return float(np.clip(r, -1, 1))
+
+
+def _space_correlation_block(Yr, A, C, n_block, Athresh=0.1, Npeaks=5, tB=-3, tA=10, thres=0.3) -> np.ndarray:
+    """ space correlation values of the first n_block components, as in classify_components_ep
+
+    The other columns of A and rows of C are the components overlapping with the
+    block. Only the pixels of each footprint are read from Yr, at the frames of its
+    activity intervals.
+    """
+    A = csc_matrix(A)
+    A.sum_duplicates()
+    nA = np.sqrt(np.asarray(A.power(2).sum(0))).ravel()
+    AA = (A.T * A[:, :n_block]).toarray() / np.outer(nA, nA[:n_block])
+    AA[np.arange(n_block), np.arange(n_block)] -= 1
+
+    LOC = find_activity_intervals(C, Npeaks=Npeaks, tB=tB, tA=tA, thres=thres)
+    rval = np.zeros(n_block)
+    for i in range(n_block):
+        if LOC[i] is None:
+            continue
+        indexes = set(LOC[i])
+        for j in np.where(AA[:, i] > Athresh)[0]:
+            if LOC[j] is not None:
+                indexes = indexes - set(LOC[j])
+        if len(indexes) == 0:
+            indexes = set(LOC[i])
+            logging.warning('Component {0} is only active '.format(i) +
+                            'jointly with neighboring components. Space ' +
+                            'correlation calculation might be unreliable.')
+        indexes = np.array(list(indexes)).astype(int)
+
+        atemp = A.data[A.indptr[i]:A.indptr[i + 1]]
+        px = A.indices[A.indptr[i]:A.indptr[i + 1]]
+        if np.any(np.isnan(atemp)):
+            atemp = A[:, i].toarray().flatten()
+            atemp[np.isnan(atemp)] = np.nanmean(atemp)
+            px = np.arange(len(atemp))
+        px, atemp = px[atemp > 0], atemp[atemp > 0]
+        if px.size < 3:
+            logging.warning('Component {0} is almost empty. '.format(i) + 'Space correlation is set to 0.')
+            continue
+        ysqr = np.array(Yr[np.ix_(px, indexes)])
+        if np.any(np.isnan(ysqr)):   # the missing values are replaced by the mean over all frames
+            ysqr = np.array(Yr[px, :])
+            ysqr[np.isnan(ysqr)] = np.nanmean(ysqr)
+            ysqr = ysqr[:, indexes]
+        rval[i] = _pearson_r(np.mean(ysqr, axis=-1), atemp)
+
+    return rval
+
+
+def _evaluate_components_block(pars) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ fitness_raw, fitness_delta and r_values of a block of components, see evaluate_components_blocks """
+    import caiman as cm
+    Y_name, traces, A, C, n_block, final_frate, remove_baseline, N, robust_std, Athresh, Npeaks, \
+        thresh_C, sigma_factor = pars
+    Yr = cm.load_memmap(Y_name)[0] if isinstance(Y_name, str) else Y_name
+    tB = np.minimum(-2, np.floor(-5. / 30 * final_frate))
+    tA = np.maximum(5, np.ceil(25. / 30 * final_frate))
+
+    fitness_delta = compute_event_exceptionality(np.diff(traces, axis=1), robust_std=robust_std, N=N,
+                                                 sigma_factor=sigma_factor)[0]
+    traces = np.array(traces)
+    if remove_baseline:
+        remove_baseline_fast(traces)
+    fitness_raw = compute_event_exceptionality(traces, robust_std=robust_std, N=N,
+                                               sigma_factor=sigma_factor)[0]
+    r_values = _space_correlation_block(Yr, A, C, n_block, Athresh=Athresh, Npeaks=Npeaks,
+                                        tB=tB, tA=tA, thres=thresh_C)
+    return fitness_raw, fitness_delta, r_values
+
+
+def evaluate_components_blocks(Y, traces, A, C, final_frate, remove_baseline: bool = True, N: int = 5,
+                               robust_std: bool = False, Athresh: float = 0.1, Npeaks: int = 5,
+                               thresh_C: float = 0.3, sigma_factor: float = 3., block_size: int = 1000,
+                               dview=None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Trace exceptionality and space correlation of the components, a block of components per task
+
+    Computes the same metrics as evaluate_components. Each task evaluates block_size
+    components and gets their traces and the footprints and traces of the components
+    overlapping with them, so that the memory used by a task does not depend on the
+    total number of components and overlaps across blocks are taken into account.
+    A task reads from the movie only the pixels of each footprint at the frames of
+    its activity intervals.
+
+    Args:
+        Y: np.memmap or ndarray
+            movie, memory mapped (the tasks load it from Y.filename) or of shape x,y,t
+            (then the blocks are evaluated serially)
+
+        traces: ndarray
+            Fluorescence traces
+
+        A, C: various types
+            outputs of cnmf
+
+        block_size: int
+            number of components evaluated per task
+
+        other args: see evaluate_components
+
+    Returns:
+        fitness_raw: ndarray
+            value estimate of the quality of components (the lesser the better) on the raw trace
+
+        fitness_delta: ndarray
+            value estimate of the quality of components (the lesser the better) on diff(trace)
+
+        r_values: ndarray
+            space correlation values
+    """
+    K = A.shape[-1]
+    A = csc_matrix(A)
+    if 'memmap' in str(type(Y)):
+        Y_name = Y.filename
+    else:
+        Y_name = np.reshape(Y, (np.prod(np.shape(Y)[:-1]), np.shape(Y)[-1]), order='F')
+        dview = None
+
+    params = []
+    for start in range(0, K, block_size):
+        block = np.arange(start, min(start + block_size, K))
+        neighbors = np.setdiff1d((A.T * A[:, block]).tocoo().row, block)
+        idx = np.concatenate([block, neighbors])
+        params.append([Y_name, traces[block], A[:, idx], C[idx], len(block), final_frate, remove_baseline,
+                       N, robust_std, Athresh, Npeaks, thresh_C, sigma_factor])
+
+    if dview is None:
+        res = list(map(_evaluate_components_block, params))
+    elif is_local_pool(dview):
+        res = dview.map_async(_evaluate_components_block, params).get(4294967)
+    else:
+        res = dview.map_sync(_evaluate_components_block, params)
+
+    if len(res) == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    return tuple(np.concatenate(r) for r in zip(*res))   # type: ignore
+
+
 def estimate_components_quality_auto(Y,
                                      A,
                                      C,
@@ -529,7 +763,8 @@ def estimate_components_quality_auto(Y,
                                      thresh_cnn_lowest=0.1,
                                      thresh_fitness_delta=-20.,
                                      min_SNR_reject=0.5,
-                                     gSig_range=None) -> Tuple[np.array, np.array, float, float, float]:
+                                     gSig_range=None,
+                                     block_size=None) -> Tuple[np.array, np.array, float, float, float]:
     ''' estimates the quality of component automatically
 
     Args:
@@ -575,6 +810,9 @@ def estimate_components_quality_auto(Y,
         min_SNR_reject:
             adaptive way to set threshold (like min_SNR but used to discard components with std lower than this value)
 
+        block_size:
+            components per task of evaluate_components_blocks (None: groups of 50 components)
+
     Returns:
         idx_components: list
             list of components that pass the tests
@@ -618,7 +856,8 @@ def estimate_components_quality_auto(Y,
         return_all=True,
         dview=dview,
         num_traces_per_group=50,
-        N=N_samples)
+        N=N_samples,
+        block_size=block_size)
 
     comp_SNR = -norm.ppf(np.exp(fitness_raw / N_samples))
 
@@ -707,7 +946,8 @@ def estimate_components_quality(traces,
                                 robust_std=False,
                                 Athresh=0.1,
                                 thresh_C=0.3,
-                                num_traces_per_group=20) -> Tuple[np.ndarray, ...]:
+                                num_traces_per_group=20,
+                                block_size=None) -> Tuple[np.ndarray, ...]:
     """ Define a metric and order components according to the probability of some "exceptional events" (like a spike).
 
     Such probability is defined as the likelihood of observing the actual trace value over N samples given an estimated noise distribution.
@@ -747,6 +987,10 @@ def estimate_components_quality(traces,
         thresh_C: float
             fraction of the maximum of C that is used as minimum peak height
 
+        block_size: int or None
+            if not None, the components are evaluated with evaluate_components_blocks,
+            block_size components per task, instead of in groups of num_traces_per_group
+
     Returns:
         idx_components: ndarray
             the components ordered according to the fitness
@@ -766,7 +1010,13 @@ def estimate_components_quality(traces,
     """
     # TODO: Consider always returning it all and let the caller ignore what it does not want
 
-    if 'memmap' not in str(type(Y)):
+    if block_size is not None:
+        fitness_raw, fitness_delta, r_values = \
+            evaluate_components_blocks(Y, traces, A, C, final_frate, remove_baseline=remove_baseline,
+                                       N=N, robust_std=robust_std, Athresh=Athresh, Npeaks=Npeaks,
+                                       thresh_C=thresh_C, block_size=block_size, dview=dview)
+
+    elif 'memmap' not in str(type(Y)):
         logging.warning('NOT MEMORY MAPPED. FALLING BACK ON SINGLE CORE IMPLEMENTATION')
         fitness_raw, fitness_delta, erfc_raw, erfc_delta, r_values, _ = \
             evaluate_components(Y, traces, A, C, b, f, final_frate, remove_baseline=remove_baseline,
@@ -798,7 +1048,7 @@ def estimate_components_quality(traces,
                 res = map(evaluate_components_placeholder, params)
             else:
                 logging.info('Component evaluation in parallel')
-                if 'multiprocessing' in str(type(dview)):
+                if is_local_pool(dview):
                     res = dview.map_async(evaluate_components_placeholder, params).get(4294967)
                 else:
                     res = dview.map_sync(evaluate_components_placeholder, params)
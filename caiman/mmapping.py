@@ -12,19 +12,33 @@ from builtins import range
 from past.builtins import basestring
 from past.utils import old_div
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import ipyparallel as parallel
+import h5py
 from itertools import chain
 import logging
 import numpy as np
 import os
 import pickle
 import sys
+import threading
 import tifffile
 from typing import Any, Dict, List, Optional, Tuple, Union
 import pathlib
 
 import caiman as cm
 from caiman.paths import memmap_frames_filename
+from .shared_multiprocessing import SharedMemoryPool, get_shared, is_local_pool, release_array
+
+try:
+    from threadpoolctl import threadpool_limits
+    HAS_THREADPOOLCTL = True
+except ImportError:
+    HAS_THREADPOOLCTL = False
+
+# default number of threads of parallel_dot_product without dview
+_dot_threads = 4
 
 
 def prepare_shape(mytuple: Tuple) -> Tuple:
@@ -47,7 +61,7 @@ def load_memmap(filename: str, mode: str = 'r') -> Tuple[Any, Tuple, int]:
 
     Returns:
         Yr:
-            memory mapped variable
+            memory mapped variable, or ChunkedMemmap for files created by save_memmap_chunked
 
         dims: tuple
             frame dimensions
@@ -60,9 +74,14 @@ def load_memmap(filename: str, mode: str = 'r') -> Tuple[Any, Tuple, int]:
         ValueError "Unknown file extension"
 
     """
+    if pathlib.Path(filename).suffix == '.cmmap':
+        if mode != 'r':
+            raise ValueError('Chunked memory mapped files can only be opened in read mode')
+        Yr = ChunkedMemmap(filename)
+        return (Yr, Yr.dims, Yr.n_frames)
     if pathlib.Path(filename).suffix != '.mmap':
         logging.error("Unknown extension for file " + str(filename))
-        raise ValueError('Unknown file extension (should be .mmap)')
+        raise ValueError('Unknown file extension (should be .mmap or .cmmap)')
     # Strip path components and use CAIMAN_DATA/example_movies
     # TODO: Eventually get the code to save these in a different dir
     file_to_load = filename
@@ -152,7 +171,7 @@ def save_memmap_each(fnames: List[str],
 
     # Perform the job using whatever computing framework we're set to use
     if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
+        if is_local_pool(dview):
             fnames_new = dview.map_async(save_place_holder, pars).get(4294967)
         else:
             fnames_new = my_map(dview, save_place_holder, pars)
@@ -215,7 +234,7 @@ def save_memmap_join(mmap_fnames: List[str], base_name: str = None, n_chunks: in
         pars[-1][-2] = d
 
     if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
+        if is_local_pool(dview):
             dview.map_async(save_portion, pars).get(4294967)
         else:
             my_map(dview, save_portion, pars)
@@ -334,6 +353,70 @@ def save_place_holder(pars: List) -> str:
                        slices=slices)
 
 
+def _load_for_memmap(f, resize_fact=(1, 1, 1), remove_init=0, idx_xy=None, var_name_hdf5='mov', xy_shifts=None,
+                     is_3D=False, add_to_movie=0, border_to_0=0, slices=None) -> Tuple[np.ndarray, Tuple, int]:
+    """load a movie and apply the processing of save_memmap, returning it as a pixels x time array"""
+    if isinstance(f, str):     # Might not always be filenames.
+        logging.debug(f)
+
+    if is_3D:
+        Yr = f if not (isinstance(f, basestring)) else tifffile.imread(f)
+        if slices is not None:
+            Yr = Yr[tuple(slices)]
+        else:
+            if idx_xy is None:         #todo remove if not used, superceded by the slices parameter
+                Yr = Yr[remove_init:]
+            elif len(idx_xy) == 2:     #todo remove if not used, superceded by the slices parameter
+                Yr = Yr[remove_init:, idx_xy[0], idx_xy[1]]
+            else:                      #todo remove if not used, superceded by the slices parameter
+                Yr = Yr[remove_init:, idx_xy[0], idx_xy[1], idx_xy[2]]
+
+    else:
+        if isinstance(f, basestring) or isinstance(f, list):
+            Yr = cm.load(f, fr=1, in_memory=True, var_name_hdf5=var_name_hdf5)
+        else:
+            Yr = cm.movie(f)
+        if xy_shifts is not None:
+            Yr = Yr.apply_shifts(xy_shifts, interpolation='cubic', remove_blanks=False)
+
+        if slices is not None:
+            Yr = Yr[tuple(slices)]
+        else:
+            if idx_xy is None:
+                if remove_init > 0:
+                    Yr = Yr[remove_init:]
+            elif len(idx_xy) == 2:
+                Yr = Yr[remove_init:, idx_xy[0], idx_xy[1]]
+            else:
+                raise Exception('You need to set is_3D=True for 3D data)')
+                Yr = np.array(Yr)[remove_init:, idx_xy[0], idx_xy[1], idx_xy[2]]
+
+    if border_to_0 > 0:
+        if slices is not None:
+            if type(slices) is list:
+                raise Exception(
+                    'You cannot slice in x and y and then use add_to_movie: if you only want to slice in time do not pass in a list but just a slice object'
+                )
+
+        min_mov = Yr.calc_min()
+        Yr[:, :border_to_0, :] = min_mov
+        Yr[:, :, :border_to_0] = min_mov
+        Yr[:, :, -border_to_0:] = min_mov
+        Yr[:, -border_to_0:, :] = min_mov
+
+    fx, fy, fz = resize_fact
+    if fx != 1 or fy != 1 or fz != 1:
+        if 'movie' not in str(type(Yr)):
+            Yr = cm.movie(Yr, fr=1)
+        Yr = Yr.resize(fx=fx, fy=fy, fz=fz)
+
+    T, dims = Yr.shape[0], Yr.shape[1:]
+    Yr = np.transpose(Yr, list(range(1, len(dims) + 1)) + [0])
+    Yr = np.reshape(Yr, (np.prod(dims), T), order='F')
+    Yr = np.ascontiguousarray(Yr, dtype=np.float32) + np.float32(0.0001) + np.float32(add_to_movie)
+    return Yr, dims, T
+
+
 #%%
 def save_memmap(filenames: List[str],
                 base_name: str = 'Yr',
@@ -348,7 +431,9 @@ def save_memmap(filenames: List[str],
                 border_to_0=0,
                 dview=None,
                 n_chunks: int = 100,
-                slices=None) -> str:
+                slices=None,
+                direct_write: bool = False,
+                resume: bool = False) -> str:
     """ Efficiently write data from a list of tif files into a memory mappable file
 
     Args:
@@ -392,6 +477,15 @@ def save_memmap(filenames: List[str],
             directions. For instance
             slices = [slice(0,200),slice(0,100),slice(0,100)] will take
             the first 200 frames and the 100 pixels along x and y dimensions.
+
+        direct_write: bool
+            for several files, decode each file in a separate worker and write it directly
+            at its frame offset in the final C order file (see save_memmap_direct), instead
+            of going through one temporary memmap file per input file
+
+        resume: bool
+            with direct_write, skip the files already written by an interrupted conversion
+
     Returns:
         fname_new: the name of the mapped file, the format is such that
             the name will contain the frame dimensions and the number of frames
@@ -403,7 +497,15 @@ def save_memmap(filenames: List[str],
     if slices is not None:
         slices = [slice(0, None) if sl is None else sl for sl in slices]
 
-    if len(filenames) > 1:
+    if len(filenames) > 1 and direct_write:
+        if order == 'F':
+            raise Exception('You cannot merge files in F order, they must be in C order for CaImAn')
+        fname_new = save_memmap_direct(filenames, base_name=base_name, resize_fact=resize_fact,
+                                       remove_init=remove_init, idx_xy=idx_xy, var_name_hdf5=var_name_hdf5,
+                                       xy_shifts=xy_shifts, is_3D=is_3D, add_to_movie=add_to_movie,
+                                       border_to_0=border_to_0, dview=dview, slices=slices, resume=resume)
+
+    elif len(filenames) > 1:
         recompute_each_memmap = False
         for file__ in filenames:
             if ('order_' + order not in file__) or ('.mmap' not in file__):
@@ -442,64 +544,9 @@ def save_memmap(filenames: List[str],
         # TODO: can be done online
         Ttot = 0
         for idx, f in enumerate(filenames):
-            if isinstance(f, str):     # Might not always be filenames.
-                logging.debug(f)
-
-            if is_3D:
-                Yr = f if not (isinstance(f, basestring)) else tifffile.imread(f)
-                if slices is not None:
-                    Yr = Yr[tuple(slices)]
-                else:
-                    if idx_xy is None:         #todo remove if not used, superceded by the slices parameter
-                        Yr = Yr[remove_init:]
-                    elif len(idx_xy) == 2:     #todo remove if not used, superceded by the slices parameter
-                        Yr = Yr[remove_init:, idx_xy[0], idx_xy[1]]
-                    else:                      #todo remove if not used, superceded by the slices parameter
-                        Yr = Yr[remove_init:, idx_xy[0], idx_xy[1], idx_xy[2]]
-
-            else:
-                if isinstance(f, basestring) or isinstance(f, list):
-                    Yr = cm.load(f, fr=1, in_memory=True, var_name_hdf5=var_name_hdf5)
-                else:
-                    Yr = cm.movie(f)
-                if xy_shifts is not None:
-                    Yr = Yr.apply_shifts(xy_shifts, interpolation='cubic', remove_blanks=False)
-
-                if slices is not None:
-                    Yr = Yr[tuple(slices)]
-                else:
-                    if idx_xy is None:
-                        if remove_init > 0:
-                            Yr = Yr[remove_init:]
-                    elif len(idx_xy) == 2:
-                        Yr = Yr[remove_init:, idx_xy[0], idx_xy[1]]
-                    else:
-                        raise Exception('You need to set is_3D=True for 3D data)')
-                        Yr = np.array(Yr)[remove_init:, idx_xy[0], idx_xy[1], idx_xy[2]]
-
-            if border_to_0 > 0:
-                if slices is not None:
-                    if type(slices) is list:
-                        raise Exception(
-                            'You cannot slice in x and y and then use add_to_movie: if you only want to slice in time do not pass in a list but just a slice object'
-                        )
-
-                min_mov = Yr.calc_min()
-                Yr[:, :border_to_0, :] = min_mov
-                Yr[:, :, :border_to_0] = min_mov
-                Yr[:, :, -border_to_0:] = min_mov
-                Yr[:, -border_to_0:, :] = min_mov
-
-            fx, fy, fz = resize_fact
-            if fx != 1 or fy != 1 or fz != 1:
-                if 'movie' not in str(type(Yr)):
-                    Yr = cm.movie(Yr, fr=1)
-                Yr = Yr.resize(fx=fx, fy=fy, fz=fz)
-
-            T, dims = Yr.shape[0], Yr.shape[1:]
-            Yr = np.transpose(Yr, list(range(1, len(dims) + 1)) + [0])
-            Yr = np.reshape(Yr, (np.prod(dims), T), order='F')
-            Yr = np.ascontiguousarray(Yr, dtype=np.float32) + np.float32(0.0001) + np.float32(add_to_movie)
+            Yr, dims, T = _load_for_memmap(f, resize_fact=resize_fact, remove_init=remove_init, idx_xy=idx_xy,
+                                           var_name_hdf5=var_name_hdf5, xy_shifts=xy_shifts, is_3D=is_3D,
+                                           add_to_movie=add_to_movie, border_to_0=border_to_0, slices=slices)
 
             if idx == 0:
                 fname_tot = base_name + '_d1_' + str(
@@ -542,111 +589,574 @@ def save_memmap(filenames: List[str],
     return fname_new
 
 
+#%%
+def save_memmap_direct(filenames: List[str],
+                       base_name: str = 'Yr',
+                       resize_fact: Tuple = (1, 1, 1),
+                       remove_init: int = 0,
+                       idx_xy: Tuple = None,
+                       var_name_hdf5: str = 'mov',
+                       xy_shifts: Optional[List] = None,
+                       is_3D: bool = False,
+                       add_to_movie: float = 0,
+                       border_to_0: int = 0,
+                       dview=None,
+                       slices=None,
+                       resume: bool = False) -> str:
+    """ Write several movie files into a single C order memory mapped file, in parallel
+
+    The number of frames of each file is read from its header, the output file is
+    allocated once and each file is decoded by a worker and written at its frame
+    offset, with the same processing as save_memmap. The files already written are
+    recorded in fname_new + '.progress', which is removed at the end: with
+    resume=True an interrupted conversion only processes the remaining files.
+
+    Args:
+        filenames: list
+            list of movie files
+
+        xy_shifts: list
+            one set of shifts per file (or None)
+
+        resume: bool
+            if the output file and its progress record exist, skip the files already written
+
+        other arguments: see save_memmap, resize_fact, remove_init, idx_xy, border_to_0 and
+            slices are applied to each file separately
+
+    Returns:
+        fname_new: the name of the mapped file
+    """
+    from .source_extraction.cnmf.utilities import get_file_size
+
+    if slices is not None:
+        slices = [slice(0, None) if sl is None else sl for sl in slices]
+    if xy_shifts is None:
+        xy_shifts = [None] * len(filenames)
+
+    # frame ranges of each file in the output, computed from the headers
+    dims_tot = None
+    offsets = [0]
+    for f in filenames:
+        dims, T = get_file_size(f, var_name_hdf5=var_name_hdf5)
+        dims, T = _processed_size(tuple(dims), T, resize_fact, remove_init, idx_xy, slices)
+        if dims_tot is not None and dims != dims_tot:
+            raise Exception('All the files must have the same dimensions after processing')
+        dims_tot = dims
+        offsets.append(offsets[-1] + T)
+    Ttot = offsets[-1]
+
+    fname_new = memmap_frames_filename(base_name, dims_tot, Ttot, 'C')
+    if isinstance(filenames[0], str):
+        fname_new = os.path.join(os.path.split(filenames[0])[0], fname_new)
+    fname_progress = fname_new + '.progress'
+    shape_tot = (int(np.prod(dims_tot)), Ttot)
+
+    done: List[int] = []
+    if resume and os.path.exists(fname_new) and \
+            os.path.getsize(fname_new) == np.prod(shape_tot) * np.dtype(np.float32).itemsize:
+        if not os.path.exists(fname_progress):
+            logging.info('{} already written'.format(fname_new))
+            return fname_new
+        with open(fname_progress) as fp:
+            done = [int(line) for line in fp if line.strip()]
+        logging.info('Resuming {}: {} of {} files already written'.format(fname_new, len(done), len(filenames)))
+    else:
+        np.memmap(fname_new, mode='w+', dtype=np.float32, shape=prepare_shape(shape_tot), order='C')
+        open(fname_progress, 'w').close()
+
+    pars = []
+    for idx, f in enumerate(filenames):
+        if idx not in done:
+            pars.append([idx, f, fname_new, shape_tot, offsets[idx], offsets[idx + 1],
+                         dict(resize_fact=resize_fact, remove_init=remove_init, idx_xy=idx_xy,
+                              var_name_hdf5=var_name_hdf5, xy_shifts=xy_shifts[idx], is_3D=is_3D,
+                              add_to_movie=add_to_movie, border_to_0=border_to_0, slices=slices)])
+
+    if dview is None:
+        results = map(save_into_memmap, pars)
+    elif is_local_pool(dview):
+        results = dview.imap_unordered(save_into_memmap, pars)
+    else:
+        results = dview.map_async(save_into_memmap, pars)
+
+    with open(fname_progress, 'a') as fp:
+        for count, idx in enumerate(results):
+            fp.write('{}\n'.format(idx))
+            fp.flush()
+            logging.info('Saved {} ({} of {} files, frames {}-{})'.format(
+                filenames[idx], len(done) + count + 1, len(filenames), offsets[idx], offsets[idx + 1]))
+
+    os.remove(fname_progress)
+    return fname_new
+
+
+def _processed_size(dims, T, resize_fact=(1, 1, 1), remove_init=0, idx_xy=None, slices=None) -> Tuple[Tuple, int]:
+    """frame dimensions and number of frames of a movie after the processing of save_memmap"""
+    if slices is not None:
+        T = len(range(T)[slices[0]])
+        dims = tuple(len(range(d)[sl]) for d, sl in zip(dims, slices[1:])) + dims[len(slices) - 1:]
+    else:
+        T = max(0, T - remove_init)
+        if idx_xy is not None:
+            dims = tuple(len(range(d)[sl]) for d, sl in zip(dims, idx_xy)) + dims[len(idx_xy):]
+    fx, fy, fz = resize_fact
+    if fx != 1 or fy != 1:
+        dims = (int(dims[0] * fx), int(dims[1] * fy)) + dims[2:]
+    if fz != 1:
+        T = max(1, int(fz * T))
+    return dims, T
+
+
+def save_into_memmap(pars: List) -> int:
+    """ process one file and write it at its frame offset in the memory mapped file, to use map reduce
+    """
+    idx, f, fname_tot, shape_tot, start, end, kwargs = pars
+    Yr, dims, T = _load_for_memmap(f, **kwargs)
+    if T != end - start or Yr.shape[0] != shape_tot[0]:
+        raise Exception('Unexpected size of {}: {} pixels x {} frames instead of {} x {}'.format(
+            f, Yr.shape[0], T, shape_tot[0], end - start))
+    # one write per pixel, much faster than assigning to a memmap of the whole file
+    itemsize, n_frames = int(Yr.dtype.itemsize), int(shape_tot[1])
+    with open(fname_tot, 'r+b') as fp:
+        for px, row in enumerate(Yr):
+            position = (px * n_frames + int(start)) * itemsize
+            if hasattr(os, 'pwrite'):
+                os.pwrite(fp.fileno(), row, position)
+            else:
+                fp.seek(position)
+                fp.write(row)
+    return idx
+
+
+#%%
+class ChunkedMemmap(object):
+    """ Read only pixels x time view of a movie saved by save_memmap_chunked
+
+    The movie is stored in an HDF5 file as a (T, d1, d2[, d3]) dataset split in
+    chunks of a few frames by a spatial tile and compressed with a lossless
+    codec. It is indexed like the C order memmap returned by load_memmap,
+    Yr[pixels, frames], but only the chunks overlapping the bounding box of the
+    requested pixels are read and decompressed.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._file = None
+        with h5py.File(filename, 'r') as f:
+            dset = f['mov']
+            self.dims = tuple(dset.shape[1:])
+            self.n_frames = dset.shape[0]
+            self.chunks = dset.chunks
+            self.storage_dtype = dset.dtype
+            self.add_to_movie = np.float32(dset.attrs.get('add_to_movie', 0))
+        self.shape = (int(np.prod(self.dims)), self.n_frames)
+        self.dtype = np.dtype(np.float32)
+        self.ndim = 2
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        return state
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    @property
+    def T(self) -> 'ChunkedFrames':
+        """frames x pixels view, as the transpose of a memmap"""
+        return ChunkedFrames(self)
+
+    @property
+    def dataset(self):
+        if self._file is None:
+            self._file = h5py.File(self.filename, 'r')
+        return self._file['mov']
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def read_box(self, slices, frames=slice(None)) -> np.ndarray:
+        """
+        Read a box of the movie
+
+        Args:
+            slices: list of slices
+                spatial extent of the box, one slice with unit step per dimension
+
+            frames: slice, int or array of int
+                frames to read
+
+        Returns:
+            Y: np.ndarray (frames x box dimensions)
+                float32 movie, with the same values as the memmap created by save_memmap
+        """
+        box = tuple(slice(*sl.indices(dim)[:2]) for sl, dim in zip(slices, self.dims))
+        if isinstance(frames, slice) or np.isscalar(frames):
+            Y = self.dataset[(frames,) + box]
+        else:
+            frames = np.asarray(frames, dtype=int).ravel()
+            if len(frames) == 0:
+                return np.zeros((0,) + tuple(sl.stop - sl.start for sl in box), dtype=np.float32)
+            # read the covering range of frames, h5py only supports increasing index lists
+            Y = self.dataset[(slice(frames.min(), frames.max() + 1),) + box]
+            if len(frames) < len(Y) or np.any(np.diff(frames) != 1):
+                Y = Y[frames - frames.min()]
+        return Y.astype(np.float32) + np.float32(0.0001) + self.add_to_movie
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        if np.isscalar(rows):
+            return self[[rows], cols][0]
+        if isinstance(rows, slice):
+            rows = np.arange(*rows.indices(self.shape[0]))
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.where(rows)[0]
+        if len(rows) == 0:
+            return np.zeros((0, len(range(self.n_frames)[cols])), dtype=np.float32)
+        coords = np.unravel_index(rows, self.dims, order='F')
+        lo = [c.min() for c in coords]
+        Y = self.read_box([slice(l, c.max() + 1) for l, c in zip(lo, coords)], cols)
+        return Y[(Ellipsis,) + tuple(c - l for c, l in zip(coords, lo))].T
+
+    def __array__(self, dtype=None, copy=None):
+        Yr = self[:, :]
+        return Yr if dtype is None else Yr.astype(dtype)
+
+
+class ChunkedFrames(object):
+    """ Frames x pixels view of a ChunkedMemmap, as Yr.T for a memmap
+
+    Indexed as Yr.T[frames, pixels]. np.reshape(Yr.T, [T] + list(dims), order='F')
+    returns the ChunkedMovie of the file without reading it.
+    """
+
+    def __init__(self, source: ChunkedMemmap):
+        self.source = source
+        self.filename = source.filename
+        self.shape = source.shape[::-1]
+        self.dtype = source.dtype
+        self.ndim = 2
+
+    @property
+    def T(self) -> ChunkedMemmap:
+        return self.source
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        frames, pixels = key if isinstance(key, tuple) else (key, slice(None))
+        return self.source[pixels, frames].T
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(self.source, dtype=dtype).T
+
+    def reshape(self, shape, order='C'):
+        shape = tuple(shape)
+        if order == 'F' and shape[0] == self.shape[0] and shape[1:] == self.source.dims:
+            return ChunkedMovie(self.source)
+        return np.array(self).reshape(shape, order=order)
+
+
+class ChunkedMovie(object):
+    """ Frames x d1 x d2[ x d3] view of a ChunkedMemmap, as the movie reshaped from a memmap
+
+    Slicing with steps of one along the spatial dimensions returns a view, and only
+    the chunks overlapping the view are read when it is converted to an array.
+    Other operations read the view first.
+    """
+
+    def __init__(self, source: ChunkedMemmap, frames: Optional[range] = None, box: Optional[Tuple] = None):
+        self.source = source
+        self.filename = source.filename
+        self.frames = range(source.n_frames) if frames is None else frames
+        self.box = tuple(range(d) for d in source.dims) if box is None else box
+        self.shape = (len(self.frames),) + tuple(len(b) for b in self.box)
+        self.dtype = source.dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        key = (key if isinstance(key, tuple) else (key,))
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) == self.ndim and all(isinstance(k, slice) for k in key):
+            ranges = [r[k] for r, k in zip((self.frames,) + self.box, key)]
+            if ranges[0].step > 0 and all(r.step == 1 for r in ranges[1:]):
+                return ChunkedMovie(self.source, ranges[0], tuple(ranges[1:]))
+        return np.array(self)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        frames = slice(self.frames.start, self.frames.start + len(self.frames) * self.frames.step,
+                       self.frames.step)
+        Y = self.source.read_box([slice(b.start, b.start + len(b)) for b in self.box], frames)
+        return Y if dtype is None else Y.astype(dtype)
+
+    def reshape(self, shape, order='C'):
+        shape = tuple(shape)
+        if order == 'F' and self.shape == (self.source.n_frames,) + self.source.dims and \
+                shape in ((self.shape[0], -1), self.source.T.shape):
+            return ChunkedFrames(self.source)
+        return np.array(self).reshape(shape, order=order)
+
+    def transpose(self, *axes):
+        return np.array(self).transpose(*axes)
+
+
+def save_memmap_chunked(filenames: List[str],
+                        base_name: str = 'Yr',
+                        resize_fact: Tuple = (1, 1, 1),
+                        remove_init: int = 0,
+                        var_name_hdf5: str = 'mov',
+                        is_3D: bool = False,
+                        add_to_movie: float = 0,
+                        dtype: str = 'float32',
+                        compression: str = 'gzip',
+                        tile_shape: Tuple = (64, 64, 16),
+                        frames_per_chunk: int = 64) -> str:
+    """ Write data from a list of movie files into a chunked, compressed file readable with load_memmap
+
+    The values returned by load_memmap/cm.load are the same as for save_memmap
+    (including the 0.0001 + add_to_movie offset), but the movie is stored in
+    chunks of frames_per_chunk frames by tile_shape pixels with a lossless codec.
+
+    Args:
+        filenames: list
+            list of movie files or list of numpy arrays
+
+        base_name: str
+            the base used to build the file name. IT MUST NOT CONTAIN "_"
+
+        resize_fact: tuple
+            x,y, and z downsampling factors (0.5 means downsampled by a factor 2)
+
+        remove_init: int
+            number of frames to remove at the begining of each file
+
+        is_3D: boolean
+            whether it is 3D data
+
+        add_to_movie: floating-point
+            value to add to each image point, typically to keep negative values out.
+
+        dtype: str
+            storage type. 'uint16' (and the other integer types) is lossless for integer
+            raw data, values are rounded and clipped otherwise. 'float16' halves the
+            size of float32 at reduced precision
+
+        compression: str
+            lossless h5py codec, 'gzip' or 'lzf' (None to disable)
+
+        tile_shape: tuple
+            spatial size of the chunks
+
+        frames_per_chunk: int
+            number of frames in each chunk
+
+    Returns:
+        fname_new: the name of the file, the format is such that
+            the name will contain the frame dimensions and the number of frames
+    """
+    if type(filenames) is not list:
+        raise Exception('input should be a list of filenames')
+
+    dtype = np.dtype(dtype)
+    fname_tmp = None
+    Ttot = 0
+    for idx, f in enumerate(filenames):
+        if isinstance(f, basestring) or isinstance(f, list):
+            Y = cm.load(f, fr=1, in_memory=True, var_name_hdf5=var_name_hdf5, is3D=is_3D)
+        else:
+            Y = cm.movie(f, fr=1)
+        Y = Y[remove_init:]
+        fx, fy, fz = resize_fact
+        if fx != 1 or fy != 1 or fz != 1:
+            Y = Y.resize(fx=fx, fy=fy, fz=fz)
+        Y = np.asarray(Y)
+        if dtype.kind in 'iu':
+            info = np.iinfo(dtype)
+            Y_store = np.clip(np.round(Y), info.min, info.max).astype(dtype)
+            if not np.array_equal(Y_store, Y):
+                logging.warning('Storing non integer values as ' + str(dtype) + ', they will be rounded')
+        else:
+            Y_store = Y.astype(dtype)
+
+        T, dims = Y.shape[0], Y.shape[1:]
+        if idx == 0:
+            fname_tmp = base_name + '_chunked_tmp'
+            if isinstance(f, str):
+                fname_tmp = os.path.join(os.path.split(f)[0], fname_tmp)
+            file_out = h5py.File(fname_tmp, 'w')
+            chunks = (max(1, min(frames_per_chunk, T)),) + tuple(int(min(t, d)) for t, d in zip(tile_shape, dims))
+            dset = file_out.create_dataset('mov', shape=(0,) + dims, maxshape=(None,) + dims, dtype=dtype,
+                                           chunks=chunks, compression=compression,
+                                           shuffle=compression is not None)
+            dset.attrs['add_to_movie'] = np.float32(add_to_movie)
+        elif dims != dset.shape[1:]:
+            raise Exception('All the movies must have the same dimensions')
+
+        dset.resize(Ttot + T, axis=0)
+        dset[Ttot:Ttot + T] = Y_store
+        Ttot += T
+
+    file_out.close()
+    fname_new = os.path.join(os.path.split(fname_tmp)[0],
+                             memmap_frames_filename(os.path.split(base_name)[-1], dims, Ttot, 'C', '.cmmap'))
+    try:
+        # need to explicitly remove destination on windows
+        os.unlink(fname_new)
+    except OSError:
+        pass
+    os.rename(fname_tmp, fname_new)
+    return fname_new
+
+
 #%%
 
 
 def parallel_dot_product(A: np.ndarray, b, block_size: int = 5000, dview=None, transpose=False,
-                         num_blocks_per_run=20) -> np.ndarray:
-    # todo: todocument
+                         num_blocks_per_run=20, n_threads: int = None) -> np.ndarray:
     """ Chunk matrix product between matrix and column vectors
 
+    Computes A.dot(b), or A.T.dot(b) if transpose, streaming contiguous blocks
+    of block_size rows of A. Without dview the blocks are processed by a pool
+    of threads working directly on A (the products run in BLAS or scipy.sparse
+    outside of the GIL), with dview each task loads its block from the memory
+    mapped file. The threads share the cores with BLAS: when threadpoolctl is
+    installed each BLAS call is limited to its share of them.
+
     Args:
         A: memory mapped ndarray
             pixels x time
 
-        b: time x comps
-    """
+        b: time x comps, or pixels x comps if transpose. Dense or sparse
 
-    import pickle
-    pars = []
+        block_size: int
+            number of rows of A in each block
+
+        dview: cluster handle
+            if None the blocks are processed by threads in this process
+
+        transpose: bool
+            if True computes A.T.dot(b)
+
+        num_blocks_per_run: int
+            number of blocks sent to dview at once
+
+        n_threads: int
+            number of threads used without dview, default 4 (at most the number of cores)
+
+    Returns:
+        output: np.ndarray float32
+            pixels x comps, or time x comps if transpose
+    """
     d1, d2 = np.shape(A)
-    b = pickle.dumps(b)
+    K = np.shape(b)[-1]
+    b = _prepare_dot_operand(b, transpose)
+    blocks = [(start, min(start + block_size, d1)) for start in range(0, d1, block_size)]
     logging.debug('parallel dot product block size: ' + str(block_size))
 
-    if block_size < d1:
-        for idx in range(0, d1 - block_size, block_size):
-            idx_to_pass = list(range(idx, idx + block_size))
-            pars.append([A.filename, idx_to_pass, b, transpose])
+    if dview is None:
+        n_cores = os.cpu_count() or 1
+        n_threads = max(1, min(n_threads or min(_dot_threads, n_cores), len(blocks)))
+        if transpose:
+            # the products of the blocks are added to a single output as they come
+            output = np.zeros((d2, K), dtype=np.float32)
+            lock = threading.Lock()
+
+            def accumulate(block):
+                res = _dot_block(A, b, *block, transpose=True)
+                with lock:
+                    np.add(output, res, out=output)
+        else:
+            output = np.zeros((d1, K), dtype=np.float32)
+
+            def accumulate(block):
+                output[block[0]:block[1]] = _dot_block(A, b, *block, transpose=False)
 
-        if (idx + block_size) < d1:
-            idx_to_pass = list(range(idx + block_size, d1))
-            pars.append([A.filename, idx_to_pass, b, transpose])
+        with (threadpool_limits(limits=max(1, n_cores // n_threads), user_api='blas')
+              if HAS_THREADPOOLCTL and n_threads > 1 else nullcontext()):
+            with ThreadPoolExecutor(n_threads) as executor:
+                list(executor.map(accumulate, blocks))
+        return output
 
+    if isinstance(dview, SharedMemoryPool):
+        b_ = dview.share(b)    # published once instead of pickled in every block
     else:
-        idx_to_pass = list(range(d1))
-        pars.append([A.filename, idx_to_pass, b, transpose])
+        b_ = pickle.dumps(b)
+    pars = [[A.filename, block, b_, transpose] for block in blocks]
 
     logging.debug('Start product')
-    b = pickle.loads(b)
-
     if transpose:
-        output = np.zeros((d2, np.shape(b)[-1]), dtype=np.float32)
+        output = np.zeros((d2, K), dtype=np.float32)
     else:
-        output = np.zeros((d1, np.shape(b)[-1]), dtype=np.float32)
+        output = np.zeros((d1, K), dtype=np.float32)
+
+    for itera in range(0, len(pars), num_blocks_per_run):
+
+        if is_local_pool(dview):
+            results = dview.map_async(dot_place_holder, pars[itera:itera + num_blocks_per_run]).get(4294967)
+        else:
+            results = dview.map_sync(dot_place_holder, pars[itera:itera + num_blocks_per_run])
+
+        logging.debug('Processed:' + str([itera, itera + len(results)]))
 
-    if dview is None:
         if transpose:
-            #            b = pickle.loads(b)
             logging.debug('Transposing')
-            for _, pr in enumerate(pars):
-                iddx, rs = dot_place_holder(pr)
-                output = output + rs
-        else:
-            for _, pr in enumerate(pars):
-                iddx, rs = dot_place_holder(pr)
-                output[iddx] = rs
 
-    else:
-        for itera in range(0, len(pars), num_blocks_per_run):
+            for _, res in enumerate(results):
+                output += res[1]
 
-            if 'multiprocessing' in str(type(dview)):
-                results = dview.map_async(dot_place_holder, pars[itera:itera + num_blocks_per_run]).get(4294967)
-            else:
-                results = dview.map_sync(dot_place_holder, pars[itera:itera + num_blocks_per_run])
+        else:
+            logging.debug('Filling')
+            for res in results:
+                output[res[0][0]:res[0][1]] = res[1]
 
-            logging.debug('Processed:' + str([itera, itera + len(results)]))
+        if not is_local_pool(dview):
+            dview.clear()
+    release_array(dview, b_)
 
-            if transpose:
-                logging.debug('Transposing')
+    return output
 
-                for _, res in enumerate(results):
-                    output += res[1]
 
-            else:
-                logging.debug('Filling')
-                for res in results:
-                    output[res[0]] = res[1]
+def _prepare_dot_operand(b, transpose):
+    """float32 copy of b, sparse matrices in the format giving cheap blocks"""
+    if 'sparse' in str(type(b)):
+        # row blocks of b for A.T.dot(b), and b.T.dot(A.T) otherwise
+        return b.tocsr().astype(np.float32) if transpose else b.T.tocsr().astype(np.float32)
+    return np.asarray(b, dtype=np.float32)
 
-            if 'multiprocessing' not in str(type(dview)):
-                dview.clear()
 
-    return output
+def _dot_block(A, b, start, stop, transpose):
+    """product of the rows start:stop of A with b, see parallel_dot_product"""
+    A_ = A[start:stop]
+    if 'sparse' in str(type(b)):
+        if transpose:
+            return np.asarray(b[start:stop].T.dot(A_)).T
+        return np.asarray(b.dot(A_.T)).T    # b is already transposed
+    if transpose:
+        return A_.T.dot(b[start:stop])
+    return A_.dot(b)
 
 
 #%%
 def dot_place_holder(par: List) -> Tuple:
-    # todo: todocument
-
-    A_name, idx_to_pass, b_, transpose = par
+    """ To use map reduce, product of a block of rows of the memory mapped file
+    """
+    A_name, block, b_, transpose = par
     A_, _, _ = load_memmap(A_name)
-    b_ = pickle.loads(b_).astype(np.float32)
-
-    logging.debug((idx_to_pass[-1]))
-    if 'sparse' in str(type(b_)):
-        if transpose:
-            #            outp = (b_.tocsr()[idx_to_pass].T.dot(
-            #                A_[idx_to_pass])).T.astype(np.float32)
-            outp = (b_.T.tocsc()[:, idx_to_pass].dot(A_[idx_to_pass])).T.astype(np.float32)
-        else:
-            outp = (b_.T.dot(A_[idx_to_pass].T)).T.astype(np.float32)
-    else:
-        if transpose:
-            outp = A_[idx_to_pass].T.dot(b_[idx_to_pass]).astype(np.float32)
-        else:
-            outp = A_[idx_to_pass].dot(b_).astype(np.float32)
+    if isinstance(b_, bytes):
+        b_ = pickle.loads(b_)
+    b_ = get_shared(b_)
 
+    outp = _dot_block(A_, b_, *block, transpose=transpose).astype(np.float32)
     del b_, A_
-    return idx_to_pass, outp
+    return block, outp
 
 
 #%%
@@ -45,6 +45,7 @@ from builtins import str
 from builtins import range
 from past.utils import old_div
 import collections
+import copy
 import cv2
 import gc
 import h5py
@@ -53,9 +54,10 @@ import logging
 import numpy as np
 from numpy.fft import ifftshift
 import os
+import pathlib
 import pylab as pl
 import tifffile
-from typing import List, Optional
+from typing import Dict, List, Optional
 from skimage.transform import resize as resize_sk
 from skimage.transform import warp as warp_sk
 
@@ -63,7 +65,8 @@ import caiman as cm
 import caiman.base.movies
 import caiman.motion_correction
 from caiman.paths import memmap_frames_filename
-from .mmapping import prepare_shape
+from .mmapping import load_memmap, prepare_shape
+from .shared_multiprocessing import SharedArray, get_shared, is_local_pool, release_array, share_array
 
 try:
     cv2.setNumThreads(0)
@@ -210,7 +213,8 @@ class MotionCorrect(object):
         if self.use_cuda and not HAS_CUDA:
             logging.debug("pycuda is unavailable. Falling back to default FFT.")
 
-    def motion_correct(self, template=None, save_movie=False):
+    def motion_correct(self, template=None, save_movie=False, order='F', base_name=None,
+                       resize_fact=(1, 1, 1), border_to_0=0, add_to_movie=0):
         """general function for performing all types of motion correction. The
         function will perform either rigid or piecewise rigid motion correction
         depending on the attribute self.pw_rigid and will perform high pass
@@ -225,6 +229,31 @@ class MotionCorrect(object):
             save_movie: bool, default: False
                 flag for saving motion corrected file(s) as memory mapped file(s)
 
+            order: 'F' or 'C', default: 'F'
+                order of the saved memory mapped file(s). With 'F' one file per
+                input file is saved, which then needs to be converted with
+                save_memmap before running CNMF. With 'C' the corrected frames
+                of all the input files are written directly into a single C
+                order file that can be opened with load_memmap, skipping the
+                intermediate F order files.
+
+            base_name: str, default: None
+                base name of the C order memory mapped file. If None it is
+                derived from the name of the first file
+
+            resize_fact: tuple, default: (1, 1, 1)
+                x, y and time resizing factors applied before saving in C order
+                (same as in save_memmap)
+
+            border_to_0: int, default: 0
+                number of pixels on the border (along the first two dimensions)
+                to set to the minimum of each file + 1 when saving in C order
+                (same as in save_memmap)
+
+            add_to_movie: float, default: 0
+                value added to the movie when saving in C order (same as in
+                save_memmap)
+
         Returns:
             self
         """
@@ -240,8 +269,13 @@ class MotionCorrect(object):
                     for m_ in cm.load(self.fname[0], var_name_hdf5=self.var_name_hdf5,
                                       subindices=slice(400))]).min()
 
+        if save_movie and order == 'C':
+            memmap_C = self._prepare_memmap_C(base_name, resize_fact, add_to_movie)
+        else:
+            memmap_C = None
+
         if self.pw_rigid:
-            self.motion_correct_pwrigid(template=template, save_movie=save_movie)
+            self.motion_correct_pwrigid(template=template, save_movie=save_movie, memmap_C=memmap_C)
             if self.is3D:
                 # TODO - error at this point after saving
                 b0 = np.ceil(np.max([np.max(np.abs(self.x_shifts_els)),
@@ -251,13 +285,50 @@ class MotionCorrect(object):
                 b0 = np.ceil(np.maximum(np.max(np.abs(self.x_shifts_els)),
                                     np.max(np.abs(self.y_shifts_els))))
         else:
-            self.motion_correct_rigid(template=template, save_movie=save_movie)
+            self.motion_correct_rigid(template=template, save_movie=save_movie, memmap_C=memmap_C)
             b0 = np.ceil(np.max(np.abs(self.shifts_rig)))
         self.border_to_0 = b0.astype(np.int)
+        if memmap_C is not None:
+            if self.pw_rigid:
+                self.fname_tot_els = [memmap_C['fname']]
+            else:
+                self.fname_tot_rig = [memmap_C['fname']]
+            if border_to_0 > 0:
+                set_border_memmap(memmap_C['fname'], border_to_0, resize_fact, memmap_C['offsets'])
         self.mmap_file = self.fname_tot_els if self.pw_rigid else self.fname_tot_rig
         return self
 
-    def motion_correct_rigid(self, template=None, save_movie=False) -> None:
+    def _prepare_memmap_C(self, base_name, resize_fact, add_to_movie):
+        """Allocates the single C order memory mapped file that the corrected
+        frames of all the files are written to and computes the frame offset
+        of each file within it
+        """
+        splits = self.splits_els if self.pw_rigid else self.splits_rig
+        if type(splits) is not int:
+            raise Exception('Saving in C order requires an integer number of splits')
+        if self.is3D and tuple(resize_fact) != (1, 1, 1):
+            raise Exception('Resizing is not supported for 3D motion correction')
+
+        offsets = []
+        T_tot = 0
+        for fname_cur in self.fname:
+            dims, T = cm.source_extraction.cnmf.utilities.get_file_size(fname_cur, var_name_hdf5=self.var_name_hdf5)
+            dims = np.zeros(dims)[self.indices].shape
+            offsets.append(T_tot)
+            T_tot += np.sum(resized_chunk_lengths(np.array_split(range(T), splits), resize_fact[2]))
+
+        dims = resized_dims(dims, resize_fact)
+        if base_name is None:
+            base_name = pathlib.Path(self.fname[0]).stem + '_memmap_'
+        fname_tot = memmap_frames_filename(base_name, dims, T_tot, 'C')
+        fname_tot = os.path.join(os.path.split(self.fname[0])[0], fname_tot)
+        np.memmap(fname_tot, mode='w+', dtype=np.float32,
+                  shape=prepare_shape((np.prod(dims), T_tot)), order='C')
+        logging.info('Saving file as {}'.format(fname_tot))
+        return {'fname': fname_tot, 'offsets': offsets, 'resize_fact': resize_fact,
+                'add_to_movie': add_to_movie}
+
+    def motion_correct_rigid(self, template=None, save_movie=False, memmap_C=None) -> None:
         """
         Perform rigid motion correction
 
@@ -268,6 +339,9 @@ class MotionCorrect(object):
             save_movie_rigid:Bool
                 save the movies vs just get the template
 
+            memmap_C: dict or None
+                C order memory mapped file to write into (see motion_correct)
+
         Important Fields:
             self.fname_tot_rig: name of the mmap file saved
 
@@ -284,7 +358,7 @@ class MotionCorrect(object):
         self.fname_tot_rig:List = []
         self.shifts_rig:List = []
 
-        for fname_cur in self.fname:
+        for file_idx, fname_cur in enumerate(self.fname):
             _fname_tot_rig, _total_template_rig, _templates_rig, _shifts_rig = motion_correct_batch_rigid(
                 fname_cur,
                 self.max_shifts,
@@ -302,7 +376,8 @@ class MotionCorrect(object):
                 border_nan=self.border_nan,
                 var_name_hdf5=self.var_name_hdf5,
                 is3D=self.is3D,
-                indices=self.indices)
+                indices=self.indices,
+                **_memmap_C_kwargs(memmap_C, file_idx))
             if template is None:
                 self.total_template_rig = _total_template_rig
 
@@ -310,7 +385,8 @@ class MotionCorrect(object):
             self.fname_tot_rig += [_fname_tot_rig]
             self.shifts_rig += _shifts_rig
 
-    def motion_correct_pwrigid(self, save_movie:bool=True, template:np.ndarray=None, show_template:bool=False) -> None:
+    def motion_correct_pwrigid(self, save_movie:bool=True, template:np.ndarray=None, show_template:bool=False,
+                               memmap_C:Optional[Dict]=None) -> None:
         """Perform pw-rigid motion correction
 
         Args:
@@ -323,6 +399,9 @@ class MotionCorrect(object):
             show_template: boolean
                 whether to show the updated template at each iteration
 
+            memmap_C: dict or None
+                C order memory mapped file to write into (see motion_correct)
+
         Important Fields:
             self.fname_tot_els: name of the mmap file saved
             self.templates_els: template updated by iterating  over the chunks
@@ -353,7 +432,7 @@ class MotionCorrect(object):
             self.z_shifts_els:List = []
 
         self.coord_shifts_els:List = []
-        for name_cur in self.fname:
+        for file_idx, name_cur in enumerate(self.fname):
             _fname_tot_els, new_template_els, _templates_els,\
                 _x_shifts_els, _y_shifts_els, _z_shifts_els, _coord_shifts_els = motion_correct_batch_pwrigid(
                     name_cur, self.max_shifts, self.strides, self.overlaps, -self.min_mov,
@@ -362,7 +441,7 @@ class MotionCorrect(object):
                     num_splits_to_process=None, num_iter=num_iter, template=self.total_template_els,
                     shifts_opencv=self.shifts_opencv, save_movie=save_movie, nonneg_movie=self.nonneg_movie, gSig_filt=self.gSig_filt,
                     use_cuda=self.use_cuda, border_nan=self.border_nan, var_name_hdf5=self.var_name_hdf5, is3D=self.is3D,
-                    indices=self.indices)
+                    indices=self.indices, **_memmap_C_kwargs(memmap_C, file_idx))
             if not self.is3D:
                 if show_template:
                     pl.imshow(new_template_els)
@@ -1127,7 +1206,7 @@ def motion_correct_parallel(file_names, fr=10, template=None, margins_out=0,
 
     try:
         if dview is not None:
-            if 'multiprocessing' in str(type(dview)):
+            if is_local_pool(dview):
                 file_res = dview.map_async(
                     process_movie_parallel, args_in).get(4294967)
             else:
@@ -1138,7 +1217,7 @@ def motion_correct_parallel(file_names, fr=10, template=None, margins_out=0,
 
     except:
         try:
-            if (dview is not None) and 'multiprocessing' not in str(type(dview)):
+            if (dview is not None) and not is_local_pool(dview):
                 dview.results.clear()
 
         except UnboundLocalError:
@@ -1749,6 +1828,160 @@ def register_translation(src_image, target_image, upsample_factor=1,
 
     return shifts, src_freq, _compute_phasediff(CCmax)
 
+
+def _upsampled_dft_batch(data, upsampled_region_size, upsample_factor, axis_offsets):
+    """
+    Batched version of _upsampled_dft for a stack of 2D arrays, each
+    upsampled around its own offset.
+
+    Args:
+        data: 3D ndarray
+            stack of DFTs (n x d1 x d2) to upsample
+
+        upsampled_region_size: int
+            size of the region to be sampled
+
+        upsample_factor: float
+            the upsampling factor
+
+        axis_offsets: ndarray
+            n x 2 offsets of the region to be sampled for each array
+
+    Returns:
+        output: 3D ndarray
+            stack of the upsampled DFTs of the specified regions
+    """
+    region = np.arange(upsampled_region_size)
+    row_freqs = ifftshift(np.arange(data.shape[1])) - np.floor(data.shape[1] / 2)
+    col_freqs = ifftshift(np.arange(data.shape[2])) - np.floor(data.shape[2] / 2)
+    row_kernel = np.exp((-1j * 2 * np.pi / (data.shape[1] * upsample_factor)) *
+                        (region[None, :, None] - axis_offsets[:, 0, None, None]) * row_freqs[None, None, :])
+    col_kernel = np.exp((-1j * 2 * np.pi / (data.shape[2] * upsample_factor)) *
+                        col_freqs[None, :, None] * (region[None, None, :] - axis_offsets[:, 1, None, None]))
+    return np.matmul(np.matmul(row_kernel, data), col_kernel)
+
+
+def register_translation_batch(src_images, target_images, upsample_factor=1, space="real",
+                               shifts_lb=None, shifts_ub=None, max_shifts=(10, 10)):
+    """
+    Batched version of register_translation for 2D images. All the pairs of
+    images in the stacks are registered at once: one stacked FFT, one
+    vectorized search of the cross-correlation maxima and one batched
+    upsampled DFT for the subpixel refinement, instead of one call (and one
+    FFT of the target) per pair. Used to register all the patches of a frame
+    in tile_and_correct.
+
+    Args:
+        src_images: 3D ndarray
+            stack (n x d1 x d2) of images to register
+
+        target_images: 3D ndarray
+            stack of reference images, one per image in src_images
+
+        upsample_factor: int, optional
+            Upsampling factor. Images will be registered to within
+            ``1 / upsample_factor`` of a pixel.
+
+        space: string, one of "real" or "fourier"
+            Whether the inputs are images or their (scaled) FFTs, as returned
+            by register_translation
+
+        shifts_lb, shifts_ub: array-like or None
+            lower and upper bounds of the shifts, shared by all the images
+
+        max_shifts: tuple
+            maximum shifts, used if shifts_lb and shifts_ub are not given
+
+    Returns:
+        shifts: ndarray
+            n x 2 shift vectors required to register each image in
+            ``src_images`` with its target
+
+        src_freq: ndarray
+            FFTs of the source images, scaled as in register_translation
+
+        phasediff: ndarray
+            Global phase difference between each pair of images
+    """
+    if src_images.shape != target_images.shape:
+        raise ValueError("Error: images must really be same size for "
+                         "register_translation_batch")
+    if src_images.ndim != 3:
+        raise NotImplementedError("Error: register_translation_batch only supports "
+                                  "stacks of 2D images")
+
+    n, d1, d2 = src_images.shape
+    shape = np.array((d1, d2))
+    if space.lower() == 'fourier':
+        src_freq = src_images
+        target_freq = target_images
+    elif space.lower() == 'real':
+        # same scaling as cv2.DFT_SCALE in register_translation
+        src_freq = np.fft.fft2(src_images) / (d1 * d2)
+        target_freq = np.fft.fft2(target_images) / (d1 * d2)
+    else:
+        raise ValueError("Error: register_translation_batch only knows the \"real\" "
+                         "and \"fourier\" values for the ``space`` argument.")
+
+    # Whole-pixel shift - Compute cross-correlation by an IFFT
+    image_product = src_freq * target_freq.conj()
+    cross_correlation = np.fft.ifft2(image_product)
+
+    # Locate maximum
+    new_cross_corr = np.abs(cross_correlation)
+    if (shifts_lb is not None) or (shifts_ub is not None):
+        if (shifts_lb[0] < 0) and (shifts_ub[0] >= 0):
+            new_cross_corr[:, shifts_ub[0]:shifts_lb[0], :] = 0
+        else:
+            new_cross_corr[:, :shifts_lb[0], :] = 0
+            new_cross_corr[:, shifts_ub[0]:, :] = 0
+
+        if (shifts_lb[1] < 0) and (shifts_ub[1] >= 0):
+            new_cross_corr[:, :, shifts_ub[1]:shifts_lb[1]] = 0
+        else:
+            new_cross_corr[:, :, :shifts_lb[1]] = 0
+            new_cross_corr[:, :, shifts_ub[1]:] = 0
+    else:
+        new_cross_corr[:, max_shifts[0]:-max_shifts[0], :] = 0
+        new_cross_corr[:, :, max_shifts[1]:-max_shifts[1]] = 0
+
+    maxima = np.stack(np.unravel_index(np.argmax(new_cross_corr.reshape(n, -1), axis=1),
+                                       (d1, d2)), axis=1)
+    midpoints = np.fix(shape / 2)
+    shifts = maxima.astype(np.float64)
+    shifts = np.where(shifts > midpoints, shifts - shape, shifts)
+
+    if upsample_factor == 1:
+        CCmax = cross_correlation.reshape(n, -1).max(1)
+    else:
+        # Initial shift estimate in upsampled grid
+        shifts = np.round(shifts * upsample_factor) / upsample_factor
+        upsampled_region_size = np.ceil(upsample_factor * 1.5)
+        # Center of output array at dftshift + 1
+        dftshift = np.fix(upsampled_region_size / 2.0)
+        upsample_factor = np.array(upsample_factor, dtype=np.float64)
+        normalization = (d1 * d2 * upsample_factor ** 2)
+        # Matrix multiply DFT around the current shift estimates
+        sample_region_offset = dftshift - shifts * upsample_factor
+        cross_correlation = _upsampled_dft_batch(image_product.conj(),
+                                                 int(upsampled_region_size),
+                                                 upsample_factor,
+                                                 sample_region_offset).conj()
+        cross_correlation /= normalization
+        # Locate maxima and map back to original pixel grid
+        cc = cross_correlation.reshape(n, -1)
+        maxima = np.stack(np.unravel_index(np.argmax(np.abs(cc), axis=1),
+                                           cross_correlation.shape[1:]), axis=1).astype(np.float64)
+        maxima -= dftshift
+        shifts = shifts + maxima / upsample_factor
+        CCmax = cc.max(1)
+
+    # If its only one row or column the shift along that dimension has no
+    # effect. We set to zero.
+    shifts[:, shape == 1] = 0
+
+    return shifts, src_freq, _compute_phasediff(CCmax)
+
 #%%
 
 def apply_shifts_dft(src_freq, shifts, diffphase, is_freq=True, border_nan=True):
@@ -1985,6 +2218,138 @@ def create_weight_matrix_for_blending(img, overlaps, strides):
 
         yield weight_mat
 
+def _registration_fft(img, is3D=False):
+    """FFT of an image as computed in register_translation (2D) or
+    register_translation_3d (3D) for real space inputs"""
+    if is3D:
+        return np.fft.fftn(np.array(img, dtype=np.complex64, copy=False))
+    freq = fftn(img, flags=cv2.DFT_COMPLEX_OUTPUT + cv2.DFT_SCALE)
+    return np.array(freq[:, :, 0] + 1j * freq[:, :, 1], dtype=np.complex128, copy=False)
+
+
+class RegistrationTemplate(object):
+    """
+    Template for registration together with the quantities that only depend
+    on it: its FFT, the FFTs of its patches, the blending weights of the
+    patches and the sampling grid used for remapping. They are computed once
+    per template, the first time they are needed, and reused for all the
+    frames registered against it. It can be passed in place of the template
+    to tile_and_correct and tile_and_correct_3d.
+    """
+
+    def __init__(self, template, add_to_movie=0, gSig_filt=None, is3D=False):
+        """
+        Args:
+            template: ndarray 2D (or 3D)
+                reference image
+
+            add_to_movie: float
+                value added to the template (and to the frames) before registration
+
+            gSig_filt: tuple or None
+                if not None, size of the kernel used to high pass filter the
+                template. Leave to None if the template is already filtered
+
+            is3D: bool
+                flag for 3D templates
+        """
+        template = np.asarray(template, dtype=np.float64)
+        if gSig_filt is not None:
+            template = high_pass_filter_space(template, gSig_filt).astype(np.float64)
+        self.template = template
+        self.shape = template.shape
+        self.add_to_movie = add_to_movie
+        self.is3D = is3D
+        self.freq = _registration_fft(template + add_to_movie, is3D)
+        self._patches: Dict = {}
+        self._weights: Dict = {}
+        self._remap_grid = None
+
+    def patches(self, strides, overlaps):
+        """Grid coordinates, patches and FFTs of the patches of the template
+        (after adding add_to_movie)"""
+        key = (tuple(strides), tuple(overlaps))
+        if key not in self._patches:
+            if self.is3D:
+                windows = list(sliding_window_3d(self.template + self.add_to_movie,
+                                                 overlaps=overlaps, strides=strides))
+                grid = [it[:3] for it in windows]
+                patches = [it[-1] for it in windows]
+                patches_freq = [_registration_fft(patch, is3D=True) for patch in patches]
+            else:
+                windows = list(sliding_window(self.template + self.add_to_movie,
+                                              overlaps=overlaps, strides=strides))
+                grid = [it[:2] for it in windows]
+                patches = np.stack([it[-1] for it in windows])
+                patches_freq = np.fft.fft2(patches) / np.prod(patches.shape[1:])
+            self._patches[key] = (grid, patches, patches_freq)
+        return self._patches[key]
+
+    def blending_weights(self, newoverlaps, newstrides):
+        """Weights used to blend the corrected patches (2D only)"""
+        key = (tuple(newstrides), tuple(newoverlaps))
+        if key not in self._weights:
+            self._weights[key] = np.stack(list(create_weight_matrix_for_blending(
+                self.template, newoverlaps, newstrides)))
+        return self._weights[key]
+
+    def remap_grid(self):
+        """Sampling grid used to apply the shifts with cv2.remap (2D only)"""
+        if self._remap_grid is None:
+            dims = self.shape
+            self._remap_grid = np.meshgrid(np.arange(0., dims[1]).astype(
+                np.float32), np.arange(0., dims[0]).astype(np.float32))
+        return self._remap_grid
+
+    def prepare(self, strides, overlaps, max_deviation_rigid, shifts_opencv=False,
+                newoverlaps=None, newstrides=None, upsample_factor_grid=4):
+        """Compute upfront what tile_and_correct (or tile_and_correct_3d) needs
+        with these arguments, so that the object can be shipped to the workers
+        with everything computed"""
+        if max_deviation_rigid == 0:
+            return self
+        self.patches(strides, overlaps)
+        if not self.is3D:
+            if shifts_opencv:
+                self.remap_grid()
+            else:
+                if newoverlaps is None:
+                    newoverlaps = overlaps
+                if newstrides is None:
+                    newstrides = tuple(
+                        np.round(np.divide(strides, upsample_factor_grid)).astype(np.int))
+                self.blending_weights(newoverlaps, newstrides)
+        return self
+
+    def _map_arrays(self, f):
+        """copy of the object with f applied to each of its arrays"""
+        def apply(x):
+            if isinstance(x, (list, tuple)):
+                return type(x)(apply(it) for it in x)
+            if isinstance(x, dict):
+                return {key: apply(val) for key, val in x.items()}
+            if isinstance(x, (np.ndarray, SharedArray)):
+                return f(x)
+            return x
+
+        other = copy.copy(self)
+        for attr in ('template', 'freq', '_patches', '_weights', '_remap_grid'):
+            setattr(other, attr, apply(getattr(self, attr)))
+        return other
+
+    def share(self, dview):
+        """copy of the object with its arrays published with share_array, to pass to the tasks of dview"""
+        return self._map_arrays(lambda x: share_array(dview, x))
+
+    def attach(self):
+        """inverse of share, to call in the tasks"""
+        return self._map_arrays(get_shared)
+
+    def release(self, dview) -> None:
+        """release the arrays of an object returned by share"""
+        self._map_arrays(lambda x: release_array(dview, x))
+
+
 def high_pass_filter_space(img_orig, gSig_filt):
     ksize = tuple([(3 * i) // 2 * 2 + 1 for i in gSig_filt])
     ker = cv2.getGaussianKernel(ksize[0], gSig_filt[0])
@@ -2052,11 +2417,16 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
         (new_img, total_shifts, start_step, xy_grid)
             new_img: ndarray, corrected image
 
-
+    Notes:
+        template can also be a RegistrationTemplate, in which case the FFTs
+        of the template and of its patches are not recomputed.
     """
 
     img = img.astype(np.float64).copy()
-    template = template.astype(np.float64).copy()
+    if not isinstance(template, RegistrationTemplate):
+        template = RegistrationTemplate(template, add_to_movie=add_to_movie)
+    elif np.any(template.add_to_movie != add_to_movie):
+        raise Exception('The template was built with a different add_to_movie')
 
     if gSig_filt is not None:
 
@@ -2064,11 +2434,16 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
         img = high_pass_filter_space(img_orig, gSig_filt)
 
     img = img + add_to_movie
-    template = template + add_to_movie
 
     # compute rigid shifts
-    rigid_shts, sfr_freq, diffphase = register_translation(
-        img, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts, use_cuda=use_cuda)
+    if HAS_CUDA and use_cuda:
+        rigid_shts, sfr_freq, diffphase = register_translation(
+            img, template.template + add_to_movie, upsample_factor=upsample_factor_fft,
+            max_shifts=max_shifts, use_cuda=use_cuda)
+    else:
+        rigid_shts, sfr_freq, diffphase = register_translation(
+            _registration_fft(img), template.freq, upsample_factor=upsample_factor_fft,
+            space='fourier', max_shifts=max_shifts)
 
     if max_deviation_rigid == 0:
 
@@ -2091,10 +2466,7 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
         return new_img - add_to_movie, (-rigid_shts[0], -rigid_shts[1]), None, None
     else:
         # extract patches
-        templates = [
-            it[-1] for it in sliding_window(template, overlaps=overlaps, strides=strides)]
-        xy_grid = [(it[0], it[1]) for it in sliding_window(
-            template, overlaps=overlaps, strides=strides)]
+        xy_grid, templates, templates_freq = template.patches(strides, overlaps)
         num_tiles = np.prod(np.add(xy_grid[-1], 1))
         imgs = [it[-1]
                 for it in sliding_window(img, overlaps=overlaps, strides=strides)]
@@ -2113,11 +2485,18 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
             ub_shifts = None
 
         # extract shifts for each patch
-        shfts_et_all = [register_translation(
-            a, b, c, shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts, use_cuda=use_cuda) for a, b, c in zip(
-            imgs, templates, [upsample_factor_fft] * num_tiles)]
-        shfts = [sshh[0] for sshh in shfts_et_all]
-        diffs_phase = [sshh[2] for sshh in shfts_et_all]
+        if HAS_CUDA and use_cuda:
+            shfts_et_all = [register_translation(
+                a, b, c, shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts, use_cuda=use_cuda) for a, b, c in zip(
+                imgs, templates, [upsample_factor_fft] * num_tiles)]
+            shfts = [sshh[0] for sshh in shfts_et_all]
+            diffs_phase = [sshh[2] for sshh in shfts_et_all]
+        else:
+            # all the patches are registered at once
+            imgs = np.stack(imgs)
+            shfts, _, diffs_phase = register_translation_batch(
+                np.fft.fft2(imgs) / np.prod(imgs.shape[1:]), templates_freq, upsample_factor_fft,
+                space='fourier', shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts)
         # create a vector field
         shift_img_x = np.reshape(np.array(shfts)[:, 0], dim_grid)
         shift_img_y = np.reshape(np.array(shfts)[:, 1], dim_grid)
@@ -2128,8 +2507,7 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
                 img = img_orig
 
             dims = img.shape
-            x_grid, y_grid = np.meshgrid(np.arange(0., dims[1]).astype(
-                np.float32), np.arange(0., dims[0]).astype(np.float32))
+            x_grid, y_grid = template.remap_grid()
             m_reg = cv2.remap(img, cv2.resize(shift_img_y.astype(np.float32), dims[::-1]) + x_grid,
                               cv2.resize(shift_img_x.astype(np.float32), dims[::-1]) + y_grid,
                               cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
@@ -2187,8 +2565,7 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
         normalizer = np.zeros_like(img) * np.nan
         new_img = np.zeros_like(img) * np.nan
 
-        weight_matrix = create_weight_matrix_for_blending(
-            img, newoverlaps, newstrides)
+        weight_matrix = template.blending_weights(newoverlaps, newstrides)
 
         if max_shear < 0.5:
             for (x, y), (_, _), im, (_, _), weight_mat in zip(start_step, xy_grid, imgs, total_shifts, weight_matrix):
@@ -2230,7 +2607,7 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
 
             img_show = cv2.resize(img_show, None, fx=1, fy=1)
 
-            cv2.imshow('frame', old_div(img_show, np.percentile(template, 99)))
+            cv2.imshow('frame', old_div(img_show, np.percentile(template.template, 99)))
             cv2.waitKey(int(1. / 500 * 1000))
 
         else:
@@ -2302,7 +2679,10 @@ def tile_and_correct_3d(img, template, strides, overlaps, max_shifts, newoverlap
     """
 
     img = img.astype(np.float64).copy()
-    template = template.astype(np.float64).copy()
+    if not isinstance(template, RegistrationTemplate):
+        template = RegistrationTemplate(template, add_to_movie=add_to_movie, is3D=True)
+    elif np.any(template.add_to_movie != add_to_movie):
+        raise Exception('The template was built with a different add_to_movie')
 
     if gSig_filt is not None:
 
@@ -2310,11 +2690,11 @@ def tile_and_correct_3d(img, template, strides, overlaps, max_shifts, newoverlap
         img = high_pass_filter_space(img_orig, gSig_filt)
 
     img = img + add_to_movie
-    template = template + add_to_movie
 
     # compute rigid shifts
     rigid_shts, sfr_freq, diffphase = register_translation_3d(
-        img, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts)
+        _registration_fft(img, is3D=True), template.freq, upsample_factor=upsample_factor_fft,
+        space='fourier', max_shifts=max_shifts)
 
     if max_deviation_rigid == 0: # if rigid shifts only
 
@@ -2332,10 +2712,7 @@ def tile_and_correct_3d(img, template, strides, overlaps, max_shifts, newoverlap
         return new_img - add_to_movie, (-rigid_shts[0], -rigid_shts[1], -rigid_shts[2]), None, None
     else:
         # extract patches
-        templates = [
-            it[-1] for it in sliding_window_3d(template, overlaps=overlaps, strides=strides)]
-        xyz_grid = [(it[0], it[1], it[2]) for it in sliding_window_3d(
-            template, overlaps=overlaps, strides=strides)]
+        xyz_grid, _, templates_freq = template.patches(strides, overlaps)
         num_tiles = np.prod(np.add(xyz_grid[-1], 1))
         imgs = [it[-1]
                 for it in sliding_window_3d(img, overlaps=overlaps, strides=strides)]
@@ -2355,8 +2732,9 @@ def tile_and_correct_3d(img, template, strides, overlaps, max_shifts, newoverlap
 
         # extract shifts for each patch
         shfts_et_all = [register_translation_3d(
-            a, b, c, shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts) for a, b, c in zip(
-            imgs, templates, [upsample_factor_fft] * num_tiles)]
+            _registration_fft(a, is3D=True), b, c, space='fourier', shifts_lb=lb_shifts,
+            shifts_ub=ub_shifts, max_shifts=max_shifts) for a, b, c in zip(
+            imgs, templates_freq, [upsample_factor_fft] * num_tiles)]
         shfts = [sshh[0] for sshh in shfts_et_all]
         diffs_phase = [sshh[2] for sshh in shfts_et_all]
         # create a vector field
@@ -2486,7 +2864,7 @@ def tile_and_correct_3d(img, template, strides, overlaps, max_shifts, newoverlap
 
             img_show = resize_sk(img_show, None, fx=1, fy=1, fz=1)
 
-            cv2.imshow('frame', old_div(img_show, np.percentile(template, 99)))
+            cv2.imshow('frame', old_div(img_show, np.percentile(template.template, 99)))
             cv2.waitKey(int(1. / 500 * 1000))
 
         else:
@@ -2598,7 +2976,8 @@ def compute_metrics_motion_correction(fname, final_size_x, final_size_y, swap_di
 def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_splits_to_process=None, num_iter=1,
                                template=None, shifts_opencv=False, save_movie_rigid=False, add_to_movie=None,
                                nonneg_movie=False, gSig_filt=None, subidx=slice(None, None, 1), use_cuda=False,
-                               border_nan=True, var_name_hdf5='mov', is3D=False, indices=(slice(None), slice(None))):
+                               border_nan=True, var_name_hdf5='mov', is3D=False, indices=(slice(None), slice(None)),
+                               order='F', fname_tot=None, frame_offset=0, resize_fact=(1, 1, 1), add_to_memmap=0):
     """
     Function that perform memory efficient hyper parallelized rigid motion corrections while also saving a memory mappable file
 
@@ -2639,6 +3018,9 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
         indices: tuple(slice), default: (slice(None), slice(None))
            Use that to apply motion correction only on a part of the FOV
 
+        order, fname_tot, frame_offset, resize_fact, add_to_memmap:
+           options for saving the movie, see motion_correction_piecewise
+
     Returns:
          fname_tot_rig: str
 
@@ -2717,7 +3099,8 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
                                                              dview=dview, save_movie=save_movie, base_name=base_name, subidx = subidx,
                                                              num_splits=num_splits_to_process, shifts_opencv=shifts_opencv, nonneg_movie=nonneg_movie, gSig_filt=gSig_filt,
                                                              use_cuda=use_cuda, border_nan=border_nan, var_name_hdf5=var_name_hdf5, is3D=is3D,
-                                                             indices=indices)
+                                                             indices=indices, order=order, fname_tot=fname_tot, frame_offset=frame_offset,
+                                                             resize_fact=resize_fact, add_to_memmap=add_to_memmap)
         if is3D:
             new_templ = np.nanmedian(np.stack([r[-1] for r in res_rig]), 0)           
         else:
@@ -2747,7 +3130,8 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
                                  splits=56, num_splits_to_process=None, num_iter=1,
                                  template=None, shifts_opencv=False, save_movie=False, nonneg_movie=False, gSig_filt=None,
                                  use_cuda=False, border_nan=True, var_name_hdf5='mov', is3D=False,
-                                 indices=(slice(None), slice(None))):
+                                 indices=(slice(None), slice(None)), order='F', fname_tot=None, frame_offset=0,
+                                 resize_fact=(1, 1, 1), add_to_memmap=0):
     """
     Function that perform memory efficient hyper parallelized rigid motion corrections while also saving a memory mappable file
 
@@ -2797,6 +3181,9 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
         indices: tuple(slice), default: (slice(None), slice(None))
            Use that to apply motion correction only on a part of the FOV
 
+        order, fname_tot, frame_offset, resize_fact, add_to_memmap:
+           options for saving the movie, see motion_correction_piecewise
+
     Returns:
         fname_tot_rig: str
 
@@ -2846,11 +3233,12 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
                                                             add_to_movie=add_to_movie, template=old_templ, max_shifts=max_shifts,
                                                             max_deviation_rigid=max_deviation_rigid,
                                                             newoverlaps=newoverlaps, newstrides=newstrides,
-                                                            upsample_factor_grid=upsample_factor_grid, order='F', dview=dview, save_movie=save_movie,
+                                                            upsample_factor_grid=upsample_factor_grid, order=order, dview=dview, save_movie=save_movie,
                                                             base_name=base_name, num_splits=num_splits_to_process,
                                                             shifts_opencv=shifts_opencv, nonneg_movie=nonneg_movie, gSig_filt=gSig_filt,
                                                             use_cuda=use_cuda, border_nan=border_nan, var_name_hdf5=var_name_hdf5, is3D=is3D,
-                                                            indices=indices)
+                                                            indices=indices, fname_tot=fname_tot, frame_offset=frame_offset,
+                                                            resize_fact=resize_fact, add_to_memmap=add_to_memmap)
 
         new_templ = np.nanmedian(np.dstack([r[-1] for r in res_el]), -1)
         if gSig_filt is not None:
@@ -2905,8 +3293,8 @@ def tile_and_correct_wrapper(params):
     img_name, out_fname, idxs, shape_mov, template, strides, overlaps, max_shifts,\
         add_to_movie, max_deviation_rigid, upsample_factor_grid, newoverlaps, newstrides, \
         shifts_opencv, nonneg_movie, gSig_filt, is_fiji, use_cuda, border_nan, var_name_hdf5, \
-        is3D, indices = params
-
+        is3D, indices, order, out_idxs, resize_fact, add_to_memmap = params
+    template = template.attach()
 
     if isinstance(img_name,tuple):
         name, extension = os.path.splitext(img_name[0])[:2]
@@ -2915,11 +3303,13 @@ def tile_and_correct_wrapper(params):
     extension = extension.lower()
     shift_info = []
 
-    imgs = cm.load(img_name, subindices=idxs, var_name_hdf5=var_name_hdf5,is3D=is3D)
-    imgs = imgs[(slice(None),) + indices]
+    if extension == '.cmmap':
+        # only the chunks inside the field of view selected by indices are read
+        imgs = cm.movie(load_memmap(img_name)[0].read_box(indices, idxs), fr=1)
+    else:
+        imgs = cm.load(img_name, subindices=idxs, var_name_hdf5=var_name_hdf5,is3D=is3D)
+        imgs = imgs[(slice(None),) + indices]
     mc = np.zeros(imgs.shape, dtype=np.float32)
-    if not imgs[0].shape == template.shape:
-        template = template[indices]
     for count, img in enumerate(imgs):
         if count % 10 == 0:
             logging.debug(count)
@@ -2947,13 +3337,25 @@ def tile_and_correct_wrapper(params):
 
     if out_fname is not None:
         outv = np.memmap(out_fname, mode='r+', dtype=np.float32,
-                         shape=prepare_shape(shape_mov), order='F')
+                         shape=prepare_shape(shape_mov), order=order)
         if nonneg_movie:
             bias = np.float32(add_to_movie)
         else:
             bias = 0
-        outv[:, idxs] = np.reshape(
-            mc.astype(np.float32), (len(imgs), -1), order='F').T + bias
+        if order == 'C':
+            # frames go straight to their final place in the C order file,
+            # with the same processing save_memmap would apply
+            mc_out = mc
+            fx, fy, fz = resize_fact
+            if fx != 1 or fy != 1 or fz != 1:
+                mc_out = cm.movie(mc, fr=1).resize(fx=fx, fy=fy, fz=fz)
+            outv[:, out_idxs] = np.reshape(
+                mc_out.astype(np.float32), (len(mc_out), -1), order='F').T + \
+                (bias + np.float32(0.0001) + np.float32(add_to_memmap))
+        else:
+            outv[:, out_idxs] = np.reshape(
+                mc.astype(np.float32), (len(imgs), -1), order='F').T + bias
+        del outv
     new_temp = np.nanmean(mc, 0)
     new_temp[np.isnan(new_temp)] = np.nanmin(new_temp)
     return shift_info, idxs, new_temp
@@ -2963,9 +3365,14 @@ def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0
                                 upsample_factor_grid=4, order='F', dview=None, save_movie=True,
                                 base_name=None, subidx = None, num_splits=None, shifts_opencv=False, nonneg_movie=False, gSig_filt=None,
                                 use_cuda=False, border_nan=True, var_name_hdf5='mov', is3D=False,
-                                indices=(slice(None), slice(None))):
+                                indices=(slice(None), slice(None)), fname_tot=None, frame_offset=0,
+                                resize_fact=(1, 1, 1), add_to_memmap=0):
     """
 
+    If order is 'C' the corrected frames are written in the final C order
+    layout used by CNMF, resized by resize_fact and offset by add_to_memmap as
+    save_memmap would do. The frames are written from frame_offset onwards in
+    the existing file fname_tot, or in a new file if fname_tot is None.
     """
     # todo todocument
     if isinstance(fname,tuple):
@@ -2992,6 +3399,15 @@ def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0
         save_movie = False
     if template is None:
         raise Exception('Not implemented')
+    if not isinstance(template, RegistrationTemplate):
+        template = np.asarray(template)
+        if template.shape != dims:
+            template = template[indices]
+        # FFTs of the template and of its patches are computed once for all the chunks
+        template = RegistrationTemplate(template, add_to_movie=add_to_movie, is3D=is3D)
+    template.prepare(strides, overlaps, max_deviation_rigid, shifts_opencv=shifts_opencv,
+                     newoverlaps=newoverlaps, newstrides=newstrides,
+                     upsample_factor_grid=upsample_factor_grid)
     
     shape_mov = (np.prod(dims), T)
 #    if is3D:
@@ -3003,40 +3419,114 @@ def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0
         save_movie = False
         #logging.warning('**** MOVIE NOT SAVED BECAUSE num_splits is not None ****')
 
+    out_idxs = list(idxs)
     if save_movie:
-        if base_name is None:
-            base_name = os.path.split(fname)[1][:-4]
-        fname_tot:Optional[str] = memmap_frames_filename(base_name, dims, T, order)
-        if isinstance(fname,tuple):
-            fname_tot = os.path.join(os.path.split(fname[0])[0], fname_tot)
-        else:
-            fname_tot = os.path.join(os.path.split(fname)[0], fname_tot)
+        if order == 'C':
+            if is3D and tuple(resize_fact) != (1, 1, 1):
+                raise Exception('Resizing is not supported for 3D motion correction')
+            chunk_ends = frame_offset + np.cumsum(resized_chunk_lengths(idxs, resize_fact[2]))
+            out_idxs = [slice(end - n, end) for end, n in
+                        zip(chunk_ends, resized_chunk_lengths(idxs, resize_fact[2]))]
+            dims = resized_dims(dims, resize_fact)
+            if fname_tot is None:
+                shape_mov = (np.prod(dims), int(chunk_ends[-1]))
+            else:
+                Yr, _, T_tot = load_memmap(fname_tot)
+                shape_mov = (Yr.shape[0], T_tot)
+                del Yr
+        if fname_tot is None:
+            if base_name is None:
+                base_name = os.path.split(fname)[1][:-4]
+            fname_tot = memmap_frames_filename(base_name, dims, shape_mov[-1], order)
+            if isinstance(fname,tuple):
+                fname_tot = os.path.join(os.path.split(fname[0])[0], fname_tot)
+            else:
+                fname_tot = os.path.join(os.path.split(fname)[0], fname_tot)
 
-        np.memmap(fname_tot, mode='w+', dtype=np.float32,
-                  shape=prepare_shape(shape_mov), order=order)
-        logging.info('Saving file as {}'.format(fname_tot))
+            np.memmap(fname_tot, mode='w+', dtype=np.float32,
+                      shape=prepare_shape(shape_mov), order=order)
+            logging.info('Saving file as {}'.format(fname_tot))
     else:
         fname_tot = None
 
+    # published once in shared memory when the pool supports it
+    template_ = template.share(dview)
     pars = []
-    for idx in idxs:
+    for idx, out_idx in zip(idxs, out_idxs):
         logging.debug('Processing: frames: {}'.format(idx))
-        pars.append([fname, fname_tot, idx, shape_mov, template, strides, overlaps, max_shifts, np.array(
+        pars.append([fname, fname_tot, idx, shape_mov, template_, strides, overlaps, max_shifts, np.array(
             add_to_movie, dtype=np.float32), max_deviation_rigid, upsample_factor_grid,
             newoverlaps, newstrides, shifts_opencv, nonneg_movie, gSig_filt, is_fiji,
-            use_cuda, border_nan, var_name_hdf5, is3D, indices])
+            use_cuda, border_nan, var_name_hdf5, is3D, indices, order, out_idx,
+            resize_fact, add_to_memmap])
 
     if dview is not None:
         logging.info('** Starting parallel motion correction **')
         if HAS_CUDA and use_cuda:
             res = dview.map(tile_and_correct_wrapper,pars)
             dview.map(close_cuda_process, range(len(pars)))
-        elif 'multiprocessing' in str(type(dview)):
+        elif is_local_pool(dview):
             res = dview.map_async(tile_and_correct_wrapper, pars).get(4294967)
         else:
             res = dview.map_sync(tile_and_correct_wrapper, pars)
         logging.info('** Finished parallel motion correction **')
     else:
         res = list(map(tile_and_correct_wrapper, pars))
+    template_.release(dview)
 
     return fname_tot, res
+
+
+def resized_dims(dims, resize_fact):
+    """Dimensions of a frame after spatial resizing with movie.resize"""
+    fx, fy, _ = resize_fact
+    if fx == 1 and fy == 1:
+        return tuple(dims)
+    return (int(dims[0] * fx), int(dims[1] * fy)) + tuple(dims[2:])
+
+
+def resized_chunk_lengths(idxs, fz):
+    """Number of frames of each chunk of frames after temporal resizing with
+    movie.resize"""
+    if fz == 1:
+        return [len(idx) for idx in idxs]
+    return [max(1, int(fz * len(idx))) for idx in idxs]
+
+
+def set_border_memmap(fname, border_to_0, resize_fact, offsets):
+    """Sets the pixels on the border of a C order memory mapped file to the
+    minimum of the movie + 1, as save_memmap does with border_to_0 (see
+    movie.calc_min). save_memmap converts each file on its own, so the minimum
+    is computed separately over the frames of each file, which start at offsets.
+    Only the rows of the border pixels are written.
+    """
+    Yr, dims, T = load_memmap(fname, mode='r+')
+    offsets = np.asarray(offsets, dtype=int)
+    # minimum of the frames of each file, reading blocks of pixels
+    block = max(1, 2**27 // (4 * T))
+    min_mov = np.full(len(offsets), np.inf, dtype=np.float32)
+    for p in range(0, Yr.shape[0], block):
+        np.fmin(min_mov, np.fmin.reduceat(Yr[p:p + block], offsets, axis=1).min(0), out=min_mov)
+    bx = int(np.ceil(border_to_0 * resize_fact[0]))
+    by = int(np.ceil(border_to_0 * resize_fact[1]))
+    mask = np.zeros(dims, dtype=bool)
+    mask[:bx] = True
+    mask[-bx:] = True
+    mask[:, :by] = True
+    mask[:, -by:] = True
+    rows = np.where(mask.flatten(order='F'))[0]
+    for t0, t1, value in zip(offsets, list(offsets[1:]) + [T], min_mov + 1):
+        Yr[rows, t0:t1] = value
+    Yr.flush()
+    del Yr
+
+
+def _memmap_C_kwargs(memmap_C, file_idx):
+    """Keyword arguments for the batch motion correction functions to write
+    file number file_idx into the C order file described by memmap_C"""
+    if memmap_C is None:
+        return {}
+    return {'order': 'C', 'fname_tot': memmap_C['fname'],
+            'frame_offset': memmap_C['offsets'][file_idx],
+            'resize_fact': memmap_C['resize_fact'],
+            'add_to_memmap': memmap_C['add_to_movie']}
@@ -33,7 +33,7 @@ def caiman_datadir_exists() -> bool:
 # In the future we may consistently store these somewhere under the caiman_datadir
 
 
-def memmap_frames_filename(basename: str, dims: Tuple, frames: int, order: str = 'F') -> str:
+def memmap_frames_filename(basename: str, dims: Tuple, frames: int, order: str = 'F', extension: str = '.mmap') -> str:
     # Some functions calling this have the first part of *their* dims Tuple be the number of frames.
     # They *must* pass a slice to this so dims is only X, Y, and optionally Z. Frames is passed separately.
     dimfield_0 = dims[0]
@@ -42,4 +42,4 @@ def memmap_frames_filename(basename: str, dims: Tuple, frames: int, order: str =
         dimfield_2 = dims[2]
     else:
         dimfield_2 = 1
-    return f"{basename}_d1_{dimfield_0}_d2_{dimfield_1}_d3_{dimfield_2}_order_{order}_frames_{frames}_.mmap"
+    return f"{basename}_d1_{dimfield_0}_d2_{dimfield_1}_d3_{dimfield_2}_order_{order}_frames_{frames}_{extension}"
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" multiprocessing pool that publishes large read-only arrays in shared memory
+
+The arrays (templates, spatial and temporal components, noise maps...) are
+copied once into a shared memory block and the tasks only carry a small
+handle, instead of pickling the whole array into every task.
+
+The pool is a multiprocessing.pool.Pool, so that is_local_pool treats it as the
+standard pool.
+"""
+
+from collections import OrderedDict
+import logging
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.pool import Pool
+import numpy as np
+import scipy.sparse
+from typing import Dict, List
+import weakref
+
+logger = logging.getLogger(__name__)
+
+# shared memory blocks attached by the current process, most recent last, and the
+# arrays built on each of them (numpy keeps no buffer export, so a block must
+# not be closed while one of its arrays is alive)
+_attached: Dict[str, shared_memory.SharedMemory] = OrderedDict()
+_attached_arrays: Dict[str, List[weakref.ref]] = {}
+_max_attached = 16
+
+# number of tasks per worker when a job is split in blocks, a few for load balancing
+_blocks_per_worker = 4
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """attach to a published block, keeping a few of the last ones open"""
+    if name in _attached:
+        _attached.move_to_end(name)
+        return _attached[name]
+    for old_name in list(_attached)[:max(0, len(_attached) - _max_attached + 1)]:
+        if all(ref() is None for ref in _attached_arrays[old_name]):
+            _attached.pop(old_name).close()
+            del _attached_arrays[old_name]
+    _attached[name] = shared_memory.SharedMemory(name=name)
+    _attached_arrays[name] = []
+    return _attached[name]
+
+
+class SharedArray(object):
+    """ picklable handle to a read-only numpy array in shared memory
+
+    Use the array property (or get_shared) to obtain the array in the worker.
+    """
+
+    def __init__(self, name: str, shape, dtype, order: str = 'C'):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.order = order
+
+    @property
+    def array(self) -> np.ndarray:
+        arr = np.ndarray(self.shape, dtype=self.dtype, buffer=_attach(self.name).buf, order=self.order)
+        arr.flags.writeable = False
+        refs = _attached_arrays[self.name]
+        refs[:] = [ref for ref in refs if ref() is not None] + [weakref.ref(arr)]
+        return arr
+
+    def __array__(self, dtype=None, copy=None):
+        return self.array if dtype is None else self.array.astype(dtype)
+
+
+class SharedSparse(object):
+    """ picklable handle to a csc or csr matrix in shared memory """
+
+    def __init__(self, fmt: str, shape, data: SharedArray, indices: SharedArray, indptr: SharedArray):
+        self.format = fmt
+        self.shape = tuple(shape)
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+
+    @property
+    def array(self):
+        cls = scipy.sparse.csc_matrix if self.format == 'csc' else scipy.sparse.csr_matrix
+        return cls((self.data.array, self.indices.array, self.indptr.array), shape=self.shape, copy=False)
+
+
+def is_local_pool(dview) -> bool:
+    """whether dview is a multiprocessing pool of the local machine (map_async), rather than
+    an ipyparallel view (map_sync) or None"""
+    return isinstance(dview, Pool)
+
+
+def n_workers(dview) -> int:
+    """number of workers of dview, 1 for None"""
+    if dview is None:
+        return 1
+    if is_local_pool(dview):
+        return dview._processes     # multiprocessing does not expose the size of the pool
+    return len(dview)
+
+
+def n_blocks(dview) -> int:
+    """number of blocks to split a job into, a few per worker of dview (1 for None)"""
+    return 1 if dview is None else _blocks_per_worker * n_workers(dview)
+
+
+def get_shared(x):
+    """return the array behind a shared memory handle, or x itself if it is not a handle"""
+    if isinstance(x, (SharedArray, SharedSparse)):
+        return x.array
+    return x
+
+
+class SharedMemoryPool(Pool):
+    """ multiprocessing pool able to publish read-only arrays in shared memory
+
+    Drop in replacement for multiprocessing.Pool. Arrays published with share()
+    stay available until release() is called or the pool is terminated.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._blocks: Dict[str, shared_memory.SharedMemory] = {}
+        # the workers must share the tracker of this process, otherwise their own
+        # tracker unlinks the blocks they attached to when they exit
+        resource_tracker.ensure_running()
+        super(SharedMemoryPool, self).__init__(*args, **kwargs)
+
+    def _share_dense(self, arr: np.ndarray) -> SharedArray:
+        arr = np.asarray(arr)
+        order = 'F' if arr.flags.f_contiguous and not arr.flags.c_contiguous else 'C'
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        self._blocks[shm.name] = shm
+        handle = SharedArray(shm.name, arr.shape, arr.dtype, order)
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf, order=order)[...] = arr
+        return handle
+
+    def share(self, x):
+        """
+        publish an array in shared memory
+
+        Args:
+            x: np.ndarray or scipy.sparse matrix
+                array to publish. It is copied, later changes to x are not seen by the workers
+
+        Returns:
+            handle: SharedArray or SharedSparse
+                small picklable object to pass to the tasks in place of x
+        """
+        if scipy.sparse.issparse(x):
+            if x.format not in ('csc', 'csr'):
+                x = x.tocsc()
+            return SharedSparse(x.format, x.shape, self._share_dense(x.data),
+                                self._share_dense(x.indices), self._share_dense(x.indptr))
+        return self._share_dense(x)
+
+    def release(self, handle) -> None:
+        """free the shared memory behind a handle returned by share()"""
+        if isinstance(handle, SharedSparse):
+            handles = [handle.data, handle.indices, handle.indptr]
+        else:
+            handles = [handle]
+        for h in handles:
+            shm = self._blocks.pop(h.name, None)
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    def release_all(self) -> None:
+        for name in list(self._blocks):
+            shm = self._blocks.pop(name)
+            shm.close()
+            shm.unlink()
+
+    def terminate(self) -> None:
+        super(SharedMemoryPool, self).terminate()
+        self.release_all()
+
+    def join(self) -> None:
+        super(SharedMemoryPool, self).join()
+        self.release_all()
+
+
+def share_array(dview, x):
+    """publish x in shared memory if dview is a SharedMemoryPool, otherwise return x unchanged"""
+    if isinstance(dview, SharedMemoryPool) and x is not None:
+        return dview.share(x)
+    return x
+
+
+def release_array(dview, handle) -> None:
+    """release a handle obtained with share_array"""
+    if isinstance(dview, SharedMemoryPool) and isinstance(handle, (SharedArray, SharedSparse)):
+        dview.release(handle)
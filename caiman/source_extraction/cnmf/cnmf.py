@@ -37,7 +37,7 @@ import pathlib
 
 from .estimates import Estimates
 from .initialization import initialize_components, compute_W
-from .map_reduce import run_CNMF_patches
+from .map_reduce import plan_patches, run_CNMF_patches
 from .merging import merge_components
 from .params import CNMFParams
 from .pre_processing import preprocess_data
@@ -47,6 +47,7 @@ from .utilities import update_order
 from ... import mmapping
 from ...components_evaluation import estimate_components_quality
 from ...motion_correction import MotionCorrect
+from ...shared_multiprocessing import is_local_pool, n_workers
 from ...utils.utils import save_dict_to_hdf5, load_dict_from_hdf5
 from caiman import summary_images
 from caiman import cluster
@@ -268,6 +269,8 @@ class CNMF(object):
         # these are movie properties that will be refactored into the Movie object
         self.dims = None
         self.empty_merged = None
+        # search locations of the components, reused between spatial updates
+        self.search_cache = {}
 
         # these are member variables related to the CNMF workflow
         self.skip_refinement = skip_refinement
@@ -337,31 +340,20 @@ class CNMF(object):
             raise Exception('File not found!')
 
         base_name = pathlib.Path(fnames[0]).stem + "_memmap_"
-        if extension == '.mmap':
+        if extension in ('.mmap', '.cmmap'):
             fname_new = fnames[0]
             Yr, dims, T = mmapping.load_memmap(fnames[0])
-            if np.isfortran(Yr):
+            if extension == '.mmap' and np.isfortran(Yr):
                 raise Exception('The file should be in C order (see save_memmap function)')
         else:
             if motion_correct:
                 mc = MotionCorrect(fnames, dview=self.dview, **self.params.motion)
-                mc.motion_correct(save_movie=True)
-                fname_mc = mc.fname_tot_els if self.params.motion['pw_rigid'] else mc.fname_tot_rig
+                mc.motion_correct(save_movie=True, order='C', base_name=base_name)
+                fname_new = mc.mmap_file[0]
                 if self.params.get('motion', 'pw_rigid'):
-                    b0 = np.ceil(np.maximum(np.max(np.abs(mc.x_shifts_els)),
-                                            np.max(np.abs(mc.y_shifts_els)))).astype(np.int)
                     self.estimates.shifts = [mc.x_shifts_els, mc.y_shifts_els]
                 else:
-                    b0 = np.ceil(np.max(np.abs(mc.shifts_rig))).astype(np.int)
                     self.estimates.shifts = mc.shifts_rig
-                # TODO - b0 is currently direction inspecific, which can cause
-                # sub-optimal behavior. See
-                # https://github.com/flatironinstitute/CaImAn/pull/618#discussion_r313960370
-                # for further details.
-                # b0 = 0 if self.params.get('motion', 'border_nan') is 'copy' else 0
-                b0 = 0
-                fname_new = mmapping.save_memmap(fname_mc, base_name=base_name, order='C',
-                                                 border_to_0=b0)
             else:
                 fname_new = mmapping.save_memmap(fnames, base_name=base_name, order='C')
             Yr, dims, T = mmapping.load_memmap(fname_new)
@@ -450,8 +442,11 @@ class CNMF(object):
         dims_orig = images.shape[1:]
         dims_sliced = images[tuple(indices)].shape[1:]
         is_sliced = (dims_orig != dims_sliced)
-        if self.params.get('patch', 'rf') is None and (is_sliced or 'ndarray' in str(type(images))):
+        is_chunked = isinstance(images, mmapping.ChunkedMovie)
+        if self.params.get('patch', 'rf') is None and (is_sliced or is_chunked or 'ndarray' in str(type(images))):
             images = images[tuple(indices)]
+            if is_chunked:  # the chunked store is read in memory
+                images, is_chunked = np.array(images), False
             self.dview = None
             logging.info("Parallel processing in a single patch "
                             "is not available for loaded in memory or sliced" +
@@ -461,9 +456,13 @@ class CNMF(object):
         self.params.set('online', {'init_batch': T})
         self.dims = images.shape[1:]
         #self.params.data['dims'] = images.shape[1:]
-        Y = np.transpose(images, list(range(1, len(self.dims) + 1)) + [0])
-        Yr = np.transpose(np.reshape(images, (T, -1), order='F'))
-        if np.isfortran(Yr):
+        if is_chunked:  # the patches read their part of the file, the refinement reads the pixels x frames view
+            Y, Yr = None, images.source
+            self.mmap_file = images.filename
+        else:
+            Y = np.transpose(images, list(range(1, len(self.dims) + 1)) + [0])
+            Yr = np.transpose(np.reshape(images, (T, -1), order='F'))
+        if not is_chunked and np.isfortran(Yr):
             raise Exception('The file is in F order, it should be in C order (see save_memmap function)')
 
         logging.info((T,) + self.dims)
@@ -587,6 +586,19 @@ class CNMF(object):
                 self.estimates.b = b_FOV
 
         else:  # use patches
+            rf = self.params.get('patch', 'rf')
+            if isinstance(rf, str) and rf == 'auto':
+                # the patches are run by the workers of dview
+                K = self.params.get('init', 'K')
+                plan = plan_patches(self.dims, T, self.params.get('init', 'gSig'), K=K,
+                                    nb_patch=self.params.get('patch', 'nb_patch'), dtype=images.dtype,
+                                    stride=self.params.get('patch', 'stride'),
+                                    n_processes=n_workers(self.dview),
+                                    border_pix=self.params.get('patch', 'border_pix'))
+                self.params.set('patch', {key: plan[key] for key in
+                                          ('rf', 'stride', 'memory_fact', 'max_concurrent')})
+                if K is None:
+                    self.params.set('init', {'K': plan['K']})
             if self.params.get('patch', 'stride') is None:
                 self.params.set('patch', {'stride': np.int(self.params.get('patch', 'rf') * 2 * .1)})
                 logging.info(
@@ -754,7 +766,7 @@ class CNMF(object):
         args_in = [(F[jj], None, jj, None, None, None, None,
                     args) for jj in range(F.shape[0])]
 
-        if 'multiprocessing' in str(type(self.dview)):
+        if is_local_pool(self.dview):
             results = self.dview.map_async(
                 constrained_foopsi_parallel, args_in).get(4294967)
         elif self.dview is not None:
@@ -932,7 +944,8 @@ class CNMF(object):
         self.estimates.A, self.estimates.b, self.estimates.C, self.estimates.f =\
             update_spatial_components(Y, C=self.estimates.C, f=self.estimates.f, A_in=self.estimates.A,
                                       b_in=self.estimates.b, dview=self.dview,
-                                      sn=self.estimates.sn, dims=self.dims, **self.params.get_group('spatial'))
+                                      sn=self.estimates.sn, dims=self.dims, search_cache=self.search_cache,
+                                      **self.params.get_group('spatial'))
 
         return self
 
@@ -948,7 +961,7 @@ class CNMF(object):
                              bl=self.estimates.bl, c1=self.estimates.c1, sn=self.estimates.neurons_sn,
                              g=self.estimates.g, thr=self.params.get('merging', 'merge_thr'), mx=mx,
                              fast_merge=fast_merge, merge_parallel=self.params.get('merging', 'merge_parallel'),
-                             max_merge_area=max_merge_area)
+                             max_merge_area=max_merge_area, merge_cache=self.estimates.merge_cache)
 
         return self
 
@@ -961,7 +974,7 @@ class CNMF(object):
                 self.params.get('init', 'ring_size_factor') is not None):
             estim.A, estim.C, estim.b, estim.f, estim.center, \
                 extra_1p = initialize_components(
-                    Y, sn=estim.sn, options_total=self.params.to_dict(),
+                    Y, sn=estim.sn, options_total=self.params.to_dict(), dview=self.dview,
                     **self.params.get_group('init'))
             try:
                 estim.S, estim.bl, estim.c1, estim.neurons_sn, \
@@ -972,7 +985,7 @@ class CNMF(object):
         else:
             estim.A, estim.C, estim.b, estim.f, estim.center =\
                 initialize_components(Y, sn=estim.sn, options_total=self.params.to_dict(),
-                                      **self.params.get_group('init'))
+                                      dview=self.dview, **self.params.get_group('init'))
 
         self.estimates = estim
 
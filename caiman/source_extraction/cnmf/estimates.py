@@ -25,6 +25,7 @@ from ...base.rois import (
         detect_duplicates_and_subsets, nf_match_neurons_in_binary_masks,
         nf_masks_to_neurof_dict)
 from .initialization import downscale
+from ...shared_multiprocessing import is_local_pool
 
 
 class Estimates(object):
@@ -128,6 +129,7 @@ class Estimates(object):
         self.center = None
 
         self.merged_ROIs = None
+        self.merge_cache = {}  # correlations of overlapping components, see merge_components
         self.coordinates = None
         self.F_dff = None
 
@@ -966,6 +968,9 @@ class Estimates(object):
                 min_cnn_thr: float
                     CNN classifier threshold
 
+                eval_block_size: int or None
+                    components per task of the block evaluation (None: groups of 50)
+
         Returns:
             self: estimates object
                 self.idx_components: np.array
@@ -993,7 +998,8 @@ class Estimates(object):
                                              thresh_cnn_min=opts['min_cnn_thr'],
                                              thresh_cnn_lowest=opts['cnn_lowest'],
                                              r_values_lowest=opts['rval_lowest'],
-                                             min_SNR_reject=opts['SNR_lowest'])
+                                             min_SNR_reject=opts['SNR_lowest'],
+                                             block_size=opts['eval_block_size'])
         self.idx_components = idx_components.astype(int)
         self.idx_components_bad = idx_components_bad.astype(int)
         if np.any(np.isnan(r_values)):
@@ -1144,7 +1150,7 @@ class Estimates(object):
         args_in = [(F[jj], None, jj, None, None, None, None,
                     args) for jj in range(F.shape[0])]
 
-        if 'multiprocessing' in str(type(dview)):
+        if is_local_pool(dview):
             results = dview.map_async(
                 constrained_foopsi_parallel, args_in).get(4294967)
         elif dview is not None:
@@ -1173,7 +1179,7 @@ class Estimates(object):
                 args_in = [(self.F_dff[jj], None, jj, 0, 0, self.g[jj], None,
                         args) for jj in range(F.shape[0])]
 
-                if 'multiprocessing' in str(type(dview)):
+                if is_local_pool(dview):
                     results = dview.map_async(
                         constrained_foopsi_parallel, args_in).get(4294967)
                 elif dview is not None:
@@ -1200,7 +1206,7 @@ class Estimates(object):
                                  bl=self.bl, c1=self.c1, sn=self.neurons_sn,
                                  g=self.g, thr=params.get('merging', 'merge_thr'), mx=mx,
                                  fast_merge=fast_merge, merge_parallel=params.get('merging', 'merge_parallel'),
-                                 max_merge_area=max_merge_area)
+                                 max_merge_area=max_merge_area, merge_cache=self.merge_cache)
 
     def manual_merge(self, components, params):
         ''' merge a given list of components. The indices
@@ -20,7 +20,7 @@ import logging
 from math import sqrt
 import matplotlib.animation as animation
 import matplotlib.pyplot as plt
-from multiprocessing import current_process
+from multiprocessing import cpu_count, current_process
 import numpy as np
 from past.utils import old_div
 import scipy
@@ -39,6 +39,7 @@ from .deconvolution import constrained_foopsi
 #from .utilities import fast_graph_Laplacian_patches
 from .pre_processing import get_noise_fft, get_noise_welch
 from .spatial import circular_constraint, connectivity_constraint
+from ...shared_multiprocessing import is_local_pool, n_workers
 from ...utils.utils import parmap
 from ...utils.stats import pd_solve, compressive_nmf
 
@@ -47,6 +48,11 @@ try:
 except:
     pass
 
+# maximum size of the products of the pixel pairs, and of the normal equations, held by compute_W
+_max_ring_bytes = 2**28
+# float32 copies of its data held by init_neurons_corr_pnr at its peak, the input included
+_corr_pnr_copies = 6
+
 def resize(Y, size, interpolation=cv2.INTER_LINEAR):
     """faster and 3D compatible version of skimage.transform.resize"""
     if Y.ndim == 2:
@@ -159,7 +165,7 @@ def initialize_components(Y, K=30, gSig=[5, 5], gSiz=None, ssub=1, tsub=1, nIter
                           rolling_length=100, sn=None, options_total=None, min_corr=0.8, min_pnr=10,
                           ring_size_factor=1.5, center_psf=False, ssub_B=2, init_iter=2, remove_baseline = True,
                           SC_kernel='heat', SC_sigma=1, SC_thr=0, SC_normalize=True, SC_use_NN=False,
-                          SC_nnn=20, lambda_gnmf=1):
+                          SC_nnn=20, lambda_gnmf=1, tile_shape=None, dview=None):
     """
     Initalize components. This function initializes the spatial footprints, temporal components,
     and background which are then further refined by the CNMF iterations. There are four
@@ -260,6 +266,12 @@ def initialize_components(Y, K=30, gSig=[5, 5], gSiz=None, ssub=1, tsub=1, nIter
         init_iter: int, optional
             number of iterations for 1-photon imaging initialization
 
+        tile_shape: tuple or None, optional
+            shape of the tiles in which the neurons are initialized by 'corr_pnr' (None: whole field of view)
+
+        dview: view on the cluster, optional
+            used to process the tiles of 'corr_pnr' in parallel
+
     Returns:
         Ain: np.ndarray
             (d1 * d2 [ * d3]) x K , spatial filter of each neuron.
@@ -344,7 +356,8 @@ def initialize_components(Y, K=30, gSig=[5, 5], gSiz=None, ssub=1, tsub=1, nIter
         Ain, Cin, _, b_in, f_in, extra_1p = greedyROI_corr(
             Y, Y_ds, max_number=K, gSiz=gSiz[0], gSig=gSig[0], min_corr=min_corr, min_pnr=min_pnr,
             ring_size_factor=ring_size_factor, center_psf=center_psf, options=options_total,
-            sn=sn, nb=nb, ssub=ssub, ssub_B=ssub_B, init_iter=init_iter)
+            sn=sn, nb=nb, ssub=ssub, ssub_B=ssub_B, init_iter=init_iter, tile_shape=tile_shape,
+            dview=dview)
 
     elif method == 'sparse_nmf':
         Ain, Cin, _, b_in, f_in = sparseNMF(
@@ -1056,7 +1069,7 @@ def greedyROI_corr(Y, Y_ds, max_number=None, gSiz=None, gSig=None, center_psf=Tr
                    min_corr=None, min_pnr=None, seed_method='auto',
                    min_pixel=3, bd=0, thresh_init=2, ring_size_factor=None, nb=1, options=None,
                    sn=None, save_video=False, video_name='initialization.mp4', ssub=1,
-                   ssub_B=2, init_iter=2):
+                   ssub_B=2, init_iter=2, tile_shape=None, dview=None):
     """
     initialize neurons based on pixels' local correlations and peak-to-noise ratios.
 
@@ -1091,6 +1104,11 @@ def greedyROI_corr(Y, Y_ds, max_number=None, gSiz=None, gSig=None, center_psf=Tr
             downsampling factor for 1-photon imaging background computation
         init_iter: int, optional
             number of iterations for 1-photon imaging initialization
+        tile_shape: tuple or None, optional
+            if not None, the neurons are initialized tile by tile by init_neurons_corr_pnr_tiled,
+            which bounds the working copies of the data. Y, Y_ds and the background are still
+            held in memory
+        dview: view on the cluster used to process the tiles, or None
     """
     if min_corr is None or min_pnr is None:
         raise Exception(
@@ -1101,13 +1119,21 @@ def greedyROI_corr(Y, Y_ds, max_number=None, gSiz=None, gSig=None, center_psf=Tr
     o['s_min'] = None
     if o['p'] > 1:
         o['p'] = 1
-    A, C, _, _, center = init_neurons_corr_pnr(
-        Y_ds, max_number=max_number, gSiz=gSiz, gSig=gSig,
-        center_psf=center_psf, min_corr=min_corr,
-        min_pnr=min_pnr * np.sqrt(np.size(Y) / np.size(Y_ds)),
-        seed_method=seed_method, deconvolve_options=o,
-        min_pixel=min_pixel, bd=bd, thresh_init=thresh_init,
-        swap_dim=True, save_video=save_video, video_name=video_name)
+    if tile_shape is None:
+        A, C, _, _, center = init_neurons_corr_pnr(
+            Y_ds, max_number=max_number, gSiz=gSiz, gSig=gSig,
+            center_psf=center_psf, min_corr=min_corr,
+            min_pnr=min_pnr * np.sqrt(np.size(Y) / np.size(Y_ds)),
+            seed_method=seed_method, deconvolve_options=o,
+            min_pixel=min_pixel, bd=bd, thresh_init=thresh_init,
+            swap_dim=True, save_video=save_video, video_name=video_name)
+    else:
+        A, C, _, _, center = init_neurons_corr_pnr_tiled(
+            Y_ds, tile_shape=tile_shape, dview=dview, max_number=max_number, gSiz=gSiz,
+            gSig=gSig, center_psf=center_psf, min_corr=min_corr,
+            min_pnr=min_pnr * np.sqrt(np.size(Y) / np.size(Y_ds)),
+            seed_method=seed_method, deconvolve_options=o,
+            min_pixel=min_pixel, bd=bd, thresh_init=thresh_init, swap_dim=True)
 
     dims = Y.shape[:2]
     T = Y.shape[-1]
@@ -1278,7 +1304,7 @@ def init_neurons_corr_pnr(data, max_number=None, gSiz=15, gSig=None,
                           seed_method='auto', deconvolve_options=None,
                           min_pixel=3, bd=1, thresh_init=2, swap_dim=True,
                           save_video=False, video_name='initialization.mp4',
-                          background_filter='disk'):
+                          background_filter='disk', seed_mask=None):
     """
     using greedy method to initialize neurons by selecting pixels with large
     local correlation and large peak-to-noise ratio
@@ -1320,6 +1346,9 @@ def init_neurons_corr_pnr(data, max_number=None, gSiz=15, gSig=None,
             save the initialization procedure if it's True
         video_name: str
             name of the video to be saved.
+        seed_mask: np.ndarray or None
+            boolean image (d1 x d2) of the pixels that can be seed pixels. If None,
+            all the pixels (but the boundary ones) can be seed pixels.
 
     Returns:
         A: np.ndarray (d1*d2*T)
@@ -1403,6 +1432,8 @@ def init_neurons_corr_pnr(data, max_number=None, gSiz=15, gSig=None,
         ind_bd[:, -bd:] = True
 
     ind_search[ind_bd] = 1
+    if seed_mask is not None:
+        ind_search[~seed_mask] = 1
 
     # creating variables for storing the results
     if not max_number:
@@ -1667,6 +1698,154 @@ def init_neurons_corr_pnr(data, max_number=None, gSiz=15, gSig=None,
     return A, C, C_raw, S, center
 
 
+def init_neurons_tile(args):
+    """helper function of init_neurons_corr_pnr_tiled, neurons seeded in one tile
+
+    Args:
+        args: tuple
+            (data of the tile and of the pixels around it (T x nr x nc), seed_mask, kwargs of
+            init_neurons_corr_pnr)
+
+    Returns:
+        A, C, C_raw, S, center: see init_neurons_corr_pnr
+    """
+    data, seed_mask, kwargs = args
+    return init_neurons_corr_pnr(data, seed_mask=seed_mask, swap_dim=False, **kwargs)
+
+
+def init_neurons_corr_pnr_tiled(data, tile_shape=(128, 128), dview=None, max_number=None, gSiz=15,
+                                gSig=None, center_psf=True, min_corr=0.8, min_pnr=10,
+                                seed_method='auto', deconvolve_options=None, min_pixel=3, bd=1,
+                                thresh_init=2, swap_dim=True, background_filter='disk', merge_thr=0.8,
+                                max_tile_bytes=2**31):
+    """
+    tiled version of init_neurons_corr_pnr.
+
+    The field of view is split in tiles, and the neurons are initialized in each tile
+    independently (in parallel if dview is not None) by init_neurons_corr_pnr, using only
+    seed pixels within the tile. Each tile is processed together with the pixels within
+    gSiz plus the radius of the spatial filter around it, so that the correlation and PNR
+    images of the tile and the boxes around its seed pixels are the ones of the whole field
+    of view, and only the data of a few tiles are copied at a time. A neuron at the border of
+    two tiles can be initialized in both: overlapping neurons of different tiles with a
+    temporal correlation above merge_thr are duplicates, and only the one further from the
+    border of its tile is kept.
+
+    Each tile is processed in memory with all its frames, which are needed for the traces
+    of its neurons: the tiles are made smaller until the memory used by init_neurons_corr_pnr
+    on a tile and its halo fits in max_tile_bytes. A tile can not be smaller than gSiz, so with
+    enough frames the limit can not be met, and a warning is logged. The correlation and PNR
+    images are computed on the data of each tile, because the greedy search updates them as
+    neurons are found, so the streamed images of correlation_pnr_tiled are not used.
+
+    Args:
+        data: np.ndarray (3D)
+            the data used for initializing neurons (d1*d2*T or T*d1*d2, see swap_dim)
+        tile_shape: tuple
+            number of rows and columns of the tiles
+        dview: view on the cluster, or None to process the tiles serially
+        merge_thr: float
+            minimum temporal correlation of duplicated neurons
+        max_tile_bytes: int or None
+            maximum memory used to process a tile, None to keep tile_shape
+        *** see init_neurons_corr_pnr for the other arguments ***
+
+    Returns:
+        A, C, C_raw, S, center: see init_neurons_corr_pnr
+    """
+    d1, d2 = data.shape[:2] if swap_dim else data.shape[1:]
+    halo = gSiz + caiman.summary_images.filter_radius(gSig) + 1
+    T = data.shape[-1] if swap_dim else data.shape[0]
+
+    def tile_bytes(shape):
+        return min(shape[0] + 2 * halo, d1) * min(shape[1] + 2 * halo, d2) * T * 4 * _corr_pnr_copies
+
+    if max_tile_bytes is not None:
+        tile_shape = list(tile_shape)
+        while tile_bytes(tile_shape) > max_tile_bytes and max(tile_shape) > gSiz:
+            k = int(np.argmax(tile_shape))
+            tile_shape[k] = max(gSiz, tile_shape[k] // 2)
+        if tile_bytes(tile_shape) > max_tile_bytes:
+            logging.warning('Processing a tile of {0} frames requires {1:.1f} GB, more than max_tile_bytes'.format(
+                T, tile_bytes(tile_shape) / 2**30))
+        logging.info('Initializing the neurons in tiles of {0} pixels'.format(tuple(tile_shape)))
+    kwargs = dict(max_number=max_number, gSiz=gSiz, gSig=gSig, center_psf=center_psf,
+                  min_corr=min_corr, min_pnr=min_pnr, seed_method=seed_method,
+                  deconvolve_options=deconvolve_options, min_pixel=min_pixel, bd=0,
+                  thresh_init=thresh_init, background_filter=background_filter)
+    tiles = [(r, min(r + tile_shape[0], d1), c, min(c + tile_shape[1], d2))
+             for r in range(0, d1, tile_shape[0]) for c in range(0, d2, tile_shape[1])]
+    regions = [(max(r0 - halo, 0), min(r1 + halo, d1), max(c0 - halo, 0), min(c1 + halo, d2))
+               for r0, r1, c0, c1 in tiles]
+
+    def tile_args(i):
+        (r0, r1, c0, c1), (ra, rb, ca, cb) = tiles[i], regions[i]
+        if swap_dim:
+            region = np.ascontiguousarray(np.transpose(data[ra:rb, ca:cb], [2, 0, 1]))
+        else:
+            region = np.array(data[:, ra:rb, ca:cb])
+        seed_mask = np.zeros((d1, d2), dtype=bool)
+        seed_mask[max(r0, bd):min(r1, d1 - bd), max(c0, bd):min(c1, d2 - bd)] = True
+        return region, seed_mask[ra:rb, ca:cb], kwargs
+
+    # the data of the tiles are copied for one batch of tiles at a time
+    batch = n_workers(dview)
+    results: List = []
+    for start in range(0, len(tiles), batch):
+        argsin = [tile_args(i) for i in range(start, min(start + batch, len(tiles)))]
+        if dview is None:
+            results += list(map(init_neurons_tile, argsin))
+        elif is_local_pool(dview):
+            results += dview.map_async(init_neurons_tile, argsin).get(4294967)
+        else:
+            results += dview.map_sync(init_neurons_tile, argsin)
+        del argsin
+
+    # footprints in the field of view, tile of each neuron, rank in its tile and distance of
+    # its center to the borders of its tile shared with other tiles
+    A, C, C_raw, S, center, tile, rank, dist = [], [], [], [], [], [], [], []
+    for i, (A_t, C_t, C_raw_t, S_t, center_t) in enumerate(results):
+        (r0, r1, c0, c1), (ra, rb, ca, cb) = tiles[i], regions[i]
+        rr, cc = np.unravel_index(np.arange(A_t.shape[0]), (rb - ra, cb - ca), order='F')
+        pixels = np.ravel_multi_index((rr + ra, cc + ca), (d1, d2), order='F')
+        A_t = spr.csc_matrix(A_t)
+        A.append(spr.csc_matrix((A_t.data, pixels[A_t.indices], A_t.indptr), shape=(d1 * d2, A_t.shape[1])))
+        C.append(C_t)
+        C_raw.append(C_raw_t)
+        S.append(S_t)
+        center_t = center_t + np.array([[ca], [ra]])
+        center.append(center_t)
+        tile.append(np.full(A_t.shape[1], i))
+        rank.append(np.arange(A_t.shape[1]))
+        cx, cy = center_t
+        dist.append(np.min([cy - r0 if r0 > 0 else np.full(len(cy), np.inf),
+                            r1 - 1 - cy if r1 < d1 else np.full(len(cy), np.inf),
+                            cx - c0 if c0 > 0 else np.full(len(cx), np.inf),
+                            c1 - 1 - cx if c1 < d2 else np.full(len(cx), np.inf)], 0))
+    A = spr.hstack(A).tocsc()
+    C, C_raw, S = np.concatenate(C), np.concatenate(C_raw), np.concatenate(S)
+    center, tile = np.concatenate(center, 1), np.concatenate(tile)
+    rank, dist = np.concatenate(rank), np.concatenate(dist)
+
+    # remove the duplicated neurons
+    keep = np.ones(len(tile), dtype=bool)
+    overlap = (A.T * A).tocoo()
+    pairs = (overlap.row < overlap.col) & (tile[overlap.row] != tile[overlap.col])
+    if pairs.any():
+        C_std = C_raw - C_raw.mean(1)[:, None]
+        C_std /= np.maximum(np.linalg.norm(C_std, axis=1), np.finfo(np.float32).eps)[:, None]
+        for i, j in zip(overlap.row[pairs], overlap.col[pairs]):
+            if keep[i] and keep[j] and C_std[i].dot(C_std[j]) > merge_thr:
+                keep[j if dist[j] < dist[i] else i] = False
+
+    # the neurons found first in each tile come first
+    order = np.lexsort((tile, rank))
+    order = order[keep[order]][:max_number]
+    logging.info('In total, {0} neurons were initialized in {1} tiles, {2} duplicates were removed.'.format(
+        len(order), len(tiles), np.sum(~keep)))
+    return A[:, order].toarray(), C[order], C_raw[order], S[order], center[:, order]
+
+
 @profile
 def extract_ac(data_filtered, data_raw, ind_ctr, patch_dims):
     # parameters
@@ -1724,6 +1903,75 @@ def extract_ac(data_filtered, data_raw, ind_ctr, patch_dims):
     return ai, ci, True
 
 
+def ring_pairs(ringidx):
+    """offsets of the pixel pairs whose products are needed by compute_W
+
+    Args:
+        ringidx: list of two np.ndarray
+            offsets of the pixels of the ring along the first and second dimension
+
+    Returns:
+        offsets: np.ndarray (n_offsets x 2)
+            offsets (along the second and first dimension) of the pairs (pixel, pixel + offset),
+            in the half plane of nonnegative offsets along the second dimension
+
+        K_ring, base_ring: np.ndarray
+            index in offsets of the pair of each two pixels a, b of the ring (n x n), and offset
+            of the pixel of the ring from which the pair starts (n x n x 2)
+
+        K_center, base_center: np.ndarray
+            same for the pairs of the center and each pixel of the ring (n and n x 2)
+    """
+    rx, ry = [np.asarray(r) for r in ringidx]
+    dx = np.concatenate([(rx[None] - rx[:, None]).ravel(), rx])
+    dy = np.concatenate([(ry[None] - ry[:, None]).ravel(), ry])
+    flip = (dy < 0) | ((dy == 0) & (dx < 0))
+    offsets, K = np.unique(np.where(flip, -1, 1)[:, None] * np.stack([dy, dx], 1), axis=0, return_inverse=True)
+    K = K.ravel()
+    n = len(rx)
+    # the pair starts from the first pixel, or from the second one if the offset is flipped
+    start = np.stack([np.concatenate([np.repeat(ry, n), np.zeros(n, dtype=int)]),
+                      np.concatenate([np.repeat(rx, n), np.zeros(n, dtype=int)])], 1)
+    end = np.stack([np.concatenate([np.tile(ry, n), ry]), np.concatenate([np.tile(rx, n), rx])], 1)
+    base = np.where(flip[:, None], end, start)
+    return (offsets, K[:n * n].reshape(n, n), base[:n * n].reshape(n, n, 2),
+            K[n * n:], base[n * n:])
+
+
+def ring_gram(X, offsets, G, block=64):
+    """add to G the products over time of the pixel pairs of each offset
+
+    Args:
+        X: np.ndarray (rows x d1 x T)
+            data, the pixel (x, y) is X[y, x]
+
+        offsets: np.ndarray
+            offsets (along rows and d1) of the pairs, with nonnegative offsets along rows
+
+        G: np.ndarray (n_offsets x rows x d1)
+            G[k, y, x] is incremented by the product of X[y, x] and X[(y, x) + offsets[k]]
+            for the pairs within X
+
+        block: int
+            number of pixels of a row multiplied at a time
+    """
+    rows, d1 = X.shape[:2]
+    for dy in np.unique(offsets[:, 0]):
+        if dy >= rows:
+            break
+        ks = np.nonzero(offsets[:, 0] == dy)[0]
+        dxs = offsets[ks, 1]
+        for x0 in range(0, d1, block):
+            x1 = min(x0 + block, d1)
+            c0, c1 = max(0, x0 + dxs.min()), min(d1, x1 + dxs.max())
+            cols = np.arange(x0, x1)[None] + dxs[:, None] - c0
+            valid = (cols >= 0) & (cols < c1 - c0)
+            # products of the pixels x0:x1 of each row with the pixels c0:c1 of the row dy below
+            Z = np.matmul(X[:rows - dy, x0:x1], X[dy:, c0:c1].transpose(0, 2, 1))
+            Z = Z[:, np.arange(x1 - x0)[None], np.clip(cols, 0, c1 - c0 - 1)]
+            G[ks, :rows - dy, x0:x1] += np.where(valid, Z, 0).transpose(1, 0, 2)
+
+
 @profile
 def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True, ssub=1, tsub=1, parallel=False):
     """compute background according to ring model
@@ -1734,6 +1982,11 @@ def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True, ssub=1, tsub=1, p
     Problem parallelizes over pixels i
     Fluctuating background activity is W*X, constant baselines b0.
 
+    The field of view is processed in bands of rows. The products over time of the pairs
+    of pixels in the rings of a band are computed once for each pair, reading the frames of
+    the band (and of the rings around it) in chunks, and the least squares problems of all
+    the pixels of the band are then solved in batches.
+
     Args:
         Y: np.ndarray (2D or 3D)
             movie, raw data in 2D or 3D (pixels x time).
@@ -1746,13 +1999,14 @@ def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True, ssub=1, tsub=1, p
         radius: int
             radius of ring
         data_fits_in_memory: [optional] bool
-            If true, use faster but more memory consuming computation
+            If true, all the frames of a band are read at once, otherwise in chunks of frames,
+            which is slower but uses less memory
         ssub: int
             spatial downscale factor
         tsub: int
             temporal downscale factor
         parallel: bool
-            If true, use multiprocessing to process pixels in parallel
+            If true, use multiprocessing to process the bands of pixels in parallel
 
     Returns:
         W: scipy.sparse.csr_matrix (pixels x pixels)
@@ -1773,64 +2027,81 @@ def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True, ssub=1, tsub=1, p
     ring = disk(radius + 1)
     ring[1:-1, 1:-1] -= disk(radius)
     ringidx = [i - radius - 1 for i in np.nonzero(ring)]
-
-    def get_indices_of_pixels_on_ring(pixel):
-        x = pixel % d1 + ringidx[0]
-        y = pixel // d1 + ringidx[1]
-        inside = (x >= 0) * (x < d1) * (y >= 0) * (y < d2)
-        return x[inside] + y[inside] * d1
+    offsets, K_ring, base_ring, K_center, base_center = ring_pairs(ringidx)
+    n = len(ringidx[0])
 
     b0 = np.array(Y.mean(1)) - A.dot(C.mean(1))
 
     if ssub > 1:
-        ds_mat = caiman.source_extraction.cnmf.utilities.decimation_matrix(dims, ssub)
-        ds = lambda x: ds_mat.dot(x)
+        ds_mat = caiman.source_extraction.cnmf.utilities.decimation_matrix(dims, ssub).tocsr()
+        b0_ds = ds_mat.dot(b0)
     else:
-        ds = lambda x: x
-
+        b0_ds = b0
+    if spr.issparse(A):
+        A = A.tocsr()
+
+    # rows of each band, such that the products of its pixels fit in _max_ring_bytes
+    halo = radius + 1
+    n_rows = max(1, _max_ring_bytes // (8 * len(offsets) * d1) - 2 * halo)
+    if parallel:
+        n_rows = min(n_rows, -(-d2 // cpu_count()))
     if data_fits_in_memory:
-        if ssub == 1 and tsub == 1:
-            X = Y - A.dot(C) - b0[:, None]
-        else:
-            X = decimate_last_axis(ds(Y), tsub) - \
-                (ds(A).dot(decimate_last_axis(C, tsub)) if A.size > 0 else 0) - \
-                ds(b0).reshape((-1, 1), order='F')
-
-        def process_pixel(p):
-            index = get_indices_of_pixels_on_ring(p)
-            B = X[index]
-            tmp = np.array(B.dot(B.T))
-            tmp[np.diag_indices(len(tmp))] += np.trace(tmp) * 1e-5
-            tmp2 = X[p]
-            data = pd_solve(tmp, B.dot(tmp2))
-            return index, data
+        chunk_size = T
     else:
-
-        def process_pixel(p):
-            index = get_indices_of_pixels_on_ring(p)
-            if ssub == 1 and tsub == 1:
-                B = Y[index] - A[index].dot(C) - b0[index, None]
-            else:
-                B = decimate_last_axis(ds(Y), tsub)[index] - \
-                    (ds(A)[index].dot(decimate_last_axis(C, tsub)) if A.size > 0 else 0) - \
-                    ds(b0).reshape((-1, 1), order='F')[index]
-            tmp = np.array(B.dot(B.T))
-            tmp[np.diag_indices(len(tmp))] += np.trace(tmp) * 1e-5
-            if ssub == 1 and tsub == 1:
-                tmp2 = Y[p] - A[p].dot(C).ravel() - b0[p]
-            else:
-                tmp2 = decimate_last_axis(ds(Y), tsub)[p] - \
-                    (ds(A)[p].dot(decimate_last_axis(C, tsub)) if A.size > 0 else 0) - \
-                    ds(b0).reshape((-1, 1), order='F')[p]
-            data = pd_solve(tmp, B.dot(tmp2))
-            return index, data
-
-    Q = list((parmap if parallel else map)(process_pixel, range(d1 * d2)))
-    indices, data = np.transpose(Q)
-    indptr = np.concatenate([[0], np.cumsum(list(map(len, indices)))])
-    indices = np.concatenate(indices)
-    data = np.concatenate(data)
-    return spr.csr_matrix((data, indices, indptr), dtype='float32'), b0.astype(np.float32)
+        # the frames of a chunk, their residual and the products A*C take about three times its size
+        chunk_size = max(1, _max_ring_bytes // (24 * (n_rows + 2 * halo) * d1 * ssub**2 * tsub)) * tsub
+
+    def process_band(y0):
+        y1 = min(y0 + n_rows, d2)
+        ya, yb = max(y0 - halo, 0), min(y1 + halo, d2)
+        # pixels of the band and of its rings in the data
+        p0, p1 = ya * ssub * dims[0], min(yb * ssub, dims[1]) * dims[0]
+        A_band = A[p0:p1]
+        if ssub > 1:
+            ds_band = ds_mat[ya * d1:yb * d1, p0:p1]
+            A_band = ds_band.dot(A_band)
+        G = np.zeros((len(offsets), yb - ya, d1))
+        for t in range(0, T, chunk_size):
+            X = np.asarray(Y[p0:p1, t:t + chunk_size])
+            if ssub > 1:
+                X = ds_band.dot(X)
+            X = decimate_last_axis(X, tsub) - b0_ds[ya * d1:yb * d1, None]
+            if A.shape[1] > 0:
+                X -= A_band.dot(decimate_last_axis(C[:, t:t + chunk_size], tsub))
+            ring_gram(X.reshape(yb - ya, d1, -1), offsets, G)
+
+        # normal equations of the pixels of the band. Pixels of the ring outside of the field
+        # of view get an identity row and a zero weight
+        indices, data, counts = [], [], []
+        diag = np.arange(n)
+        yy, xx = np.divmod(np.arange(y0 * d1, y1 * d1), d1)
+        # the normal equations of a batch of pixels and the indices gathering them from G
+        batch = max(1, _max_ring_bytes // (32 * n * n))
+        for s in range(0, len(yy), batch):
+            y, x = yy[s:s + batch, None] - ya, xx[s:s + batch, None]
+            ring_y, ring_x = y + ringidx[1], x + ringidx[0]
+            inside = (ring_x >= 0) & (ring_x < d1) & (ring_y + ya >= 0) & (ring_y + ya < d2)
+            M = G[K_ring, np.clip(y[..., None] + base_ring[..., 0], 0, yb - ya - 1),
+                  np.clip(x[..., None] + base_ring[..., 1], 0, d1 - 1)]
+            M[~(inside[:, :, None] & inside[:, None, :])] = 0
+            M[:, diag, diag] += np.trace(M, axis1=1, axis2=2)[:, None] * 1e-5 + ~inside
+            rhs = G[K_center, np.clip(y + base_center[:, 0], 0, yb - ya - 1),
+                    np.clip(x + base_center[:, 1], 0, d1 - 1)]
+            rhs[~inside] = 0
+            try:
+                weights = np.linalg.solve(M, rhs[..., None])[..., 0]
+            except np.linalg.LinAlgError:
+                weights = np.array([np.linalg.lstsq(m, r, rcond=None)[0] for m, r in zip(M, rhs)])
+            indices.append((ring_x + (ring_y + ya) * d1)[inside])
+            data.append(weights[inside])
+            counts.append(inside.sum(1))
+        return np.concatenate(indices), np.concatenate(data), np.concatenate(counts)
+
+    Q = list((parmap if parallel else map)(process_band, range(0, d2, n_rows)))
+    indices, data, counts = [np.concatenate(q) for q in zip(*Q)]
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    return (spr.csr_matrix((data, indices, indptr), shape=(d1 * d2, d1 * d2), dtype='float32'),
+            b0.astype(np.float32))
 
 #%%
 def nnsvd_init(X, n_components, r_ov=10, eps=1e-6, random_state=42):
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+""" Per frame latency instrumentation of the online algorithm
+
+FrameProfiler records the time spent in each stage of every frame in
+log-spaced histograms (bounded memory, for p50/p99/max over the whole run),
+keeps the per stage latencies of the last frames, counts the frames over
+the time budget and tracks the depth of the queue of incoming frames.
+"""
+
+import json
+import numpy as np
+from time import perf_counter
+from typing import Dict, List, Optional
+
+# histogram bins: 1us to 10s, 40 bins per decade (~6% resolution)
+_BIN_EDGES = np.logspace(-6, 1, 7 * 40 + 1)
+
+
+class FrameProfiler(object):
+    """ latency histograms, deadline misses and queue depth of a stream of frames
+
+    Usage (fit_online does it for each frame):
+        profiler.start_frame()
+        ...                       # work of stage 'a'
+        profiler.mark('a')        # time since the previous mark goes to stage 'a'
+        ...
+        profiler.end_frame()
+    """
+
+    def __init__(self, stages: List[str], budget: Optional[float] = None, fr: Optional[float] = None,
+                 history: int = 10000, max_deferred: int = 10):
+        """
+        Args:
+            stages: list of str
+                names of the stages, in the order they run
+
+            budget: float or None
+                time budget of a frame (s), frames taking longer are counted as missed. Defaults to 1/fr
+
+            fr: float or None
+                frame rate (Hz) of the acquisition, used to simulate the queue of incoming frames
+
+            history: int
+                number of frames for which the latency of each stage is kept
+
+            max_deferred: int
+                a stage is not postponed for more than max_deferred consecutive frames, so
+                that postponed work runs even when the budget is always tight
+        """
+        self.stages = list(stages) + ['frame']
+        self._index = {stage: i for i, stage in enumerate(self.stages)}
+        self.fr = fr
+        self.budget = budget if budget is not None else (1. / fr if fr else None)
+        self.history = history
+        self.max_deferred = max_deferred
+        self.hist = np.zeros((len(self.stages), len(_BIN_EDGES) + 1), dtype=np.int64)
+        self.total = np.zeros(len(self.stages))
+        self.max = np.zeros(len(self.stages))
+        self.recent = np.zeros((history, len(self.stages)), dtype=np.float32)
+        self.recent_queue = np.zeros(history, dtype=np.int32)
+        self.n_frames = 0
+        self.missed = 0
+        self.max_queue_depth = 0
+        self.queue_depth = 0
+        self.deferred: Dict[str, int] = {}
+        self.expected = np.zeros(len(self.stages))  # running average of the latency of each stage when it runs
+        self._skipped = np.zeros(len(self.stages), dtype=bool)
+        self._n_skipped = np.zeros(len(self.stages), dtype=np.int64)  # consecutive frames
+        self._current = np.zeros(len(self.stages))
+        self._t_start = None
+        self._t_last = None
+        self._t_first = None
+        self.in_frame = False
+
+    def start_frame(self) -> None:
+        self._t_start = self._t_last = perf_counter()
+        if self._t_first is None:
+            self._t_first = self._t_start
+        self._current[:] = 0
+        self._skipped[:] = False
+        self.in_frame = True
+
+    def mark(self, stage: str) -> None:
+        """attribute the time since the previous mark (or the start of the frame) to stage"""
+        now = perf_counter()
+        self._current[self._index[stage]] += now - self._t_last
+        self._t_last = now
+
+    def add(self, stage: str, duration: float) -> None:
+        """record duration (s) for a stage nested in another one, without moving the mark"""
+        self._current[self._index[stage]] += duration
+
+    def defer(self, stage: str) -> None:
+        """count a piece of work postponed to a later frame"""
+        self.deferred[stage] = self.deferred.get(stage, 0) + 1
+        self._skipped[self._index[stage]] = True
+
+    def elapsed(self) -> float:
+        """time since the start of the current frame (s)"""
+        return perf_counter() - self._t_start
+
+    def over_budget(self, stage: Optional[str] = None) -> bool:
+        """whether frames are waiting in the queue or the current frame is over budget, or would be
+        after running stage (predicted from its running average latency)"""
+        if self.budget is None:
+            return False
+        if stage is not None and self._n_skipped[self._index[stage]] >= self.max_deferred:
+            return False
+        expected = 0. if stage is None else self.expected[self._index[stage]]
+        return self.queue_depth > 0 or self.elapsed() + expected > self.budget
+
+    def end_frame(self, queue_depth: Optional[int] = None) -> None:
+        """
+        close the current frame
+
+        Args:
+            queue_depth: int or None
+                number of frames waiting to be processed. If None and fr is known, it is
+                simulated as the frames a camera running at fr has produced since the
+                first frame minus the frames processed
+        """
+        now = perf_counter()
+        self._current[-1] = now - self._t_start
+        if queue_depth is None and self.fr:
+            queue_depth = max(0, int((now - self._t_first) * self.fr) - self.n_frames)
+        self.queue_depth = queue_depth or 0
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        if self.budget is not None and self._current[-1] > self.budget:
+            self.missed += 1
+        ran = ~self._skipped
+        self._n_skipped[ran] = 0
+        self._n_skipped[self._skipped] += 1
+        self.expected[ran] += (self._current[ran] - self.expected[ran]) * (1. if self.n_frames == 0 else .05)
+        self.hist[np.arange(len(self.stages)), np.searchsorted(_BIN_EDGES, self._current)] += 1
+        self.total += self._current
+        np.maximum(self.max, self._current, out=self.max)
+        self.recent[self.n_frames % self.history] = self._current
+        self.recent_queue[self.n_frames % self.history] = self.queue_depth
+        self.n_frames += 1
+        self.in_frame = False
+
+    def percentile(self, stage: str, q: float) -> float:
+        """q-th percentile (0-100) of the latency of stage, from the histogram"""
+        counts = self.hist[self._index[stage]]
+        if self.n_frames == 0:
+            return 0.
+        k = np.searchsorted(np.cumsum(counts), q / 100. * self.n_frames)
+        # upper edge of the bin, the exact max for the last one
+        return float(min(_BIN_EDGES[min(k, len(_BIN_EDGES) - 1)], self.max[self._index[stage]]))
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """p50, p99, max and mean latency (s) of each stage"""
+        return {stage: {'p50': self.percentile(stage, 50), 'p99': self.percentile(stage, 99),
+                        'max': float(self.max[i]), 'mean': float(self.total[i] / max(self.n_frames, 1))}
+                for i, stage in enumerate(self.stages)}
+
+    def to_dict(self) -> Dict:
+        """all the recorded data as a dict of lists and numbers"""
+        n = min(self.n_frames, self.history)
+        order = (np.arange(self.n_frames - n, self.n_frames) % self.history)
+        return {'stages': self.stages, 'n_frames': self.n_frames, 'budget': self.budget, 'fr': self.fr,
+                'missed': self.missed, 'deferred': dict(self.deferred),
+                'max_queue_depth': self.max_queue_depth, 'summary': self.summary(),
+                'bin_edges': _BIN_EDGES.tolist(),
+                'histograms': {stage: self.hist[i].tolist() for i, stage in enumerate(self.stages)},
+                'recent': {stage: self.recent[order, i].tolist() for i, stage in enumerate(self.stages)},
+                'recent_queue_depth': self.recent_queue[order].tolist()}
+
+    def save(self, filename: str) -> None:
+        """write to_dict() to a json file"""
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    def report(self) -> str:
+        """human readable table of the summary"""
+        lines = ['{0:<12}{1:>10}{2:>10}{3:>10}{4:>10}'.format('stage (ms)', 'p50', 'p99', 'max', 'mean')]
+        for stage, s in self.summary().items():
+            lines.append('{0:<12}{1:>10.2f}{2:>10.2f}{3:>10.2f}{4:>10.2f}'.format(
+                stage, 1e3 * s['p50'], 1e3 * s['p99'], 1e3 * s['max'], 1e3 * s['mean']))
+        lines.append('{0} frames, {1} over the budget of {2}, max queue depth {3}, deferred {4}'.format(
+            self.n_frames, self.missed, 'None' if self.budget is None else '{0:.1f}ms'.format(1e3 * self.budget),
+            self.max_queue_depth, self.deferred))
+        return '\n'.join(lines)
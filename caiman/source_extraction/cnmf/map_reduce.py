@@ -21,17 +21,22 @@ from builtins import range
 
 from past.utils import old_div
 
+from collections import Counter
 from copy import copy, deepcopy
+import itertools
 import logging
 import numpy as np
 import os
+import psutil
+import queue
 import scipy
 from sklearn.decomposition import NMF
 import time
-from typing import Set
+from typing import List, Set
 
-from ...mmapping import load_memmap
+from ...mmapping import ChunkedMemmap, load_memmap
 from ...cluster import extract_patch_coordinates
+from ...shared_multiprocessing import is_local_pool, n_workers
 
 #%%
 def cnmf_patches(args_in):
@@ -115,11 +120,15 @@ def cnmf_patches(args_in):
     # insert slice for timesteps, equivalent to :
     slices.insert(0, slice(timesteps))
 
-    images = np.reshape(Yr.T, [timesteps] + list(dims), order='F')
-    if params.get('patch', 'in_memory'):
-        images = np.array(images[tuple(slices)], dtype=np.float32)
+    if isinstance(Yr, ChunkedMemmap):
+        # only the chunks overlapping the patch are read
+        images = Yr.read_box(slices[1:], slices[0])
     else:
-        images = images[slices]
+        images = np.reshape(Yr.T, [timesteps] + list(dims), order='F')
+        if params.get('patch', 'in_memory'):
+            images = np.array(images[tuple(slices)], dtype=np.float32)
+        else:
+            images = images[slices]
 
     logger.debug(name_log+'file loaded')
 
@@ -145,6 +154,370 @@ def cnmf_patches(args_in):
 # %%
 
 
+def cnmf_patches_timed(args_in):
+    """run cnmf_patches and return its result with the time spent on the patch (s)"""
+    st = time.time()
+    return cnmf_patches(args_in), time.time() - st
+
+
+def estimate_patch_costs(Yr, idx_flat, T, n_frames=1000, block_size=10000) -> np.ndarray:
+    """
+    cheap estimate of the relative work of each patch
+
+    The temporal std of each pixel over a run of frames in the middle of the movie
+    is compared to the median over the FOV. Patches over active tissue hold more
+    components and take longer than quiet ones.
+
+    Args:
+        Yr: np.memmap or ChunkedMemmap
+            movie (pixels x frames) as returned by load_memmap
+
+        idx_flat: list of np.ndarray
+            flat indices of the pixels of each patch
+
+        T: int
+            number of frames
+
+        n_frames: int
+            number of consecutive frames read
+
+        block_size: int
+            number of pixels processed at once
+
+    Returns:
+        costs: np.ndarray
+            number of pixels of each patch weighted by its activity
+    """
+    start = max(0, (T - n_frames) // 2)
+    frames = slice(start, min(T, start + n_frames))
+    d = Yr.shape[0]
+    std = np.zeros(d, dtype=np.float32)
+    for b in range(0, d, block_size):
+        std[b:b + block_size] = np.std(np.asarray(Yr[b:b + block_size, frames], dtype=np.float32), axis=1)
+    std /= max(np.median(std), np.finfo(np.float32).eps)
+    return np.array([len(idx) * (1 + np.mean(std[idx])) for idx in idx_flat])
+
+
+def run_patches_balanced(dview, args_in, costs=None, max_concurrent=None, max_retries=1,
+                         straggler_factor=3., min_straggler_time=10.):
+    """
+    run cnmf_patches on each patch and yield the results as soon as they are available
+
+    The patches are submitted one at a time, most expensive first, so that no more
+    than max_concurrent (default: the number of workers) run at once and the cheap
+    patches fill the cores at the end. A patch raising an exception is run again up
+    to max_retries times. Once all the patches are submitted, a patch running
+    straggler_factor times longer than the median patch (and at least
+    min_straggler_time seconds) is submitted again and the first copy to finish wins:
+    the other copy is aborted if it has not started on an ipyparallel cluster, and its
+    result is discarded otherwise. The results are waited for through the completion
+    callbacks of the tasks.
+
+    Args:
+        dview: multiprocessing pool, ipyparallel direct view or None
+            workers. The patches of an ipyparallel cluster go through a load balanced view
+
+        args_in: list
+            arguments of cnmf_patches for each patch
+
+        costs: np.ndarray or None
+            predicted work of each patch, see estimate_patch_costs. None keeps the order of args_in
+
+        max_concurrent: int or None
+            maximum number of patches running at the same time
+
+        max_retries: int
+            number of times a failing patch is run again before the exception is raised
+
+        straggler_factor: float
+            patches slower than straggler_factor times the median are resubmitted
+
+        min_straggler_time: float
+            patches running for less than min_straggler_time seconds are never resubmitted
+
+    Yields:
+        index: int
+            position of the patch in args_in
+
+        result: list or None
+            output of cnmf_patches
+
+        elapsed: float
+            time spent by the worker on the patch (s)
+    """
+    order = list(range(len(args_in))) if costs is None else list(np.argsort(-np.asarray(costs), kind='stable'))
+    if dview is None:
+        for i in order:
+            for attempt in range(max_retries + 1):
+                try:
+                    res, elapsed = cnmf_patches_timed(args_in[i])
+                    break
+                except Exception:
+                    if attempt == max_retries:
+                        raise
+                    logging.warning('Patch {0} failed, running it again'.format(i), exc_info=True)
+            yield i, res, elapsed
+        return
+
+    finished: queue.Queue = queue.Queue()    # ids of the jobs as they finish, put by the callbacks
+    if is_local_pool(dview):
+        def submit(i, job):
+            return dview.apply_async(cnmf_patches_timed, (args_in[i],), callback=lambda _: finished.put(job),
+                                     error_callback=lambda _: finished.put(job))
+
+        def drop(result):
+            pass    # a running task of a multiprocessing pool cannot be stopped, its result is ignored
+    else:
+        lview = dview.client.load_balanced_view()
+
+        def submit(i, job):
+            result = lview.apply_async(cnmf_patches_timed, args_in[i])
+            result.add_done_callback(lambda _: finished.put(job))
+            return result
+
+        def drop(result):
+            try:
+                result.abort()    # only effective if the copy has not started yet
+            except Exception:
+                logging.debug('Could not abort a copy of a finished patch', exc_info=True)
+
+    n_run = n_workers(dview) if max_concurrent is None else max(1, int(max_concurrent))
+    todo = order[::-1]    # next patch to submit last
+    running = {}          # job id: (patch index, async result, submission time)
+    job_ids = itertools.count()
+    failures = [0] * len(args_in)
+    done = set()
+    timings: List[float] = []
+
+    def start(i):
+        job = next(job_ids)
+        running[job] = (i, submit(i, job), time.time())
+
+    while len(done) < len(args_in):
+        while todo and len(running) < n_run:
+            start(todo.pop())
+        timeout = None    # wait for the next job to finish
+        if not todo and len(running) < n_run and len(timings) > 0:
+            limit = max(min_straggler_time, straggler_factor * np.median(timings))
+            copies = Counter(i for i, _, _ in running.values())
+            now = time.time()
+            for i, _, t0 in list(running.values()):
+                if len(running) < n_run and copies[i] == 1 and now - t0 > limit:
+                    logging.warning('Patch {0} is slow, submitting it again'.format(i))
+                    copies[i] += 1
+                    start(i)
+            if len(running) < n_run:    # or until the next patch becomes a straggler
+                single = [t0 for i, _, t0 in running.values() if copies[i] == 1]
+                if single:
+                    timeout = max(0., min(single) + limit - now)
+        try:
+            job = finished.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        if job not in running:
+            continue    # copy of a patch that is already done
+        i, result, _ = running.pop(job)
+        try:
+            res, elapsed = result.get()
+        except Exception:
+            if any(other[0] == i for other in running.values()):
+                continue    # a copy of the patch is still running
+            failures[i] += 1
+            if failures[i] > max_retries:
+                raise
+            logging.warning('Patch {0} failed, running it again'.format(i), exc_info=True)
+            todo.append(i)
+            continue
+        done.add(i)
+        for other in [other for other, (k, _, _) in running.items() if k == i]:
+            drop(running.pop(other)[1])
+        timings.append(elapsed)
+        yield i, res, elapsed
+    if not is_local_pool(dview):
+        lview.results.clear()
+
+
+# runtime model of a patch: fixed overhead (s) plus a cost per entry of the
+# pixels x frames x components product, in float32 matrix product flops.
+# Fitted on synthetic patches of 25x25 to 49x49 pixels, 1000 to 4000 frames
+_PATCH_OVERHEAD = 0.2
+_FLOP_PER_ENTRY = 750
+_flop_rate = None
+
+
+def _measured_flop_rate() -> float:
+    """float32 matrix product throughput of this machine in flop/s, measured once"""
+    global _flop_rate
+    if _flop_rate is None:
+        a = np.random.rand(1024, 256).astype(np.float32)
+        b = np.random.rand(256, 64).astype(np.float32)
+        a.dot(b)
+        st = time.time()
+        for _ in range(5):
+            a.dot(b)
+        _flop_rate = 5 * 2 * a.shape[0] * a.shape[1] * b.shape[1] / max(time.time() - st, 1e-6)
+    return _flop_rate
+
+
+def count_patches(dims, rf, stride) -> int:
+    """number of patches extract_patch_coordinates creates for the given geometry"""
+    n = 1
+    for dim in dims:
+        n *= len(range(rf, dim - rf, 2 * rf - stride)) + 1
+    return n
+
+
+def patch_memory(n_pixels, T, K, nb=1, memory_fact=1, itemsize=4) -> int:
+    """
+    predicted peak memory (bytes) of cnmf_patches on a single patch
+
+    Args:
+        n_pixels: int
+            number of pixels of the patch
+
+        T: int
+            number of frames
+
+        K: int
+            number of components in the patch
+
+        nb: int
+            number of background components in the patch
+
+        memory_fact: float
+            the pixels are processed in blocks of n_pixels / memory_fact pixels
+
+        itemsize: int
+            bytes per value of the movie loaded in memory
+
+    Returns:
+        bytes: int
+            the patch in memory, a float64 working copy of a block of pixels
+            and the dense spatial and temporal components
+    """
+    patch_bytes = n_pixels * T * itemsize
+    block_bytes = 8 * (n_pixels / memory_fact) * T
+    comp_bytes = 8 * (K + nb) * (4 * T + n_pixels)
+    return int(patch_bytes + block_bytes + comp_bytes)
+
+
+def plan_patches(dims, T, gSig, K=None, nb_patch=1, dtype=np.float32, rf=None, stride=None,
+                 n_processes=None, memory_budget=None, border_pix=0):
+    """Choose the patch geometry, memory_fact, number of workers and batching of run_CNMF_patches
+
+    The geometry starts from a patch of half-size 4*gSig and an overlap of one
+    neuron diameter. Patches are made smaller when there are fewer of them than
+    cores. When the workers do not fit in the memory budget, the pixels of a patch
+    are processed in smaller blocks (memory_fact), then fewer patches are run
+    concurrently, then the patches are made smaller. The predicted memory and
+    runtime per patch are logged.
+
+    Args:
+        dims: tuple of int
+            dimensions of the FOV
+
+        T: int
+            number of frames
+
+        gSig: int or list of int
+            expected half-size of the neurons
+
+        K: int or None
+            expected number of neurons in a patch of half-size rf (or 4*gSig when rf is None).
+            If None, neurons are assumed to cover a quarter of the FOV
+
+        nb_patch: int
+            number of background components per patch
+
+        dtype: numpy dtype
+            dtype of the patches loaded in memory
+
+        rf: int or None
+            starting half-size of the patches, 4*gSig if None
+
+        stride: int or None
+            overlap between patches, one neuron diameter (2*gSig) if None
+
+        n_processes: int or None
+            number of cores available, psutil.cpu_count() if None
+
+        memory_budget: float or None
+            bytes that all the workers together may use, 80% of the available memory if None
+
+        border_pix: int
+            number of pixels excluded around each border
+
+    Returns:
+        plan: dict
+            rf, stride, K, memory_fact, n_processes (workers to start), max_concurrent
+            (patches run at the same time), n_patches, patch_memory (bytes), patch_time (s)
+            and memory_budget (bytes). The entries rf, stride, memory_fact and
+            max_concurrent can be passed to the patch parameters and K to the init parameters.
+    """
+    dims = tuple(int(d) - 2 * border_pix for d in dims)
+    gSig = int(np.max(gSig))
+    itemsize = np.dtype(dtype).itemsize
+    if n_processes is None:
+        n_processes = psutil.cpu_count()
+    if memory_budget is None:
+        memory_budget = 0.8 * psutil.virtual_memory().available
+
+    rf_min = 2 * gSig + 2    # rf > gSiz
+    rf_max = max(rf_min, int(np.ceil(max(dims) / 2.)))
+    rf_ref = min(max(rf_min, 4 * gSig if rf is None else int(rf)), rf_max)
+    rf = rf_ref
+    stride = 2 * gSig if stride is None else int(stride)
+    if K is None:
+        K = (2 * rf_ref + 1) ** len(dims) / 4. / (2 * gSig + 1) ** len(dims)
+
+    def evaluate(rf, memory_fact):
+        n_pixels = int(np.prod([min(2 * rf + 1, d) for d in dims]))
+        K_rf = max(1, int(np.ceil(K * n_pixels / (2 * rf_ref + 1) ** len(dims))))
+        n_patches = count_patches(dims, rf, min(stride, rf))
+        mem = patch_memory(n_pixels, T, K_rf, nb_patch, memory_fact, itemsize)
+        return n_pixels, K_rf, n_patches, mem
+
+    # use all the cores before anything else
+    while rf > rf_min and evaluate(rf, 1)[2] < n_processes:
+        rf = max(rf_min, int(rf * 0.8))
+
+    memory_fact = 1
+    while True:
+        n_pixels, K_rf, n_patches, mem = evaluate(rf, memory_fact)
+        # the parent process keeps the components of all the patches
+        budget = memory_budget - n_patches * K_rf * T * 4 * 3
+        n_workers = min(n_processes, n_patches)
+        max_concurrent = int(budget // mem)
+        if max_concurrent >= n_workers:
+            break
+        if memory_fact < 16 and n_pixels // memory_fact > 1:
+            memory_fact *= 2
+        elif max_concurrent >= 1:
+            n_workers = max_concurrent
+            break
+        elif rf > rf_min:
+            rf, memory_fact = max(rf_min, int(rf * 0.8)), 1
+        else:
+            logging.warning('A single patch needs {0:.0f}MB, more than the memory budget of {1:.0f}MB'.format(
+                mem / 2.**20, budget / 2.**20))
+            n_workers = max_concurrent = 1
+            break
+
+    patch_time = _PATCH_OVERHEAD + _FLOP_PER_ENTRY * n_pixels * T * (K_rf + nb_patch) / _measured_flop_rate()
+    logging.info('Patch plan: rf={0}, stride={1}, K={2}, memory_fact={3}, {4} patches, '
+                 '{5} workers'.format(rf, min(stride, rf), K_rf, memory_fact, n_patches, n_workers))
+    logging.info('Predicted per patch: {0:.1f}MB and {1:.1f}s; all patches: {2:.1f}MB peak '
+                 '(budget {3:.1f}MB) and {4:.1f}s'.format(
+                     mem / 2.**20, patch_time, n_workers * mem / 2.**20, memory_budget / 2.**20,
+                     patch_time * np.ceil(n_patches / n_workers)))
+
+    return {'rf': rf, 'stride': min(stride, rf), 'K': K_rf, 'memory_fact': memory_fact,
+            'n_processes': n_workers,
+            'max_concurrent': n_workers if n_workers < min(n_processes, n_patches) else None,
+            'n_patches': n_patches, 'patch_memory': mem, 'patch_time': patch_time,
+            'memory_budget': memory_budget}
+
+
 def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
                      memory_fact=1, border_pix=0, low_rank_background=True,
                      del_duplicates=False, indices=[slice(None)]*3):
@@ -243,33 +616,21 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
     logging.info('Patch size: {0}'.format(id_2d))
     st = time.time()
     if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            file_res = dview.map_async(cnmf_patches, args_in).get(4294967)
-        else:
-            try:
-                file_res = dview.map_sync(cnmf_patches, args_in)
-                dview.results.clear()
-            except:
-                print('Something went wrong')
-                raise
-            finally:
-                logging.info('Patch processing complete')
-
+        costs = estimate_patch_costs(load_memmap(file_name)[0], idx_flat, T)
     else:
-        file_res = list(map(cnmf_patches, args_in))
-
-    logging.info('Elapsed time for processing patches: \
-                 {0}s'.format(str(time.time() - st).split('.')[0]))
-    # count components
+        costs = None
+    # count components while the other patches are still running
     count = 0
-    count_bgr = 0
-    patch_id = 0
-    num_patches = len(file_res)
-    for jj, fff in enumerate(file_res):
+    num_patches = len(args_in)
+    file_res = [None] * num_patches
+    patch_timings = np.full(num_patches, np.nan)
+    for jj, fff, elapsed in run_patches_balanced(
+            dview, args_in, costs=costs, max_concurrent=params.get('patch', 'max_concurrent')):
+        logging.debug('Patch {0} processed in {1:.1f}s'.format(jj, elapsed))
+        patch_timings[jj] = elapsed
+        file_res[jj] = fff
         if fff is not None:
             idx_, shapes, A, b, C, f, S, bl, c1, neurons_sn, g, sn, _, YrA = fff
-            for _ in range(np.shape(b)[-1]):
-                count_bgr += 1
 
             A = A.tocsc()
             if del_duplicates:
@@ -298,7 +659,9 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
             #         count += 1
             count += np.sum(A.sum(0) > 0)
 
-            patch_id += 1
+    logging.info('Patch processing complete')
+    logging.info('Elapsed time for processing patches: \
+                 {0}s'.format(str(time.time() - st).split('.')[0]))
 
     # INITIALIZING
     nb_patch = params.get('patch', 'nb_patch')
@@ -406,6 +769,7 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
     optional_outputs['B'] = B_tot
     optional_outputs['F'] = F_tot
     optional_outputs['mask'] = mask
+    optional_outputs['patch_timings'] = patch_timings
 
     logging.info("Constructing background")
 
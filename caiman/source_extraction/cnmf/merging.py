@@ -15,7 +15,7 @@ import numpy as np
 import logging
 from past.utils import old_div
 import scipy
-from scipy.sparse import csgraph, csc_matrix, lil_matrix, csr_matrix
+from scipy.sparse import csgraph, csc_matrix, csr_matrix
 
 from .spatial import update_spatial_components, threshold_components
 from .temporal import update_temporal_components
@@ -27,7 +27,7 @@ from .utilities import update_order_greedy
 def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
                      spatial_params, dview=None, thr=0.85, fast_merge=True,
                      mx=1000, bl=None, c1=None, sn=None, g=None,
-                     merge_parallel=False, max_merge_area=None):
+                     merge_parallel=False, max_merge_area=None, merge_cache=None):
 
     """ Merging of spatially overlapping components that have highly correlated temporal activity
 
@@ -95,6 +95,11 @@ def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
             maximum area (in pixels) of merged components,
             used to determine whether to merge
 
+        merge_cache: dict or None
+            correlations of the previous call, updated in place. The correlations
+            of overlapping components whose footprints and traces did not change
+            (e.g. in successive merging rounds) are not recomputed
+
     Returns:
         A:     sparse matrix
                 matrix of merged spatial components (d x K)
@@ -154,14 +159,9 @@ def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
     A_corr.setdiag(0)
     A_corr = A_corr.tocsc()
     FF2 = A_corr > 0
-    C_corr = scipy.sparse.lil_matrix(A_corr.shape)
-    for ii in range(nr):
-        overlap_indices = A_corr[ii, :].nonzero()[1]
-        if len(overlap_indices) > 0:
-            # we chesk the correlation of the calcium traces for eahc overlapping components
-            corr_values = [scipy.stats.pearsonr(C[ii, :], C[jj, :])[
-                0] for jj in overlap_indices]
-            C_corr[ii, overlap_indices] = corr_values
+    # we check the correlation of the calcium traces for each pair of overlapping components
+    fingerprints = component_fingerprints(A, C)
+    C_corr = overlap_correlations(A_corr, C, fingerprints=fingerprints, cache=merge_cache)
 
     FF1 = (C_corr + C_corr.T) > thr
     FF3 = FF1.multiply(FF2)
@@ -170,32 +170,27 @@ def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
         FF3)  # % extract connected components
 
     p = temporal_params['p']
-    list_conxcomp_initial = []
-    for i in range(nb):  # we list them
-        if np.sum(connected_comp == i) > 1:
-            list_conxcomp_initial.append((connected_comp == i).T)
-    list_conxcomp = np.asarray(list_conxcomp_initial).T
-
-    if list_conxcomp.ndim > 1:
-        cor = np.zeros((np.shape(list_conxcomp)[1], 1))
-        for i in range(np.size(cor)):
-            fm = np.where(list_conxcomp[:, i])[0]
-            for j1 in range(np.size(fm)):
-                for j2 in range(j1 + 1, np.size(fm)):
-                    cor[i] = cor[i] + C_corr[fm[j1], fm[j2]]
+    groups = np.where(np.bincount(connected_comp, minlength=nb) > 1)[0]
+    kept, n_merged = np.arange(nr), 0
+
+    if len(groups) > 0:
+        # sum of the correlations of the overlapping pairs within each group
+        pairs = C_corr.tocoo()
+        same = connected_comp[pairs.row] == connected_comp[pairs.col]
+        cor = np.bincount(connected_comp[pairs.row[same]], weights=pairs.data[same], minlength=nb)[groups]
 
 #        if not fast_merge:
 #            Y_res = Y - A.dot(C) #residuals=background=noise
         if np.size(cor) > 1:
             # we get the size (indices)
-            ind = np.argsort(np.squeeze(cor))[::-1]
+            ind = np.argsort(cor)[::-1]
         else:
             ind = [0]
 
         nbmrg = min((np.size(ind), mx))   # number of merging operations
 
         if merge_parallel:
-            merged_ROIs = [np.where(list_conxcomp[:, ind[i]])[0] for i in range(nbmrg)]
+            merged_ROIs = [np.where(connected_comp == groups[ind[i]])[0] for i in range(nbmrg)]
             Acsc_mats = [csc_matrix(A[:, merged_ROI]) for merged_ROI in merged_ROIs]
             Ctmp_mats = [C[merged_ROI] + R[merged_ROI] for merged_ROI in merged_ROIs]
             C_to_norms = [np.sqrt(np.ravel(Acsc.power(2).sum(
@@ -224,7 +219,7 @@ def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
             R_merged = np.vstack([res[7] for res in merge_res])
         else:
             # we initialize the values
-            A_merged = lil_matrix((d, nbmrg))
+            A_merged = []
             C_merged = np.zeros((nbmrg, t))
             R_merged = np.zeros((nbmrg, t))
             S_merged = np.zeros((nbmrg, t))
@@ -234,11 +229,11 @@ def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
             g_merged = np.zeros((nbmrg, p))
             merged_ROIs = []
             for i in range(nbmrg):
-                merged_ROI = np.where(list_conxcomp[:, ind[i]])[0]
+                merged_ROI = np.where(connected_comp == groups[ind[i]])[0]
                 logging.info('Merging components {}'.format(merged_ROI))
                 merged_ROIs.append(merged_ROI)
                 Acsc = A.tocsc()[:, merged_ROI]
-                Ctmp = np.array(C)[merged_ROI, :] + np.array(R)[merged_ROI, :]
+                Ctmp = np.asarray(C)[merged_ROI, :] + np.asarray(R)[merged_ROI, :]
                 C_to_norm = np.sqrt(np.ravel(Acsc.power(2).sum(
                     axis=0)) * np.sum(Ctmp ** 2, axis=1))
                 indx = np.argmax(C_to_norm)
@@ -246,7 +241,7 @@ def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
                 bm, cm, computedA, computedC, gm, sm, ss, yra = merge_iteration(Acsc, C_to_norm, Ctmp, fast_merge, g, g_idx,
                                                                                 indx, temporal_params)
 
-                A_merged[:, i] = csr_matrix(computedA).T
+                A_merged.append(csc_matrix(computedA.reshape((d, 1))))
                 C_merged[i, :] = computedC
                 R_merged[i, :] = yra
                 S_merged[i, :] = ss[:t]
@@ -254,6 +249,7 @@ def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
                 c1_merged[i] = cm
                 sn_merged[i] = sm
                 g_merged[i, :] = gm
+            A_merged = scipy.sparse.hstack(A_merged).tocsc()
 
         empty = np.ravel((C_merged.sum(1) == 0) + (A_merged.sum(0) == 0))
         if np.any(empty):
@@ -291,14 +287,111 @@ def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
                 g = np.vstack((g, g_merged))
 
             nr = nr - len(neur_id) + len(C_merged)
+            kept, n_merged = good_neurons, len(C_merged)
 
     else:
         logging.info('No more components merged!')
         merged_ROIs = []
         empty = []
 
+    if merge_cache is not None:
+        update_merge_cache(merge_cache, C_corr, fingerprints, kept, n_merged)
+
     return A, C, nr, merged_ROIs, S, bl, c1, sn, g, empty, R
 
+def component_fingerprints(A, C) -> np.ndarray:
+    """ column sums of A and row sums and sums of squares of C (K x 3), used to
+    tell which components changed between two calls of merge_components
+    """
+    return np.stack([np.ravel(csc_matrix(A).sum(0)), np.sum(C, 1, dtype=np.float64),
+                     np.einsum('ij,ij->i', C, C, dtype=np.float64)], 1)
+
+
+def overlap_correlations(A_corr, C, fingerprints=None, cache=None, block_bytes=2**27) -> csr_matrix:
+    """ correlation coefficients of the traces of overlapping components
+
+    The traces are standardized once and the correlations of all the pairs are
+    computed in blocks of pairs, using at most about block_bytes of memory per block.
+
+    Args:
+        A_corr: sparse matrix
+            K x K upper triangular overlaps, the correlations are computed at its nonzero entries
+
+        C: np.ndarray
+            matrix of temporal components (K x T)
+
+        fingerprints: np.ndarray or None
+            fingerprints of the components, see component_fingerprints (needed by the cache)
+
+        cache: dict or None
+            see update_merge_cache. The correlations of the pairs of components whose
+            fingerprints are the same as in the cache are taken from it
+
+        block_bytes: int
+            size of the blocks of pairs
+
+    Returns:
+        C_corr: csr_matrix
+            K x K correlations of the traces at the nonzero entries of A_corr
+    """
+    K, T = np.shape(C)
+    A_corr = csr_matrix(A_corr)
+    A_corr.eliminate_zeros()
+    A_corr.sort_indices()
+    rows = np.repeat(np.arange(K), np.diff(A_corr.indptr))
+    cols = A_corr.indices
+    corr = np.zeros(len(rows))
+    todo = np.ones(len(rows), dtype=bool)
+    if cache and fingerprints is not None:
+        n = min(len(cache['fingerprints']), K)
+        known = np.zeros(K, dtype=bool)
+        known[:n] = np.all(cache['fingerprints'][:n] == fingerprints[:n], 1)
+        todo = ~(known[rows] & known[cols])
+        if not np.all(todo):
+            corr[~todo] = np.ravel(cache['corr'][rows[~todo], cols[~todo]])
+
+    if np.any(todo):
+        idx, pos = np.unique(np.concatenate([rows[todo], cols[todo]]), return_inverse=True)
+        Cs = np.array(C[idx], dtype=np.float64)
+        Cs -= Cs.mean(1)[:, None]
+        with np.errstate(invalid='ignore', divide='ignore'):   # constant traces have no correlation (nan)
+            Cs /= np.linalg.norm(Cs, axis=1)[:, None]
+        ii, jj = np.split(pos, 2)
+        step = max(1, block_bytes // (16 * T))
+        values = [np.einsum('ij,ij->i', Cs[ii[k:k + step]], Cs[jj[k:k + step]]) for k in range(0, len(ii), step)]
+        corr[todo] = np.clip(np.concatenate(values), -1, 1)
+
+    return csr_matrix((corr, (rows, cols)), shape=(K, K))
+
+
+def update_merge_cache(cache, C_corr, fingerprints, kept, n_merged) -> None:
+    """ store in cache the correlations and fingerprints of the components after merging
+
+    Args:
+        cache: dict
+            updated in place
+
+        C_corr: sparse matrix
+            correlations before merging, see overlap_correlations
+
+        fingerprints: np.ndarray
+            fingerprints of the components before merging
+
+        kept: np.ndarray
+            indices (before merging) of the components that were not merged, in their order after merging
+
+        n_merged: int
+            number of merged components, appended after the kept ones
+    """
+    K = len(kept) + n_merged
+    pos = np.full(C_corr.shape[0], -1)
+    pos[kept] = np.arange(len(kept))
+    pairs = C_corr.tocoo()
+    keep = (pos[pairs.row] >= 0) & (pos[pairs.col] >= 0)
+    cache['corr'] = csr_matrix((pairs.data[keep], (pos[pairs.row[keep]], pos[pairs.col[keep]])), shape=(K, K))
+    cache['fingerprints'] = np.vstack([fingerprints[kept], np.full((n_merged, fingerprints.shape[1]), np.nan)])
+
+
 def merge_iter(a):
     Acsc, C_to_norm, Ctmp, fast_merge, g, g_idx, indx, temporal_params = a
     res = merge_iteration(Acsc, C_to_norm, Ctmp, fast_merge, g, g_idx,
@@ -58,6 +58,8 @@ cdef class OASIS:
         Pools of the active set method, i.e. a sufficient statistics.
     t : int
         Number of processed time steps.
+    t0 : int
+        First time step still covered by the pools, see retire_pools.
     h : array of float
         Explicit calcium kernel to avoid duplicated recalculations.
     d : float
@@ -76,7 +78,7 @@ cdef class OASIS:
         Py_ssize_t i
         SINGLE v, w, g, lam, s_min, b, g2, d, r, yt
         vector[Pool] P
-        unsigned int t
+        unsigned int t, t0
         SINGLE[1000] h, g12, g11g11, g11g12  # assume kernel length <= 1000
         vector[SINGLE] _y
 
@@ -92,6 +94,7 @@ cdef class OASIS:
         self.s_min = s_min
         self.b = b
         self.P = []
+        self.t0 = 0
         # precompute
         if g2 == 0:  # AR(1)
             # calc explicit kernel h just once; length should be >=max ISI
@@ -141,9 +144,11 @@ cdef class OASIS:
         """
         fit next time step t
         """
+        self._fit_next(yt)
+
+    cdef void _fit_next(self, SINGLE yt):
         cdef Pool newpool
         cdef Py_ssize_t j, k
-        cdef np.ndarray[SINGLE, ndim = 1] h, g12, g11g11, g11g12
         cdef SINGLE tmp
         if self.g2 == 0:  # AR(1)
             newpool.v = yt - self.b - self.lam * (1 - self.g)
@@ -494,6 +499,34 @@ cdef class OASIS:
                 #     c[k] = c[k - 1] * self.d
         return c
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _write_c_of_last_pool(self, SINGLE[:] c, Py_ssize_t t):
+        """
+        write the denoised calcium of the last pool into c, ending at index t,
+        i.e. c[t + 1 - l:t + 1] = get_c_of_last_pool() truncated at the start of c
+        """
+        cdef Py_ssize_t k, l, k0
+        cdef SINGLE tmp
+        l = self.P[self.i].l
+        k0 = l - 1 - t if l > t + 1 else 0
+        if self.g2 == 0:  # AR(1)
+            tmp = self.P[self.i].v / self.P[self.i].w
+            for k in range(k0, l):
+                c[t + 1 - l + k] = tmp * self.h[k] if k < 1000 else 0
+        else:  # AR(2)
+            if self.i == 0:  # first pool
+                tmp = self.P[0].v
+                for k in range(l):
+                    if k > 0:
+                        tmp = tmp * self.d
+                    if k >= k0:
+                        c[t + 1 - l + k] = tmp
+            else:
+                for k in range(k0, l):
+                    c[t + 1 - l + k] = (self.h[k] * self.P[self.i].v +
+                                        self.g12[k] * self.P[self.i - 1].w) if k < 1000 else 0
+
     def remove_last_pool(self):
         cdef Py_ssize_t k
         self.t -= self.P[self.i].l
@@ -503,6 +536,32 @@ cdef class OASIS:
         self.i -= 1
         self.P.pop_back()
 
+    def retire_pools(self, t):
+        """
+        drop the pools ending before time step t, except the last of them (the last
+        two for AR(2)), which the later pools depend on. The time steps of the dropped
+        pools can no longer be refit and are left out of c and s, which then start at
+        time step t0 with the kept pools. The values of c and s over the kept pools
+        that end before t are not exact, the later ones are.
+        """
+        cdef Py_ssize_t j, k, off
+        j = 0
+        while j < self.i and self.P[j + 1].t + self.P[j + 1].l + self.t0 <= t:
+            j += 1
+        if self.g2 != 0:
+            j -= 1  # the first pool is handled as the start of the trace
+        if j <= 0:
+            return
+        off = self.P[j].t
+        self.P.erase(self.P.begin(), self.P.begin() + j)
+        self.i -= j
+        for k in range(self.i + 1):
+            self.P[k].t -= off
+        if self.g2 != 0:
+            self._y.erase(self._y.begin(), self._y.begin() + off)
+        self.t -= off
+        self.t0 += off
+
     def get_l_of_pool(self, idx_from_end=0):
         return self.P[self.i - idx_from_end].l
 
@@ -539,12 +598,16 @@ cdef class OASIS:
 
     @property
     def t(self):
-        return self.t
+        return self.t + self.t0
+
+    @property
+    def t0(self):
+        return self.t0
 
     @property
     def c(self):
         """
-        construct and return full calcium trace
+        construct and return full calcium trace, from time step t0
         """
         cdef np.ndarray[SINGLE, ndim = 1] c
         cdef Py_ssize_t j, k
@@ -577,7 +640,7 @@ cdef class OASIS:
     @property
     def s(self):
         """
-        construct and return full deconvolved activity, 'spike rates'
+        construct and return full deconvolved activity, 'spike rates', from time step t0
         """
         cdef np.ndarray[SINGLE, ndim = 1] s
         cdef Py_ssize_t j
@@ -591,6 +654,45 @@ cdef class OASIS:
             return self.get_s(self.P[self.i].t + self.P[self.i].l)
 
 
+def fit_next_batch(list oases, SINGLE[:] y, SINGLE[:, :] C, Py_ssize_t t):
+    """
+    Advance each OASIS instance oases[n] by the time step y[n] and write the
+    denoised calcium of its last pool into C[n, :t + 1], as
+    o.fit_next(y[n]); C[n, t + 1 - l:t + 1] = o.get_c_of_last_pool()
+    in a single compiled loop over all components.
+
+    Parameters
+    ----------
+    oases : list of OASIS
+        One instance per component.
+    y : array of float32, shape (len(oases),)
+        Undenoised fluorescence of each component at the new time step.
+    C : array of float32, shape (len(oases), T)
+        Denoised fluorescence, modified in place. Pools reaching back before
+        the first column of C are truncated.
+    t : int
+        Column of C of the new time step.
+    """
+    cdef Py_ssize_t n
+    cdef OASIS o
+    for n in range(len(oases)):
+        o = oases[n]
+        o._fit_next(y[n])
+        o._write_c_of_last_pool(C[n], t)
+
+
+def get_c_of_last_pools(list oases, SINGLE[:, :] C, Py_ssize_t t):
+    """
+    Write the denoised calcium of the last pool of each OASIS instance oases[n]
+    into C[n, :t + 1], see fit_next_batch.
+    """
+    cdef Py_ssize_t n
+    cdef OASIS o
+    for n in range(len(oases)):
+        o = oases[n]
+        o._write_c_of_last_pool(C[n], t)
+
+
 @cython.cdivision(True)
 def oasisAR1(np.ndarray[SINGLE, ndim=1] y, SINGLE g, SINGLE lam=0, SINGLE s_min=0):
     """ Infer the most likely discretized spike train underlying an AR(1) fluorescence trace
@@ -25,6 +25,7 @@ from multiprocessing import current_process, cpu_count
 import numpy as np
 import os
 from past.utils import old_div
+import tempfile
 from scipy.ndimage import percentile_filter
 from scipy.ndimage.filters import gaussian_filter
 from scipy.sparse import coo_matrix, csc_matrix, spdiags, hstack
@@ -39,16 +40,18 @@ import caiman
 from .cnmf import CNMF
 from .estimates import Estimates
 from .initialization import imblur, initialize_components, hals, downscale
-from .oasis import OASIS
+from .latency import FrameProfiler
+from .oasis import OASIS, fit_next_batch, get_c_of_last_pools
 from .params import CNMFParams
 from .pre_processing import get_noise_fft
 from .utilities import update_order, get_file_size, peak_local_max, decimation_matrix
 from ... import mmapping
-from ...components_evaluation import compute_event_exceptionality
+from ...components_evaluation import compute_event_exceptionality, load_CNN_model
 from ...motion_correction import (motion_correct_iteration_fast,
                                   tile_and_correct, high_pass_filter_space,
                                   sliding_window)
-from ...utils.utils import save_dict_to_hdf5, load_dict_from_hdf5, parmap, load_graph
+from ...shared_multiprocessing import is_local_pool
+from ...utils.utils import save_dict_to_hdf5, load_dict_from_hdf5, parmap
 from ...utils.stats import pd_solve
 from ... import summary_images
 
@@ -92,6 +95,10 @@ class OnACID(object):
             self.params = params if params is not None else onacid.params
             self.estimates= estimates if estimates is not None else onacid.estimates
         self.dview = dview
+        self.trace_store = None   # file receiving the traces older than the trace window
+        self.trace_offset = 0     # frame of the first column of C_on and noisyC
+        self.profiler = None
+        self._shape_update_pending = False
 #            if params is None or estimates is None:
 #                raise ValueError("Cannot Specify Estimates and Params While \
 #                                 Loading Object From File")
@@ -160,6 +167,23 @@ class OnACID(object):
         else:
             self.estimates.dims = old_dims
 
+        trace_window = self.params.get('online', 'trace_window')
+        if trace_window is not None:
+            # fit_next reads up to min_keep frames back from the current one
+            min_keep = max(self.params.get('online', 'minibatch_shape'),
+                           self.params.get('online', 'minibatch_suff_stat') + 1, 51)
+            T = max(int(trace_window), 2 * min_keep, init_batch + 1)
+            self.trace_store = self.params.get('online', 'trace_store')
+            if self.trace_store is None:
+                fd, self.trace_store = tempfile.mkstemp(suffix='.traces')
+                os.close(fd)
+            TraceStore(self.trace_store).clear()
+            logging.info('Keeping the last {0} frames of the traces in memory, older ones go to {1}'.format(
+                T, self.trace_store))
+        else:
+            self.trace_store = None
+        self.trace_offset = 0
+
         self.estimates.normalize_components()
         self.estimates.A = self.estimates.A.todense()
         self.estimates.noisyC = np.zeros(
@@ -229,6 +253,9 @@ class OnACID(object):
             self.estimates.Ab_dense[:, :self.estimates.Ab.shape[1]] = self.estimates.Ab.toarray()
         self.estimates.C_on = np.vstack(
             [self.estimates.noisyC[:self.params.get('init', 'nb'), :], self.estimates.C_on.astype(np.float32)])
+        # identifiers of the rows of C_on and noisyC in the trace store
+        self.trace_ids = list(range(self.M))
+        self.next_trace_id = self.M
 
         if not self.is1p:
             self.params.set('init', {'gSiz': np.add(np.multiply(np.ceil(
@@ -293,6 +320,8 @@ class OnACID(object):
         if self.params.get('online', 'dist_shape_update'):
             self.time_spend = 0
             self.comp_upd:List = []
+        self.profiler = self._new_profiler()
+        self._shape_update_pending = False
         # setup per patch classifier
 
         if self.params.get('online', 'path_to_model') is None or self.params.get('online', 'sniper_mode') is False:
@@ -301,34 +330,11 @@ class OnACID(object):
             self.tf_in = None
             self.tf_out = None
         else:
-            try:
-                from tensorflow.keras.models import model_from_json
-                logging.info('Using Keras')
-                use_keras = True
-            except(ModuleNotFoundError):
-                use_keras = False
-                logging.info('Using Tensorflow')
-            if use_keras:
-                path = self.params.get('online', 'path_to_model').split(".")[:-1]
-                json_path = ".".join(path + ["json"])
-                model_path = ".".join(path + ["h5"])
-                json_file = open(json_path, 'r')
-                loaded_model_json = json_file.read()
-                json_file.close()
-                loaded_model = model_from_json(loaded_model_json)
-                loaded_model.load_weights(model_path)
-                #opt = tf.keras.optimizers.rmsprop(lr=0.0001, decay=1e-6)
-                #loaded_model.compile(loss=tf.keras.losses.categorical_crossentropy,
-                #                     optimizer=opt, metrics=['accuracy'])
-                self.tf_in = None
-                self.tf_out = None
-            else:
-                path = self.params.get('online', 'path_to_model').split(".")[:-1]
-                model_path = '.'.join(path + ['h5', 'pb'])
-                loaded_model = load_graph(model_path)
-                self.tf_in = loaded_model.get_tensor_by_name('prefix/conv2d_1_input:0')
-                self.tf_out = loaded_model.get_tensor_by_name('prefix/output_node0:0')
-                loaded_model = tf.Session(graph=loaded_model)
+            # shared with the other instances of this process
+            loaded_model = load_CNN_model(
+                '.'.join(self.params.get('online', 'path_to_model').split(".")[:-1]))
+            self.tf_in = None
+            self.tf_out = None
         self.loaded_model = loaded_model
 
         if self.is1p:
@@ -399,61 +405,75 @@ class OnACID(object):
         """
 
         t_start = time()
+        if not isinstance(self.profiler, FrameProfiler):
+            self.profiler = self._new_profiler()
+        own_frame = not self.profiler.in_frame
+        if own_frame:
+            self.profiler.start_frame()
 
         # locally scoped variables for brevity of code and faster look up
-        nb_ = self.params.get('init', 'nb')
+        online = self.params.snapshot('online')
+        init = self.params.snapshot('init')
+        preprocess = self.params.snapshot('preprocess')
+        data = self.params.snapshot('data')
+        temporal = self.params.snapshot('temporal')
+        deadline = online.deadline_mode
+        nb_ = init.nb
         Ab_ = self.estimates.Ab
-        mbs = self.params.get('online', 'minibatch_shape')
-        ssub_B = self.params.get('init', 'ssub_B') * self.params.get('init', 'ssub')
+        mbs = online.minibatch_shape
+        ssub_B = init.ssub_B * init.ssub
         d1, d2 = self.estimates.dims
-        expected_comps = self.params.get('online', 'expected_comps')
+        expected_comps = online.expected_comps
+        if self.trace_store is not None and t - self.trace_offset >= self.estimates.C_on.shape[-1]:
+            self._spill_traces()
+        tc = t - self.trace_offset    # column of frame t in C_on and noisyC
         frame = frame_in.astype(np.float32)
 #        print(np.max(1/scipy.sparse.linalg.norm(self.estimates.Ab,axis = 0)))
         self.estimates.Yr_buf.append(frame)
         if len(self.estimates.ind_new) > 0:
             self.estimates.mean_buff = self.estimates.Yres_buf.mean(0)
 
-        if (not self.params.get('online', 'simultaneously')) or self.params.get('preprocess', 'p') == 0:
+        if (not online.simultaneously) or preprocess.p == 0:
             # get noisy fluor value via NNLS (project data on shapes & demix)
-            C_in = self.estimates.noisyC[:self.M, t - 1].copy()
+            C_in = self.estimates.noisyC[:self.M, tc - 1].copy()
             if self.is1p:
-                self.estimates.C_on[:self.M, t], self.estimates.noisyC[:self.M, t] = demix1p(
+                self.estimates.C_on[:self.M, tc], self.estimates.noisyC[:self.M, tc] = demix1p(
                     frame, self.estimates.Ab, C_in, self.estimates.AtA, Atb=self.estimates.Atb,
                     AtW=self.estimates.AtW, AtWA=self.estimates.AtWA, iters=num_iters_hals,
                     groups=self.estimates.groups, ssub_B=ssub_B, 
                     downscale_matrix=self.estimates.downscale_matrix if ssub_B > 1 else None)
             else:
-                self.estimates.C_on[:self.M, t], self.estimates.noisyC[:self.M, t] = HALS4activity(
+                self.estimates.C_on[:self.M, tc], self.estimates.noisyC[:self.M, tc] = HALS4activity(
                     frame, self.estimates.Ab, C_in, self.estimates.AtA, iters=num_iters_hals, groups=self.estimates.groups)
-            if self.params.get('preprocess', 'p'):
-                # denoise & deconvolve
-                for i, o in enumerate(self.estimates.OASISinstances):
-                    o.fit_next(self.estimates.noisyC[nb_ + i, t])
-                    self.estimates.C_on[nb_ + i, t - o.get_l_of_last_pool() +
-                              1: t + 1] = o.get_c_of_last_pool()
+            self.profiler.mark('demix')
+            if preprocess.p:
+                # denoise & deconvolve all components in one call, the part of the
+                # last pool older than the trace window is recovered from OASIS
+                fit_next_batch(self.estimates.OASISinstances, self.estimates.noisyC[nb_:self.M, tc],
+                               self.estimates.C_on[nb_:self.M], tc)
 
         else:
             if self.is1p:
                 raise NotImplementedError(
                     'simultaneous demixing and deconvolution not implemented yet for CNMF-E')
             # update buffer, initialize C with previous value
-            self.estimates.C_on[:, t] = self.estimates.C_on[:, t - 1]
-            self.estimates.noisyC[:, t] = self.estimates.C_on[:, t - 1]
+            self.estimates.C_on[:, tc] = self.estimates.C_on[:, tc - 1]
+            self.estimates.noisyC[:, tc] = self.estimates.C_on[:, tc - 1]
             self.estimates.AtY_buf = np.concatenate((self.estimates.AtY_buf[:, 1:], self.estimates.Ab.T.dot(frame)[:, None]), 1) \
-                if self.params.get('online', 'n_refit') else self.estimates.Ab.T.dot(frame)[:, None]
+                if online.n_refit else self.estimates.Ab.T.dot(frame)[:, None]
             # demix, denoise & deconvolve
-            (self.estimates.C_on[:self.M, t + 1 - mbs:t + 1], self.estimates.noisyC[:self.M, t + 1 - mbs:t + 1],
+            (self.estimates.C_on[:self.M, tc + 1 - mbs:tc + 1], self.estimates.noisyC[:self.M, tc + 1 - mbs:tc + 1],
                 self.estimates.OASISinstances) = demix_and_deconvolve(
-                self.estimates.C_on[:self.M, t + 1 - mbs:t + 1],
-                self.estimates.noisyC[:self.M, t + 1 - mbs:t + 1],
+                self.estimates.C_on[:self.M, tc + 1 - mbs:tc + 1],
+                self.estimates.noisyC[:self.M, tc + 1 - mbs:tc + 1],
                 self.estimates.AtY_buf, self.estimates.AtA, self.estimates.OASISinstances, iters=num_iters_hals,
-                n_refit=self.params.get('online', 'n_refit'))
-            for i, o in enumerate(self.estimates.OASISinstances):
-                self.estimates.C_on[nb_ + i, t - o.get_l_of_last_pool() + 1: t +
-                          1] = o.get_c_of_last_pool()
+                n_refit=online.n_refit)
+            self.profiler.mark('demix')
+            get_c_of_last_pools(self.estimates.OASISinstances, self.estimates.C_on[nb_:self.M], tc)
+        self.profiler.mark('deconvolve')
 
         #self.estimates.mean_buff = self.estimates.Yres_buf.mean(0)
-        res_frame = frame - self.estimates.Ab.dot(self.estimates.C_on[:self.M, t])
+        res_frame = frame - self.estimates.Ab.dot(self.estimates.C_on[:self.M, tc])
         if self.is1p:
             self.estimates.b0 = self.estimates.b0 * (t-1)/t + res_frame/t
             res_frame -= self.estimates.b0
@@ -466,12 +486,13 @@ class OnACID(object):
         self.estimates.mn = (t-1)/t*self.estimates.mn + res_frame/t
         self.estimates.vr = (t-1)/t*self.estimates.vr + (res_frame - mn_)*(res_frame - self.estimates.mn)/t
         self.estimates.sn = np.sqrt(self.estimates.vr)
-        
+        self.profiler.mark('residual')
+
         t_new = time()
         num_added = 0
-        if self.params.get('online', 'update_num_comps'):
+        if online.update_num_comps:
 
-            if self.params.get('online', 'use_corr_img'):
+            if online.use_corr_img:
                 corr_img_mode = 'simple'  #'exponential'  # 'cumulative'
                 self.estimates.corr_img = summary_images.update_local_correlations(
                     t + 1 if corr_img_mode == 'cumulative' else mbs, 
@@ -481,66 +502,78 @@ class OnACID(object):
                     self.estimates.num_neigbors, self.estimates.corrM,
                     del_frames=[self.estimates.Yres_buf[self.estimates.Yres_buf.cur]]
                     if corr_img_mode == 'simple' else None)
-            self.estimates.mean_buff += (res_frame-self.estimates.Yres_buf[self.estimates.Yres_buf.cur])/self.params.get('online', 'minibatch_shape')
+            self.estimates.mean_buff += (res_frame-self.estimates.Yres_buf[self.estimates.Yres_buf.cur])/online.minibatch_shape
             self.estimates.Yres_buf.append(res_frame)
 
             res_frame = np.reshape(res_frame, self.estimates.dims, order='F')
 
-            if self.params.get('online', 'use_corr_img'):
+            if online.use_corr_img:
                 self.estimates.max_img = np.max([self.estimates.max_img, res_frame], 0)
             else:
-                rho = imblur(np.maximum(res_frame,0), sig=self.params.get('init', 'gSig'),
-                             siz=self.params.get('init', 'gSiz'),
-                             nDimBlur=len(self.params.get('data', 'dims')))**2
-                rho = np.reshape(rho, np.prod(self.params.get('data', 'dims')))
+                rho = imblur(np.maximum(res_frame,0), sig=init.gSig,
+                             siz=init.gSiz,
+                             nDimBlur=len(data.dims))**2
+                rho = np.reshape(rho, np.prod(data.dims))
                 self.estimates.rho_buf.append(rho)
 
             # old_max_img = self.estimates.max_img.copy()
-            if self.params.get('preprocess', 'p') == 1:
+            if preprocess.p == 1:
                 g_est = np.mean(self.estimates.g)
-            elif self.params.get('preprocess', 'p') == 2:
+            elif preprocess.p == 2:
                 g_est = np.mean(self.estimates.g, 0)
             else:
                 g_est = 0
-            use_corr = self.params.get('online', 'use_corr_img')
-            (self.estimates.Ab, Cf_temp, self.estimates.Yres_buf, self.estimates.rho_buf,
-                self.estimates.CC, self.estimates.CY, self.ind_A, self.estimates.sv,
-                self.estimates.groups, self.estimates.ind_new, self.ind_new_all,
-                self.estimates.sv, self.cnn_pos) = update_num_components(
-                t, self.estimates.sv, self.estimates.Ab, self.estimates.C_on[:self.M, (t - mbs + 1):(t + 1)],
-                self.estimates.Yres_buf, self.estimates.Yr_buf, self.estimates.rho_buf,
-                self.params.get('data', 'dims'), self.params.get('init', 'gSig'),
-                self.params.get('init', 'gSiz'), self.ind_A, self.estimates.CY, self.estimates.CC,
-                rval_thr=self.params.get('online', 'rval_thr'),
-                thresh_fitness_delta=self.params.get('online', 'thresh_fitness_delta'),
-                thresh_fitness_raw=self.params.get('online', 'thresh_fitness_raw'),
-                thresh_overlap=self.params.get('online', 'thresh_overlap'), groups=self.estimates.groups,
-                batch_update_suff_stat=self.params.get('online', 'batch_update_suff_stat'),
-                gnb=self.params.get('init', 'nb'), sn=self.estimates.sn, 
-                g=g_est, s_min=self.params.get('temporal', 's_min'),
-                Ab_dense=self.estimates.Ab_dense if self.params.get('online', 'use_dense') else None,
-                oases=self.estimates.OASISinstances if self.params.get('preprocess', 'p') else None,
-                N_samples_exceptionality=self.params.get('online', 'N_samples_exceptionality'),
-                max_num_added=self.params.get('online', 'max_num_added'),
-                min_num_trial=self.params.get('online', 'min_num_trial'),
-                loaded_model = self.loaded_model, test_both=self.params.get('online', 'test_both'),
-                thresh_CNN_noisy = self.params.get('online', 'thresh_CNN_noisy'),
-                sniper_mode=self.params.get('online', 'sniper_mode'),
-                use_peak_max=self.params.get('online', 'use_peak_max'),
-                mean_buff=self.estimates.mean_buff,
-                tf_in=self.tf_in, tf_out=self.tf_out,
-                ssub_B=ssub_B, W=self.estimates.W if self.is1p else None,
-                b0=self.estimates.b0 if self.is1p else None,
-                corr_img=self.estimates.corr_img if use_corr else None,
-                first_moment=self.estimates.first_moment if use_corr else None,
-                second_moment=self.estimates.second_moment if use_corr else None,
-                crosscorr=self.estimates.crosscorr if use_corr else None,
-                col_ind=self.estimates.col_ind if use_corr else None,
-                row_ind=self.estimates.row_ind if use_corr else None,
-                corr_img_mode=corr_img_mode if use_corr else None,
-                downscale_matrix=self.estimates.downscale_matrix if
-                (self.is1p and ssub_B > 1) else None,
-                max_img=self.estimates.max_img if use_corr else None)
+            use_corr = online.use_corr_img
+            self.profiler.mark('residual')
+            if deadline and self.profiler.over_budget('detect'):
+                # search for new components in a later frame, but keep the running
+                # sum of the residual buffer up to date as update_num_components does
+                if not use_corr:
+                    self.estimates.sv -= self.estimates.rho_buf.get_first()
+                    self.estimates.sv += self.estimates.rho_buf.get_last_frames(1).squeeze()
+                    self.estimates.sv = np.maximum(self.estimates.sv, 0)
+                self.estimates.ind_new = []
+                self.profiler.defer('detect')
+            else:
+                (self.estimates.Ab, Cf_temp, self.estimates.Yres_buf, self.estimates.rho_buf,
+                    self.estimates.CC, self.estimates.CY, self.ind_A, self.estimates.sv,
+                    self.estimates.groups, self.estimates.ind_new, self.ind_new_all,
+                    self.estimates.sv, self.cnn_pos) = update_num_components(
+                    t, self.estimates.sv, self.estimates.Ab, self.estimates.C_on[:self.M, (tc - mbs + 1):(tc + 1)],
+                    self.estimates.Yres_buf, self.estimates.Yr_buf, self.estimates.rho_buf,
+                    data.dims, init.gSig,
+                    init.gSiz, self.ind_A, self.estimates.CY, self.estimates.CC,
+                    rval_thr=online.rval_thr,
+                    thresh_fitness_delta=online.thresh_fitness_delta,
+                    thresh_fitness_raw=online.thresh_fitness_raw,
+                    thresh_overlap=online.thresh_overlap, groups=self.estimates.groups,
+                    batch_update_suff_stat=online.batch_update_suff_stat,
+                    gnb=init.nb, sn=self.estimates.sn, 
+                    g=g_est, s_min=temporal.s_min,
+                    Ab_dense=self.estimates.Ab_dense if online.use_dense else None,
+                    oases=self.estimates.OASISinstances if preprocess.p else None,
+                    N_samples_exceptionality=online.N_samples_exceptionality,
+                    max_num_added=online.max_num_added,
+                    min_num_trial=online.min_num_trial,
+                    loaded_model = self.loaded_model, test_both=online.test_both,
+                    thresh_CNN_noisy = online.thresh_CNN_noisy,
+                    sniper_mode=online.sniper_mode,
+                    use_peak_max=online.use_peak_max,
+                    mean_buff=self.estimates.mean_buff,
+                    tf_in=self.tf_in, tf_out=self.tf_out,
+                    ssub_B=ssub_B, W=self.estimates.W if self.is1p else None,
+                    b0=self.estimates.b0 if self.is1p else None,
+                    corr_img=self.estimates.corr_img if use_corr else None,
+                    first_moment=self.estimates.first_moment if use_corr else None,
+                    second_moment=self.estimates.second_moment if use_corr else None,
+                    crosscorr=self.estimates.crosscorr if use_corr else None,
+                    col_ind=self.estimates.col_ind if use_corr else None,
+                    row_ind=self.estimates.row_ind if use_corr else None,
+                    corr_img_mode=corr_img_mode if use_corr else None,
+                    downscale_matrix=self.estimates.downscale_matrix if
+                    (self.is1p and ssub_B > 1) else None,
+                    max_img=self.estimates.max_img if use_corr else None,
+                    profiler=self.profiler)
 
             num_added = len(self.ind_A) - self.N
 
@@ -566,7 +599,7 @@ class OnACID(object):
                 
                 self.N += num_added
                 self.M += num_added
-                if self.N + self.params.get('online', 'max_num_added') > expected_comps:
+                if self.N + online.max_num_added > expected_comps:
                     expected_comps += 200
                     self.params.set('online', {'expected_comps': expected_comps})
                     self.estimates.CY.resize(
@@ -578,7 +611,7 @@ class OnACID(object):
                         [expected_comps + nb_, self.estimates.C_on.shape[-1]], refcheck=False)
                     self.estimates.noisyC.resize(
                         [expected_comps + nb_, self.estimates.C_on.shape[-1]])
-                    if self.params.get('online', 'use_dense'):  # resize won't work due to contingency issue
+                    if online.use_dense:  # resize won't work due to contingency issue
                         # self.estimates.Ab_dense.resize([self.estimates.CY.shape[-1], expected_comps+nb_])
                         self.estimates.Ab_dense = np.zeros((self.estimates.CY.shape[-1], expected_comps + nb_),
                                                  dtype=np.float32)
@@ -587,19 +620,21 @@ class OnACID(object):
                           str(expected_comps))
                 self.update_counter.resize(self.N, refcheck=False)
 
-                self.estimates.noisyC[self.M - num_added:self.M, t - mbs +
-                            1:t + 1] = Cf_temp[self.M - num_added:self.M]
+                self.estimates.noisyC[self.M - num_added:self.M, tc - mbs +
+                            1:tc + 1] = Cf_temp[self.M - num_added:self.M]
 
+                self.trace_ids += list(range(self.next_trace_id, self.next_trace_id + num_added))
+                self.next_trace_id += num_added
                 for _ct in range(self.M - num_added, self.M):
                     self.time_neuron_added.append((_ct - nb_, t))
-                    if self.params.get('preprocess', 'p'):
+                    if preprocess.p:
                         # N.B. OASISinstances are already updated within update_num_components
-                        self.estimates.C_on[_ct, t - mbs + 1: t +
+                        self.estimates.C_on[_ct, tc - mbs + 1: tc +
                                   1] = self.estimates.OASISinstances[_ct - nb_].get_c(mbs)
                     else:
-                        self.estimates.C_on[_ct, t - mbs + 1: t + 1] = np.maximum(
-                            0, self.estimates.noisyC[_ct, t - mbs + 1: t + 1])
-                    if self.params.get('online', 'simultaneously') and self.params.get('online', 'n_refit'):
+                        self.estimates.C_on[_ct, tc - mbs + 1: tc + 1] = np.maximum(
+                            0, self.estimates.noisyC[_ct, tc - mbs + 1: tc + 1])
+                    if online.simultaneously and online.n_refit:
                         self.estimates.AtY_buf = np.concatenate((
                             self.estimates.AtY_buf, [Ab_.data[Ab_.indptr[_ct]:Ab_.indptr[_ct + 1]].dot(
                                 self.estimates.Yr_buf.T[Ab_.indices[Ab_.indptr[_ct]:Ab_.indptr[_ct + 1]]])]))
@@ -610,7 +645,7 @@ class OnACID(object):
                 AtA = self.estimates.AtA
                 self.estimates.AtA = np.zeros((self.M, self.M), dtype=np.float32)
                 self.estimates.AtA[:-num_added, :-num_added] = AtA
-                if self.params.get('online', 'use_dense'):
+                if online.use_dense:
                     self.estimates.AtA[:, -num_added:] = self.estimates.Ab.T.dot(
                         self.estimates.Ab_dense[:, self.M - num_added:self.M])
                 else:
@@ -665,13 +700,14 @@ class OnACID(object):
                 idx_overlap = self.estimates.AtA[nb_:-num_added, -num_added:].nonzero()[0]
                 self.update_counter[idx_overlap] = 0
         self.t_detect.append(time() - t_new)
+        self.profiler.mark('detect')
         t_stat = time()
-        if self.params.get('online', 'batch_update_suff_stat'):
+        if online.batch_update_suff_stat:
         # faster update using minibatch of frames
-            min_batch = min(self.params.get('online', 'update_freq'), mbs)
-            if ((t + 1 - self.params.get('online', 'init_batch')) % min_batch == 0):
+            min_batch = min(online.update_freq, mbs)
+            if ((t + 1 - online.init_batch) % min_batch == 0):
 
-                ccf = self.estimates.C_on[:self.M, t - min_batch + 1:t + 1]
+                ccf = self.estimates.C_on[:self.M, tc - min_batch + 1:tc + 1]
                 y = self.estimates.Yr_buf.get_last_frames(min_batch)
                 if self.is1p:  # subtract background
                     if ssub_B == 1:
@@ -688,7 +724,7 @@ class OnACID(object):
                     # self.estimates.XXt += x.dot(x.T)
                     # exploit that we only access some elements of XXt, hence update only these
 
-                    if self.params.get('online', 'full_XXt'):
+                    if online.full_XXt:
                         XXt = self.estimates.XXt  # alias for faster repeated look up in large loop
                         for i, idx in enumerate(self.estimates.XXt_ind):
                             XXt[i, idx] += (x[i].dot(x[idx].T)).flatten()
@@ -703,7 +739,7 @@ class OnACID(object):
                             XXt_vecs[p] += x_i.dot(x[p].T)
                 # much faster: exploit that we only access CY[m, ind_pixels], hence update only these
                 n0 = min_batch
-                t0 = 0 * self.params.get('online', 'init_batch')
+                t0 = 0 * online.init_batch
                 w1 = (t - n0 + t0) * 1. / (t + t0)  # (1 - 1./t)#mbs*1. / t
                 w2 = 1. / (t + t0)  # 1.*mbs /t
                 ccf = np.ascontiguousarray(ccf)
@@ -718,9 +754,9 @@ class OnACID(object):
                 self.estimates.CC = self.estimates.CC * w1 + w2 * ccf.dot(ccf.T)
 
         else:
-            ccf = self.estimates.C_on[:self.M, t - self.params.get('online', 'minibatch_suff_stat'):t -
-                                      self.params.get('online', 'minibatch_suff_stat') + 1]
-            y = self.estimates.Yr_buf.get_last_frames(self.params.get('online', 'minibatch_suff_stat') + 1)[:1]
+            ccf = self.estimates.C_on[:self.M, tc - online.minibatch_suff_stat:tc -
+                                      online.minibatch_suff_stat + 1]
+            y = self.estimates.Yr_buf.get_last_frames(online.minibatch_suff_stat + 1)[:1]
             if self.is1p:  # subtract background
                 if ssub_B == 1:
                     x = (y - self.estimates.Ab.dot(ccf).T - self.estimates.b0).T
@@ -735,7 +771,7 @@ class OnACID(object):
                         .reshape((len(y), -1), order='F') + self.estimates.b0)
                 # self.estimates.XXt += x.dot(x.T)
                 # exploit that we only access some elements of XXt, hence update only these
-                if self.params.get('online', 'full_XXt'):
+                if online.full_XXt:
                     XXt = self.estimates.XXt  # alias for faster repeated look up in large loop
                     for i, idx in enumerate(self.estimates.XXt_ind):
                         XXt[i, idx] += (x[i] * x[idx]).flatten()
@@ -758,39 +794,45 @@ class OnACID(object):
             self.estimates.CY[:nb_] = self.estimates.CY[:nb_] * (1 - 1. / t) + ccf[:nb_].dot(y / t)
             self.estimates.CC = self.estimates.CC * (1 - 1. / t) + ccf.dot(ccf.T / t)
         self.t_stat.append(time() - t_stat)
+        self.profiler.mark('suff_stat')
 
         # update shapes
         t_sh = time()
-        if not self.params.get('online', 'dist_shape_update'):  # bulk shape update
-            if ((t + 1 - self.params.get('online', 'init_batch')) %
-                    self.params.get('online', 'update_freq') == 0):
+        if not online.dist_shape_update:  # bulk shape update
+            due = ((t + 1 - online.init_batch) %
+                   online.update_freq == 0) or self._shape_update_pending
+            # in deadline mode a late frame postpones the update to the next frame
+            self._shape_update_pending = due and deadline and self.profiler.over_budget('shapes')
+            if self._shape_update_pending:
+                self.profiler.defer('shapes')
+            elif due:
                 logging.info('Updating Shapes')
 
-                if self.N > self.params.get('online', 'max_comp_update_shape'):
+                if self.N > online.max_comp_update_shape:
                     indicator_components = np.where(self.update_counter <=
-                                                    self.params.get('online', 'num_times_comp_updated'))[0]
+                                                    online.num_times_comp_updated)[0]
                     # np.random.choice(self.N,10,False)
                     self.update_counter[indicator_components] += 1
                 else:
                     indicator_components = None
 
-                if self.params.get('online', 'use_dense'):
+                if online.use_dense:
                     # update dense Ab and sparse Ab simultaneously;
                     # this is faster than calling update_shapes with sparse Ab only
                     Ab_, self.ind_A, self.estimates.Ab_dense[:, :self.M] = update_shapes(
                         self.estimates.CY, self.estimates.CC, self.estimates.Ab, self.ind_A,
                         indicator_components=indicator_components,
                         Ab_dense=self.estimates.Ab_dense[:, :self.M],
-                        sn=self.estimates.sn, q=0.5, iters=self.params.get('online', 'iters_shape'))
+                        sn=self.estimates.sn, q=0.5, iters=online.iters_shape)
                 else:
                     Ab_, self.ind_A, _ = update_shapes(
                         self.estimates.CY, self.estimates.CC, Ab_, self.ind_A,
                         indicator_components=indicator_components, sn=self.estimates.sn,
-                        q=0.5, iters=self.params.get('online', 'iters_shape'))
+                        q=0.5, iters=online.iters_shape)
 
                 self.estimates.AtA = (Ab_.T.dot(Ab_)).toarray()
-                if self.is1p and ((t + 1 - self.params.get('online', 'init_batch')) %
-                    (self.params.get('online', 'W_update_factor') * self.params.get('online', 'update_freq')) == 0):
+                if self.is1p and ((t + 1 - online.init_batch) %
+                    (online.W_update_factor * online.update_freq) == 0):
                     W = self.estimates.W
                     # for p in range(W.shape[0]):
                     #     # index = self.get_indices_of_pixels_on_ring(p)
@@ -804,7 +846,7 @@ class OnACID(object):
                     #     tmp = XXt[index[:, None], index]
                     #     tmp[np.diag_indices(len(tmp))] += np.trace(tmp) * 1e-5
                     #     W.data[W.indptr[p]:W.indptr[p + 1]] = np.linalg.inv(tmp).dot(XXt[index, p])
-                    if self.params.get('online', 'full_XXt'):
+                    if online.full_XXt:
                         XXt = self.estimates.XXt  # alias for considerably faster look up in large loop
                         def process_pixel(p):
                             # index = W.indices[W.indptr[p]:W.indptr[p + 1]]
@@ -825,7 +867,7 @@ class OnACID(object):
                        # W.data = np.concatenate(list(map(process_pixel2, range(W.shape[0]))))
                         if self.dview is None: 
                             W.data = np.concatenate(list(map(inv_mat_vec, zip(XXt_mats, XXt_vecs))))
-                        elif 'multiprocessing' in str(type(self.dview)):
+                        elif is_local_pool(self.dview):
                             W.data = np.concatenate(list(self.dview.imap(inv_mat_vec, zip(XXt_mats, XXt_vecs), chunksize=256)))
                         else:
                             W.data = np.concatenate(list(self.dview.map_sync(inv_mat_vec, zip(XXt_mats, XXt_vecs))))
@@ -855,7 +897,7 @@ class OnACID(object):
                     ind_keep = list(set(range(Ab_.shape[-1])) - set(ind_zero))
                     ind_keep.sort()
 
-                    if self.params.get('online', 'use_dense'):
+                    if online.use_dense:
                         self.estimates.Ab_dense = np.delete(
                             self.estimates.Ab_dense, ind_zero, axis=1)
                     self.estimates.AtA = np.delete(self.estimates.AtA, ind_zero, axis=0)
@@ -867,10 +909,11 @@ class OnACID(object):
                     self.N -= len(ind_zero)
                     self.estimates.noisyC = np.delete(self.estimates.noisyC, ind_zero, axis=0)
                     for ii in ind_zero:
-                        del self.estimates.OASISinstances[ii - self.params.get('init', 'nb')]
+                        del self.estimates.OASISinstances[ii - init.nb]
                         #del self.ind_A[ii-self.params.init['nb']]
 
                     self.estimates.C_on = np.delete(self.estimates.C_on, ind_zero, axis=0)
+                    self.trace_ids = list(np.delete(self.trace_ids, ind_zero))
                     self.estimates.AtY_buf = np.delete(self.estimates.AtY_buf, ind_zero, axis=0)
                     #Ab_ = Ab_[:,ind_keep]
                     Ab_ = csc_matrix(Ab_[:, ind_keep])
@@ -879,31 +922,32 @@ class OnACID(object):
                     self.Ab_copy = Ab_
                     self.estimates.Ab = Ab_
                     self.ind_A = list(
-                        [(self.estimates.Ab.indices[self.estimates.Ab.indptr[ii]:self.estimates.Ab.indptr[ii + 1]]) for ii in range(self.params.get('init', 'nb'), self.M)])
+                        [(self.estimates.Ab.indices[self.estimates.Ab.indptr[ii]:self.estimates.Ab.indptr[ii + 1]]) for ii in range(init.nb, self.M)])
                     self.estimates.groups = list(map(list, update_order(Ab_)[0]))
 
-                if self.params.get('online', 'n_refit'):
+                if online.n_refit:
                     self.estimates.AtY_buf = Ab_.T.dot(self.estimates.Yr_buf.T)
 
         else:  # distributed shape update
-            self.update_counter *= 2**(-1. / self.params.get('online', 'update_freq'))
+            self.update_counter *= 2**(-1. / online.update_freq)
             # if not num_added:
-            if (not num_added) and (time() - t_start < 2*self.time_spend / (t - self.params.get('online', 'init_batch') + 1)):
+            if ((not num_added) and (time() - t_start < 2*self.time_spend / (t - online.init_batch + 1))
+                    and not (deadline and self.profiler.over_budget())):
                 candidates = np.where(self.update_counter <= 1)[0]
                 if len(candidates):
                     indicator_components = candidates[:self.N // mbs + 1]
                     self.comp_upd.append(len(indicator_components))
                     self.update_counter[indicator_components] += 1
-                    #update_bkgrd = (t % self.params.get('online', 'update_freq') == 0)
+                    #update_bkgrd = (t % online.update_freq == 0)
                     update_bkgrd = (t % mbs == 0)
-                    if self.params.get('online', 'use_dense'):
+                    if online.use_dense:
                         # update dense Ab and sparse Ab simultaneously;
                         # this is faster than calling update_shapes with sparse Ab only
                         Ab_, self.ind_A, self.estimates.Ab_dense[:, :self.M] = update_shapes(
                             self.estimates.CY, self.estimates.CC, self.estimates.Ab, self.ind_A,
                             indicator_components=indicator_components, update_bkgrd=update_bkgrd,
                             Ab_dense=self.estimates.Ab_dense[:, :self.M], sn=self.estimates.sn,
-                            q=0.5, iters=self.params.get('online', 'iters_shape'))
+                            q=0.5, iters=online.iters_shape)
                         if update_bkgrd:
                             self.estimates.AtA = (Ab_.T.dot(Ab_)).toarray()
                         else:
@@ -915,7 +959,7 @@ class OnACID(object):
                         Ab_, self.ind_A, _ = update_shapes(
                             self.estimates.CY, self.estimates.CC, Ab_, self.ind_A,
                             indicator_components=indicator_components, update_bkgrd=update_bkgrd,
-                            q=0.5, iters=self.params.get('online', 'iters_shape'))
+                            q=0.5, iters=online.iters_shape)
                         self.estimates.AtA = (Ab_.T.dot(Ab_)).toarray()
                 else:
                     self.comp_upd.append(0)
@@ -924,14 +968,103 @@ class OnACID(object):
                 self.comp_upd.append(0)
             self.time_spend += time() - t_start
         self.t_shapes.append(time() - t_sh)
+        self.profiler.mark('shapes')
+        if own_frame:
+            self.profiler.end_frame()
 
         return self
 
-    def initialize_online(self, model_LN=None):
+    def _new_profiler(self):
+        return FrameProfiler(['motion', 'demix', 'deconvolve', 'residual', 'detect', 'cnn',
+                              'suff_stat', 'shapes', 'display'],
+                             budget=self.params.get('online', 'frame_budget'),
+                             fr=self.params.get('data', 'fr'),
+                             history=self.params.get('online', 'profile_history'))
+
+    def _spill_traces(self):
+        """append the oldest half of the trace window to the trace store, shift the window
+        and retire the OASIS pools that ended before it"""
+        width = self.estimates.C_on.shape[-1]
+        n = width - width // 2
+        S = np.zeros((self.M, n), dtype=np.float32)
+        if self.estimates.OASISinstances is not None:
+            nb = self.params.get('init', 'nb')
+            for i, o in enumerate(self.estimates.OASISinstances):
+                S[nb + i] = o.s[self.trace_offset - o.t0:self.trace_offset + n - o.t0]
+        TraceStore(self.trace_store).append(self.trace_offset, self.trace_ids,
+                                            self.estimates.C_on[:self.M, :n],
+                                            self.estimates.noisyC[:self.M, :n], S)
+        for trace in (self.estimates.C_on, self.estimates.noisyC):
+            trace[:, :width - n] = trace[:, n:]
+            trace[:, width - n:] = 0
+        self.trace_offset += n
+        if self.estimates.OASISinstances is not None:
+            # the stored frames are final: a pool reaching back into them keeps
+            # the values it had when they were stored
+            for o in self.estimates.OASISinstances:
+                o.retire_pools(self.trace_offset)
+
+    def get_traces(self, t_start=0, t_stop=None):
+        """
+        temporal traces of the current components, from memory and from the trace store
+
+        Args:
+            t_start, t_stop: int
+                range of frames. t_stop defaults to the end of the trace window
+
+        Returns:
+            C_on: np.ndarray
+                denoised traces (background first), current components x frames
+
+            noisyC: np.ndarray
+                noisy traces, same layout as C_on
+        """
+        width = self.estimates.C_on.shape[-1]
+        if t_stop is None:
+            t_stop = self.trace_offset + width
+        if self.trace_store is None:
+            return (self.estimates.C_on[:self.M, t_start:t_stop],
+                    self.estimates.noisyC[:self.M, t_start:t_stop])
+        C_on, noisyC, _ = TraceStore(self.trace_store).read(self.trace_ids, t_start, t_stop)
+        start = max(t_start, self.trace_offset)
+        if start < t_stop:
+            C_on[:, start - t_start:] = self.estimates.C_on[:self.M, start - self.trace_offset:t_stop - self.trace_offset]
+            noisyC[:, start - t_start:] = self.estimates.noisyC[:self.M, start - self.trace_offset:t_stop - self.trace_offset]
+        return C_on, noisyC
+
+    def get_spikes(self, t_start, t_stop):
+        """
+        deconvolved activity of the current components (without background), from the
+        OASIS instances and from the trace store
+
+        Args:
+            t_start, t_stop: int
+                range of frames, t_stop at most the number of frames processed
+
+        Returns:
+            S: np.ndarray
+                deconvolved activity, components x frames
+        """
+        nb = self.params.get('init', 'nb')
+        if self.trace_store is None:
+            S = np.zeros((self.M - nb, t_stop - t_start), dtype=np.float32)
+        else:
+            S = TraceStore(self.trace_store).read(self.trace_ids, t_start, t_stop)[2][nb:]
+        if self.estimates.OASISinstances is not None:
+            start = max(t_start, self.trace_offset)
+            for i, o in enumerate(self.estimates.OASISinstances):
+                S[i, start - t_start:] = o.s[start - o.t0:t_stop - o.t0]
+        return S
+
+    def initialize_online(self, model_LN=None, Y=None, T=None):
         fls = self.params.get('data', 'fnames')
         opts = self.params.get_group('online')
-        Y = caiman.load(fls[0], subindices=slice(0, opts['init_batch'],
-                 None), var_name_hdf5=self.params.get('data', 'var_name_hdf5')).astype(np.float32)
+        from_files = Y is None
+        if from_files:
+            Y = caiman.load(fls[0], subindices=slice(0, opts['init_batch'],
+                     None), var_name_hdf5=self.params.get('data', 'var_name_hdf5')).astype(np.float32)
+        else:
+            Y = caiman.movie(np.asarray(Y, dtype=np.float32))
         if model_LN is not None:
             Y = Y - caiman.movie(np.squeeze(model_LN.predict(np.expand_dims(Y, -1))))
             Y = np.maximum(Y, 0)
@@ -1040,10 +1173,17 @@ class OnACID(object):
             self.estimates.lam = np.zeros(nr)
         else:
             raise Exception('Unknown initialization method!')
-        dims, Ts = get_file_size(fls, var_name_hdf5=self.params.get('data', 'var_name_hdf5'))
+        if T is None:
+            if from_files:
+                T = np.array(get_file_size(fls, var_name_hdf5=self.params.get('data', 'var_name_hdf5'))[1]).sum()
+            elif self.params.get('online', 'trace_window') is None:
+                raise ValueError('The number of frames T is needed to allocate the traces '
+                                 'unless trace_window is set')
+            else:
+                T = Y.shape[0]    # unused, the traces are kept in a window
         dims = Y.shape[1:]
         self.params.set('data', {'dims': dims})
-        T1 = np.array(Ts).sum()*self.params.get('online', 'epochs')
+        T1 = T*self.params.get('online', 'epochs')
         self._prepare_object(Yr, T1)
         if opts['show_movie']:
             self.bnd_AC = np.percentile(self.estimates.A.dot(self.estimates.C),
@@ -1067,7 +1207,7 @@ class OnACID(object):
             raise Exception("Unsupported file extension")
 
 
-    def fit_online(self, **kwargs):
+    def fit_online(self, frames=None, n_frames=None, **kwargs):
         """Implements the caiman online algorithm on the list of files fls. The
         files are taken in alpha numerical order and are assumed to each have
         the same number of frames (except the last one that can be shorter).
@@ -1075,6 +1215,15 @@ class OnACID(object):
         methods.
 
         Args:
+            frames: iterable or None
+                frames to process instead of the files in params.data['fnames'], e.g.
+                from a live acquisition. The first init_batch frames are used for the
+                initialization. Only one epoch is supported
+
+            n_frames: int or None
+                number of frames of the stream, used to allocate the traces. Not
+                needed when the trace_window parameter is set
+
             fls: list
                 list of files to be processed
 
@@ -1097,6 +1246,13 @@ class OnACID(object):
         self.t_init = -time()
         fls = self.params.get('data', 'fnames')
         init_batch = self.params.get('online', 'init_batch')
+        Y_init = None
+        if frames is not None:
+            if self.params.get('online', 'epochs') > 1:
+                raise ValueError('Only one epoch can be run over a stream of frames')
+            frames = (frame for frame in frames)
+            Y_init = np.stack([next(frames) for _ in range(init_batch)]).astype(np.float32)
+            fls = [None]
         if self.params.get('online', 'ring_CNN'):
             logging.info('Using Ring CNN model')
             from caiman.utils.nn_models import (fit_NL_model, create_LN_model, quantile_loss, rate_scheduler)
@@ -1111,8 +1267,11 @@ class OnACID(object):
                 sch = None
             else:
                 sch = rate_scheduler(*self.params.get('ring_CNN', 'lr_scheduler'))
-            Y = caiman.base.movies.load(fls[0], subindices=slice(init_batch),
-                                        var_name_hdf5=self.params.get('data', 'var_name_hdf5'))
+            if Y_init is None:
+                Y = caiman.base.movies.load(fls[0], subindices=slice(init_batch),
+                                            var_name_hdf5=self.params.get('data', 'var_name_hdf5'))
+            else:
+                Y = caiman.movie(Y_init)
             shape = Y.shape[1:] + (1,)
             logging.info('Starting background model training.')
             model_LN = create_LN_model(Y, shape=shape, n_channels=nch,
@@ -1134,7 +1293,7 @@ class OnACID(object):
         else:
             model_LN = None
         epochs = self.params.get('online', 'epochs')
-        self.initialize_online(model_LN=model_LN)
+        self.initialize_online(model_LN=model_LN, Y=Y_init, T=n_frames)
         self.t_init += time()
         extra_files = len(fls) - 1
         init_files = 1
@@ -1174,20 +1333,24 @@ class OnACID(object):
 
         #     Go through all files
             for file_count, ffll in enumerate(process_files):
-                logging.warning('Now processing file {}'.format(ffll))
-                Y_ = caiman.base.movies.load_iter(
-                    ffll, var_name_hdf5=self.params.get('data', 'var_name_hdf5'),
-                    subindices=slice(init_batc_iter[file_count], None, None))
+                if frames is not None:
+                    Y_ = frames
+                else:
+                    logging.warning('Now processing file {}'.format(ffll))
+                    Y_ = caiman.base.movies.load_iter(
+                        ffll, var_name_hdf5=self.params.get('data', 'var_name_hdf5'),
+                        subindices=slice(init_batc_iter[file_count], None, None))
 
                 old_comps = self.N     # number of existing components
                 frame_count = -1
                 while True:   # process each file
                     try:
                         frame = next(Y_)
+                        online, init, data = (self.params.snapshot(group) for group in ('online', 'init', 'data'))
                         if model_LN is not None:
                             if self.params.get('ring_CNN', 'remove_activity'):
-                                activity = self.estimates.Ab[:,:self.N].dot(self.estimates.C_on[:self.N, t-1]).reshape(self.params.get('data', 'dims'), order='F')
-                                if self.params.get('online', 'normalize'):
+                                activity = self.estimates.Ab[:,:self.N].dot(self.estimates.C_on[:self.N, t-1-self.trace_offset]).reshape(data.dims, order='F')
+                                if online.normalize:
                                     activity *= self.img_norm
                             else:
                                 activity = 0.
@@ -1196,6 +1359,7 @@ class OnACID(object):
                             frame = np.maximum(frame, 0)
                         frame_count += 1
                         t_frame_start = time()
+                        self.profiler.start_frame()
                         if np.isnan(np.sum(frame)):
                             raise Exception('Frame ' + str(frame_count) +
                                             ' contains NaN')
@@ -1204,33 +1368,33 @@ class OnACID(object):
                                          ' frames have beeen processed in total. ' +
                                          str(self.N - old_comps) +
                                          ' new components were added. Total # of components is '
-                                         + str(self.estimates.Ab.shape[-1] - self.params.get('init', 'nb')))
+                                         + str(self.estimates.Ab.shape[-1] - init.nb))
                             old_comps = self.N
 
                         # Downsample and normalize
                         frame_ = frame.copy().astype(np.float32)
-                        if self.params.get('online', 'ds_factor') > 1:
+                        if online.ds_factor > 1:
                             frame_ = cv2.resize(frame_, self.img_norm.shape[::-1])
 
-                        if self.params.get('online', 'normalize'):
+                        if online.normalize:
                             frame_ -= self.img_min     # make data non-negative
                         t_mot = time()
 
                         # Motion Correction
-                        if self.params.get('online', 'motion_correct'):    # motion correct
+                        if online.motion_correct:    # motion correct
                             templ = self.estimates.Ab.dot(
-                                    np.median(self.estimates.C_on[:self.M, t-51:t-1], 1)).reshape(self.params.get('data', 'dims'), order='F')#*self.img_norm
+                                    np.median(self.estimates.C_on[:self.M, t-51-self.trace_offset:t-1-self.trace_offset], 1)).reshape(data.dims, order='F')#*self.img_norm
                             if self.is1p and self.estimates.W is not None:
                                 if ssub_B == 1:
                                     B = self.estimates.W.dot((frame_ - templ).flatten(order='F') - self.estimates.b0) + self.estimates.b0
-                                    B = B.reshape(self.params.get('data', 'dims'), order='F')
+                                    B = B.reshape(data.dims, order='F')
                                 else:
                                     b0 = self.estimates.b0.reshape((d1, d2), order='F')#*self.img_norm
                                     bc2 = downscale(frame_ - templ - b0, (ssub_B, ssub_B)).flatten(order='F')
                                     Wb = self.estimates.W.dot(bc2).reshape(((d1 - 1) // ssub_B + 1, (d2 - 1) // ssub_B + 1), order='F')
                                     B = b0 + np.repeat(np.repeat(Wb, ssub_B, 0), ssub_B, 1)[:d1, :d2]
                                 templ += B
-                            if self.params.get('online', 'normalize'):
+                            if online.normalize:
                                 templ *= self.img_norm
                             if self.is1p:
                                 templ = high_pass_filter_space(templ, self.params.motion['gSig_filt'])
@@ -1257,16 +1421,17 @@ class OnACID(object):
                             frame_cor = frame_
 
                         self.t_motion.append(time() - t_mot)
+                        self.profiler.mark('motion')
                         
-                        if self.params.get('online', 'normalize'):
+                        if online.normalize:
                             frame_cor = frame_cor/self.img_norm
                         # Fit next frame
                         self.fit_next(t, frame_cor.reshape(-1, order='F'))
                         # Show
-                        if self.params.get('online', 'show_movie'):
+                        if online.show_movie:
                             self.t = t
                             vid_frame = self.create_frame(frame_cor, resize_fact=resize_fact)
-                            if self.params.get('online', 'save_online_movie'):
+                            if online.save_online_movie:
                                 out.write(vid_frame)
                                 for rp in range(len(self.estimates.ind_new)*2):
                                     out.write(vid_frame)
@@ -1276,6 +1441,8 @@ class OnACID(object):
                                 cv2.imshow('frame', vid_frame)
                             if cv2.waitKey(1) & 0xFF == ord('q'):
                                 break
+                        self.profiler.mark('display')
+                        self.profiler.end_frame()
                         t += 1
                         t_online.append(time() - t_frame_start)
                     except  (StopIteration, RuntimeError):
@@ -1287,14 +1454,13 @@ class OnACID(object):
             self.estimates.Ab = csc_matrix(self.estimates.Ab.multiply(
                 self.img_norm.reshape(-1, order='F')[:, np.newaxis]))
         self.estimates.A, self.estimates.b = self.estimates.Ab[:, self.params.get('init', 'nb'):], self.estimates.Ab[:, :self.params.get('init', 'nb')].toarray()
-        self.estimates.C, self.estimates.f = self.estimates.C_on[self.params.get('init', 'nb'):self.M, t - t //
-                         epochs:t], self.estimates.C_on[:self.params.get('init', 'nb'), t - t // epochs:t]
-        noisyC = self.estimates.noisyC[self.params.get('init', 'nb'):self.M, t - t // epochs:t]
-        self.estimates.YrA = noisyC - self.estimates.C
+        C_on, noisyC = self.get_traces(t - t // epochs, t)
+        nb = self.params.get('init', 'nb')
+        self.estimates.C, self.estimates.f = C_on[nb:], C_on[:nb]
+        self.estimates.YrA = noisyC[nb:] - self.estimates.C
         if self.estimates.OASISinstances is not None:
             self.estimates.bl = [osi.b for osi in self.estimates.OASISinstances]
-            self.estimates.S = np.stack([osi.s for osi in self.estimates.OASISinstances])
-            self.estimates.S = self.estimates.S[:, t - t // epochs:t]
+            self.estimates.S = self.get_spikes(t - t // epochs, t)
         else:
             self.estimates.bl = [0] * self.estimates.C.shape[0]
             self.estimates.S = np.zeros_like(self.estimates.C)
@@ -1318,6 +1484,7 @@ class OnACID(object):
         if self.params.get('online', 'show_movie'):
             cv2.destroyAllWindows()
         self.t_online = t_online
+        logging.info('Latency per frame:\n' + self.profiler.report())
         self.estimates.C_on = self.estimates.C_on[:self.M]
         self.estimates.noisyC = self.estimates.noisyC[:self.M]
 
@@ -1337,7 +1504,7 @@ class OnACID(object):
         C, f = est.C_on[gnb:self.M, :], est.C_on[:gnb, :]
         # inferred activity due to components (no background)
         frame_plot = (frame_cor.copy() - self.bnd_Y[0])/np.diff(self.bnd_Y)
-        comps_frame = A.dot(C[:, self.t - 1]).reshape(self.dims, order='F')
+        comps_frame = A.dot(C[:, self.t - 1 - self.trace_offset]).reshape(self.dims, order='F')
         if self.is1p:
             ssub_B = self.params.get('init', 'ssub_B') * self.params.get('init', 'ssub')
             if ssub_B == 1:
@@ -1349,7 +1516,7 @@ class OnACID(object):
                 Wb = self.estimates.W.dot(bc2).reshape(((self.dims[0] - 1) // ssub_B + 1, (self.dims[1] - 1) // ssub_B + 1), order='F')
                 bgkrnd_frame = b0 + np.repeat(np.repeat(Wb, ssub_B, 0), ssub_B, 1)[:self.dims[0], :self.dims[1]]
         else:
-            bgkrnd_frame = b.dot(f[:, self.t - 1]).reshape(self.dims, order='F')  # denoised frame (components + background)
+            bgkrnd_frame = b.dot(f[:, self.t - 1 - self.trace_offset]).reshape(self.dims, order='F')  # denoised frame (components + background)
         denoised_frame = comps_frame + bgkrnd_frame
         denoised_frame = (denoised_frame.copy() - self.bnd_Y[0])/np.diff(self.bnd_Y)
         comps_frame = (comps_frame.copy() - self.bnd_AC[0])/np.diff(self.bnd_AC)
@@ -1977,6 +2144,53 @@ class RingBuffer(np.ndarray):
             return np.concatenate([self[(self.cur - num_frames):], self[:self.cur]], axis=0)
 
 
+class TraceStore(object):
+    """ append-only file of the traces that left the trace window of OnACID
+
+    Each record holds a range of frames for the components present at that time,
+    identified by the ids of their rows. Components removed later keep their
+    records, components added later have none for the earlier frames.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def clear(self):
+        open(self.filename, 'wb').close()
+
+    def append(self, t_start, ids, C_on, noisyC, S):
+        """store C_on, noisyC and S (rows x frames) for the frames starting at t_start"""
+        with open(self.filename, 'ab') as f:
+            np.save(f, np.array([t_start, t_start + C_on.shape[-1]], dtype=np.int64))
+            np.save(f, np.asarray(ids, dtype=np.int64))
+            np.save(f, np.asarray(C_on, dtype=np.float32))
+            np.save(f, np.asarray(noisyC, dtype=np.float32))
+            np.save(f, np.asarray(S, dtype=np.float32))
+
+    def records(self):
+        """iterate over the (t_start, t_stop, ids, C_on, noisyC, S) records"""
+        size = os.path.getsize(self.filename)
+        with open(self.filename, 'rb') as f:
+            while f.tell() < size:
+                (t_start, t_stop), ids = np.load(f), np.load(f)
+                yield t_start, t_stop, ids, np.load(f), np.load(f), np.load(f)
+
+    def read(self, ids, t_start, t_stop):
+        """traces C_on, noisyC and S of the components with the given ids over the
+        frames [t_start, t_stop), zero where not stored"""
+        row = {idx: i for i, idx in enumerate(ids)}
+        traces = [np.zeros((len(ids), t_stop - t_start), dtype=np.float32) for _ in range(3)]
+        for t0, t1, rec_ids, *rec_traces in self.records():
+            lo, hi = max(t0, t_start), min(t1, t_stop)
+            if lo >= hi:
+                continue
+            sel = [i for i, idx in enumerate(rec_ids) if idx in row]
+            rows = [row[rec_ids[i]] for i in sel]
+            for trace, rec_trace in zip(traces, rec_traces):
+                trace[rows, lo - t_start:hi - t_start] = rec_trace[sel, lo - t0:hi - t0]
+        return tuple(traces)
+
+
 #%%
 def csc_append(a, b):
     """ Takes in 2 csc_matrices and appends the second one to the right of the first one.
@@ -2038,7 +2252,7 @@ def get_candidate_components(sv, dims, Yres_buf, min_num_trial=3, gSig=(5, 5),
                              patch_size=50, loaded_model=None, test_both=False,
                              thresh_CNN_noisy=0.5, use_peak_max=False,
                              thresh_std_peak_resid = 1, mean_buff=None,
-                             tf_in=None, tf_out=None):
+                             tf_in=None, tf_out=None, profiler=None):
     """
     Extract new candidate components from the residual buffer and test them
     using space correlation or the CNN classifier. The function runs the CNN
@@ -2141,10 +2355,13 @@ def get_candidate_components(sv, dims, Yres_buf, min_num_trial=3, gSig=(5, 5),
         Ain2 /= np.std(Ain2,axis=1)[:,None]
         Ain2 = np.reshape(Ain2,(-1,) + tuple(np.diff(ijSig_cnn).squeeze()),order= 'F')
         Ain2 = np.stack([cv2.resize(ain,(patch_size ,patch_size)) for ain in Ain2])
+        t_cnn = time()
         if tf_in is None:
             predictions = loaded_model.predict(Ain2[:,:,:,np.newaxis], batch_size=min_num_trial, verbose=0)
         else:
             predictions = loaded_model.run(tf_out, feed_dict={tf_in: Ain2[:, :, :, np.newaxis]})
+        if profiler is not None:
+            profiler.add('cnn', time() - t_cnn)
         keep_cnn = list(np.where(predictions[:, 0] > thresh_CNN_noisy)[0])
         cnn_pos = Ain2[keep_cnn]
     else:
@@ -2197,7 +2414,7 @@ def update_num_components(t, sv, Ab, Cf, Yres_buf, Y_buf, rho_buf,
                           corr_img=None, first_moment=None, second_moment=None,
                           crosscorr=None, col_ind=None, row_ind=None, corr_img_mode=None,
                           max_img=None, downscale_matrix=None, tf_in=None,
-                          tf_out=None):
+                          tf_out=None, profiler=None):
     """
     Checks for new components in the residual buffer and incorporates them if they pass the acceptance tests
     """
@@ -2227,7 +2444,7 @@ def update_num_components(t, sv, Ab, Cf, Yres_buf, Y_buf, rho_buf,
         sniper_mode=sniper_mode, rval_thr=rval_thr, patch_size=50,
         loaded_model=loaded_model, thresh_CNN_noisy=thresh_CNN_noisy,
         use_peak_max=use_peak_max, test_both=test_both, mean_buff=mean_buff,
-        tf_in=tf_in, tf_out=tf_out)
+        tf_in=tf_in, tf_out=tf_out, profiler=profiler)
 
     ind_new_all = ijsig_all
 
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+""" Run several OnACID instances side by side, one process per stream
+
+A stream is an imaging plane or a session. The streams are either given as
+separate lists of files, which each process reads on its own, or as movies in
+which the frames of n_planes planes are interleaved (plane k holds frames
+k, k + n_planes, ...). Interleaved movies are read once by the calling
+process, which dispatches each frame to the bounded queue of its plane. A
+plane that falls behind fills its queue and blocks the reader, so that no
+stream drops frames or buffers an unbounded number of them.
+"""
+
+from copy import deepcopy
+import logging
+import multiprocessing
+import numpy as np
+import queue
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+import caiman
+from .estimates import Estimates
+from .params import CNMFParams
+from .utilities import get_file_size
+
+logger = logging.getLogger(__name__)
+
+
+def _frames_from_queue(frame_queue):
+    """iterate over the frames put in frame_queue until None"""
+    while True:
+        frame = frame_queue.get()
+        if frame is None:
+            return
+        yield frame
+
+
+def _run_stream(index: int, params: CNMFParams, frame_queue, n_frames: Optional[int], result_queue) -> None:
+    """fit one stream and put (index, estimates, timing) or (index, exception) in result_queue"""
+    from .online_cnmf import OnACID
+    try:
+        cnm = OnACID(params=params)
+        if frame_queue is None:
+            cnm.fit_online()
+        else:
+            cnm.fit_online(frames=_frames_from_queue(frame_queue), n_frames=n_frames)
+        timing = {'t_init': cnm.t_init, 't_online': float(np.sum(cnm.t_online)),
+                  'n_frames': len(cnm.t_online), 'latency': cnm.profiler.summary(),
+                  'missed': cnm.profiler.missed}
+        result_queue.put((index, cnm.estimates, timing))
+    except Exception as e:
+        logger.exception('Stream {0} failed'.format(index))
+        result_queue.put((index, e))
+
+
+def fit_online_streams(params, fnames: Optional[List] = None, n_planes: Optional[int] = None,
+                       max_queue: int = 100) -> Tuple[List[Estimates], Dict]:
+    """
+    Fit independent OnACID instances to several streams, each in its own process
+
+    Args:
+        params: CNMFParams or list of CNMFParams
+            parameters of the streams, a single object is used for all of them. For
+            interleaved planes, params.data['fnames'] holds the interleaved movies and
+            'fr' is the frame rate of a plane
+
+        fnames: list of lists of str or None
+            files of each stream, read by the process of the stream. If None, the
+            frames of params.data['fnames'] are split into n_planes streams
+
+        n_planes: int or None
+            number of planes interleaved in the movies (when fnames is None)
+
+        max_queue: int
+            maximum number of frames waiting in the queue of each interleaved plane.
+            The reader blocks when a queue is full
+
+    Returns:
+        estimates: list of Estimates
+            results of each stream
+
+        timing: dict
+            'wall': total time (s), 'streams': list with the initialization time,
+            the time spent in fit_online, the number of frames, the latency summary
+            (see FrameProfiler.summary) and the frames over budget of each stream.
+            For interleaved planes also 'blocked': time (s) the reader waited for each
+            plane and 'max_queue_depth': the maximum number of frames in each queue
+
+    Raises:
+        Exception 'Stream failed'
+    """
+    if fnames is None:
+        if n_planes is None:
+            raise ValueError('Either fnames or n_planes must be given')
+        n_streams = n_planes
+    else:
+        n_streams = len(fnames)
+    if isinstance(params, CNMFParams):
+        params = [params] * n_streams
+    if len(params) != n_streams:
+        raise ValueError('One CNMFParams object is needed per stream')
+    params = [deepcopy(p) for p in params]
+
+    ctx = multiprocessing.get_context()
+    result_queue = ctx.Queue()
+    frame_queues: List = [None] * n_streams
+    n_frames: List[Optional[int]] = [None] * n_streams
+    if fnames is None:
+        movies = params[0].get('data', 'fnames')
+        var_name_hdf5 = params[0].get('data', 'var_name_hdf5')
+        T = int(np.sum(get_file_size(movies, var_name_hdf5=var_name_hdf5)[1]))
+        n_frames = [len(range(plane, T, n_planes)) for plane in range(n_planes)]
+        frame_queues = [ctx.Queue(maxsize=max_queue) for _ in range(n_planes)]
+    else:
+        for p, fls in zip(params, fnames):
+            p.change_params({'fnames': list(fls), 'dims': None})
+
+    t_start = time()
+    processes = [ctx.Process(target=_run_stream, args=(i, params[i], frame_queues[i], n_frames[i], result_queue),
+                             daemon=True) for i in range(n_streams)]
+    for proc in processes:
+        proc.start()
+
+    results: Dict[int, tuple] = {}
+
+    def collect(block: bool) -> None:
+        while len(results) < n_streams:
+            try:
+                res = result_queue.get(block=block, timeout=1 if block else None)
+            except queue.Empty:
+                if not block:
+                    return
+                if not any(proc.is_alive() for i, proc in enumerate(processes) if i not in results):
+                    raise Exception('Stream failed')
+                continue
+            results[res[0]] = res
+            if len(res) == 2:
+                raise Exception('Stream failed') from res[1]
+
+    blocked = np.zeros(n_streams)
+    max_depth = np.zeros(n_streams, dtype=int)
+    try:
+        if fnames is None:
+            t = 0
+            for movie in movies:
+                for frame in caiman.base.movies.load_iter(movie, var_name_hdf5=var_name_hdf5):
+                    plane = t % n_planes
+                    try:
+                        max_depth[plane] = max(max_depth[plane], frame_queues[plane].qsize())
+                    except NotImplementedError:  # macOS
+                        pass
+                    t_put = time()
+                    while True:
+                        try:
+                            frame_queues[plane].put(frame, timeout=1)
+                            break
+                        except queue.Full:
+                            collect(block=False)    # a failed stream would never free its queue
+                            if not processes[plane].is_alive():
+                                raise Exception('Stream failed')
+                    blocked[plane] += time() - t_put
+                    t += 1
+            for frame_queue in frame_queues:
+                frame_queue.put(None)
+        collect(block=True)
+    finally:
+        for proc in processes:
+            if proc.is_alive() and len(results) < n_streams:
+                proc.terminate()
+            proc.join()
+
+    timing = {'wall': time() - t_start, 'streams': [results[i][2] for i in range(n_streams)]}
+    if fnames is None:
+        timing['blocked'] = blocked.tolist()
+        timing['max_queue_depth'] = max_depth.tolist()
+    n_total = sum(s['n_frames'] for s in timing['streams'])
+    logger.info('{0} streams, {1} frames in {2:.1f}s ({3:.1f} frames/s)'.format(
+        n_streams, n_total, timing['wall'], n_total / timing['wall']))
+    return [results[i][1] for i in range(n_streams)], timing
@@ -1,3 +1,4 @@
+from collections import namedtuple
 import logging
 import numpy as np
 import os
@@ -10,16 +11,22 @@ import caiman.utils.utils
 from ...paths import caiman_datadir
 from .utilities import dict_compare, get_file_size
 
+# namedtuple classes of the snapshots, one per group and set of keys
+_snapshot_types: dict = {}
+
 
 class CNMFParams(object):
     """Class for setting and changing the various parameters."""
-    
+
+    # the snapshot cache is kept out of __dict__, which only holds the parameter groups
+    __slots__ = ('__dict__', '_snapshots')
+
     def __init__(self, fnames=None, dims=None, dxy=(1, 1),
                  border_pix=0, del_duplicates=False, low_rank_background=True,
                  memory_fact=1, n_processes=1, nb_patch=1, p_ssub=2, p_tsub=2,
                  remove_very_bad_comps=False, rf=None, stride=None,
                  check_nan=True, n_pixels_per_process=None,
-                 k=30, alpha_snmf=100, center_psf=False, gSig=[5, 5], gSiz=None,
+                 k=None, alpha_snmf=100, center_psf=False, gSig=[5, 5], gSiz=None,
                  init_iter=2, method_init='greedy_roi', min_corr=.85,
                  min_pnr=20, gnb=1, normalize_init=True, options_local_NMF=None,
                  ring_size_factor=1.5, rolling_length=100, rolling_sum=True,
@@ -84,8 +91,10 @@ class CNMFParams(object):
 
         PATCH PARAMS (CNMFParams.patch)######
 
-            rf: int or None, default: None
-                Half-size of patch in pixels. If None, no patches are constructed and the whole FOV is processed jointly
+            rf: int, 'auto' or None, default: None
+                Half-size of patch in pixels. If None, no patches are constructed and the whole FOV is processed jointly.
+                If 'auto', rf, stride, memory_fact, max_concurrent and the number of components per patch
+                (unless K is set) are chosen by map_reduce.plan_patches when fitting, for the workers of dview
 
             stride: int or None, default: None
                 Overlap between neighboring patches in pixels.
@@ -132,6 +141,10 @@ class CNMFParams(object):
             in_memory: bool, default: True
                 Whether to load patches in memory
 
+            max_concurrent: int or None, default: None
+                Maximum number of patches processed at the same time, to bound the memory used. If None,
+                all the patches are dispatched to the cluster at once
+
         PRE-PROCESS PARAMS (CNMFParams.preprocess) #############
 
             sn: np.array or None, default: None
@@ -167,10 +180,15 @@ class CNMFParams(object):
             check_nan: bool, default: True
                 whether to check for NaNs
 
+            cache_noise: bool, default: True
+                whether to cache the noise of a memory mapped movie in a file next to it (filename + '.noise.npz').
+                The cache is used until the movie or the noise parameters change
+
         INIT PARAMS (CNMFParams.init)###############
 
-            K: int, default: 30
-                number of components to be found (per patch or whole FOV depending on whether rf=None)
+            K: int or None, default: None
+                number of components to be found (per patch or whole FOV depending on whether rf=None).
+                If None, 30, or with rf='auto' the number chosen by map_reduce.plan_patches when fitting
 
             SC_kernel: {'heat', 'cos', binary'}, default: 'heat'
                 kernel for graph affinity matrix
@@ -232,6 +250,12 @@ class CNMFParams(object):
             init_iter: int, default: 2
                 number of iterations during greedy_pnr (1p) initialization
 
+            tile_shape: (int, int) or None, default: None
+                if not None, greedy_pnr (1p) initialization seeds the neurons tile by tile (in parallel), from the
+                correlation and PNR images of each tile and the pixels around it. Neurons found in two tiles are kept
+                once. This bounds the working copies of the seeding to a few tiles, but the movie and the ring model
+                background are still held in memory: a movie that does not fit in memory can not be initialized
+
             nIter: int, default: 5
                 number of rank-1 refinement iterations during greedy_roi initialization
 
@@ -406,6 +430,11 @@ class CNMFParams(object):
             gSig_range: list or integers, default: None
                 gSig scale values for CNN classifier. In not None, multiple values are tested in the CNN classifier.
 
+            eval_block_size: int, default: None
+                if not None, the SNR and space correlation are computed by evaluate_components_blocks, for blocks
+                of eval_block_size components at a time, taking into account overlaps between all the components.
+                If None, they are computed in groups of 50 components.
+
         ONLINE CNMF (ONACID) PARAMETERS (CNMFParams.online)#####
 
             N_samples_exceptionality: int, default: np.ceil(decay_time*fr),
@@ -417,6 +446,11 @@ class CNMFParams(object):
             ds_factor: int, default: 1,
                 spatial downsampling factor for faster processing (if > 1)
 
+            deadline_mode: bool, default: False
+                when a frame runs over frame_budget (or frames are queued), postpone the search for
+                new components and the bulk shape update to a later frame. The postponed work is
+                counted in OnACID.profiler.deferred
+
             dist_shape_update: bool, default: False,
                 update shapes in a distributed fashion
 
@@ -426,6 +460,10 @@ class CNMFParams(object):
             expected_comps: int, default: 500
                 number of expected components (for memory allocation purposes)
 
+            frame_budget: float or None, default: None
+                time budget (s) for processing a frame, used by the latency profiler and by
+                deadline_mode. If None it is set to 1/fr
+
             full_XXt: bool, default: False
                 save the full residual sufficient statistic matrix for updating W in 1p.
                 If set to False, a list of submatrices is saved (typically faster).
@@ -480,6 +518,9 @@ class CNMFParams(object):
             path_to_model: str, default: os.path.join(caiman_datadir(), 'model', 'cnn_model_online.h5')
                 Path to online CNN classifier
 
+            profile_history: int, default: 10000
+                number of frames for which OnACID.profiler keeps the latency of every stage
+
             rval_thr: float, default: 0.8
                 space correlation threshold for accepting a new component
 
@@ -511,6 +552,15 @@ class CNMFParams(object):
             thresh_overlap: float, default: 0.5
                 Intersection-over-Union space overlap threshold for screening new components
 
+            trace_store: str or None, default: None
+                file receiving the traces older than trace_window (a temporary file if None)
+
+            trace_window: int or None, default: None
+                number of frames of the traces (C_on, noisyC) kept in memory. Older frames are appended to
+                trace_store, together with the deconvolved activity, and OnACID.get_traces reads them
+                back. The OASIS pools that ended before the window are dropped, so that the stored
+                frames are no longer refit. If None, the traces of the whole movie are preallocated
+
             update_freq: int, default: 200
                 Update each shape at least once every X frames when in distributed mode
 
@@ -644,6 +694,7 @@ class CNMFParams(object):
             'del_duplicates': del_duplicates,
             'in_memory': True,
             'low_rank_background': low_rank_background,
+            'max_concurrent': None,
             'memory_fact': memory_fact,
             'n_processes': n_processes,
             'nb_patch': nb_patch,
@@ -658,6 +709,7 @@ class CNMFParams(object):
         }
 
         self.preprocess = {
+            'cache_noise': True,         # cache the noise of memory mapped movies next to them
             'check_nan': check_nan,
             'compute_g': False,          # flag for estimating global time constant
             'include_noise': False,      # flag for using noise values when estimating g
@@ -708,6 +760,7 @@ class CNMFParams(object):
             'sigma_smooth_snmf': (.5, .5, .5),
             'ssub': ssub,             # spatial downsampling factor
             'ssub_B': ssub_B,
+            'tile_shape': None,       # tiles of the greedy_pnr initialization (None: whole FOV)
             'tsub': tsub,             # temporal downsampling factor
         }
 
@@ -774,6 +827,7 @@ class CNMFParams(object):
         self.quality = {
             'SNR_lowest': 0.5,         # minimum accepted SNR value
             'cnn_lowest': 0.1,         # minimum accepted value for CNN classifier
+            'eval_block_size': None,   # components per task of the block evaluation (None: groups of 50)
             'gSig_range': None,        # range for gSig scale for CNN classifier
             'min_SNR': min_SNR,        # transient SNR threshold
             'min_cnn_thr': 0.9,        # threshold for CNN classifier
@@ -787,10 +841,12 @@ class CNMFParams(object):
         self.online = {
             'N_samples_exceptionality': N_samples_exceptionality,  # timesteps to compute SNR
             'batch_update_suff_stat': batch_update_suff_stat,
+            'deadline_mode': False,            # postpone detection and shape updates of late frames
             'dist_shape_update': False,        # update shapes in a distributed way
             'ds_factor': 1,                    # spatial downsampling for faster processing
             'epochs': 1,                       # number of epochs
             'expected_comps': expected_comps,  # number of expected components
+            'frame_budget': None,              # time budget for processing a frame (None: 1/fr)
             'full_XXt': False,                 # store entire XXt matrix (as opposed to a list of sub-matrices) 
             'init_batch': 200,                 # length of mini batch for initialization
             'init_method': 'bare',             # initialization method for first batch,
@@ -811,6 +867,7 @@ class CNMFParams(object):
             'opencv_codec': 'H264',            # FourCC video codec for saving movie. Check http://www.fourcc.org/codecs.php
             'path_to_model': os.path.join(caiman_datadir(), 'model',
                                           'cnn_model_online.h5'),
+            'profile_history': 10000,          # frames for which the per stage latency is kept
             'ring_CNN': False,                 # flag for using a ring CNN background model 
             'rval_thr': rval_thr,              # space correlation threshold
             'save_online_movie': False,        # flag for saving online movie
@@ -823,6 +880,8 @@ class CNMFParams(object):
             'thresh_fitness_delta': thresh_fitness_delta,
             'thresh_fitness_raw': thresh_fitness_raw,    # threshold for trace SNR (computed below)
             'thresh_overlap': thresh_overlap,
+            'trace_store': None,               # file receiving the traces older than trace_window
+            'trace_window': None,              # number of frames of the traces kept in memory (None: all)
             'update_freq': update_freq,            # update every shape at least once every update_freq steps
             'update_num_comps': update_num_comps,  # flag for searching for new components
             'use_corr_img': use_corr_img,      # flag for using correlation image to detect new components
@@ -870,6 +929,7 @@ class CNMFParams(object):
             'reuse_model': False                # reuse an already trained model
         }
 
+        self._snapshots = {}
         self.change_params(params_dict)
 
 
@@ -877,7 +937,10 @@ class CNMFParams(object):
         """ Populates the params object with some dataset dependent values
         and ensures that certain constraints are satisfied.
         """
+        self._snapshots = {}
         self.data['last_commit'] = '-'.join(caiman.utils.utils.get_caiman_version())
+        if self.init['K'] is None and not (isinstance(self.patch['rf'], str) and self.patch['rf'] == 'auto'):
+            self.init['K'] = 30
         if self.data['dims'] is None and self.data['fnames'] is not None:
             self.data['dims'] = get_file_size(self.data['fnames'], var_name_hdf5=self.data['var_name_hdf5'])[0]
         if self.data['fnames'] is not None:
@@ -907,7 +970,7 @@ class CNMFParams(object):
         if self.init['gSiz'] is None:
             self.init['gSiz'] = [2*gs + 1 for gs in self.init['gSig']]
         self.init['gSiz'] = tuple([gs + 1 if gs % 2 == 0 else gs for gs in self.init['gSiz']])
-        if self.patch['rf'] is not None:
+        if self.patch['rf'] is not None and not isinstance(self.patch['rf'], str):
             if self.patch['rf'] <= self.init['gSiz'][0]:
                 logging.warning("Changing rf from {0} to {1} ".format(self.patch['rf'], 2*self.init['gSiz'][0]) +
                                 "because the constraint rf > gSiz was not satisfied.")
@@ -950,6 +1013,7 @@ class CNMFParams(object):
         if not hasattr(self, group):
             raise KeyError('No group in CNMFParams named {0}'.format(group))
 
+        getattr(self, '_snapshots', {}).pop(group, None)
         d = getattr(self, group)
         for k, v in val_dict.items():
             if k not in d and not set_if_not_exists:
@@ -993,6 +1057,38 @@ class CNMFParams(object):
 
         return getattr(self, group)
 
+    def snapshot(self, group):
+        """ Get an immutable snapshot of a group, a namedtuple with one field per key.
+        Reading a field is much cheaper than calling get, which matters in the per frame
+        loop of OnACID. The snapshot is cached until the next call to set, change_params or
+        check_consistency; values written directly into the group dictionary are not seen.
+
+        Args:
+            group: The name of the group.
+
+        Returns: The snapshot of the group.
+        """
+        try:
+            return self._snapshots[group]
+        except (AttributeError, KeyError):
+            pass
+        d = self.get_group(group)
+        key = (group, tuple(d))
+        if key not in _snapshot_types:
+            _snapshot_types[key] = namedtuple(group.capitalize() + 'Params', key[1])
+        snap = _snapshot_types[key](**d)
+        if not hasattr(self, '_snapshots'):
+            self._snapshots = {}
+        self._snapshots[group] = snap
+        return snap
+
+    def __getstate__(self):
+        # the snapshots are rebuilt on demand, their classes cannot be pickled
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
     def __eq__(self, other):
 
         if type(other) != CNMFParams:
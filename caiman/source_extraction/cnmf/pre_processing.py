@@ -17,14 +17,16 @@
 #\date Created on Tue Jun 30 21:01:17 2015
 
 
+import json
+import logging
 import numpy as np
+import os
 import scipy
-import shutil
-import tempfile
-import logging
 from builtins import map
 from builtins import range
 from ...mmapping import load_memmap
+from ...shared_multiprocessing import is_local_pool
+from .spatial import pixel_blocks
 from past.builtins import basestring
 from past.utils import old_div
 
@@ -51,7 +53,8 @@ def interpolate_missing_data(Y):
     """
     coor = []
     logging.info('Checking for missing data entries (NaN)')
-    if np.any(np.isnan(Y)):
+    n_rows = max(1, 2 ** 26 // max(Y[:1].nbytes, 1))
+    if any(np.isnan(Y[i:i + n_rows]).any() for i in range(0, len(Y), n_rows)):
         logging.info('Interpolating missing data')
         for idx, row in enumerate(Y):
             nans = np.where(np.isnan(row))[0]
@@ -206,21 +209,24 @@ def get_noise_fft(Y, noise_range=[0.25, 0.5], noise_method='logmexp', max_num_sa
     return sn, psdx
 
 
-def get_noise_fft_parallel(Y, n_pixels_per_process=100, dview=None, **kwargs):
+def get_noise_fft_parallel(Y, n_pixels_per_process=100, dview=None, return_psx=True, **kwargs):
     """parallel version of get_noise_fft.
 
+    The pixels are processed in contiguous blocks, of which only the frames used by
+    get_noise_fft are read, so that the memory used does not depend on the size of
+    the movie.
+
     Args:
         Y: ndarray
             input movie (n_pixels x Time). Can be also memory mapped file.
 
-        n_processes: [optional] int
-            number of processes/threads to use concurrently
-
         n_pixels_per_process: [optional] int
-            number of pixels to be simultaneously processed by each process
+            minimum number of pixels to be simultaneously processed by each process
+
+        dview: [optional] view on the cluster, or None to process the blocks serially
 
-        backend: [optional] string
-            the type of concurrency to be employed. only 'multithreading' for the moment
+        return_psx: [optional] bool
+            whether to return the power spectral density of each pixel
 
         **kwargs: [optional] dict
             all the parameters passed to get_noise_fft
@@ -228,64 +234,123 @@ def get_noise_fft_parallel(Y, n_pixels_per_process=100, dview=None, **kwargs):
     Returns:
         sn: ndarray(double)
             noise associated to each pixel
-    """
-    folder = tempfile.mkdtemp()
-
-    # Pre-allocate a writeable shared memory map as a container for the
-    # results of the parallel computation
-    pixel_groups = list(
-        range(0, Y.shape[0] - n_pixels_per_process + 1, n_pixels_per_process))
 
-    if type(Y) is np.core.memmap:  # if input file is already memory mapped then find the filename
+        psx: ndarray(double) or None
+            power spectral density of each pixel
+    """
+    if isinstance(Y, np.memmap) and Y.filename is not None and _is_whole_file(Y):
         Y_name = Y.filename
-
     else:
         if dview is not None:
-            raise Exception('parallel processing requires memory mapped files')
+            logging.warning('Parallel processing requires memory mapped files, processing serially')
+            dview = None
         Y_name = Y
 
-    argsin = [(Y_name, i, n_pixels_per_process, kwargs) for i in pixel_groups]
-    pixels_remaining = Y.shape[0] % n_pixels_per_process
-    if pixels_remaining > 0:
-        argsin.append(
-            (Y_name, Y.shape[0] - pixels_remaining, pixels_remaining, kwargs))
+    d, T = Y.shape
+    n_samples = sum(len(range(*seg.indices(T))) for seg in _fft_segments(T, kwargs.get('max_num_samples_fft', 3072)))
+    bounds = pixel_blocks(d, n_samples, n_pixels_per_process, dview)
+    argsin = [(Y_name, start, stop, return_psx, kwargs) for start, stop in zip(bounds[:-1], bounds[1:])]
 
     if dview is None:
-        print('Single Thread')
-        results = list(map(fft_psd_multithreading, argsin))
-
+        results = map(fft_psd_block, argsin)
+    elif is_local_pool(dview):
+        results = dview.map_async(fft_psd_block, argsin).get(4294967)
     else:
-        if 'multiprocessing' in str(type(dview)):
-            results = dview.map_async(
-                fft_psd_multithreading, argsin).get(4294967)
-        else:
-            ne = len(dview)
-            print(('Running on %d engines.' % (ne)))
-            if dview.client.profile == 'default':
-                results = dview.map_sync(fft_psd_multithreading, argsin)
+        logging.info('Running on %d engines.' % (len(dview)))
+        results = dview.map_sync(fft_psd_block, argsin)
+
+    sn_s = np.zeros(d)
+    psx_s = None
+    for start, stop, sn, psx in results:
+        sn_s[start:stop] = sn
+        if return_psx:
+            if psx_s is None:
+                psx_s = np.zeros((d, psx.shape[-1]))
+            psx_s[start:stop] = psx
 
-            else:
-                print(('PROFILE:' + dview.client.profile))
-                results = dview.map_sync(fft_psd_multithreading, argsin)
+    return sn_s, psx_s
 
-    _, _, psx_ = results[0]
-    sn_s = np.zeros(Y.shape[0])
-    psx_s = np.zeros((Y.shape[0], psx_.shape[-1]))
-    for idx, sn, psx_ in results:
-        sn_s[idx] = sn
-        psx_s[idx, :] = psx_
 
-    sn_s = np.array(sn_s)
-    psx_s = np.array(psx_s)
+def fft_psd_block(args):
+    """helper function of get_noise_fft_parallel, noise of the pixels start:stop
+
+    Args:
+        args: tuple
+            (Y or the name of its memory mapped file, start, stop, return_psx, kwargs of get_noise_fft)
+
+    Returns:
+        start, stop: int
+            pixel bounds
 
+        sn: ndarray
+            noise associated to each pixel
+
+        psx: ndarray or None
+            power spectral density of each pixel
+    """
+    Y, start, stop, return_psx, kwargs = args
+    if isinstance(Y, basestring):
+        Y, _, _ = load_memmap(Y)
+    sn, psx = get_noise_fft(Y[start:stop], **kwargs)
+    return start, stop, sn, psx if return_psx else None
+
+
+def _fft_segments(T, max_num_samples_fft):
+    """slices of the frames used by get_noise_fft"""
+    if T > max_num_samples_fft:
+        return [slice(1, max_num_samples_fft // 3 + 1),
+                slice(int(T // 2 - max_num_samples_fft / 3 / 2), int(T // 2 + max_num_samples_fft / 3 / 2)),
+                slice(-max_num_samples_fft // 3, None)]
+    return [slice(0, T)]
+
+
+def _is_whole_file(Y):
+    """whether the memory mapped array Y covers its whole file, in the order of the file"""
+    return Y.offset + Y.nbytes == os.path.getsize(Y.filename) and \
+        (Y.flags['C_CONTIGUOUS'] or Y.flags['F_CONTIGUOUS'])
+
+
+def _noise_cache(Y, **kwargs):
+    """name of the file caching the noise of the memory mapped movie Y and the key
+    identifying the file and the parameters, or (None, None) if Y is not a whole file"""
+    if not isinstance(Y, np.memmap) or Y.filename is None or not _is_whole_file(Y):
+        return None, None
+    stat = os.stat(Y.filename)
+    key = json.dumps([stat.st_size, stat.st_mtime_ns, Y.shape, str(Y.dtype), bool(Y.flags['C_CONTIGUOUS']),
+                      sorted((k, np.asarray(v).tolist()) for k, v in kwargs.items())])
+    return Y.filename + '.noise.npz', key
+
+
+def load_noise_cache(Y, **kwargs):
+    """noise of each pixel of Y cached by save_noise_cache and whether Y was checked
+    for missing values, or None"""
+    fname, key = _noise_cache(Y, **kwargs)
+    if fname is None or not os.path.isfile(fname):
+        return None
     try:
-        shutil.rmtree(folder)
+        with np.load(fname) as f:
+            if str(f['key']) == key:
+                return f['sn'], bool(f['checked_nan'])
+    except Exception as e:
+        logging.warning('Could not read {}: {}'.format(fname, e))
+    return None
+
+
+def save_noise_cache(Y, sn, checked_nan=False, **kwargs):
+    """cache the noise of each pixel of the memory mapped movie Y next to its file
+
+    The cache is used by preprocess_data until the file or the parameters change.
+    """
+    fname, key = _noise_cache(Y, **kwargs)
+    if fname is None:
+        return
+    try:
+        with open(fname, 'wb') as f:
+            np.savez(f, sn=sn, checked_nan=checked_nan, key=key)
+    except OSError as e:
+        logging.warning('Could not cache the noise in {}: {}'.format(fname, e))
 
-    except:
-        print(("Failed to delete: " + folder))
-        raise
 
-    return sn_s, psx_s
 #%%
 
 
@@ -347,8 +412,7 @@ def fft_psd_multithreading(args):
         Y, _, _ = load_memmap(Y)
 
     idxs = list(range(i, i + num_pixels))
-    #print(len(idxs))
-    res, psx = get_noise_fft(Y[idxs], **kwargs)
+    res, psx = get_noise_fft(Y[i:i + num_pixels], **kwargs)
 
     return (idxs, res, psx)
 
@@ -492,7 +556,7 @@ def nextpow2(value):
 def preprocess_data(Y, sn=None, dview=None, n_pixels_per_process=100,
                     noise_range=[0.25, 0.5], noise_method='logmexp',
                     compute_g=False, p=2, lags=5, include_noise=False,
-                    pixels=None, max_num_samples_fft=3000, check_nan=True):
+                    pixels=None, max_num_samples_fft=3000, check_nan=True, cache_noise=True):
     """
     Performs the pre-processing operations described above.
 
@@ -526,6 +590,14 @@ def preprocess_data(Y, sn=None, dview=None, n_pixels_per_process=100,
             'median': Median
             'logmexp': Exponential of the mean of the logarithm of PSD (default)
 
+        check_nan: Boolean
+            Flag to check for (and interpolate) missing values. Default: True
+
+        cache_noise: Boolean
+            Flag to cache the noise of a memory mapped movie in a file next to it
+            (filename + '.noise.npz'), used until the movie or the noise parameters
+            change. The check for missing values is skipped when the cache is used. Default: True
+
     Returns:
         Y: ndarray
              movie preprocessed (n_pixels x Time). Can be also memory mapped file.
@@ -537,19 +609,29 @@ def preprocess_data(Y, sn=None, dview=None, n_pixels_per_process=100,
             file where to store the results of computation.
     """
 
-    if check_nan:
+    noise_params = dict(noise_range=noise_range, noise_method=noise_method,
+                        max_num_samples_fft=max_num_samples_fft)
+    cached = None
+    if sn is None and cache_noise:
+        cached = load_noise_cache(Y, **noise_params)
+
+    # a movie is checked once for missing values, the cache records it
+    if check_nan and (cached is None or not cached[1]):
         Y, coor = interpolate_missing_data(Y)
 
-    if sn is None:
-        if dview is None:
-            sn, psx = get_noise_fft(Y, noise_range=noise_range, noise_method=noise_method,
-                                    max_num_samples_fft=max_num_samples_fft)
+    if sn is None and cached is not None:
+        logging.info('Using the noise cached for {}'.format(Y.filename))
+        sn = cached[0]
+        if check_nan and not cached[1]:
+            save_noise_cache(Y, sn, checked_nan=True, **noise_params)
+    elif sn is None:
+        if Y.ndim == 2:
+            sn, _ = get_noise_fft_parallel(Y, n_pixels_per_process=n_pixels_per_process, dview=dview,
+                                           return_psx=False, **noise_params)
         else:
-            sn, psx = get_noise_fft_parallel(Y, n_pixels_per_process=n_pixels_per_process, dview=dview,
-                                             noise_range=noise_range, noise_method=noise_method,
-                                             max_num_samples_fft=max_num_samples_fft)
-    else:
-        psx = None
+            sn, _ = get_noise_fft(Y, **noise_params)
+        if cache_noise:
+            save_noise_cache(Y, sn, checked_nan=check_nan, **noise_params)
 
     if compute_g:
         g = estimate_time_constant(Y, sn, p=p, lags=lags,
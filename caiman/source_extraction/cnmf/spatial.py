@@ -16,6 +16,7 @@ from builtins import str
 from builtins import range
 
 import cv2
+import hashlib
 import logging
 import numpy as np
 import os
@@ -29,12 +30,15 @@ from scipy.ndimage.morphology import binary_closing
 from scipy.ndimage.morphology import generate_binary_structure, iterate_structure
 import shutil
 from sklearn.decomposition import NMF
+from sklearn.linear_model import lars_path_gram
 import tempfile
 import time
 import psutil
-from typing import List
+from typing import Dict, List
 
 from ...mmapping import load_memmap, parallel_dot_product
+from ...shared_multiprocessing import (SharedMemoryPool, get_shared, is_local_pool, n_blocks, release_array,
+                                       share_array)
 from ...utils.stats import csc_column_remove
 
 
@@ -55,7 +59,7 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
                               ss=np.ones((3, 3), dtype=np.int), nb=1,
                               method_ls='lasso_lars', update_background_components=True,
                               low_rank_background=True, block_size_spat=1000,
-                              num_blocks_per_run_spat=20):
+                              num_blocks_per_run_spat=20, search_cache=None):
     """update spatial footprints and background through Basis Pursuit Denoising
 
     for each pixel i solve the problem
@@ -101,7 +105,8 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
             SLURM: use the slurm scheduler
 
         n_pixels_per_process: [optional] int
-            number of pixels to be processed by each thread
+            minimum number of pixels to be processed by each task, larger blocks are
+            used when there are few workers for many pixels (see pixel_blocks)
 
         method: [optional] string
             method used to expand the search for pixels 'ellipse' or 'dilate'
@@ -133,6 +138,9 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
             whether to update the using a low rank approximation. In the False case all the nonzero elements of the background components are updated using hals
             (to be used with one background per patch)
 
+        search_cache: dict or None
+            search locations of the previous calls, the components whose footprint
+            did not change are not recomputed (see determine_search_location)
 
     Returns:
         A: np.ndarray
@@ -183,7 +191,8 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
     logging.info('Computing support of spatial components')
     # we compute the indicator from distance indicator
     ind2_, nr, C, f, b_, A_in = computing_indicator(
-        Y, A_in, b_in, C, f, nb, method_exp, dims, min_size, max_size, dist, expandCore, dview)
+        Y, A_in, b_in, C, f, nb, method_exp, dims, min_size, max_size, dist, expandCore, dview,
+        search_cache=search_cache)
     
     # remove components that have a nan
     ff = np.where(np.isnan(np.sum(C, axis=1)))
@@ -220,16 +229,13 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
     # we create a pixel group array (chunks for the cnmf)for the parrallelization of the process
     logging.info('Updating Spatial Components using lasso lars')
     cct = np.diag(C.dot(C.T))
-    pixel_groups = []
-    for i in range(0, np.prod(dims) - n_pixels_per_process + 1, n_pixels_per_process):
-        pixel_groups.append([Y_name, C_name, sn, ind2_[i:i + n_pixels_per_process], list(
-            range(i, i + n_pixels_per_process)), method_ls, cct, ])
-    if i + n_pixels_per_process < np.prod(dims):
-        pixel_groups.append([Y_name, C_name, sn, ind2_[(i + n_pixels_per_process):np.prod(dims)], list(
-            range(i + n_pixels_per_process, np.prod(dims))), method_ls, cct])
+    sn_, cct_, ind2_shared = share_array(dview, sn), share_array(dview, cct), share_array(dview, ind2_)
+    bounds = pixel_blocks(d, T, n_pixels_per_process, dview)
+    pixel_groups = [[Y_name, C_name, sn_, ind2_shared if ind2_shared is not ind2_ else ind2_[start:stop],
+                     start, stop, method_ls, cct_] for start, stop in zip(bounds[:-1], bounds[1:])]
     #A_ = scipy.sparse.lil_matrix((d, nr + np.size(f, 0)))
     if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
+        if is_local_pool(dview):
             parallel_result = dview.map_async(
                 regression_ipyparallel, pixel_groups).get(4294967)
         else:
@@ -238,6 +244,8 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
             dview.results.clear()
     else:
         parallel_result = list(map(regression_ipyparallel, pixel_groups))
+    for handle in (C_name, sn_, cct_, ind2_shared):
+        release_array(dview, handle)
     data:List = []
     rows:List = []
     cols:List = []
@@ -304,12 +312,13 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
     # print(("--- %s seconds ---" % (time.time() - start_time)))
     logging.info('Updating done in ' + 
                  '{0}s'.format(str(time.time() - start_time).split(".")[0]))
-    try:  # clean up
-        # remove temporary file created
-        logging.info("Removing created tempfiles")
-        shutil.rmtree(folder)
-    except:
-        raise Exception("Failed to delete: " + folder)
+    if folder is not None:
+        try:  # clean up
+            # remove temporary file created
+            logging.info("Removing created tempfiles")
+            shutil.rmtree(folder)
+        except:
+            raise Exception("Failed to delete: " + folder)
 
     return csc_matrix(A_), b, C, f
 
@@ -335,34 +344,42 @@ def regression_ipyparallel(pars):
        subject to
            || Y(i,:) - A(i,:)*C + b(i)*f || <= sn(i)*sqrt(T);
 
-       for each pixel the search is limited to a few spatial components
+       for each pixel the search is limited to a few spatial components. The pixels
+       of the block with the same search locations are solved together
 
        Args:
-           C_name: string
-                memmap C
-
-           Y_name: string
+           Y_name: string or np.ndarray
                 memmap Y
 
-           idxs_Y: np.array
-               indices of the Calcium traces for each computed components
+           C_name: string, np.ndarray or SharedArray
+                C and f, as a .npy file or in memory
+
+           noise_sn: np.ndarray or SharedArray
+                noise level of each pixel
+
+           ind: scipy.sparse.csr_matrix or SharedSparse
+               search locations (see search_locations_to_csr), of all the pixels or only of
+               the pixels start:stop
 
-           idxs_C: np.array
-               indices of the Calcium traces for each computed components
+           start, stop: int
+               pixels of the block
 
            method_least_square:
                method to perform the regression for the basis pursuit denoising.
                     'nnls_L0'. Nonnegative least square with L0 penalty
                     'lasso_lars' lasso lars function from scikit learn
 
+           cct: np.ndarray or SharedArray
+               squared norm of the temporal components
+
        Returns:
-           px: np.ndarray
-                positions o the regression
+           list of (px, idxs_C, a):
+               px: position of the pixel
 
-           idxs_C: np.ndarray
-               indices of the Calcium traces for each computed components
+               idxs_C: np.ndarray
+                   indices of the Calcium traces for each computed components
 
-           a: learned weight
+               a: learned weight
 
        Raises:
            Exception 'Least Square Method not found!
@@ -372,59 +389,52 @@ def regression_ipyparallel(pars):
     import numpy as np
     import sys
     import gc
-    from sklearn import linear_model
 
-    Y_name, C_name, noise_sn, idxs_C, idxs_Y, method_least_square, cct = pars
+    Y_name, C_name, noise_sn, ind, start, stop, method_least_square, cct = pars
+    noise_sn, cct, ind = get_shared(noise_sn), get_shared(cct), get_shared(ind)
+    if ind.shape[0] != stop - start:    # the search locations of all the pixels
+        ind = ind[start:stop]
     # we load from the memmap file
     if isinstance(Y_name, basestring):
         Y, _, _ = load_memmap(Y_name)
-        Y = np.array(Y[idxs_Y, :])
+        Y = np.array(Y[start:stop, :])
     else:
-        Y = Y_name[idxs_Y, :]
+        Y = Y_name[start:stop, :]
     if isinstance(C_name, basestring):
         C = np.load(C_name, mmap_mode='r')
-        C = np.array(C)
     else:
-        C = C_name
+        C = get_shared(C_name)
 
     _, T = np.shape(C)  # initialize values
+    # pixels with the same search locations share the regressors
+    groups:Dict = {}
+    for i in range(stop - start):
+        idxs_C = ind.indices[ind.indptr[i]:ind.indptr[i + 1]]
+        # skip if no components OR pixel has 0 activity
+        if len(idxs_C) > 0 and noise_sn[start + i] > 0:
+            groups.setdefault(idxs_C.tobytes(), (idxs_C, []))[1].append(i)
+
     As = []
-    for y, px, idx_px_from_0 in zip(Y, idxs_Y, range(len(idxs_C))):
-        c = C[idxs_C[idx_px_from_0], :]
-        idx_only_neurons = idxs_C[idx_px_from_0]
-        if len(idx_only_neurons) > 0:
-            cct_ = cct[idx_only_neurons[idx_only_neurons < len(cct)]]
-        else:
-            cct_ = []
+    for idxs_C, rows in groups.values():
+        c = np.array(C[idxs_C])
+        cct_ = cct[idxs_C[idxs_C < len(cct)]]
+        sn = noise_sn[start + np.array(rows)]
+        if method_least_square == 'lasso_lars_old':
+            raise Exception("Obsolete parameter") # Old code, support was removed
 
-        # skip if no components OR pixel has 0 activity
-        if np.size(c) > 0 and noise_sn[px] > 0:
-            sn = noise_sn[px] ** 2 * T
-            if method_least_square == 'lasso_lars_old':
-                raise Exception("Obsolete parameter") # Old code, support was removed
-
-            elif method_least_square == 'nnls_L0':  # Nonnegative least square with L0 penalty
-                a = nnls_L0(c.T, y, 1.2 * sn)
-
-            elif method_least_square == 'lasso_lars':  # lasso lars function from scikit learn
-                lambda_lasso = 0 if np.size(cct_) == 0 else \
-                    .5 * noise_sn[px] * np.sqrt(np.max(cct_)) / T
-                clf = linear_model.LassoLars(alpha=lambda_lasso, positive=True,
-                                             fit_intercept=True)
-#                clf = linear_model.Lasso(alpha=lambda_lasso, positive=True,
-#                                         fit_intercept=True, normalize=True,
-#                                         selection='random')
-                a_lrs = clf.fit(np.array(c.T), np.ravel(y))
-                a = a_lrs.coef_
+        elif method_least_square == 'nnls_L0':  # Nonnegative least square with L0 penalty
+            a = [nnls_L0(c.T, Y[i], 1.2 * sn_ ** 2 * T) for i, sn_ in zip(rows, sn)]
 
-            else:
-                raise Exception(
-                    'Least Square Method not found!' + method_least_square)
+        elif method_least_square == 'lasso_lars':  # lasso lars function from scikit learn
+            lambda_lasso = np.zeros(len(rows)) if np.size(cct_) == 0 else \
+                .5 * sn * np.sqrt(np.max(cct_)) / T
+            a = lasso_lars_group(c, Y[rows], lambda_lasso)
 
-            if not np.isscalar(a):
-                a = a.T
+        else:
+            raise Exception(
+                'Least Square Method not found!' + method_least_square)
 
-            As.append((px, idxs_C[idx_px_from_0], a))
+        As.extend((start + i, idxs_C, a_) for i, a_ in zip(rows, a))
 
     if isinstance(Y_name, basestring):
         del Y
@@ -435,27 +445,80 @@ def regression_ipyparallel(pars):
 
     return As
 
+
+def lasso_lars_group(c, Y, alphas):
+    """positive lasso of several pixels on the same components
+
+    Equivalent to LassoLars(alpha=alphas[i], positive=True, fit_intercept=True).fit(c.T, Y[i]).coef_
+    for each pixel i, but the centering, the Gram matrix and the correlations with
+    the components are computed once for all the pixels.
+
+    Args:
+        c: np.ndarray
+            components x time, regressors
+
+        Y: np.ndarray
+            pixels x time
+
+        alphas: np.ndarray
+            penalty of each pixel
+
+    Returns:
+        a: list of np.ndarray
+            weights of the components for each pixel
+    """
+    X = c.T - np.average(c.T, axis=0)
+    Gram = X.T.dot(X)
+    Y = np.asarray(Y, dtype=X.dtype)
+    Xy = X.T.dot((Y - Y.mean(axis=1, keepdims=True)).T)
+    a = []
+    for k, alpha in enumerate(alphas):
+        _, _, coef_path = lars_path_gram(Xy[:, k], Gram, n_samples=X.shape[0], alpha_min=alpha,
+                                         method='lasso', max_iter=500, eps=np.finfo(float).eps,
+                                         positive=True, return_path=True)
+        a.append(coef_path[:, -1])
+    return a
+
+
 def construct_ellipse_parallel(pars):
-    """update spatial footprints and background through Basis Pursuit Denoising
+    """search locations of one component inside an ellipse around its center of mass
+
+    The ellipse follows the covariance of the footprint, with axes clipped between
+    min_size and max_size, scaled by dist. Only the bounding box of the largest
+    possible ellipse is evaluated.
+
+    Args:
+        px: np.ndarray
+            pixels (in F order) of the footprint
 
+        a: np.ndarray
+            values of the footprint in px
 
+    Returns:
+        np.ndarray, sorted pixels (in F order) of the search locations
     """
-    Coor, cm, A_i, Vr, dims, dist, max_size, min_size, d = pars
-    dist_cm = coo_matrix(np.hstack([Coor[c].reshape(-1, 1) - cm[k]
-                                    for k, c in enumerate(['x', 'y', 'z'][:len(dims)])]))
-    Vr.append(dist_cm.T * spdiags(A_i.toarray().squeeze(),
-                                  0, d, d) * dist_cm / A_i.sum(axis=0))
+    px, a, dims, dist, max_size, min_size = pars
+    coor = np.stack(np.unravel_index(px, dims, order='F'), 1).astype(float)
+    cm = old_div(np.dot(a, coor), np.sum(a))
+    dist_cm = coor - cm
+    Vr = old_div(np.dot(dist_cm.T * a, dist_cm), np.sum(a))
 
     if np.sum(np.isnan(Vr)) > 0:
         raise Exception('You cannot pass empty (all zeros) components!')
 
-    D, V = eig(Vr[-1])
+    D, V = eig(Vr)
 
     dkk = [np.min((max_size ** 2, np.max((min_size ** 2, dd.real))))
            for dd in D]
 
-    # search indexes for each component
-    return np.sqrt(np.sum([old_div((dist_cm * V[:, k]) ** 2, dkk[k]) for k in range(len(dkk))], 0)) <= dist
+    # no axis is longer than max_size * dist
+    half = np.ceil(max_size * dist) + 1
+    grid = np.meshgrid(*[np.arange(max(0, int(np.floor(c - half))), min(n, int(np.ceil(c + half)) + 1))
+                         for c, n in zip(cm, dims)], indexing='ij')
+    box = np.stack([g.ravel() for g in grid], 1)
+    dist_cm = box - cm
+    inside = np.sqrt(np.sum([old_div(np.dot(dist_cm, V[:, k]) ** 2, dkk[k]) for k in range(len(dkk))], 0)) <= dist
+    return np.sort(np.ravel_multi_index(tuple(box[inside].T), dims, order='F'))
 
 def threshold_components(A, dims, medw=None, thr_method='max', maxthr=0.1, nrgthr=0.9999, extract_cc=True,
                          se=None, ss=None, dview=None):
@@ -519,7 +582,7 @@ def threshold_components(A, dims, medw=None, thr_method='max', maxthr=0.1, nrgth
                      medw, d, thr_method, se, ss, maxthr, nrgthr, extract_cc])
 
     if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
+        if is_local_pool(dview):
             res = dview.map_async(
                 threshold_components_parallel, pars).get(4294967)
         else:
@@ -818,11 +881,13 @@ def test(Y, A_in, C, f, n_pixels_per_process, nb):
     return Y, A_in, C, f, n_pixels_per_process, nb, d, T
 
 def determine_search_location(A, dims, method='ellipse', min_size=3, max_size=8, dist=3,
-                              expandCore=iterate_structure(generate_binary_structure(2, 1), 2).astype(int), dview=None):
+                              expandCore=iterate_structure(generate_binary_structure(2, 1), 2).astype(int), dview=None,
+                              cache=None):
     """
     compute the indices of the distance from the cm to search for the spatial component
 
-    does this by following an ellipse from the cm or doing a step by step dilatation around the cm
+    does this by following an ellipse from the cm or doing a step by step dilatation around the cm.
+    Each component is processed in the bounding box of its footprint
 
     Args:
         A[:, i]: the A of each components
@@ -851,142 +916,108 @@ def determine_search_location(A, dims, method='ellipse', min_size=3, max_size=8,
         dims: [optional] tuple
              x, y[, z] movie dimensions
 
+        cache: [optional] dict
+            search locations computed by previous calls, keyed by footprint and
+            settings. The components whose footprint did not change are not
+            recomputed. Updated in place, entries of components that disappeared
+            are removed
+
     Returns:
-        dist_indicator: np.ndarray
-            distance from the cm to search for the spatial footprint
+        dist_indicator: scipy.sparse.csc_matrix
+            boolean pixels x components, distance from the cm to search for the spatial footprint
 
     Raises:
         Exception 'You cannot pass empty (all zeros) components!'
     """
-
-    from scipy.ndimage.morphology import grey_dilation
-
-    # we initialize the values
-    if len(dims) == 2:
-        d1, d2 = dims
-    elif len(dims) == 3:
-        d1, d2, d3 = dims
     d, nr = np.shape(A)
     A = csc_matrix(A)
-#    dist_indicator = scipy.sparse.lil_matrix((d, nr),dtype= np.float32)
-#    dist_indicator = scipy.sparse.csc_matrix((d, nr), dtype=np.float32)
-
     if method == 'ellipse':
-        Coor = dict()
-        # we create a matrix of size A.x of each pixel coordinate in A.y and inverse
-        if len(dims) == 2:
-            Coor['x'] = np.kron(np.ones(d2), list(range(d1)))
-            Coor['y'] = np.kron(list(range(d2)), np.ones(d1))
-        elif len(dims) == 3:
-            Coor['x'] = np.kron(np.ones(d3 * d2), list(range(d1)))
-            Coor['y'] = np.kron(
-                np.kron(np.ones(d3), list(range(d2))), np.ones(d1))
-            Coor['z'] = np.kron(list(range(d3)), np.ones(d2 * d1))
-        if not dist == np.inf:  # determine search area for each neuron
-            cm = np.zeros((nr, len(dims)))  # vector for center of mass
-            Vr:List = []  # cell(nr,1);
-            dist_indicator = []
-            pars = []
-            # for each dim
-            for i, c in enumerate(['x', 'y', 'z'][:len(dims)]):
-                # mass center in this dim = (coor*A)/sum(A)
-                cm[:, i] = old_div(
-                    np.dot(Coor[c], A[:, :nr].todense()), A[:, :nr].sum(axis=0))
-
-            # parrallelizing process of the construct ellipse function
-            for i in range(nr):
-                pars.append([Coor, cm[i], A[:, i], Vr, dims,
-                             dist, max_size, min_size, d])
-            if dview is None:
-                res = list(map(construct_ellipse_parallel, pars))
-            else:
-                if 'multiprocessing' in str(type(dview)):
-                    res = dview.map_async(
-                        construct_ellipse_parallel, pars).get(4294967)
-                else:
-                    res = dview.map_sync(construct_ellipse_parallel, pars)
-            for r in res:
-                dist_indicator.append(r)
-
-            dist_indicator = scipy.sparse.coo_matrix((np.asarray(dist_indicator)).squeeze().T)
-
-        else:
+        if dist == np.inf:
             raise Exception('Not implemented')
-            dist_indicator = True * np.ones((d, nr))
-
+        settings = repr((method, tuple(dims), min_size, max_size, dist)).encode()
     elif method == 'dilate':
-        indptr = [0]
-        indices:List = []
-        data = []
-        if dview is None:
-            for i in range(nr):
-                A_temp = np.reshape(A[:, i].toarray(), dims[::-1])
-                if len(expandCore) > 0:
-                    if len(expandCore.shape) < len(dims):  # default for 3D
-                        expandCore = iterate_structure(
-                            generate_binary_structure(len(dims), 1), 2).astype(int)
-                    A_temp = grey_dilation(A_temp, footprint=expandCore)
-                else:
-                    A_temp = grey_dilation(A_temp, [1] * len(dims))
-
-                nz = np.where(np.squeeze(np.reshape(A_temp, (d, 1)))[:, None] > 0)[0].tolist()
-                indptr.append(indptr[-1] + len(nz))
-                indices.extend(nz)
-                data.extend(len(nz)*[True])
-                #dist_indicator[:, i] = scipy.sparse.coo_matrix(np.squeeze(np.reshape(A_temp, (d, 1)))[:, None] > 0)
-            dist_indicator = csc_matrix((data, indices, indptr), shape=(d, nr))
-
-        else:
-            logging.info('dilate in parallel...')
-            pars = []
-            for i in range(nr):
-                pars.append([A[:, i], dims, expandCore, d])
-
-            if 'multiprocessing' in str(type(dview)):
-                parallel_result = dview.map_async(
-                    construct_dilate_parallel, pars).get(4294967)
-            else:
-                parallel_result = dview.map_sync(
-                    construct_dilate_parallel, pars)
-                dview.results.clear()
-
-            i = 0
-            for res in parallel_result:
-                indptr.append(indptr[-1] + len(res.row))
-                indices.extend(res.row)
-                data.extend(len(res.row)*[True])
-                #dist_indicator[:, i] = res
-                i += 1
-            dist_indicator = csc_matrix((data, indices, indptr), shape=(d, nr))
-
+        if len(expandCore) > 0 and len(expandCore.shape) < len(dims):  # default for 3D
+            expandCore = iterate_structure(generate_binary_structure(len(dims), 1), 2).astype(int)
+        settings = repr((method, tuple(dims), np.shape(expandCore))).encode() + np.asarray(expandCore).tobytes()
     else:
         raise Exception('Not implemented')
-        dist_indicator = True * np.ones((d, nr))
 
-    return csc_matrix(dist_indicator)
+    keys = []
+    pars = []
+    cache = {} if cache is None else cache
+    for i in range(nr):
+        px = A.indices[A.indptr[i]:A.indptr[i + 1]]
+        a = A.data[A.indptr[i]:A.indptr[i + 1]]
+        key = hashlib.sha1(settings)
+        if method == 'ellipse':
+            key.update(px.tobytes())
+            key.update(a.tobytes())
+            pars.append([px, a, dims, dist, max_size, min_size])
+        else:   # only the support matters
+            px = px[a > 0]
+            key.update(px.tobytes())
+            pars.append([px, dims, expandCore])
+        keys.append(key.hexdigest())
+    todo = [i for i in range(nr) if keys[i] not in cache]
+    pars = [pars[i] for i in todo]
+    logging.debug('search locations of {0} out of {1} components'.format(len(todo), nr))
+
+    fun = construct_ellipse_parallel if method == 'ellipse' else construct_dilate_parallel
+    if dview is None or len(pars) == 0:
+        res = list(map(fun, pars))
+    elif is_local_pool(dview):
+        res = dview.map_async(fun, pars).get(4294967)
+    else:
+        res = dview.map_sync(fun, pars)
+        dview.results.clear()
+
+    for i, r in zip(todo, res):
+        cache[keys[i]] = r
+    for key in set(cache) - set(keys):
+        del cache[key]
+
+    indices = [cache[key] for key in keys]
+    indptr = np.append(0, np.cumsum([len(ind) for ind in indices]))
+    indices = np.concatenate(indices + [np.zeros(0, dtype=int)])
+    return csc_matrix((np.ones(len(indices), dtype=bool), indices, indptr), shape=(d, nr))
 
 def construct_dilate_parallel(pars):
-    """
+    """search locations of one component by dilation of its support with expandCore
+
+    The dilation is computed in the bounding box of the support, padded enough that
+    the result matches the dilation of the whole field of view.
+
+    Args:
+        px: np.ndarray
+            pixels (in F order) where the footprint is positive
+
+    Returns:
+        np.ndarray, sorted pixels (in F order) of the search locations
     """
 
-    from scipy.ndimage.morphology import generate_binary_structure, iterate_structure, grey_dilation
+    from scipy.ndimage.morphology import grey_dilation
 
-    A_i, dims, expandCore, d  = pars
-    A_temp = np.reshape(A_i.toarray(), dims[::-1])
+    px, dims, expandCore = pars
+    if len(px) == 0:
+        return px
+    # the footprints are reshaped in C order with reversed dims, as in the whole field of view
+    shape = dims[::-1]
+    size = np.shape(expandCore) if len(expandCore) > 0 else [1] * len(dims)
+    sub = np.unravel_index(px, shape)
+    lo = [max(0, s.min() - 2 * n) for s, n in zip(sub, size)]
+    hi = [min(sh, s.max() + 2 * n + 1) for s, sh, n in zip(sub, shape, size)]
+    A_temp = np.zeros([h - l for l, h in zip(lo, hi)], dtype=np.uint8)
+    A_temp[tuple(s - l for s, l in zip(sub, lo))] = 1
     if len(expandCore) > 0:
-        if len(expandCore.shape) < len(dims):  # default for 3D
-            expandCore = iterate_structure(
-                generate_binary_structure(len(dims), 1), 2).astype(int)
         A_temp = grey_dilation(A_temp, footprint=expandCore)
     else:
         A_temp = grey_dilation(A_temp, [1] * len(dims))
 
-    dist_indicator_i = scipy.sparse.coo_matrix(np.squeeze(np.reshape(A_temp, (d, 1)))[:,None] > 0)
+    # search indexes for the component
+    return np.ravel_multi_index(tuple(s + l for s, l in zip(np.nonzero(A_temp), lo)), shape)
 
-    # search indexes for each component
-    return dist_indicator_i
-
-def computing_indicator(Y, A_in, b, C, f, nb, method, dims, min_size, max_size, dist, expandCore, dview):
+def computing_indicator(Y, A_in, b, C, f, nb, method, dims, min_size, max_size, dist, expandCore, dview,
+                        search_cache=None):
     """compute the indices of the distance from the cm to search for the spatial component (calling determine_search_location)
 
     does this by following an ellipse from the cm or doing a step by step dilatation around the cm
@@ -1026,9 +1057,15 @@ def computing_indicator(Y, A_in, b, C, f, nb, method, dims, min_size, max_size,
                 if method is dilate this represents the kernel used for expansion
 
 
+        search_cache: [optional] dict
+                search locations of previous calls, see determine_search_location
+
     Returns:
-        same:
-            but reshaped and tested
+        ind2_: scipy.sparse.csr_matrix
+            boolean pixels x components, search locations of each pixel
+
+        nr, C, f, b, A_in:
+            same but reshaped and tested
 
     Raises:
         Exception 'You need to define the input dimensions'
@@ -1077,6 +1114,7 @@ def computing_indicator(Y, A_in, b, C, f, nb, method, dims, min_size, max_size,
             nr, _ = np.shape(C)  # number of neurons
             ind2_ = [np.hstack((np.where(iid_)[0], nr + np.arange(f.shape[0])))
                      if np.size(np.where(iid_)[0]) > 0 else [] for iid_ in dist_indicator]
+            ind2_ = search_locations_to_csr(ind2_, nr + f.shape[0])
 
     else:
         if C is None:
@@ -1086,21 +1124,65 @@ def computing_indicator(Y, A_in, b, C, f, nb, method, dims, min_size, max_size,
 
         if b is None:
             dist_indicator = determine_search_location(
-                A_in, dims, method=method, min_size=min_size, max_size=max_size, dist=dist, expandCore=expandCore, dview=dview)
+                A_in, dims, method=method, min_size=min_size, max_size=max_size, dist=dist, expandCore=expandCore,
+                dview=dview, cache=search_cache)
         else:
             dist_indicator = determine_search_location(
                 scipy.sparse.hstack([A_in, scipy.sparse.coo_matrix(b)]), dims, method=method, min_size=min_size, max_size=max_size, dist=dist, expandCore=expandCore,
-                dview=dview)
+                dview=dview, cache=search_cache)
 
-        ind2_ = [np.where(iid_.squeeze())[0]  for iid_ in dist_indicator.astype(np.bool).toarray()]
-        ind2_ = [iid_ if (np.size(iid_) > 0) and (np.min(iid_) < nr) else [] for iid_ in ind2_]
+        # pixels searched only by the background are skipped
+        ind2_ = csr_matrix(dist_indicator, dtype=bool)
+        ind2_.sort_indices()
+        ind2_.data[np.repeat(ind2_[:, :nr].getnnz(1) == 0, np.diff(ind2_.indptr))] = False
+        ind2_.eliminate_zeros()
 
     return ind2_, nr, C, f, b, A_in
 
+# maximum size of the pixels of Y loaded by a task
+_max_block_bytes = 2 ** 28
+
+
+def pixel_blocks(d, T, n_pixels_per_process, dview=None):
+    """split the d pixels in contiguous blocks for the regressions
+
+    A few blocks per worker are used, of at least n_pixels_per_process pixels, and
+    small enough that the block of Y fits in _max_block_bytes.
+
+    Args:
+        d: int
+            number of pixels
+
+        T: int
+            number of frames
+
+        n_pixels_per_process: int
+            minimum number of pixels per block
+
+        dview: None or view on the cluster
+
+    Returns:
+        bounds: np.ndarray
+            the block i holds the pixels bounds[i]:bounds[i + 1]
+    """
+    n_tasks = n_blocks(dview)
+    block = max(n_pixels_per_process, min(-(-d // n_tasks), _max_block_bytes // (8 * T)))
+    return np.append(np.arange(0, d, max(block, 1)), d)
+
+
+def search_locations_to_csr(ind2_, n_components):
+    """search locations of each pixel (list of arrays of component indices) as a
+    boolean pixels x components csr_matrix"""
+    indptr = np.append(0, np.cumsum([len(iid_) for iid_ in ind2_]))
+    indices = np.concatenate([np.asarray(iid_, dtype=np.int32) for iid_ in ind2_] + [np.zeros(0, dtype=np.int32)])
+    return csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr), shape=(len(ind2_), n_components))
+
+
 def creatememmap(Y, Cf, dview):
     """memmap the C and Y objects in parallel
 
-       the memmaped object will be read during parallelized computation such as the regression function
+       the memmaped object will be read during parallelized computation such as the regression function.
+       With a SharedMemoryPool Cf is published in shared memory instead
 
        Args:
            Y: np.ndarray (2D or 3D)
@@ -1116,22 +1198,30 @@ def creatememmap(Y, Cf, dview):
            Y_name: string
                 the memmaped name of Y
 
+           folder: string or None
+                temporary folder to remove after use, None if no file was written
+
            Raises:
            Exception 'Not implemented consistently'
            """
-    if os.environ.get('SLURM_SUBMIT_DIR') is not None:
-        tmpf = os.environ.get('SLURM_SUBMIT_DIR')
-        print(f'cluster temporary folder: {tmpf}')
-        folder = tempfile.mkdtemp(dir=tmpf)
-    else:
-        folder = tempfile.mkdtemp()
-
+    def make_folder():
+        if os.environ.get('SLURM_SUBMIT_DIR') is not None:
+            tmpf = os.environ.get('SLURM_SUBMIT_DIR')
+            print(f'cluster temporary folder: {tmpf}')
+            return tempfile.mkdtemp(dir=tmpf)
+        return tempfile.mkdtemp()
+
+    folder = None
     if dview is None:
         Y_name = Y
         C_name = Cf
     else:
-        C_name = os.path.join(folder, 'C_temp.npy')
-        np.save(C_name, Cf)
+        if isinstance(dview, SharedMemoryPool):
+            C_name = dview.share(Cf)
+        else:
+            folder = make_folder()
+            C_name = os.path.join(folder, 'C_temp.npy')
+            np.save(C_name, Cf)
 
         if type(Y) is np.core.memmap:  # if input file is already memory mapped then find the filename
             Y_name = Y.filename
@@ -1139,9 +1229,6 @@ def creatememmap(Y, Cf, dview):
         elif isinstance(Y, basestring) or dview is None:
             Y_name = Y
         else:
-            Y_name = os.path.join(folder, 'Y_temp.npy')
-            np.save(Y_name, Y)
-            Y, _, _, _ = load_memmap(Y_name)
             raise Exception('Not implemented consistently')
     return C_name, Y_name, folder
 
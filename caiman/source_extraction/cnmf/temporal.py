@@ -18,6 +18,8 @@ from .deconvolution import constrained_foopsi
 from .utilities import update_order_greedy
 import sys
 from ...mmapping import parallel_dot_product
+from ...shared_multiprocessing import get_shared, is_local_pool, n_blocks, release_array, share_array
+
 
 def make_G_matrix(T, g):
     """
@@ -64,6 +66,21 @@ def constrained_foopsi_parallel(arg_in):
 
     return C_, Sp_, Ytemp_, cb_, c1_, sn_, gn_, jj_, lam_
 
+def constrained_foopsi_block(arg_in):
+    """ deconvolve the traces start:stop of Ytemp in one task, see constrained_foopsi_parallel
+
+        Ytemp (T x n) holds the traces of a whole vertex cover, as an array or a shared memory handle
+    """
+
+    Ytemp, start, stop, argss = arg_in
+    Ytemp = get_shared(Ytemp)
+    results = []
+    for jj in range(stop - start):
+        res = constrained_foopsi_parallel((np.array(Ytemp[:, start + jj]), None, jj, None, None, None, None, argss))
+        # the residual trace is not used, the indices are relative to start
+        results.append(res[:2] + (None,) + res[3:])
+    return results
+
 def update_temporal_components(Y, A, b, Cin, fin, bl=None, c1=None, g=None, sn=None, nb=1, ITER=2, block_size_temp=5000, num_blocks_per_run_temp=20, debug=False, dview=None, **kwargs):
     """Update temporal components and background given spatial components using a block coordinate descent approach.
 
@@ -341,18 +358,26 @@ def update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
             Ytemp = YrA[:, jo.flatten()] + Cin[jo, :].T
             Ctemp = np.zeros((np.size(jo), T))
             Stemp = np.zeros((np.size(jo), T))
-            nT = nA[jo]
-            args_in = [(np.squeeze(np.array(Ytemp[:, jj])), nT[jj], jj, None,
-                        None, None, None, kwargs) for jj in range(len(jo))]
+            # each task deconvolves a contiguous block of traces, the traces are
+            # shared once with a SharedMemoryPool and sliced per block otherwise
+            Ytemp = np.ascontiguousarray(Ytemp)
+            n_tasks = n_blocks(dview)
+            bounds = np.linspace(0, len(jo), min(n_tasks, len(jo)) + 1).astype(int)
+            Ytemp_ = share_array(dview, Ytemp)
+            if Ytemp_ is Ytemp:
+                args_in = [(Ytemp[:, start:stop], 0, stop - start, kwargs)
+                           for start, stop in zip(bounds[:-1], bounds[1:])]
+            else:
+                args_in = [(Ytemp_, start, stop, kwargs) for start, stop in zip(bounds[:-1], bounds[1:])]
             # computing the most likely discretized spike train underlying a fluorescence trace
-            if 'multiprocessing' in str(type(dview)):
+            if is_local_pool(dview):
                 results = dview.map_async(
-                    constrained_foopsi_parallel, args_in).get(4294967)
+                    constrained_foopsi_block, args_in).get(4294967)
 
             elif dview is not None and platform.system() != 'Darwin':
                 if debug:
                     results = dview.map_async(
-                        constrained_foopsi_parallel, args_in)
+                        constrained_foopsi_block, args_in)
                     results.get()
                     for outp in results.stdout:
                         print((outp[:-1]))
@@ -362,10 +387,14 @@ def update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
                         sys.stderr.flush()
                 else:
                     results = dview.map_sync(
-                        constrained_foopsi_parallel, args_in)
+                        constrained_foopsi_block, args_in)
 
             else:
-                results = list(map(constrained_foopsi_parallel, args_in))
+                results = list(map(constrained_foopsi_block, args_in))
+            release_array(dview, Ytemp_)
+            # block-relative indices back to indices in jo
+            results = [(*chunk[:7], start + chunk[7], chunk[8])
+                       for start, block in zip(bounds[:-1], results) for chunk in block]
             # unparsing and updating the result
             for chunk in results:
                 C_, Sp_, Ytemp_, cb_, c1_, sn_, gn_, jj_, lam_ = chunk
@@ -389,7 +418,7 @@ def update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
             YrA -= AA[ii, :].T.dot((cc - Cin[ii])[None, :]).T
             C[ii, :] = cc
 
-        if dview is not None and not('multiprocessing' in str(type(dview))):
+        if dview is not None and not is_local_pool(dview):
             dview.results.clear()
 
         try:
@@ -996,7 +996,7 @@ def get_file_size(file_name, var_name_hdf5='mov'):
                     T = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT))
                     dims[1] = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_WIDTH))
                     dims[0] = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT))
-            elif extension == '.mmap':
+            elif extension in ('.mmap', '.cmmap'):
                 filename = os.path.split(file_name)[-1]
                 Yr, dims, T = load_memmap(os.path.join(
                         os.path.split(file_name)[0], filename))
@@ -15,12 +15,16 @@ from builtins import range
 import cv2
 import logging
 import numpy as np
+import os
 from scipy.ndimage import convolve, generate_binary_structure
 from scipy.sparse import coo_matrix
 from typing import Any, List, Optional, Tuple
 
 import caiman as cm
-from caiman.source_extraction.cnmf.pre_processing import get_noise_fft
+from caiman.mmapping import prepare_shape
+from caiman.paths import memmap_frames_filename
+from caiman.shared_multiprocessing import is_local_pool
+from caiman.source_extraction.cnmf.pre_processing import _fft_segments, get_noise_fft
 from caiman.source_extraction.cnmf.utilities import get_file_size
 
 def max_correlation_image(Y, bin_size: int = 1000, eight_neighbours: bool = True, swap_dim: bool = True) -> np.ndarray:
@@ -290,6 +294,56 @@ def local_correlations(Y, eight_neighbours: bool = True, swap_dim: bool = True,
     return rho
 
 
+def filter_frames(Y, gSig, center_psf: bool = True, background_filter: str = 'disk') -> np.ndarray:
+    """
+    spatially filter in place each frame of the movie Y (T x d1 x d2, float32), as done by
+    correlation_pnr and the corr_pnr initialization
+
+    Args:
+        Y:  np.ndarray (3D)
+            movie, overwritten with the filtered frames
+        gSig:  scalar or vector.
+            gaussian width
+        center_psf: Boolean
+            True indicates subtracting the mean of the filtering kernel
+        background_filter: str
+            'box' subtracts a box filter from the gaussian filter, otherwise the
+            gaussian kernel is centered over a disk
+
+    Returns:
+        Y: np.ndarray (3D)
+    """
+    if not isinstance(gSig, list):
+        gSig = [gSig, gSig]
+    ksize = tuple([int(2 * i) * 2 + 1 for i in gSig])
+
+    if center_psf:
+        if background_filter == 'box':
+            for idx, img in enumerate(Y):
+                Y[idx, ] = cv2.GaussianBlur(
+                    img, ksize=ksize, sigmaX=gSig[0], sigmaY=gSig[1], borderType=1) \
+                    - cv2.boxFilter(img, ddepth=-1, ksize=ksize, borderType=1)
+        else:
+            psf = cv2.getGaussianKernel(ksize[0], gSig[0],
+                                        cv2.CV_32F).dot(cv2.getGaussianKernel(ksize[1], gSig[1], cv2.CV_32F).T)
+            ind_nonzero = psf >= psf[0].max()
+            psf -= psf[ind_nonzero].mean()
+            psf[~ind_nonzero] = 0
+            for idx, img in enumerate(Y):
+                Y[idx,] = cv2.filter2D(img, -1, psf, borderType=1)
+    else:
+        for idx, img in enumerate(Y):
+            Y[idx,] = cv2.GaussianBlur(img, ksize=ksize, sigmaX=gSig[0], sigmaY=gSig[1], borderType=1)
+    return Y
+
+
+def filter_radius(gSig) -> int:
+    """number of pixels on each side of a pixel used by filter_frames"""
+    if not gSig:
+        return 0
+    return int(2 * np.max(gSig))
+
+
 def correlation_pnr(Y, gSig=None, center_psf: bool = True, swap_dim: bool = True,
                     background_filter: str = 'disk') -> Tuple[np.ndarray, np.ndarray]:
     """
@@ -327,29 +381,7 @@ def correlation_pnr(Y, gSig=None, center_psf: bool = True, swap_dim: bool = True
     # filter data
     data_filtered = data_raw.copy()
     if gSig:
-        if not isinstance(gSig, list):
-            gSig = [gSig, gSig]
-        ksize = tuple([int(2 * i) * 2 + 1 for i in gSig])
-
-        if center_psf:
-            if background_filter == 'box':
-                for idx, img in enumerate(data_filtered):
-                    data_filtered[idx, ] = cv2.GaussianBlur(
-                        img, ksize=ksize, sigmaX=gSig[0], sigmaY=gSig[1], borderType=1) \
-                        - cv2.boxFilter(img, ddepth=-1, ksize=ksize, borderType=1)
-            else:
-                psf = cv2.getGaussianKernel(ksize[0], gSig[0],
-                                            cv2.CV_32F).dot(cv2.getGaussianKernel(ksize[1], gSig[1], cv2.CV_32F).T)
-                ind_nonzero = psf >= psf[0].max()
-                psf -= psf[ind_nonzero].mean()
-                psf[~ind_nonzero] = 0
-                for idx, img in enumerate(data_filtered):
-                    data_filtered[idx,] = cv2.filter2D(img, -1, psf, borderType=1)
-
-            # data_filtered[idx, ] = cv2.filter2D(img, -1, psf, borderType=1)
-        else:
-            for idx, img in enumerate(data_filtered):
-                data_filtered[idx,] = cv2.GaussianBlur(img, ksize=ksize, sigmaX=gSig[0], sigmaY=gSig[1], borderType=1)
+        filter_frames(data_filtered, gSig, center_psf=center_psf, background_filter=background_filter)
 
     # compute peak-to-noise ratio
     data_filtered -= data_filtered.mean(axis=0)
@@ -368,6 +400,192 @@ def correlation_pnr(Y, gSig=None, center_psf: bool = True, swap_dim: bool = True
     return cn, pnr
 
 
+# maximum size of the frames of a tile kept in memory by correlation_pnr_tile and iter_local_correlations_tile
+_max_tile_bytes = 2**28
+
+# pairs of 8-neighbours (pixel, pixel + offset) as 2D slices: right, down, down-right, down-left
+_neighbour_pairs = [((slice(None), slice(None, -1)), (slice(None), slice(1, None))),
+                    ((slice(None, -1), slice(None)), (slice(1, None), slice(None))),
+                    ((slice(None, -1), slice(None, -1)), (slice(1, None), slice(1, None))),
+                    ((slice(None, -1), slice(1, None)), (slice(1, None), slice(None, -1)))]
+
+
+def neighbour_moments(Y, moments=None) -> List[np.ndarray]:
+    """
+    add the first and second moments of the frames Y (T x d1 x d2) and the cross moments
+    with their 8 neighbours to the running sums in moments. The sums over the frames are
+    computed in single precision, unless Y is in double precision
+
+    Returns:
+        moments: list
+            [sum of Y, sum of Y**2, sum of Y * Y shifted right, down, down-right and down-left]
+    """
+    Y = np.asarray(Y, dtype=np.result_type(Y, np.float32))
+    sums = [Y.sum(0), np.einsum('tij,tij->ij', Y, Y)] + \
+        [np.einsum('tij,tij->ij', Y[(slice(None),) + a], Y[(slice(None),) + b]) for a, b in _neighbour_pairs]
+    if moments is None:
+        return [m.astype(np.float64) for m in sums]
+    for m, sm in zip(moments, sums):
+        m += sm
+    return moments
+
+
+def correlation_from_moments(moments, T, eight_neighbours: bool = True) -> np.ndarray:
+    """
+    local correlation image from the running sums of neighbour_moments over T frames, as
+    computed by local_correlations_fft
+
+    Returns:
+        Cn: d1 x d2 matrix, mean correlation with the adjacent pixels (8 neighbours if
+            eight_neighbours, otherwise 4)
+    """
+    mean = moments[0] / T
+    std = np.sqrt(np.maximum(moments[1] / T - mean**2, 0))
+    std[std == 0] = np.inf
+    Cn = np.zeros(mean.shape)
+    n_neighbours = np.zeros(mean.shape)
+    for (a, b), cross in zip(_neighbour_pairs[:4 if eight_neighbours else 2], moments[2:]):
+        rho = (cross / T - mean[a] * mean[b]) / (std[a] * std[b])
+        Cn[a] += rho
+        Cn[b] += rho
+        n_neighbours[a] += 1
+        n_neighbours[b] += 1
+    return Cn / n_neighbours
+
+
+def correlation_pnr_tile(args) -> Tuple[Tuple, np.ndarray, np.ndarray]:
+    """
+    helper function of correlation_pnr_tiled, correlation and PNR images of one tile
+
+    The tile and the pixels around it needed by the spatial filter and the correlations
+    are read chunk_size frames at a time, in two passes over the frames: the first for the
+    mean, the maximum and the noise (from the frames used by get_noise_fft), the second for
+    the moments of the thresholded data. The second pass reads and filters the frames again,
+    unless the filtered frames fit in _max_tile_bytes.
+
+    Args:
+        args: tuple
+            (Y or the name of its memory mapped file, (r0, r1, c0, c1) bounds of the tile,
+            gSig, center_psf, background_filter, chunk_size)
+
+    Returns:
+        bounds: tuple
+            (r0, r1, c0, c1)
+
+        cn, pnr: np.ndarray
+            correlation and peak-to-noise ratio images of the tile
+    """
+    Y, bounds, gSig, center_psf, background_filter, chunk_size = args
+    if isinstance(Y, str):
+        Yr, dims, T = cm.load_memmap(Y)
+        Y = np.reshape(Yr.T, [T] + list(dims), order='F')
+    T, d1, d2 = Y.shape
+    r0, r1, c0, c1 = bounds
+    halo = filter_radius(gSig) + 1
+    ra, rb, ca, cb = max(r0 - halo, 0), min(r1 + halo, d1), max(c0 - halo, 0), min(c1 + halo, d2)
+
+    def chunks():
+        for t in range(0, T, chunk_size):
+            Yc = np.array(Y[t:t + chunk_size, ra:rb, ca:cb], dtype=np.float32)
+            yield t, filter_frames(Yc, gSig, center_psf, background_filter) if gSig else Yc
+
+    # the filtered frames are kept for the second pass if they fit in _max_tile_bytes
+    filtered: Optional[List] = [] if 4 * T * (rb - ra) * (cb - ca) <= _max_tile_bytes else None
+    frames_fft = np.concatenate([np.arange(T)[seg] for seg in _fft_segments(T, 3072)])
+    data_sum = np.zeros((rb - ra, cb - ca))
+    data_max = np.full((rb - ra, cb - ca), -np.inf, dtype=np.float32)
+    data_fft = np.zeros((len(frames_fft), rb - ra, cb - ca), dtype=np.float32)
+    for t, Yc in chunks():
+        data_sum += Yc.sum(0)
+        np.maximum(data_max, Yc.max(0), out=data_max)
+        in_chunk = (frames_fft >= t) & (frames_fft < t + len(Yc))
+        data_fft[in_chunk] = Yc[frames_fft[in_chunk] - t]
+        if filtered is not None:
+            filtered.append((t, Yc))
+    data_mean = (data_sum / T).astype(np.float32)
+    data_fft -= data_mean
+    data_std = get_noise_fft(data_fft.transpose(1, 2, 0), noise_method='mean')[0]
+    del data_fft
+
+    moments = None
+    for t, Yc in chunks() if filtered is None else filtered:
+        Yc -= data_mean
+        Yc[Yc < 3 * data_std] = 0
+        moments = neighbour_moments(Yc, moments)
+
+    inner = (slice(r0 - ra, r1 - ra), slice(c0 - ca, c1 - ca))
+    cn = correlation_from_moments(moments, T)[inner]
+    pnr = np.divide(data_max - data_mean, data_std)[inner]
+    pnr[pnr < 0] = 0
+    return bounds, cn, pnr
+
+
+def correlation_pnr_tiled(Y, gSig=None, center_psf: bool = True, swap_dim: bool = True,
+                          background_filter: str = 'disk', tile_shape=(128, 128), chunk_size: int = 1000,
+                          dview=None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    compute the correlation image and the peak-to-noise ratio (PNR) image as correlation_pnr,
+    without loading the movie in memory.
+
+    The field of view is split in tiles that are processed independently (in parallel if dview
+    is not None), reading chunk_size frames at a time of the tile and of the pixels around it
+    that are needed by the spatial filter. The memory used by each tile does not depend on the
+    number of frames. The images can be used to choose min_corr and min_pnr for a movie that does
+    not fit in memory; the seeding of init_neurons_corr_pnr_tiled computes its own images per tile.
+
+    Args:
+        Y:  np.ndarray (3D) or str
+            input movie, or the name of a memory mapped file (required for parallel processing)
+        gSig:  scalar or vector.
+            gaussian width. If gSig == None, no spatial filtering
+        center_psf: Boolean
+            True indicates subtracting the mean of the filtering kernel
+        swap_dim: Boolean
+            True indicates that time is listed in the last axis of Y (matlab format)
+            and moves it in the front. Ignored for memory mapped files
+        background_filter: str
+            see filter_frames
+        tile_shape: tuple
+            number of rows and columns of the tiles
+        chunk_size: int
+            number of frames read at a time
+        dview: view on the cluster, or None to process the tiles serially
+
+    Returns:
+        cn: np.ndarray (2D).
+            local correlation image of the spatially filtered (or not) data
+        pnr: np.ndarray (2D).
+            peak-to-noise ratios of all pixels
+    """
+    if isinstance(Y, str):
+        dims = get_file_size(Y)[0]
+    else:
+        if swap_dim:
+            Y = np.transpose(Y, tuple(np.hstack((Y.ndim - 1, list(range(Y.ndim))[:-1]))))
+        dims = Y.shape[1:]
+        if dview is not None:
+            logging.warning('Parallel processing requires memory mapped files, processing serially')
+            dview = None
+    d1, d2 = dims
+    params = [(Y, (r, min(r + tile_shape[0], d1), c, min(c + tile_shape[1], d2)), gSig, center_psf,
+               background_filter, chunk_size)
+              for r in range(0, d1, tile_shape[0]) for c in range(0, d2, tile_shape[1])]
+
+    if dview is None:
+        results = map(correlation_pnr_tile, params)
+    elif is_local_pool(dview):
+        results = dview.map_async(correlation_pnr_tile, params).get(4294967)
+    else:
+        results = dview.map_sync(correlation_pnr_tile, params)
+
+    cn = np.zeros((d1, d2))
+    pnr = np.zeros((d1, d2), dtype=np.float32)
+    for (r0, r1, c0, c1), cn_tile, pnr_tile in results:
+        cn[r0:r1, c0:c1] = cn_tile
+        pnr[r0:r1, c0:c1] = pnr_tile
+    return cn, pnr
+
+
 def iter_chunk_array(arr: np.array, chunk_size: int):
     if ((arr.shape[0] // chunk_size) - 1) > 0:
         for i in range((arr.shape[0] // chunk_size) - 1):
@@ -765,7 +983,7 @@ def local_correlations_movie_offline(file_name,
     if dview is None:
         parallel_result = list(map(local_correlations_movie_parallel, params))
     else:
-        if 'multiprocessing' in str(type(dview)):
+        if is_local_pool(dview):
             parallel_result = dview.map_async(local_correlations_movie_parallel, params).get(4294967)
         else:
             parallel_result = dview.map_sync(local_correlations_movie_parallel, params)
@@ -786,3 +1004,208 @@ def local_correlations_movie_parallel(params: Tuple) -> np.ndarray:
     else:
         return local_correlations(mv, eight_neighbours=eight_neighbours, swap_dim=swap_dim,
                                   order_mean=order_mean)[None, :, :].astype(np.float32)
+
+
+def iter_local_correlations_tile(Y, bounds, window: int, stride: int, eight_neighbours: bool = True,
+                                 chunk_size: int = 200):
+    """
+    helper function of iter_local_correlations_movie and local_correlations_movie_tile, yields
+    the correlation images of one tile in the windows of window frames starting every stride
+    frames
+
+    The frames of the tile and of the pixels around it are read chunk_size frames at a time,
+    or less if window + chunk_size frames of the tile do not fit in _max_tile_bytes. The
+    moments of the window are updated with the frames that enter it and those that leave it,
+    which are kept in memory until then. The frames are centered on the mean of the first chunk and the sums are
+    computed in double precision, so that they remain accurate over long movies.
+
+    Args:
+        Y: np.ndarray (T x d1 x d2)
+            input movie
+
+        bounds: tuple
+            (r0, r1, c0, c1) bounds of the tile
+
+        other arguments: see local_correlations_movie_tiled
+
+    Yields:
+        cn: np.ndarray
+            correlation image of the tile in each window
+    """
+    T, d1, d2 = Y.shape
+    r0, r1, c0, c1 = bounds
+    ra, rb, ca, cb = max(r0 - 1, 0), min(r1 + 1, d1), max(c0 - 1, 0), min(c1 + 1, d2)
+    inner = (slice(r0 - ra, r1 - ra), slice(c0 - ca, c1 - ca))
+    chunk_size = max(1, min(chunk_size, _max_tile_bytes // (8 * (rb - ra) * (cb - ca)) - window))
+    ref = np.array(Y[:min(chunk_size, T), ra:rb, ca:cb], dtype=np.float64).mean(0)
+
+    def read(t0, t1):
+        return np.array(Y[t0:t1, ra:rb, ca:cb], dtype=np.float64) - ref
+
+    # buf holds the frames b0 to b0 + len(buf), moments those of the frames lo to hi
+    buf, b0 = read(0, 0), 0
+    moments, lo, hi = None, 0, 0
+    for j in range(0, T - window + 1, stride):
+        if j >= hi:     # no overlap with the previous window
+            moments, lo, hi = None, j, j
+        end = b0 + len(buf)
+        if j + window > end:
+            start = max(lo, end)
+            new = read(start, min(max(j + window, start + chunk_size), T))
+            buf, b0 = (np.concatenate([buf[lo - b0:], new]), lo) if lo < end else (new, start)
+        moments = neighbour_moments(buf[hi - b0:j + window - b0], moments)
+        if j > lo:
+            for m, old in zip(moments, neighbour_moments(buf[lo - b0:j - b0])):
+                m -= old
+        lo, hi = j, j + window
+        yield correlation_from_moments(moments, window, eight_neighbours)[inner]
+
+
+def _movie_tiles(dims, tile_shape) -> List[Tuple]:
+    """bounds (r0, r1, c0, c1) of the tiles of the field of view"""
+    d1, d2 = dims
+    return [(r, min(r + tile_shape[0], d1), c, min(c + tile_shape[1], d2))
+            for r in range(0, d1, tile_shape[0]) for c in range(0, d2, tile_shape[1])]
+
+
+def _load_movie(Y, swap_dim: bool):
+    """movie (T x d1 x d2) from Y or from the memory mapped file named Y"""
+    if isinstance(Y, str):
+        Yr, dims, T = cm.load_memmap(Y)
+        return np.reshape(Yr.T, [T] + list(dims), order='F')
+    if swap_dim:
+        Y = np.transpose(Y, tuple(np.hstack((Y.ndim - 1, list(range(Y.ndim))[:-1]))))
+    return Y
+
+
+def iter_local_correlations_movie(Y, window: int = 100, stride: int = 100, swap_dim: bool = False,
+                                  eight_neighbours: bool = True, tile_shape=(128, 128), chunk_size: int = 200):
+    """
+    Yield the frames of the local correlation movie in sliding windows one at a time, without
+    loading the movie in memory
+
+    Args:
+        Y:  np.ndarray (3D) or str
+            input movie, or the name of a memory mapped file
+
+        other arguments: see local_correlations_movie_tiled
+
+    Yields:
+        cn: np.ndarray (2D)
+            correlation image of the frames j to j + window, for j = 0, stride, 2 * stride, ...
+    """
+    Y = _load_movie(Y, swap_dim)
+    tiles = _movie_tiles(Y.shape[1:], tile_shape)
+    iters = [iter_local_correlations_tile(Y, bounds, window, stride, eight_neighbours, chunk_size)
+             for bounds in tiles]
+    for cn_tiles in zip(*iters):
+        cn = np.zeros(Y.shape[1:], dtype=np.float32)
+        for (r0, r1, c0, c1), cn_tile in zip(tiles, cn_tiles):
+            cn[r0:r1, c0:c1] = cn_tile
+        yield cn
+
+
+def local_correlations_movie_tile(args) -> Tuple:
+    """
+    helper function of local_correlations_movie_tiled, writes the correlation images of one
+    tile in all windows to the output memory mapped file, chunk_size frames at a time
+
+    Args:
+        args: tuple
+            (Y or the name of its memory mapped file, (r0, r1, c0, c1) bounds of the tile,
+            window, stride, eight_neighbours, chunk_size, name of the output file)
+
+    Returns:
+        bounds: tuple
+            (r0, r1, c0, c1)
+    """
+    Y, bounds, window, stride, eight_neighbours, chunk_size, fname_out = args
+    Y = _load_movie(Y, False)
+    r0, r1, c0, c1 = bounds
+    Yr_out, dims, T_out = cm.load_memmap(fname_out, mode='r+')
+    # frames of the output file are contiguous, with the pixels in Fortran order
+    out = np.reshape(Yr_out.T, (T_out, dims[1], dims[0]))
+    block: List[np.ndarray] = []
+    t = 0
+    for cn in iter_local_correlations_tile(Y, bounds, window, stride, eight_neighbours, chunk_size):
+        block.append(cn)
+        if len(block) == chunk_size:
+            out[t:t + len(block), c0:c1, r0:r1] = np.transpose(block, (0, 2, 1))
+            t += len(block)
+            block = []
+    if block:
+        out[t:t + len(block), c0:c1, r0:r1] = np.transpose(block, (0, 2, 1))
+    Yr_out.flush()
+    return bounds
+
+
+def local_correlations_movie_tiled(Y, base_name: str = 'corr_movie', window: int = 100, stride: int = 100,
+                                   swap_dim: bool = False, eight_neighbours: bool = True, tile_shape=(128, 128),
+                                   chunk_size: int = 200, dview=None) -> str:
+    """
+    Compute the local correlation movie in sliding windows, as local_correlations_movie_offline
+    (without baseline removal), and write it to a memory mapped file
+
+    The field of view is split in tiles that are processed independently (in parallel if dview
+    is not None). Each tile streams through the frames once, updating the moments of the window
+    with the frames that enter and leave it, and writes its part of the output frames. The
+    memory used does not depend on the number of frames. See iter_local_correlations_movie to
+    get the frames one at a time instead.
+
+    Args:
+        Y:  np.ndarray (3D) or str
+            input movie, or the name of a memory mapped file (required for parallel processing)
+
+        base_name: str
+            base name of the output file, which is saved in the folder of Y if Y is a file name
+
+        window: int
+            window length in frames
+
+        stride: int
+            stride length in frames
+
+        swap_dim: Boolean
+            True indicates that time is listed in the last axis of Y (matlab format)
+            and moves it in the front. Ignored for memory mapped files
+
+        eight_neighbours: Boolean
+            Use 8 neighbors if true, and 4 if false
+
+        tile_shape: tuple
+            number of rows and columns of the tiles
+
+        chunk_size: int
+            number of frames read at a time
+
+        dview: view on the cluster, or None to process the tiles serially
+
+    Returns:
+        fname_new: str
+            name of the memory mapped file (order 'F') holding the correlation images of the
+            windows j to j + window, for j = 0, stride, 2 * stride, ...
+    """
+    if isinstance(Y, str):
+        dims, T = get_file_size(Y)
+        base_name = os.path.join(os.path.split(Y)[0], base_name)
+    else:
+        Y = _load_movie(Y, swap_dim)
+        T, dims = len(Y), Y.shape[1:]
+        if dview is not None:
+            logging.warning('Parallel processing requires memory mapped files, processing serially')
+            dview = None
+    if T < window:
+        raise ValueError('The movie is shorter than the window')
+    T_out = (T - window) // stride + 1
+    fname_new = memmap_frames_filename(base_name, dims, T_out, 'F')
+    np.memmap(fname_new, mode='w+', dtype=np.float32, shape=prepare_shape((np.prod(dims), T_out)), order='F').flush()
+    params = [(Y, bounds, window, stride, eight_neighbours, chunk_size, fname_new)
+              for bounds in _movie_tiles(dims, tile_shape)]
+
+    if dview is None:
+        list(map(local_correlations_movie_tile, params))
+    elif is_local_pool(dview):
+        dview.map_async(local_correlations_movie_tile, params).get(4294967)
+    else:
+        dview.map_sync(local_correlations_movie_tile, params)
+    return fname_new
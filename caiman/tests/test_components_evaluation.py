@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import cv2
+import numpy.testing as npt
+import numpy as np
+import scipy.ndimage
+import scipy.sparse
+from caiman.components_evaluation import crop_components, evaluate_components, evaluate_components_blocks
+from caiman.utils.stats import _hsm, mode_robust
+
+
+def test_crop_components():
+    np.random.seed(0)
+    dims, half_crop, patch_size = np.array((60, 40)), (9, 9), 50
+    A = scipy.sparse.random(np.prod(dims), 20, density=.01, format='csc', random_state=0)
+    A[np.ravel_multi_index((2, 38), dims, order='F'), 0] = 5    # close to the border
+    # one component at a time
+    crops = []
+    for a in A.T:
+        img = a.toarray().reshape(dims, order='F')
+        com = np.minimum(np.maximum(scipy.ndimage.center_of_mass(img), half_crop), dims - half_crop).astype(int)
+        img = img[com[0] - half_crop[0]:com[0] + half_crop[0], com[1] - half_crop[1]:com[1] + half_crop[1]]
+        crops.append(cv2.resize(img / np.linalg.norm(img) if img.any() else img, (patch_size, patch_size)))
+    npt.assert_allclose(crop_components(A, dims, half_crop, patch_size), crops, atol=1e-6)
+    # an empty component gives a zero crop
+    A = scipy.sparse.hstack([A, scipy.sparse.csc_matrix((np.prod(dims), 1))])
+    crops = crop_components(A, dims, half_crop, patch_size)
+    assert np.all(np.isfinite(crops)) and not crops[-1].any()
+
+
+def test_mode_robust():
+    np.random.seed(0)
+    for T in (1, 2, 3, 4, 7, 1000):
+        x = np.random.randn(10, T).astype(np.float32)
+        x[0] = np.round(x[0])   # ties
+        npt.assert_array_equal(mode_robust(x, axis=1), [_hsm(np.sort(r)) for r in x])
+
+
+def test_evaluate_components_blocks():
+    np.random.seed(0)
+    dims, K, T = (40, 40), 30, 600
+    yy, xx = np.meshgrid(np.arange(dims[0]), np.arange(dims[1]), indexing='ij')
+    A = np.stack([np.exp(-((yy - y)**2 + (xx - x)**2) / 8.).ravel(order='F') for y, x in np.random.rand(K, 2) * dims], 1)
+    A[A < .05] = 0
+    C = scipy.ndimage.gaussian_filter1d((np.random.rand(K, T) < .02) * 5., 2, axis=1)
+    Y = (A.dot(C) + .1 * np.random.randn(np.prod(dims), T)).reshape(dims + (T,), order='F')
+    A = scipy.sparse.csc_matrix(A)
+    traces = C + .1 * np.random.randn(K, T)
+    fitness_raw, fitness_delta, _, _, r_values, _ = evaluate_components(Y, traces.copy(), A, C, None, None, 30)
+    # overlaps across blocks are taken into account
+    for res, expected in zip(evaluate_components_blocks(Y, traces, A, C, 30, block_size=7),
+                             (fitness_raw, fitness_delta, r_values)):
+        npt.assert_allclose(res, expected, rtol=1e-5, atol=1e-5)
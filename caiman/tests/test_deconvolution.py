@@ -77,3 +77,23 @@ def foo(method, p):
 def test_oasis():
     foo('oasis', 1)
     foo('oasis', 2)
+
+
+def test_oasis_fit_next_batch():
+    from caiman.source_extraction.cnmf.oasis import OASIS, fit_next_batch
+    for g in ([.95], [1.7, -.71]):
+        Y = gen_data(g, N=20, T=300)[0].astype(np.float32)
+        kwargs = dict(g=g[0], g2=g[1] if len(g) == 2 else 0, b=10, s_min=.1)
+        loop = [OASIS(**kwargs) for _ in Y]
+        batch = [OASIS(**kwargs) for _ in Y]
+        C_loop, C_batch = np.zeros((2, len(Y), 50), dtype=np.float32)
+        for t in range(Y.shape[1]):
+            tc = t % 50  # window shorter than the pools, as with a trace window in OnACID
+            for i, o in enumerate(loop):
+                o.fit_next(Y[i, t])
+                l = min(o.get_l_of_last_pool(), tc + 1)
+                C_loop[i, tc - l + 1:tc + 1] = o.get_c_of_last_pool()[-l:]
+            fit_next_batch(batch, Y[:, t], C_batch, tc)
+            npt.assert_array_equal(C_loop, C_batch)
+        for o1, o2 in zip(loop, batch):
+            npt.assert_array_equal(o1.c, o2.c)
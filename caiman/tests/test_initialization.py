@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import numpy.testing as npt
+import numpy as np
+from caiman.source_extraction.cnmf import initialization
+from caiman.source_extraction.cnmf.utilities import decimation_matrix
+
+
+def synthetic_1p(T=1200, dims=(50, 60), K=15):
+    np.random.seed(0)
+    Y = np.random.randn(T, *dims).astype(np.float32)
+    yy, xx = np.mgrid[:dims[0], :dims[1]]
+    for _ in range(K):
+        y, x = np.random.rand(2) * dims
+        c = np.convolve((np.random.rand(T) < .01) * 5., .9 ** np.arange(30))[:T]
+        Y += (np.exp(-((yy - y)**2 + (xx - x)**2) / 8.)[None] * c[:, None, None]).astype(np.float32)
+    return Y + 10
+
+
+def test_init_neurons_corr_pnr_tiled():
+    Y = synthetic_1p()
+    opts = dict(gSiz=9, gSig=2, min_corr=.8, min_pnr=6, deconvolve_options={'p': 0}, swap_dim=False)
+    A, C, _, _, center = initialization.init_neurons_corr_pnr(Y, **opts)
+    # small tiles, so that most neurons are initialized in several tiles
+    A_tiled, C_tiled, _, _, center_tiled = initialization.init_neurons_corr_pnr_tiled(
+        Y, tile_shape=(12, 15), **opts)
+    assert A_tiled.shape == A.shape
+    distance = np.linalg.norm(center[:, :, None] - center_tiled[:, None], axis=0)
+    npt.assert_array_less(distance.min(0), 1.5)
+    npt.assert_array_less(distance.min(1), 1.5)
+    # the default tiles cover the field of view, and are made smaller to bound their memory
+    A_bounded, _, _, _, center_bounded = initialization.init_neurons_corr_pnr_tiled(
+        Y, max_tile_bytes=4 * Y.nbytes, **opts)
+    assert A_bounded.shape == A.shape
+    distance = np.linalg.norm(center[:, :, None] - center_bounded[:, None], axis=0)
+    npt.assert_array_less(distance.min(0), 1.5)
+    npt.assert_array_less(distance.min(1), 1.5)
+
+
+def test_compute_W():
+    np.random.seed(0)
+    dims, T, K, radius = (23, 19), 300, 4, 4
+    Y = np.random.rand(np.prod(dims), T).astype(np.float32) + 5
+    A = np.random.rand(np.prod(dims), K) * (np.random.rand(np.prod(dims), K) < .1)
+    C = np.random.rand(K, T)
+    for ssub, tsub, data_fits_in_memory in ((1, 1, False), (2, 2, True), (2, 2, False)):
+        W, b0 = initialization.compute_W(Y, A, C, dims, radius, data_fits_in_memory=data_fits_in_memory,
+                                         ssub=ssub, tsub=tsub)
+        # regularized least squares fit of each pixel to the pixels of its ring, in the downsampled movie
+        X = Y - A.dot(C) - b0[:, None]
+        if ssub > 1:
+            X = decimation_matrix(dims, ssub).dot(X)
+        X = initialization.decimate_last_axis(X, tsub)
+        dims_ds, radius_ds = [(d - 1) // ssub + 1 for d in dims], int(round(radius / ssub))
+        ring = initialization.disk(radius_ds + 1)
+        ring[1:-1, 1:-1] -= initialization.disk(radius_ds)
+        ringidx = [i - radius_ds - 1 for i in np.nonzero(ring)]
+        for p in range(np.prod(dims_ds)):
+            y, x = divmod(p, dims_ds[0])
+            xx, yy = x + ringidx[0], y + ringidx[1]
+            inside = (xx >= 0) & (xx < dims_ds[0]) & (yy >= 0) & (yy < dims_ds[1])
+            index = xx[inside] + yy[inside] * dims_ds[0]
+            BB = X[index].dot(X[index].T)
+            w = np.linalg.solve(BB + np.trace(BB) * 1e-5 * np.eye(len(index)), X[index].dot(X[p]))
+            npt.assert_array_equal(W[p].indices, index)
+            npt.assert_allclose(W[p].toarray()[0, index], w, rtol=1e-4, atol=1e-6)
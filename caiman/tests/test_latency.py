@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+import json
+import numpy as np
+import numpy.testing as npt
+import os
+import tempfile
+from time import sleep
+from caiman.source_extraction.cnmf.latency import FrameProfiler
+
+
+def test_frame_profiler():
+    profiler = FrameProfiler(['a', 'b'], fr=1000., history=3)
+    assert profiler.budget == 1e-3
+    for i in range(5):
+        profiler.start_frame()
+        sleep(5e-3 if i == 2 else 0)
+        profiler.mark('a')
+        profiler.add('b', 1e-4)
+        if profiler.over_budget('b'):
+            profiler.defer('b')
+        profiler.end_frame()
+    assert profiler.n_frames == 5 and profiler.missed >= 1 and profiler.deferred['b'] >= 1
+    assert profiler.max_queue_depth >= 1
+    summary = profiler.summary()
+    npt.assert_allclose(summary['b']['mean'], 1e-4)
+    assert summary['a']['max'] >= 5e-3 and summary['a']['max'] <= summary['frame']['max']
+    assert summary['a']['p50'] < 5e-3
+    with tempfile.TemporaryDirectory() as tmpdir:
+        profiler.save(os.path.join(tmpdir, 'latency.json'))
+        with open(os.path.join(tmpdir, 'latency.json')) as f:
+            saved = json.load(f)
+    assert len(saved['recent']['a']) == 3 and saved['recent']['a'][0] >= 5e-3
+    assert np.sum(saved['histograms']['frame']) == 5
+
+
+def test_frame_profiler_max_deferred():
+    profiler = FrameProfiler(['a'], budget=1e-9, max_deferred=2)
+    ran = []
+    for i in range(9):
+        profiler.start_frame()
+        if profiler.over_budget('a'):
+            profiler.defer('a')
+            ran.append(False)
+        else:
+            profiler.mark('a')
+            ran.append(True)
+        profiler.end_frame()
+    assert ran == [False, False, True] * 3
+    assert profiler.deferred['a'] == 6 and profiler.missed == 9
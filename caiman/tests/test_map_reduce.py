@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import numpy as np
+import numpy.testing as npt
+import os
+from scipy.ndimage import gaussian_filter
+import tempfile
+import tifffile
+
+from caiman.cluster import extract_patch_coordinates
+from caiman.mmapping import load_memmap, save_memmap
+from caiman.source_extraction.cnmf.map_reduce import (count_patches, estimate_patch_costs, patch_memory,
+                                                      plan_patches, run_CNMF_patches)
+from caiman.source_extraction.cnmf.params import CNMFParams
+
+
+def test_plan_patches():
+    dims, T = (120, 100), 2000
+    for rf, stride in ((10, 4), (16, 6), (30, 12)):
+        assert count_patches(dims, rf, stride) == len(extract_patch_coordinates(dims, [rf] * 2, [stride] * 2)[0])
+    plan = plan_patches(dims, T, gSig=4, n_processes=4, memory_budget=2**31)
+    assert plan['rf'] > 9 and plan['stride'] <= plan['rf']
+    assert plan['n_processes'] == 4 and plan['max_concurrent'] is None and plan['memory_fact'] == 1
+    # a tight budget is met by smaller blocks of pixels and then fewer patches at a time
+    budget = 3 * patch_memory((2 * plan['rf'] + 1)**2, T, plan['K'], memory_fact=16)
+    tight = plan_patches(dims, T, gSig=4, n_processes=4, memory_budget=budget)
+    assert tight['memory_fact'] == 16
+    assert 1 <= tight['n_processes'] * tight['patch_memory'] <= budget
+    assert tight['max_concurrent'] == tight['n_processes'] < 4
+
+
+def test_run_CNMF_patches_balanced():
+    from multiprocessing import Pool
+    with tempfile.TemporaryDirectory() as tmpdir:
+        np.random.seed(0)
+        dims, T, K = (60, 50), 300, 12
+        A = np.zeros(dims + (K,))
+        A[np.random.randint(4, 30, K), np.random.randint(4, 46, K), np.arange(K)] = 1
+        A = gaussian_filter(A, (2, 2, 0)).reshape(-1, K, order='F') * 100
+        Y = 10 + np.random.randn(np.prod(dims), T) + A.dot(np.maximum(0, np.random.randn(K, T)))
+        fname = os.path.join(tmpdir, 'mov.tif')
+        tifffile.imwrite(fname, Y.T.reshape((T,) + dims, order='F').astype(np.float32))
+        fname = save_memmap([fname], base_name=os.path.join(tmpdir, 'Yr'), order='C')
+        idx_flat = extract_patch_coordinates(dims, [12, 12], [6, 6])[0]
+        costs = estimate_patch_costs(load_memmap(fname)[0], idx_flat, T)
+        # the neurons are in the upper half of the FOV
+        assert costs[0] > costs[-1]
+        opts = CNMFParams(dims=dims, gSig=[3, 3], rf=12, stride=6, p=1, k=4)
+        res = run_CNMF_patches(fname, dims + (T,), opts)
+        pool = Pool(2)
+        try:
+            res_pool = run_CNMF_patches(fname, dims + (T,), opts, dview=pool)
+        finally:
+            pool.terminate()
+        npt.assert_allclose(res[0].toarray(), res_pool[0].toarray(), atol=1e-3)
+        npt.assert_allclose(res[1], res_pool[1], rtol=1e-3, atol=1e-2)
+        timings = res_pool[-1]['patch_timings']
+        assert len(timings) == len(idx_flat) and np.all(timings > 0)
+
+
+def test_cnmf_auto_patches():
+    from caiman.source_extraction.cnmf.cnmf import CNMF
+    np.random.seed(0)
+    dims, T, K = (60, 50), 300, 12
+    A = np.zeros(dims + (K,))
+    A[np.random.randint(4, 56, K), np.random.randint(4, 46, K), np.arange(K)] = 1
+    A = gaussian_filter(A, (2, 2, 0)).reshape(-1, K, order='F') * 100
+    Y = 10 + np.random.randn(np.prod(dims), T) + A.dot(np.maximum(0, np.random.randn(K, T)))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = save_memmap([Y.T.reshape((T,) + dims, order='F').astype(np.float32)],
+                            base_name=os.path.join(tmpdir, 'Yr'), order='C')
+        Yr, _, _ = load_memmap(fname)
+        images = np.reshape(Yr.T, (T,) + dims, order='F')
+        # the number of components per patch set by the user is kept, the planner chooses it otherwise
+        for k in (3, None):
+            opts = CNMFParams(dims=dims, gSig=[3, 3], rf='auto', p=1, k=k)
+            assert opts.get('init', 'K') == k
+            cnm = CNMF(1, params=opts).fit(images)
+            assert cnm.params.get('init', 'K') == (3 if k is not None else plan_patches(
+                dims, T, [3, 3], dtype=np.float32, n_processes=1)['K'])
+            assert cnm.params.get('patch', 'rf') != 'auto'
+        del Yr, images
+    assert CNMFParams(rf=12).get('init', 'K') == 30
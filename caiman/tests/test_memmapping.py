@@ -73,3 +73,113 @@ def test_load_successful_3d():
     assert (d1, d2, d3) == (10, 11, 13)
     assert T == 12
     assert isinstance(Yr, np.memmap)
+
+
+def test_save_memmap_chunked():
+    import tempfile
+    import caiman as cm
+    np.random.seed(0)
+    mov = np.random.randint(0, 4000, size=(30, 20, 24)).astype(np.float32)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        base_name = str(pathlib.Path(tmpdir) / "Yr")
+        fname_ref = mmapping.save_memmap([mov], base_name=base_name, order="C", add_to_movie=3)
+        Yr_ref, dims_ref, T_ref = mmapping.load_memmap(fname_ref)
+        for dtype in ("float32", "uint16"):
+            fname = mmapping.save_memmap_chunked([mov[:10], mov[10:]], base_name=base_name + dtype,
+                                                 add_to_movie=3, dtype=dtype, tile_shape=(8, 8),
+                                                 frames_per_chunk=7)
+            assert fname.endswith(".cmmap")
+            Yr, dims, T = mmapping.load_memmap(fname)
+            assert isinstance(Yr, mmapping.ChunkedMemmap)
+            assert (dims, T, Yr.shape) == (dims_ref, T_ref, Yr_ref.shape)
+            np.testing.assert_array_equal(np.array(Yr), Yr_ref)
+            idx = np.ravel_multi_index(np.mgrid[3:9, 5:17].reshape(2, -1), dims, order="F")
+            np.testing.assert_array_equal(Yr[np.sort(idx), 4:20], Yr_ref[np.sort(idx), 4:20])
+            np.testing.assert_array_equal(Yr[7, [1, 5, 6]], Yr_ref[7, [1, 5, 6]])
+            np.testing.assert_array_equal(cm.load(fname, subindices=range(2, 12)),
+                                          cm.load(fname_ref, subindices=range(2, 12)))
+            Yr.close()
+        del Yr_ref
+
+
+def test_cnmf_fit_file_chunked():
+    import tempfile
+    from caiman.source_extraction.cnmf import cnmf, params
+    np.random.seed(0)
+    T, dims = 300, (40, 50)
+    yy, xx = np.mgrid[:dims[0], :dims[1]]
+    mov = np.random.randn(T, *dims).astype(np.float32) * .3 + 2
+    for _ in range(12):
+        y, x = np.random.rand(2) * dims
+        c = np.convolve((np.random.rand(T) < .02) * 3., .9 ** np.arange(40))[:T]
+        mov += (np.exp(-((yy - y)**2 + (xx - x)**2) / 6.)[None] * c[:, None, None]).astype(np.float32)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        base_name = str(pathlib.Path(tmpdir) / "Yr")
+        estimates = []
+        for fname in (mmapping.save_memmap([mov], base_name=base_name, order="C"),
+                      mmapping.save_memmap_chunked([mov], base_name=base_name)):
+            Yr, dims_file, T_file = mmapping.load_memmap(fname)
+            images = np.reshape(Yr.T, [T_file] + list(dims_file), order="F")
+            assert images.shape == (T,) + dims
+            np.testing.assert_array_equal(images[5:9, 3:20, 7:31], mov[5:9, 3:20, 7:31] + np.float32(0.0001))
+            opts = params.CNMFParams(params_dict={"fnames": [fname], "K": 4, "gSig": [2, 2], "rf": 20,
+                                                  "stride": 5, "p": 1, "nb": 1, "fr": 10})
+            estimates.append(cnmf.CNMF(1, params=opts).fit_file().estimates)
+            del Yr, images
+        np.testing.assert_allclose(estimates[1].A.toarray(), estimates[0].A.toarray(), atol=1e-5)
+        np.testing.assert_allclose(estimates[1].C, estimates[0].C, rtol=1e-4, atol=1e-3)
+
+
+def test_save_memmap_direct():
+    import os
+    import tempfile
+    import tifffile
+    import caiman as cm
+    np.random.seed(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fnames = []
+        for i, T in enumerate((12, 7, 15)):
+            fnames.append(os.path.join(tmpdir, "mov{}.tif".format(i)))
+            tifffile.imwrite(fnames[-1], np.random.rand(T, 20, 24).astype(np.float32))
+        opts = dict(order="C", remove_init=2, resize_fact=(0.5, 1, 0.5), add_to_movie=1)
+        fname_ref = cm.save_memmap(fnames, base_name=os.path.join(tmpdir, "ref"), **opts)
+        fname = cm.save_memmap(fnames, base_name=os.path.join(tmpdir, "direct"), direct_write=True, **opts)
+        Yr_ref, dims_ref, T_ref = mmapping.load_memmap(fname_ref)
+        Yr, dims, T = mmapping.load_memmap(fname)
+        assert (dims, T) == (dims_ref, T_ref)
+        np.testing.assert_array_equal(Yr, Yr_ref)
+        # simulate a conversion interrupted after the first file
+        big_mov = np.memmap(fname, mode="r+", dtype=np.float32, shape=Yr.shape, order="C")
+        big_mov[:, 5:] = 0
+        del big_mov
+        with open(fname + ".progress", "w") as fp:
+            fp.write("0\n")
+        fname_resume = cm.save_memmap(fnames, base_name=os.path.join(tmpdir, "direct"), direct_write=True,
+                                      resume=True, **opts)
+        assert fname_resume == fname
+        assert not os.path.exists(fname + ".progress")
+        np.testing.assert_array_equal(Yr, Yr_ref)
+        del Yr, Yr_ref
+
+
+def test_parallel_dot_product():
+    import os
+    import tempfile
+    import scipy.sparse
+    from caiman.paths import memmap_frames_filename
+    np.random.seed(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, memmap_frames_filename("Yr", (30, 10), 50, "C"))
+        Y = np.memmap(fname, mode="w+", dtype=np.float32, shape=(300, 50), order="C")
+        Y[:] = np.random.rand(300, 50)
+        del Y
+        Yr, _, _ = mmapping.load_memmap(fname)
+        for transpose in (False, True):
+            b = np.random.rand(300 if transpose else 50, 4)
+            for b_ in (b, scipy.sparse.csc_matrix(b * (b > 0.7))):
+                ref = (Yr.T if transpose else Yr).dot(b_.toarray() if scipy.sparse.issparse(b_) else b_)
+                for n_threads in (1, 3):
+                    np.testing.assert_allclose(
+                        mmapping.parallel_dot_product(Yr, b_, block_size=70, transpose=transpose,
+                                                      n_threads=n_threads), ref, rtol=1e-5)
+        del Yr
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+import numpy.testing as npt
+import numpy as np
+import scipy.sparse
+import scipy.stats
+from caiman.source_extraction import cnmf
+
+
+def test_overlap_correlations():
+    np.random.seed(0)
+    K, T = 30, 200
+    A = scipy.sparse.random(100, K, density=.1, format='csc', random_state=0)
+    C = np.random.rand(K, T)
+    C[3] = 1    # constant trace
+    A_corr = scipy.sparse.triu(A.T * A, 1)
+    fingerprints = cnmf.merging.component_fingerprints(A, C)
+    C_corr = cnmf.merging.overlap_correlations(A_corr, C, fingerprints=fingerprints, block_bytes=T * 16 * 3)
+    rows, cols = A_corr.nonzero()
+    npt.assert_array_equal(np.sort(np.ravel_multi_index(C_corr.nonzero(), (K, K))),
+                           np.sort(np.ravel_multi_index((rows, cols), (K, K))))
+    for i, j in zip(rows, cols):
+        if 3 in (i, j):
+            assert np.isnan(C_corr[i, j])
+        else:
+            npt.assert_allclose(C_corr[i, j], scipy.stats.pearsonr(C[i], C[j])[0])
+
+    # components 0 and 1 are merged into a new last component, the other correlations are reused
+    cache = {}
+    kept = np.arange(2, K)
+    cnmf.merging.update_merge_cache(cache, C_corr, fingerprints, kept, 1)
+    A2 = scipy.sparse.hstack([A[:, kept], A[:, :2].sum(1)]).tocsc()
+    C2 = np.vstack([C[kept], C[:2].mean(0)])
+    C2[0] += 1  # component 2 changed after merging
+    A2_corr = scipy.sparse.triu(A2.T * A2, 1)
+    fingerprints2 = cnmf.merging.component_fingerprints(A2, C2)
+    cached = cnmf.merging.overlap_correlations(A2_corr, C2, fingerprints=fingerprints2, cache=cache)
+    npt.assert_allclose(cached.toarray(), cnmf.merging.overlap_correlations(A2_corr, C2).toarray())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import numpy as np
+import numpy.testing as npt
+import os
+import tempfile
+import tifffile
+
+import caiman as cm
+from caiman.motion_correction import (MotionCorrect, RegistrationTemplate, register_translation,
+                                       register_translation_batch, sliding_window, tile_and_correct)
+from caiman.shared_multiprocessing import SharedMemoryPool
+
+
+def gen_movie(T=120, dims=(48, 56)):
+    np.random.seed(0)
+    m = (np.random.rand(T, *dims) * 10 + 5).astype(np.float32)
+    m[:, 15:25, 20:30] += 50
+    return m
+
+
+def test_motion_correct_save_C_order():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fnames = [os.path.join(tmpdir, 'mov{}.tif'.format(i)) for i in range(2)]
+        m = gen_movie()
+        tifffile.imwrite(fnames[0], m)
+        tifffile.imwrite(fnames[1], m[:80])
+        for pw_rigid, border_to_0, add_to_movie in ((False, 0, 0), (True, 0, 0), (False, 3, 2)):
+            opts = dict(max_shifts=(4, 4), strides=(16, 16), overlaps=(8, 8),
+                        splits_rig=3, splits_els=3, pw_rigid=pw_rigid)
+            # two passes: F order files and then conversion to C order
+            mc = MotionCorrect(fnames, **opts)
+            mc.motion_correct(save_movie=True)
+            fname_ref = cm.save_memmap(mc.mmap_file, base_name=os.path.join(tmpdir, 'ref'), order='C',
+                                       border_to_0=border_to_0, add_to_movie=add_to_movie)
+            Yr_ref, dims_ref, T_ref = cm.load_memmap(fname_ref)
+            # single pass directly in C order
+            mc = MotionCorrect(fnames, min_mov=mc.min_mov, **opts)
+            mc.motion_correct(save_movie=True, order='C', base_name='single', border_to_0=border_to_0,
+                              add_to_movie=add_to_movie)
+            assert len(mc.mmap_file) == 1
+            Yr, dims, T = cm.load_memmap(mc.mmap_file[0])
+            assert not np.isfortran(Yr)
+            assert dims == dims_ref
+            assert T == T_ref == 200
+            npt.assert_allclose(Yr, Yr_ref, atol=1e-4)
+            del Yr, Yr_ref
+
+
+def test_register_translation_batch():
+    np.random.seed(1)
+    template = gen_movie(T=1, dims=(64, 64))[0]
+    img = np.roll(template, (2, -1), axis=(0, 1)) + np.random.randn(64, 64)
+    imgs = np.stack([it[-1] for it in sliding_window(img, (8, 8), (16, 16))])
+    templates = np.stack([it[-1] for it in sliding_window(template, (8, 8), (16, 16))])
+    for lb, ub in ((None, None), (np.array([-1, -3]), np.array([4, 1]))):
+        shifts, _, phase = register_translation_batch(imgs, templates, 10, shifts_lb=lb,
+                                                      shifts_ub=ub, max_shifts=(5, 5))
+        res = [register_translation(a, b, 10, shifts_lb=lb, shifts_ub=ub, max_shifts=(5, 5))
+               for a, b in zip(imgs, templates)]
+        npt.assert_allclose(shifts, [r[0] for r in res])
+        npt.assert_allclose(phase, [r[2] for r in res], atol=1e-6)
+
+
+def test_tile_and_correct_cached_template():
+    np.random.seed(2)
+    template = gen_movie(T=1, dims=(64, 64))[0].astype(np.float64)
+    img = np.roll(template, (2, -1), axis=(0, 1)) + np.random.randn(64, 64)
+    tmpl = RegistrationTemplate(template)
+    for max_deviation_rigid in (0, 2):
+        res = tile_and_correct(img, template, (16, 16), (8, 8), (5, 5), upsample_factor_fft=10,
+                               max_deviation_rigid=max_deviation_rigid)
+        res_cached = tile_and_correct(img, tmpl, (16, 16), (8, 8), (5, 5), upsample_factor_fft=10,
+                                      max_deviation_rigid=max_deviation_rigid)
+        npt.assert_array_equal(res[0], res_cached[0])
+        npt.assert_array_equal(res[1], res_cached[1])
+
+    # the template prepared and shipped once to the workers gives the same result
+    dview = SharedMemoryPool(1)
+    try:
+        for shifts_opencv in (False, True):
+            tmpl = RegistrationTemplate(template).prepare((16, 16), (8, 8), 2, shifts_opencv=shifts_opencv)
+            shared = tmpl.share(dview)
+            res = tile_and_correct(img, tmpl, (16, 16), (8, 8), (5, 5), max_deviation_rigid=2,
+                                   shifts_opencv=shifts_opencv)
+            res_shared = tile_and_correct(img, shared.attach(), (16, 16), (8, 8), (5, 5),
+                                          max_deviation_rigid=2, shifts_opencv=shifts_opencv)
+            npt.assert_array_equal(res[0], res_shared[0])
+            shared.release(dview)
+        assert len(dview._blocks) == 0
+    finally:
+        dview.terminate()
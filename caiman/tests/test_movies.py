@@ -17,3 +17,31 @@ def test_load_iter():
             except StopIteration:
                 break
         npt.assert_allclose(S, load(fname, subindices=subindices).sum(), rtol=1e-6)
+
+
+def test_load_iter_batches():
+    import h5py
+    import tempfile
+    import tifffile
+    from caiman.base.movies import load_iter_batches
+    from caiman.mmapping import save_memmap
+    np.random.seed(0)
+    mov = np.random.randint(0, 1000, size=(23, 10, 12)).astype(np.uint16)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fnames = [os.path.join(tmpdir, 'mov.tif'), os.path.join(tmpdir, 'mov.h5'), os.path.join(tmpdir, 'mov.npy')]
+        tifffile.imwrite(fnames[0], mov)
+        with h5py.File(fnames[1], 'w') as f:
+            f['mov'] = mov
+        np.save(fnames[2], mov)
+        fnames.append(save_memmap([fnames[0]], base_name=os.path.join(tmpdir, 'Yr'), order='C'))
+        for fname in fnames:
+            for subindices in (None, slice(3, None, 2), np.array([2, 3, 7, 20])):
+                ref = load(fname, subindices=subindices)
+                for read_ahead in (0, 2):
+                    batches = list(load_iter_batches(fname, subindices=subindices, batch_size=4,
+                                                     read_ahead=read_ahead))
+                    assert all(b.dtype == np.float32 and b.flags.c_contiguous and len(b) <= 4 for b in batches)
+                    npt.assert_array_equal(np.concatenate(batches), ref)
+                frames = list(load_iter(fname, subindices=subindices))
+                assert frames[0].dtype == (np.float32 if fname.endswith('.mmap') else mov.dtype)    # as stored
+                npt.assert_array_equal(np.array(frames), ref)
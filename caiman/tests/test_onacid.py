@@ -53,3 +53,97 @@ def demo():
 def test_onacid():
     demo()
     pass
+
+
+def test_onacid_deadline_mode():
+    import numpy as np
+    fname = [os.path.join(caiman_datadir(), 'example_movies', 'demoMovie.tif')]
+    params_dict = {'fnames': fname, 'fr': 10, 'decay_time': .75, 'gSig': [6, 6], 'p': 1,
+                   'motion_correct': False, 'nb': 2, 'init_batch': 400, 'init_method': 'bare',
+                   'K': 4, 'sniper_mode': False, 'use_peak_max': False, 'expected_comps': 30,
+                   'deadline_mode': True, 'frame_budget': 1e-6}
+    np.random.seed(0)
+    cnm = cnmf.online_cnmf.OnACID(params=cnmf.params.CNMFParams(params_dict=params_dict))
+    cnm.fit_online()
+    n_frames = 2000 - 400
+    # every frame is late: the search for new components and the shape updates are
+    # postponed for max_deferred frames in a row and then run anyway
+    max_deferred = cnm.profiler.max_deferred
+    assert cnm.profiler.n_frames == cnm.profiler.missed == n_frames
+    assert cnm.profiler.deferred['detect'] == n_frames - n_frames // (max_deferred + 1)
+    assert cnm.profiler.deferred['shapes'] > 0
+    summary = cnm.profiler.summary()
+    assert set(summary) == set(cnm.profiler.stages)
+    assert summary['frame']['p50'] <= summary['frame']['p99'] <= summary['frame']['max']
+    assert summary['detect']['max'] < summary['frame']['max']
+
+
+def _synthetic_movie(T=2000, dims=(60, 80), K=20):
+    """movie of K gaussian neurons with exponentially decaying transients, frames x dims"""
+    import numpy as np
+    np.random.seed(0)
+    yy, xx = np.mgrid[:dims[0], :dims[1]]
+    Y = 2 + .5 * np.random.randn(T, *dims)
+    for _ in range(K):
+        y, x = np.random.rand(2) * dims
+        c = np.convolve((np.random.rand(T) < .01) * 5., .9 ** np.arange(30))[:T]
+        Y += np.exp(-((yy - y)**2 + (xx - x)**2) / 18.)[None] * c[:, None, None]
+    return Y.astype(np.float32)
+
+
+def test_onacid_trace_window():
+    import numpy as np
+    import tempfile
+    import tifffile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'movie.tif')
+        tifffile.imwrite(fname, _synthetic_movie())
+        for p in (1, 2):
+            estimates = []
+            for trace_window in (None, 300):
+                params_dict = {'fnames': [fname], 'fr': 10, 'decay_time': .75, 'gSig': [3, 3], 'p': p,
+                               'motion_correct': False, 'nb': 2, 'init_batch': 400, 'init_method': 'bare',
+                               'K': 4, 'sniper_mode': False, 'use_peak_max': False, 'expected_comps': 40,
+                               'trace_window': trace_window, 'trace_store': os.path.join(tmpdir, 'traces')}
+                np.random.seed(0)
+                cnm = cnmf.online_cnmf.OnACID(params=cnmf.params.CNMFParams(params_dict=params_dict))
+                cnm.fit_online()
+                estimates.append(cnm.estimates)
+            # only the last frames are kept in memory, the rest is read back from the store
+            assert estimates[1].C_on.shape[-1] < 1000 < estimates[0].C_on.shape[-1]
+            for key in ('C', 'f', 'YrA', 'S'):
+                npt.assert_array_equal(getattr(estimates[0], key), getattr(estimates[1], key))
+            npt.assert_array_equal(cnm.get_traces(1000, 1500)[0], estimates[0].C_on[:, 1000:1500])
+            # the OASIS pools of the stored frames are dropped
+            assert max(o.t0 for o in estimates[1].OASISinstances) > 1000
+            assert (sum(len(o.P) for o in estimates[1].OASISinstances) <
+                    sum(len(o.P) for o in estimates[0].OASISinstances))
+
+
+def test_onacid_streams():
+    import numpy as np
+    import tempfile
+    import tifffile
+    from caiman.source_extraction.cnmf.online_streams import fit_online_streams
+    movie = _synthetic_movie()
+    planes = [movie[:1000], movie[1000:]]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname_planes = [os.path.join(tmpdir, 'plane{}.tif'.format(i)) for i in range(2)]
+        for fname, plane in zip(fname_planes, planes):
+            tifffile.imwrite(fname, plane)
+        fname_interleaved = os.path.join(tmpdir, 'interleaved.tif')
+        tifffile.imwrite(fname_interleaved, np.stack(planes, 1).reshape((-1,) + movie.shape[1:]))
+        params_dict = {'fnames': [fname_interleaved], 'fr': 10, 'decay_time': .75, 'gSig': [3, 3], 'p': 1,
+                       'motion_correct': False, 'nb': 2, 'init_batch': 400, 'init_method': 'bare',
+                       'K': 4, 'sniper_mode': False, 'use_peak_max': False, 'expected_comps': 30}
+        params = cnmf.params.CNMFParams(params_dict=params_dict)
+        np.random.seed(0)
+        interleaved, timing = fit_online_streams(params, n_planes=2, max_queue=10)
+        np.random.seed(0)
+        separate, _ = fit_online_streams(params, fnames=[[fname] for fname in fname_planes])
+    # demultiplexing the interleaved movie gives the same planes as reading them separately
+    for est1, est2 in zip(interleaved, separate):
+        assert est1.C.shape[1] == 1000
+        npt.assert_array_equal(est1.C, est2.C)
+    assert [s['n_frames'] for s in timing['streams']] == [600, 600]
+    assert max(timing['max_queue_depth']) <= 10
@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+import pickle
+from caiman.source_extraction.cnmf.params import CNMFParams
+
+
+def test_params_snapshot():
+    params = CNMFParams(params_dict={'fr': 30, 'p': 1})
+    online = params.snapshot('online')
+    assert online is params.snapshot('online')
+    assert online.init_batch == params.get('online', 'init_batch')
+    assert online._asdict() == params.get_group('online')
+    params.set('online', {'init_batch': 123})
+    assert params.snapshot('online').init_batch == 123 and online.init_batch == 200
+    params.change_params({'init_batch': 7, 'nb': 3})
+    assert params.snapshot('online').init_batch == 7 and params.snapshot('init').nb == 3
+    # the cache is neither a parameter group nor pickled
+    assert '_snapshots' not in params.__dict__
+    loaded = pickle.loads(pickle.dumps(params))
+    assert loaded == params and loaded.snapshot('online').init_batch == 7
@@ -12,3 +12,30 @@ def test_axcov():
     print(C)
 
     npt.assert_allclose(C, np.concatenate((np.zeros(maxlag), np.array([1]), np.zeros(maxlag))), atol=1)
+
+
+def test_preprocess_data_cache(tmpdir):
+    np.random.seed(0)
+    d, T = 300, 4000
+    fname = str(tmpdir.join('Yr_d1_300_d2_1_d3_1_order_C_frames_4000_.mmap'))
+    Y = np.memmap(fname, mode='w+', dtype=np.float32, shape=(d, T), order='C')
+    Y[:] = np.random.randn(d, T) * np.linspace(.5, 2, d)[:, None]
+    Y.flush()
+    Y = np.memmap(fname, mode='r', dtype=np.float32, shape=(d, T), order='C')
+    sn, psx = cnmf.pre_processing.get_noise_fft(np.array(Y), noise_method='mean')
+    # pixel blocks, also of a view that is not the whole file
+    sn_blocks, psx_blocks = cnmf.pre_processing.get_noise_fft_parallel(Y, n_pixels_per_process=64, noise_method='mean')
+    npt.assert_array_equal(sn_blocks, sn)
+    npt.assert_array_equal(psx_blocks, psx)
+    npt.assert_array_equal(cnmf.pre_processing.get_noise_fft_parallel(Y[10:], noise_method='mean')[0], sn[10:])
+
+    _, sn_pre, _, _ = cnmf.pre_processing.preprocess_data(Y, noise_method='mean', max_num_samples_fft=3072)
+    npt.assert_array_equal(sn_pre, sn)
+    assert tmpdir.join('Yr_d1_300_d2_1_d3_1_order_C_frames_4000_.mmap.noise.npz').check()
+    cnmf.pre_processing.save_noise_cache(Y, sn + 1, checked_nan=True, noise_range=[0.25, 0.5],
+                                         noise_method='mean', max_num_samples_fft=3072)
+    npt.assert_array_equal(cnmf.pre_processing.preprocess_data(Y, noise_method='mean', max_num_samples_fft=3072)[1],
+                           sn + 1)
+    # other parameters are not cached
+    npt.assert_array_equal(cnmf.pre_processing.preprocess_data(Y, noise_method='median', max_num_samples_fft=3072)[1],
+                           cnmf.pre_processing.get_noise_fft(np.array(Y), noise_method='median')[0])
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import numpy as np
+import numpy.testing as npt
+import os
+import pickle
+import scipy.sparse
+import tempfile
+
+import caiman as cm
+from caiman.cluster import setup_cluster
+from caiman.mmapping import parallel_dot_product
+from caiman.shared_multiprocessing import SharedMemoryPool, get_shared, is_local_pool, n_blocks, n_workers
+
+
+def _sum_shared(x):
+    return get_shared(x).sum()
+
+
+def test_shared_memory_pool():
+    _, dview, _ = setup_cluster(backend='shared_memory', n_processes=2, ignore_preexisting=True)
+    try:
+        assert isinstance(dview, SharedMemoryPool)
+        assert is_local_pool(dview) and not is_local_pool(None)
+        assert n_workers(dview) == 2 and n_workers(None) == 1 and n_blocks(None) == 1
+        np.random.seed(0)
+        x = np.asfortranarray(np.random.rand(30, 20))
+        S = scipy.sparse.random(30, 20, density=0.2, format='csc')
+        hx, hS = dview.share(x), dview.share(S)
+        assert len(pickle.dumps(hx)) < x.nbytes
+        npt.assert_array_equal(get_shared(hx), x)
+        npt.assert_array_equal(get_shared(hS).toarray(), S.toarray())
+        npt.assert_allclose(dview.map(_sum_shared, [hx, hS]), [x.sum(), S.sum()])
+        dview.release(hx)
+        dview.release(hS)
+
+        # more blocks than are kept attached: the ones still in use stay valid
+        handles = [dview.share(np.full(10, i, dtype=float)) for i in range(40)]
+        arrays = [get_shared(h) for h in handles]
+        npt.assert_array_equal([a[0] for a in arrays], np.arange(40))
+        del arrays
+        for h in handles:
+            dview.release(h)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'Yr_d1_30_d2_2_d3_1_order_C_frames_40_.mmap')
+            Y = np.memmap(fname, mode='w+', dtype=np.float32, shape=(60, 40), order='C')
+            Y[:] = np.random.rand(60, 40)
+            Y.flush()
+            Yr, _, _ = cm.load_memmap(fname)
+            b = np.random.rand(40, 3)
+            npt.assert_allclose(parallel_dot_product(Yr, b, block_size=16, dview=dview),
+                                Yr.dot(b), rtol=1e-5)
+            b = np.random.rand(60, 3)
+            npt.assert_allclose(parallel_dot_product(Yr, b, block_size=16, dview=dview, transpose=True),
+                                Yr.T.dot(b), rtol=1e-5)
+            del Y, Yr
+        assert len(dview._blocks) == 0
+    finally:
+        dview.terminate()
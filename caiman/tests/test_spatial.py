@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import numpy.testing as npt
+import numpy as np
+import scipy.sparse
+from sklearn.linear_model import LassoLars
+from caiman.source_extraction import cnmf
+
+
+def test_lasso_lars_group():
+    np.random.seed(0)
+    c = np.random.rand(4, 200)
+    Y = np.random.rand(3, 4).dot(c) + .1 * np.random.randn(3, 200)
+    alphas = np.array([0, 1e-3, 1e-2])
+    a = cnmf.spatial.lasso_lars_group(c, Y.astype(np.float32), alphas)
+    for y, alpha, a_ in zip(Y.astype(np.float32), alphas, a):
+        clf = LassoLars(alpha=alpha, positive=True, fit_intercept=True).fit(c.T, y)
+        npt.assert_allclose(a_, clf.coef_, atol=1e-10)
+
+
+def test_search_locations_to_csr():
+    ind2_ = [np.array([0, 2]), [], np.array([1])]
+    ind = cnmf.spatial.search_locations_to_csr(ind2_, 3)
+    npt.assert_array_equal(ind.toarray(), [[1, 0, 1], [0, 0, 0], [0, 1, 0]])
+    npt.assert_array_equal(cnmf.spatial.pixel_blocks(1000, 100, 128), [0, 1000])
+
+
+def test_determine_search_location():
+    np.random.seed(0)
+    dims = (30, 20)
+    A = np.zeros((np.prod(dims), 3))
+    for k, (x, y) in enumerate([(5, 5), (15, 10), (28, 18)]):
+        m = np.zeros(dims)
+        m[max(0, x - 2):x + 3, max(0, y - 2):y + 3] = np.random.rand(*m[max(0, x - 2):x + 3, max(0, y - 2):y + 3].shape)
+        A[:, k] = m.ravel(order='F')
+    # dense ellipse around the center of mass of each component
+    coor = np.stack(np.unravel_index(np.arange(np.prod(dims)), dims, order='F'), 1)
+    expected = np.zeros(A.shape, dtype=bool)
+    for a, e in zip(A.T, expected.T):
+        cm = a.dot(coor) / a.sum()
+        D, V = np.linalg.eigh((coor - cm).T.dot(a[:, None] * (coor - cm)) / a.sum())
+        dkk = np.clip(D, 3 ** 2, 8 ** 2)
+        e[:] = np.sqrt(((coor - cm).dot(V) ** 2 / dkk).sum(1)) <= 3
+    cache = {}
+    ind = cnmf.spatial.determine_search_location(scipy.sparse.csc_matrix(A), dims, method='ellipse', cache=cache)
+    npt.assert_array_equal(ind.toarray(), expected)
+    assert len(cache) == 3
+    ind = cnmf.spatial.determine_search_location(scipy.sparse.csc_matrix(A[:, :2]), dims, method='dilate', cache=cache)
+    assert ind.shape == (np.prod(dims), 2) and len(cache) == 2
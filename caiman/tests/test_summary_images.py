@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+import numpy.testing as npt
+import numpy as np
+import caiman as cm
+from caiman import summary_images
+
+
+def synthetic_1p(T=1200, dims=(50, 60), K=15):
+    np.random.seed(0)
+    Y = np.random.randn(T, *dims).astype(np.float32)
+    yy, xx = np.mgrid[:dims[0], :dims[1]]
+    for _ in range(K):
+        y, x = np.random.rand(2) * dims
+        c = np.convolve((np.random.rand(T) < .01) * 5., .9 ** np.arange(30))[:T]
+        Y += (np.exp(-((yy - y)**2 + (xx - x)**2) / 8.)[None] * c[:, None, None]).astype(np.float32)
+    return Y + 10
+
+
+def test_correlation_pnr_tiled():
+    Y = synthetic_1p()
+    for gSig, background_filter in ((3, 'disk'), (3, 'box'), (None, 'disk')):
+        cn, pnr = summary_images.correlation_pnr(Y, gSig=gSig, swap_dim=False, background_filter=background_filter)
+        cn_tiled, pnr_tiled = summary_images.correlation_pnr_tiled(
+            Y, gSig=gSig, swap_dim=False, background_filter=background_filter, tile_shape=(20, 25), chunk_size=500)
+        npt.assert_allclose(cn_tiled, cn, atol=1e-3)
+        npt.assert_allclose(pnr_tiled, pnr, rtol=1e-3, atol=1e-3)
+
+
+def test_local_correlations_movie_tiled(tmp_path):
+    Y = synthetic_1p(T=530, dims=(30, 41))
+    Y += np.linspace(0, 20, len(Y), dtype=np.float32)[:, None, None]     # drifting baseline
+    for window, stride, eight_neighbours in ((100, 7, True), (50, 80, False)):
+        cn = [summary_images.local_correlations_fft(Y[j:j + window], eight_neighbours=eight_neighbours,
+                                                    swap_dim=False)
+              for j in range(0, len(Y) - window + 1, stride)]
+        cn_iter = list(summary_images.iter_local_correlations_movie(
+            Y, window, stride, eight_neighbours=eight_neighbours, tile_shape=(11, 13), chunk_size=64))
+        npt.assert_allclose(cn_iter, cn, atol=1e-5)
+        fname = summary_images.local_correlations_movie_tiled(
+            Y, str(tmp_path / 'corr'), window, stride, eight_neighbours=eight_neighbours, tile_shape=(11, 13),
+            chunk_size=64)
+        npt.assert_allclose(cm.load(fname), cn, atol=1e-5)
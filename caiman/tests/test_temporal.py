@@ -2,7 +2,10 @@
 
 import numpy.testing as npt
 import numpy as np
+import scipy.sparse
+from caiman.cluster import setup_cluster
 from caiman.source_extraction import cnmf
+from caiman.source_extraction.cnmf.params import CNMFParams
 
 
 def test_make_G_matrix():
@@ -21,3 +24,55 @@ def test_make_G_matrix():
     # yapf: enable
 
     npt.assert_allclose(G, true_G)
+
+
+def _synthetic_traces(K, T, g=.9):
+    s = np.random.rand(K, T) * (np.random.rand(K, T) < .05)
+    c = np.zeros((K, T))
+    for t in range(T):
+        c[:, t] = s[:, t] + (g * c[:, t - 1] if t > 0 else 0)
+    return c
+
+
+def test_constrained_foopsi_block():
+    np.random.seed(0)
+    T = 300
+    Ytemp = (_synthetic_traces(5, T) + .1 * np.random.randn(5, T)).T
+    kwargs = {'p': 1, 'method_deconvolution': 'oasis'}
+    block = cnmf.temporal.constrained_foopsi_block((Ytemp, 1, 4, kwargs))
+    assert len(block) == 3
+    for jj, res in enumerate(block):
+        ref = cnmf.temporal.constrained_foopsi_parallel(
+            (Ytemp[:, 1 + jj], None, jj, None, None, None, None, kwargs))
+        assert res[2] is None and res[7] == jj
+        for k in (0, 1, 3, 4, 5, 6, 8):
+            npt.assert_array_equal(res[k], ref[k])
+
+
+def test_update_temporal_components_parallel():
+    np.random.seed(0)
+    dims, K, T = (30, 40), 12, 400
+    A = np.zeros((np.prod(dims), K))
+    for k in range(K):
+        m = np.zeros(dims)
+        x, y = 1 + 5 * (k % 6), 5 + 10 * (k // 6)    # non overlapping, a single vertex cover
+        m[x:x + 4, y:y + 4] = np.random.rand(4, 4)
+        A[:, k] = m.ravel(order='F')
+    C = _synthetic_traces(K, T)
+    b, f = np.random.rand(np.prod(dims), 1), 1 + .1 * np.random.rand(1, T)
+    Y = (A.dot(C) + b.dot(f) + .05 * np.random.randn(np.prod(dims), T)).astype(np.float32)
+    A = scipy.sparse.csc_matrix(A)
+    kwargs = CNMFParams(params_dict={'p': 1}).get_group('temporal')
+    Cin = C + .1 * np.random.rand(K, T)
+    serial = cnmf.temporal.update_temporal_components(Y, A, b, Cin, f, dview=None, **kwargs)
+    _, dview, _ = setup_cluster(backend='shared_memory', n_processes=2, ignore_preexisting=True)
+    try:
+        parallel = cnmf.temporal.update_temporal_components(Y, A, b, Cin, f, dview=dview, **kwargs)
+    finally:
+        dview.terminate()
+    # C, f, S, bl, c1, sn, YrA
+    for k in (0, 3, 4, 5, 6, 7, 9):
+        npt.assert_array_equal(parallel[k], serial[k])
+    for k in (8, 10):    # g, lam
+        for par, ser in zip(parallel[k], serial[k]):
+            npt.assert_array_equal(par, ser)
@@ -50,3 +50,29 @@ def test_tf():
         pass
     except:
         raise Exception('NN model could not be deployed. use_keras = ' + str(use_keras))
+
+
+def test_numpy_cnn(tmpdir):
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import Activation, Conv2D, Dense, Dropout, Flatten, MaxPooling2D
+    from caiman.components_evaluation import load_CNN_model
+    from caiman.utils.numpy_cnn import NumpySequential
+
+    # architecture of cnn_model
+    model = Sequential([Conv2D(8, (3, 3), input_shape=(50, 50, 1)), Activation('relu'), Conv2D(8, (3, 3)),
+                        Activation('relu'), MaxPooling2D(pool_size=(2, 2)), Dropout(0.25),
+                        Conv2D(16, (3, 3), padding='same', activation='relu'), Conv2D(16, (3, 3)),
+                        Activation('relu'), MaxPooling2D(pool_size=(2, 2)), Dropout(0.25), Flatten(),
+                        Dense(32), Activation('relu'), Dropout(0.5), Dense(2), Activation('softmax')])
+    model_name = os.path.join(str(tmpdir), 'cnn_model')
+    with open(model_name + '.json', 'w') as f:
+        f.write(model.to_json())
+    model.save_weights(model_name + '.h5')
+
+    A = np.random.randn(40, 50, 50, 1).astype(np.float32)
+    np.testing.assert_allclose(NumpySequential(model_name + '.json', model_name + '.h5').predict(A),
+                               model.predict(A, verbose=0), rtol=1e-4, atol=1e-6)
+    assert isinstance(load_CNN_model(model_name, runtime='numpy'), NumpySequential)
+    assert load_CNN_model(model_name) is load_CNN_model(model_name)
+    np.testing.assert_allclose(load_CNN_model(model_name).predict(A, batch_size=16), model.predict(A, verbose=0),
+                               rtol=1e-5, atol=1e-7)
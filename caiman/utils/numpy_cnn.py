@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Inference of small Keras Sequential models with NumPy only
+
+The architecture is read from the Keras .json file and the weights from the
+.h5 file, as saved by model.to_json() and model.save_weights(). Only the layers
+used by the CaImAn classifiers are supported (Conv2D, MaxPooling2D,
+AveragePooling2D, Dense, Flatten, Dropout, Activation, BatchNormalization),
+with channels last. Unsupported models raise NotImplementedError.
+"""
+
+import h5py
+import json
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from typing import Dict, List
+
+
+def _activation(x: np.ndarray, name: str) -> np.ndarray:
+    if name == 'linear':
+        return x
+    if name == 'relu':
+        return np.maximum(x, 0)
+    if name == 'sigmoid':
+        return 1 / (1 + np.exp(-x))
+    if name == 'tanh':
+        return np.tanh(x)
+    if name == 'softmax':
+        e = np.exp(x - x.max(-1, keepdims=True))
+        return e / e.sum(-1, keepdims=True)
+    raise NotImplementedError('Activation {} is not supported'.format(name))
+
+
+def _pad(x: np.ndarray, pool_size, strides, padding: str, value=0) -> np.ndarray:
+    """pad the spatial dimensions of x (N x H x W x C) as Keras does"""
+    if padding == 'valid':
+        return x
+    pads = [(0, 0)]
+    for n, k, s in zip(x.shape[1:3], pool_size, strides):
+        total = max((-(-n // s) - 1) * s + k - n, 0)
+        pads.append((total // 2, total - total // 2))
+    return np.pad(x, pads + [(0, 0)], constant_values=value)
+
+
+def _windows(x: np.ndarray, pool_size, strides) -> np.ndarray:
+    """N x H' x W' x C x kh x kw windows of x"""
+    return sliding_window_view(x, pool_size, axis=(1, 2))[:, ::strides[0], ::strides[1]]
+
+
+class NumpySequential(object):
+    """ Keras Sequential model evaluated with NumPy
+
+    Drop in replacement of the Keras model for predict()
+    """
+
+    def __init__(self, json_file: str, weights_file: str):
+        with open(json_file, 'r') as f:
+            config = json.load(f)
+        if config.get('class_name') != 'Sequential':
+            raise NotImplementedError('Only Sequential models are supported')
+        layers = config['config']
+        if isinstance(layers, dict):
+            layers = layers['layers']
+        self.layers: List[Dict] = []
+        with h5py.File(weights_file, 'r') as f:
+            if 'model_weights' in f:
+                f = f['model_weights']
+            for layer in layers:
+                cls, cfg = layer['class_name'], layer['config']
+                if cls not in ('Conv2D', 'MaxPooling2D', 'AveragePooling2D', 'Dense', 'Flatten',
+                               'Dropout', 'Activation', 'BatchNormalization', 'InputLayer'):
+                    raise NotImplementedError('Layer {} is not supported'.format(cls))
+                if cfg.get('data_format', 'channels_last') != 'channels_last':
+                    raise NotImplementedError('Only channels_last is supported')
+                if cls == 'Conv2D' and tuple(cfg.get('dilation_rate', (1, 1))) != (1, 1):
+                    raise NotImplementedError('Dilated convolutions are not supported')
+                if cls == 'BatchNormalization' and cfg['axis'] not in (-1, 3, [-1], [3]):
+                    raise NotImplementedError('Only channels_last is supported')
+                weights = []
+                if cfg['name'] in f:
+                    g = f[cfg['name']]
+                    weights = [np.array(g[name], dtype=np.float32) for name in g.attrs['weight_names']]
+                self.layers.append({'class_name': cls, 'config': cfg, 'weights': weights})
+
+    def _forward(self, x: np.ndarray) -> np.ndarray:
+        for layer in self.layers:
+            cls, cfg, w = layer['class_name'], layer['config'], layer['weights']
+            if cls == 'Conv2D':
+                kernel = w[0]
+                kh, kw = kernel.shape[:2]
+                win = _windows(_pad(x, (kh, kw), cfg['strides'], cfg['padding']), (kh, kw), cfg['strides'])
+                x = np.tensordot(win, kernel, axes=([3, 4, 5], [2, 0, 1]))
+                if cfg.get('use_bias', True):
+                    x += w[1]
+                x = _activation(x, cfg.get('activation', 'linear'))
+            elif cls in ('MaxPooling2D', 'AveragePooling2D'):
+                pool_size = cfg['pool_size']
+                strides = cfg.get('strides') or pool_size
+                if cls == 'MaxPooling2D':
+                    x = _windows(_pad(x, pool_size, strides, cfg['padding'], -np.inf),
+                                 pool_size, strides).max((-2, -1))
+                elif cfg['padding'] == 'valid':
+                    x = _windows(x, pool_size, strides).mean((-2, -1))
+                else:  # the padding is not counted in the average
+                    ones = np.ones(x.shape[:3] + (1,), dtype=x.dtype)
+                    x = _windows(_pad(x, pool_size, strides, 'same'), pool_size, strides).sum((-2, -1)) / \
+                        _windows(_pad(ones, pool_size, strides, 'same'), pool_size, strides).sum((-2, -1))
+            elif cls == 'Dense':
+                x = x.dot(w[0])
+                if cfg.get('use_bias', True):
+                    x += w[1]
+                x = _activation(x, cfg.get('activation', 'linear'))
+            elif cls == 'Flatten':
+                x = x.reshape(len(x), -1)
+            elif cls == 'Activation':
+                x = _activation(x, cfg['activation'])
+            elif cls == 'BatchNormalization':
+                w = list(w)
+                gamma = w.pop(0) if cfg.get('scale', True) else 1
+                beta = w.pop(0) if cfg.get('center', True) else 0
+                x = (x - w[0]) / np.sqrt(w[1] + cfg['epsilon']) * gamma + beta
+        return x
+
+    def predict(self, x: np.ndarray, batch_size: int = 32, verbose: int = 0) -> np.ndarray:
+        """predictions for the samples x (N x H x W x C), batch_size samples at a time"""
+        x = np.asarray(x, dtype=np.float32)
+        return np.concatenate([self._forward(x[i:i + batch_size])
+                               for i in range(0, max(len(x), 1), batch_size)], 0)
@@ -32,11 +32,7 @@ def mode_robust_fast(inputData, axis=None):
     """
 
     if axis is not None:
-
-        def fnc(x):
-            return mode_robust_fast(x)
-
-        dataMode = np.apply_along_axis(fnc, axis, inputData)
+        dataMode = _mode_along_axis(inputData, axis)
     else:
         # Create the function that we can use for the half-sample mode
         data = inputData.ravel()
@@ -57,7 +53,9 @@ def mode_robust(inputData, axis=None, dtype=None):
 
     .. versionadded: 1.0.3
     """
-    if axis is not None:
+    if axis is not None and type(inputData).__name__ != "MaskedArray":
+        dataMode = _mode_along_axis(inputData, axis, dtype=dtype)
+    elif axis is not None:
 
         def fnc(x):
             return mode_robust(x, dtype=dtype)
@@ -139,6 +137,30 @@ def _hsm(data):
         return _hsm(data[j:j + N])
 
 
+def _hsm_rows(data):
+    """half-sample mode of each row of data, sorted along the rows (same result as _hsm on each row)"""
+    while data.shape[1] > 3:
+        N = data.shape[1] // 2 + data.shape[1] % 2
+        j = np.argmin(data[:, N - 1:2 * N - 1] - data[:, :N], axis=1)
+        data = np.take_along_axis(data, j[:, None] + np.arange(N), axis=1)
+    if data.shape[1] == 3:
+        return np.where(data[:, 1] - data[:, 0] < data[:, 2] - data[:, 1],
+                        data[:, :2].mean(1), data[:, 1])
+    elif data.shape[1] == 2:
+        return data.mean(1)
+    return data[:, 0]
+
+
+def _mode_along_axis(inputData, axis, dtype=None):
+    """half-sample mode along axis, computed for all the other indices at once"""
+    data = np.moveaxis(np.asarray(inputData), axis, -1)
+    shape = data.shape[:-1]
+    data = data.reshape(-1, data.shape[-1])
+    if dtype is not None:
+        data = data.astype(dtype)
+    return _hsm_rows(np.sort(data, axis=1)).reshape(shape)
+
+
 def compressive_nmf(A, L, R, r, X=None, Y=None, max_iter=100, ls=0):
     """Implements compressive NMF using an ADMM method as described in 
     Tepper and Shapiro, IEEE TSP 2015
@@ -477,7 +477,7 @@ def recursively_save_dict_contents_to_group(h5file:h5py.File, path:str, dic:Dict
             item = np.asarray(item, dtype=np.float)
         if key in ['groups', 'idx_tot', 'ind_A', 'Ab_epoch', 'coordinates',
                    'loaded_model', 'optional_outputs', 'merged_ROIs', 'tf_in',
-                   'tf_out', 'empty_merged']:
+                   'tf_out', 'empty_merged', 'search_cache', 'merge_cache']:
             logging.info('Key {} is not saved.'.format(key))
             continue
 
@@ -522,6 +522,8 @@ def recursively_save_dict_contents_to_group(h5file:h5py.File, path:str, dic:Dict
             h5file[path + key] = np.array(item)
         elif type(item).__name__ in ['CNMFParams', 'Estimates']: #  parameter object
             recursively_save_dict_contents_to_group(h5file, path + key + '/', item.__dict__)
+        elif type(item).__name__ == 'FrameProfiler':  # latency profile of OnACID
+            recursively_save_dict_contents_to_group(h5file, path + key + '/', item.to_dict())
         else:
             raise ValueError("Cannot save %s type for key '%s'." % (type(item), key))
 
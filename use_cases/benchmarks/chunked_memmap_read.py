@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Read throughput of the raw .mmap files versus the chunked .cmmap store
+(save_memmap_chunked), for patch shaped and frame shaped access.
+
+Usage: python chunked_memmap_read.py [d1 d2 T]
+"""
+
+import numpy as np
+import os
+import sys
+import tempfile
+import time
+
+import caiman as cm
+from caiman.cluster import extract_patch_coordinates
+from caiman.mmapping import load_memmap, save_memmap, save_memmap_chunked
+
+#%%
+def bench(fun, n_bytes, repeats=3):
+    times = []
+    for _ in range(repeats):
+        t0 = time.time()
+        fun()
+        times.append(time.time() - t0)
+    return n_bytes / min(times) / 2**20
+
+
+def main(d1=512, d2=512, T=2000, rf=(32, 32), stride=(8, 8), frames_per_read=200):
+    np.random.seed(0)
+    # uint16 raw data with some spatial and temporal structure so the codecs have something to work with
+    mov = (np.random.poisson(100, size=(T, d1, d2)) +
+           200 * np.sin(np.arange(T) / 50.)[:, None, None] * np.hanning(d1)[:, None] * np.hanning(d2)).astype(np.float32)
+    mov = np.maximum(mov, 0).round()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fnames = {'mmap': save_memmap([mov], base_name=os.path.join(tmpdir, 'raw'), order='C')}
+        for dtype, compression in (('float32', 'gzip'), ('uint16', 'gzip'), ('uint16', 'lzf')):
+            fnames['cmmap ' + dtype + ' ' + compression] = save_memmap_chunked(
+                [mov], base_name=os.path.join(tmpdir, 'chunked' + dtype + compression), dtype=dtype,
+                compression=compression)
+        del mov
+
+        idx_flat, _ = extract_patch_coordinates((d1, d2), rf=rf, stride=stride)
+        print('{:<24}{:>10}{:>16}{:>16}'.format('format', 'MB', 'patch MB/s', 'frames MB/s'))
+        for name, fname in fnames.items():
+            size = os.path.getsize(fname) / 2**20
+
+            def read_patches():
+                Yr, dims, T = load_memmap(fname)
+                for idx in idx_flat[::max(1, len(idx_flat) // 8)]:
+                    np.array(Yr[idx, :])
+
+            def read_frames():
+                cm.load(fname, subindices=range(T // 2, T // 2 + frames_per_read))
+
+            n_patch = sum(len(idx) for idx in idx_flat[::max(1, len(idx_flat) // 8)]) * T * 4
+            n_frames = frames_per_read * d1 * d2 * 4
+            print('{:<24}{:>10.1f}{:>16.1f}{:>16.1f}'.format(name, size, bench(read_patches, n_patch),
+                                                           bench(read_frames, n_frames)))
+
+
+#%%
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Time of evaluate_components_CNN for K components on a 512 x 512 field of view,
+for each runtime. The classifier has the architecture of cnn_model with random
+weights. The first call of each runtime includes loading the model.
+
+Usage: python cnn_classifier.py [K]
+"""
+
+import numpy as np
+import os
+import scipy.sparse
+import sys
+import tempfile
+import time
+
+from caiman.components_evaluation import evaluate_components_CNN
+
+#%%
+def cnn_model(model_name):
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import Activation, Conv2D, Dense, Dropout, Flatten, MaxPooling2D
+    model = Sequential([Conv2D(32, (3, 3), input_shape=(50, 50, 1)), Activation('relu'), Conv2D(32, (3, 3)),
+                        Activation('relu'), MaxPooling2D(pool_size=(2, 2)), Dropout(0.25),
+                        Conv2D(64, (3, 3), padding='same'), Activation('relu'), Conv2D(64, (3, 3)),
+                        Activation('relu'), MaxPooling2D(pool_size=(2, 2)), Dropout(0.25), Flatten(),
+                        Dense(512), Activation('relu'), Dropout(0.5), Dense(2), Activation('softmax')])
+    with open(model_name + '.json', 'w') as f:
+        f.write(model.to_json())
+    model.save_weights(model_name + '.h5')
+
+
+def main(K=10000, d1=512, gSig=4):
+    np.random.seed(0)
+    rows, cols = [], []
+    for k in range(K):
+        x, y = np.random.randint(0, d1 - 9, 2)
+        xx, yy = np.meshgrid(np.arange(x, x + 9), np.arange(y, y + 9))
+        rows.append((xx + d1 * yy).ravel())
+        cols.append(np.full(81, k))
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    A = scipy.sparse.csc_matrix((np.random.rand(len(rows)), (rows, cols)), shape=(d1 * d1, K))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        model_name = os.path.join(tmpdir, 'cnn_model')
+        cnn_model(model_name)
+        print('{:<12}{:>12}{:>12}'.format('runtime', 'first (s)', 'next (s)'))
+        for runtime in ('numpy', 'keras'):
+            times = []
+            for _ in range(2):
+                t0 = time.time()
+                evaluate_components_CNN(A, (d1, d1), (gSig, gSig), model_name=model_name, runtime=runtime)
+                times.append(time.time() - t0)
+            print('{:<12}{:>12.2f}{:>12.2f}'.format(runtime, *times))
+
+
+#%%
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
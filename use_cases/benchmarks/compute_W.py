@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Time and peak memory (numpy allocations of the calling process) of the ring
+model of the background (compute_W) on a synthetic 1p movie of d1 x d1 pixels
+and T frames: the products of the ring pixels computed per pixel, as before,
+against the shared products of compute_W, with all frames in memory or in
+chunks, and with spatial downsampling.
+
+Usage: python compute_W.py [d1 T radius]
+"""
+
+import numpy as np
+import sys
+import time
+import tracemalloc
+
+from caiman.source_extraction.cnmf.initialization import compute_W, disk
+
+#%%
+def per_pixel_W(Y, A, C, dims, radius):
+    """least squares fit of each pixel to the pixels of its ring, one pixel at a time"""
+    b0 = Y.mean(1) - A.dot(C.mean(1))
+    X = Y - A.dot(C) - b0[:, None]
+    ring = disk(radius + 1)
+    ring[1:-1, 1:-1] -= disk(radius)
+    ringidx = [i - radius - 1 for i in np.nonzero(ring)]
+    W = []
+    for p in range(np.prod(dims)):
+        y, x = divmod(p, dims[0])
+        xx, yy = x + ringidx[0], y + ringidx[1]
+        inside = (xx >= 0) & (xx < dims[0]) & (yy >= 0) & (yy < dims[1])
+        B = X[xx[inside] + yy[inside] * dims[0]]
+        BB = B.dot(B.T)
+        W.append(np.linalg.solve(BB + np.trace(BB) * 1e-5 * np.eye(len(B)), B.dot(X[p])))
+    return W, b0
+
+
+def measure(fun, *args, **kwargs):
+    tracemalloc.start()
+    t0 = time.time()
+    fun(*args, **kwargs)
+    t = time.time() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return t, peak / 2**20
+
+
+def main(d1=100, T=4000, radius=10):
+    np.random.seed(0)
+    dims, K = (d1, d1), d1 * d1 // 400
+    Y = np.random.rand(np.prod(dims), T).astype(np.float32) + 10
+    A = np.random.rand(np.prod(dims), K) * (np.random.rand(np.prod(dims), K) < .01)
+    C = np.random.rand(K, T)
+    print('{:<36}{:>12}{:>16}'.format('method', 'time (s)', 'peak (MB)'))
+    for name, fun, kwargs in (
+            ('per pixel', per_pixel_W, {}),
+            ('compute_W', compute_W, {}),
+            ('compute_W (chunks of frames)', compute_W, dict(data_fits_in_memory=False)),
+            ('compute_W (ssub=2)', compute_W, dict(ssub=2)),
+            ('compute_W (parallel)', compute_W, dict(parallel=True))):
+        print('{:<36}{:>12.2f}{:>16.0f}'.format(name, *measure(fun, Y, A, C, dims, radius, **kwargs)))
+
+
+#%%
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
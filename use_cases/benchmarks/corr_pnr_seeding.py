@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Time and peak memory (numpy allocations of the calling process) of the correlation
+and PNR images and of the corr_pnr seeding of neurons on a synthetic 1p movie of
+d1 x d2 pixels and T frames: whole field of view against tiles, serially and on
+the multiprocessing cluster.
+
+Usage: python corr_pnr_seeding.py [d1 T n_processes]
+"""
+
+import numpy as np
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import caiman as cm
+from caiman.source_extraction.cnmf.initialization import init_neurons_corr_pnr, init_neurons_corr_pnr_tiled
+from caiman.summary_images import correlation_pnr, correlation_pnr_tiled
+
+#%%
+def synthetic_movie(d1, d2, T, K):
+    np.random.seed(0)
+    Y = np.random.randn(T, d1, d2).astype(np.float32)
+    yy, xx = np.mgrid[:d1, :d2]
+    for _ in range(K):
+        y, x = np.random.rand(2) * (d1, d2)
+        c = np.convolve((np.random.rand(T) < .01) * 5., .9 ** np.arange(30))[:T]
+        Y += (np.exp(-((yy - y)**2 + (xx - x)**2) / 8.)[None] * c[:, None, None]).astype(np.float32)
+    Y += 10 + np.sin(np.arange(T) / 50.)[:, None, None] * \
+        np.exp(-((yy - d1 / 2)**2 + (xx - d2 / 2)**2) / d1**2)[None].astype(np.float32)
+    return Y
+
+
+def measure(fun, *args, **kwargs):
+    tracemalloc.start()
+    t0 = time.time()
+    fun(*args, **kwargs)
+    t = time.time() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return t, peak / 2**20
+
+
+def main(d1=200, T=3000, n_processes=None):
+    d2 = d1
+    Y = synthetic_movie(d1, d2, T, K=d1 * d2 // 400)
+    opts = dict(gSiz=13, gSig=3, min_corr=.8, min_pnr=8, deconvolve_options={'p': 0}, swap_dim=False)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = cm.save_memmap([Y], base_name=os.path.join(tmpdir, 'Y'), order='C')
+        _, dview, n_processes = cm.cluster.setup_cluster(backend='multiprocessing', n_processes=n_processes)
+        print('{:<36}{:>12}{:>16}'.format('method', 'time (s)', 'peak (MB)'))
+        for name, fun, args, kwargs in (
+                ('correlation_pnr', correlation_pnr, (Y,), dict(gSig=3, swap_dim=False)),
+                ('correlation_pnr_tiled', correlation_pnr_tiled, (fname,), dict(gSig=3)),
+                ('correlation_pnr_tiled (cluster)', correlation_pnr_tiled, (fname,), dict(gSig=3, dview=dview)),
+                ('init_neurons_corr_pnr', init_neurons_corr_pnr, (Y,), opts),
+                ('init_neurons_corr_pnr_tiled', init_neurons_corr_pnr_tiled, (Y,), opts),
+                ('init_neurons_corr_pnr_tiled (cluster)', init_neurons_corr_pnr_tiled, (Y,),
+                 dict(opts, dview=dview))):
+            print('{:<36}{:>12.2f}{:>16.0f}'.format(name, *measure(fun, *args, **kwargs)))
+        cm.stop_server(dview=dview)
+
+
+#%%
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Time and peak memory (numpy allocations of the calling process) of the local
+correlation movie in sliding windows of a memory mapped movie of d1 x d1 pixels
+and T frames: local_correlations_movie_offline, which loads each window, against
+the running moments of local_correlations_movie_tiled, serially and on the
+multiprocessing cluster, and iter_local_correlations_movie.
+
+Usage: python correlation_movie.py [d1 T window stride n_processes]
+"""
+
+import numpy as np
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import caiman as cm
+from caiman.summary_images import (iter_local_correlations_movie, local_correlations_movie_offline,
+                                   local_correlations_movie_tiled)
+
+#%%
+def measure(fun, *args, **kwargs):
+    tracemalloc.start()
+    t0 = time.time()
+    fun(*args, **kwargs)
+    t = time.time() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return t, peak / 2**20
+
+
+def main(d1=256, T=10000, window=300, stride=30, n_processes=None):
+    np.random.seed(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = cm.save_memmap([np.random.randn(T, d1, d1).astype(np.float32) + 10],
+                               base_name=os.path.join(tmpdir, 'Y'), order='C')
+        _, dview, n_processes = cm.cluster.setup_cluster(backend='multiprocessing', n_processes=n_processes)
+        print('{:<40}{:>12}{:>16}'.format('method', 'time (s)', 'peak (MB)'))
+        for name, fun, kwargs in (
+                ('local_correlations_movie_offline', local_correlations_movie_offline, {}),
+                ('local_correlations_movie_tiled', local_correlations_movie_tiled, {}),
+                ('local_correlations_movie_tiled (cluster)', local_correlations_movie_tiled, dict(dview=dview)),
+                ('iter_local_correlations_movie', lambda *args, **kw: sum(1 for _ in
+                                                                          iter_local_correlations_movie(*args, **kw)),
+                 {})):
+            print('{:<40}{:>12.2f}{:>16.0f}'.format(name, *measure(fun, fname, window=window, stride=stride,
+                                                                    **kwargs)))
+        cm.stop_server(dview=dview)
+
+
+#%%
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+Time of the SNR and space correlation evaluation of K components on a memory
+mapped synthetic movie: groups of 50 components against the block evaluation
+(evaluate_components_blocks), serially and on the multiprocessing cluster.
+
+Usage: python evaluate_components.py [K T block_size n_processes]
+"""
+
+import numpy as np
+import os
+import sys
+import tempfile
+import time
+
+import caiman as cm
+from caiman.components_evaluation import estimate_components_quality
+from caiman.paths import memmap_frames_filename
+from update_temporal import synthetic_data
+
+#%%
+def main(K=1000, T=3000, block_size=250, n_processes=None):
+    Y, A, C, b, f, dims = synthetic_data(K, T, dims=(256, 256))
+    traces = C + .1 * np.random.randn(K, T)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, memmap_frames_filename('Yr', (Y.shape[0], 1), T, 'C'))
+        Yr = np.memmap(fname, mode='w+', dtype=np.float32, shape=Y.shape, order='C')
+        Yr[:] = Y
+        Yr.flush()
+        del Yr, Y
+        Yr, _, _ = cm.load_memmap(fname)
+        print('{:<16}{:<10}{:>12}'.format('backend', 'method', 'time (s)'))
+        for backend in ('serial', 'multiprocessing'):
+            dview = None
+            if backend != 'serial':
+                _, dview, n_processes = cm.cluster.setup_cluster(backend=backend, n_processes=n_processes)
+            for method, size in (('groups', None), ('blocks', block_size)):
+                t0 = time.time()
+                estimate_components_quality(traces, Yr, A, C, b, f, final_frate=30, dview=dview,
+                                            num_traces_per_group=50, block_size=size)
+                print('{:<16}{:<10}{:>12.2f}'.format(backend, method, time.time() - t0))
+            if dview is not None:
+                cm.stop_server(dview=dview)
+        del Yr
+
+
+#%%
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Time of the merging rounds of CNMF (merge_components until nothing is merged)
+on K synthetic components, half of them split in two overlapping components
+with correlated traces.
+
+Usage: python merge_components.py [K T]
+"""
+
+import numpy as np
+import scipy.signal
+import scipy.sparse
+import sys
+import time
+
+from caiman.source_extraction.cnmf.merging import merge_components
+from caiman.source_extraction.cnmf.params import CNMFParams
+
+#%%
+def split_components(K, T, dims=(256, 256)):
+    np.random.seed(0)
+    yy, xx = np.meshgrid(np.arange(dims[0]), np.arange(dims[1]), indexing='ij')
+    centers = np.random.rand(K, 2) * dims
+    centers[1::4] = centers[0::4] + 2  # components 4k and 4k + 1 are the halves of a neuron
+    A = np.stack([np.exp(-((yy - y) ** 2 + (xx - x) ** 2) / 8.).ravel(order='F') for y, x in centers], 1)
+    A[A < .05] = 0
+    S = (np.random.rand(K, T) < .02) * np.random.rand(K, T)
+    S[1::4] = S[0::4]
+    C = scipy.signal.lfilter([1], [1, -.95], S, axis=1) + .05 * np.random.rand(K, T)
+    return scipy.sparse.csc_matrix(A), C, dims
+
+
+def main(K=2000, T=2000):
+    A, C, dims = split_components(K, T)
+    params = CNMFParams(params_dict={'dims': dims, 'p': 1})
+    merged_ROIs, rounds, cache = [0], 0, {}
+    R, S = np.zeros_like(C), C.copy()
+    Y = np.broadcast_to(np.float32(0), (A.shape[0], T))    # only the shape of Y is used
+    t0 = time.time()
+    while len(merged_ROIs) > 0:
+        A, C, nr, merged_ROIs, S, _, _, _, _, _, R = merge_components(
+            Y, A, None, C, R, None, S, None, params.get_group('temporal'), params.get_group('spatial'),
+            thr=params.get('merging', 'merge_thr'), mx=np.Inf, merge_cache=cache)
+        rounds += 1
+    print('{} rounds, {} -> {} components in {:.2f} s'.format(rounds, K, nr, time.time() - t0))
+
+
+#%%
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Time of the noise estimation of preprocess_data on a memory mapped movie of d
+pixels and T frames, serially and on the multiprocessing cluster, without and
+with the noise cached next to the movie.
+
+Usage: python noise_estimation.py [d T n_processes]
+"""
+
+import numpy as np
+import os
+import sys
+import tempfile
+import time
+
+import caiman as cm
+from caiman.paths import memmap_frames_filename
+from caiman.source_extraction.cnmf.pre_processing import preprocess_data
+
+#%%
+def main(d=65536, T=6000, n_processes=None):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, memmap_frames_filename('Yr', (d, 1), T, 'C'))
+        Yr = np.memmap(fname, mode='w+', dtype=np.float32, shape=(d, T), order='C')
+        for i in range(0, d, 4096):
+            Yr[i:i + 4096] = np.random.randn(len(Yr[i:i + 4096]), T)
+        Yr.flush()
+        del Yr
+        Yr, _, _ = cm.load_memmap(fname)
+        print('{:<16}{:>12}{:>12}'.format('backend', 'time (s)', 'cached (s)'))
+        for backend in ('serial', 'multiprocessing'):
+            dview = None
+            if backend != 'serial':
+                _, dview, n_processes = cm.cluster.setup_cluster(backend=backend, n_processes=n_processes)
+            times = []
+            for cache_noise in (False, True):
+                t0 = time.time()
+                preprocess_data(Yr, dview=dview, cache_noise=cache_noise, max_num_samples_fft=3072)
+                times.append(time.time() - t0)
+            t0 = time.time()
+            preprocess_data(Yr, dview=dview, max_num_samples_fft=3072)
+            print('{:<16}{:>12.2f}{:>12.2f}'.format(backend, times[0], time.time() - t0))
+            os.remove(fname + '.noise.npz')
+            if dview is not None:
+                cm.stop_server(dview=dview)
+        del Yr
+
+
+#%%
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""
+Per frame latency of the online deconvolution in OnACID.fit_next: the loop
+over the OASIS instances against oasis.fit_next_batch, for K components.
+
+Usage: python online_oasis.py [K T p]
+"""
+
+import numpy as np
+import sys
+import time
+
+from caiman.source_extraction.cnmf.oasis import OASIS, fit_next_batch
+
+#%%
+def main(K=1000, T=2000, p=1):
+    np.random.seed(0)
+    g, g2 = (.95, 0) if p == 1 else (1.7, -.71)
+    Y = ((np.random.rand(K, T) < .05) * 3 + .3 * np.random.randn(K, T)).astype(np.float32)
+    print('{:<12}{:>12}{:>12}'.format('method', 'p50 (us)', 'max (us)'))
+    for method in ('loop', 'batch'):
+        oases = [OASIS(g=g, g2=g2, s_min=.1) for _ in range(K)]
+        C_on = np.zeros((K, T), dtype=np.float32)
+        times = np.zeros(T)
+        for t in range(T):
+            t0 = time.perf_counter()
+            if method == 'loop':
+                for i, o in enumerate(oases):
+                    o.fit_next(Y[i, t])
+                    l = min(o.get_l_of_last_pool(), t + 1)
+                    C_on[i, t - l + 1: t + 1] = o.get_c_of_last_pool()[-l:]
+            else:
+                fit_next_batch(oases, Y[:, t], C_on, t)
+            times[t] = time.perf_counter() - t0
+        print('{:<12}{:>12.1f}{:>12.1f}'.format(method, 1e6 * np.median(times), 1e6 * times.max()))
+
+
+#%%
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
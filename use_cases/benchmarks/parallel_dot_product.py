@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+Throughput of caiman.mmapping.parallel_dot_product on a C order memmap,
+for Y.b and Y^T.A products with dense and sparse operands.
+
+Usage: python parallel_dot_product.py [d T K]
+"""
+
+import numpy as np
+import os
+import scipy.sparse
+import sys
+import tempfile
+import time
+
+from caiman.mmapping import load_memmap, parallel_dot_product
+from caiman.paths import memmap_frames_filename
+
+#%%
+def main(d=256 * 256, T=2000, K=200, block_size=5000, repeats=3):
+    np.random.seed(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, memmap_frames_filename('Yr', (d, 1), T, 'C'))
+        Y = np.memmap(fname, mode='w+', dtype=np.float32, shape=(d, T), order='C')
+        for start in range(0, d, 10000):
+            Y[start:start + 10000] = np.random.rand(min(10000, d - start), T)
+        del Y
+        Yr, _, _ = load_memmap(fname)
+        operands = {
+            'Y.C dense': (np.random.rand(T, K).astype(np.float32), False),
+            'Y^T.A dense': (np.random.rand(d, K).astype(np.float32), True),
+            'Y^T.A sparse': (scipy.sparse.random(d, K, density=0.01, format='csc', dtype=np.float32), True),
+        }
+        n_bytes = d * T * 4
+        print('{:<16}{:>12}'.format('product', 'GB/s'))
+        for name, (b, transpose) in operands.items():
+            times = []
+            for _ in range(repeats):
+                t0 = time.time()
+                parallel_dot_product(Yr, b, block_size=block_size, transpose=transpose)
+                times.append(time.time() - t0)
+            print('{:<16}{:>12.2f}'.format(name, n_bytes / min(times) / 1e9))
+        del Yr
+
+
+#%%
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Per frame cost of the parameter lookups of OnACID.fit_next with
+CNMFParams.get against a CNMFParams.snapshot of each group.
+
+Usage: python params_lookup.py [n_frames]
+"""
+
+import sys
+import time
+
+from caiman.source_extraction.cnmf.params import CNMFParams
+
+# the parameters read by fit_next, with the number of places reading each of them
+# (all of them are not reached for every frame)
+LOOKUPS = (
+    ('data', 'dims', 3),
+    ('init', 'gSig', 2),
+    ('init', 'gSiz', 2),
+    ('init', 'nb', 4),
+    ('init', 'ssub', 1),
+    ('init', 'ssub_B', 1),
+    ('online', 'N_samples_exceptionality', 1),
+    ('online', 'W_update_factor', 1),
+    ('online', 'batch_update_suff_stat', 2),
+    ('online', 'deadline_mode', 1),
+    ('online', 'dist_shape_update', 1),
+    ('online', 'expected_comps', 1),
+    ('online', 'full_XXt', 3),
+    ('online', 'init_batch', 5),
+    ('online', 'iters_shape', 4),
+    ('online', 'max_comp_update_shape', 1),
+    ('online', 'max_num_added', 2),
+    ('online', 'min_num_trial', 1),
+    ('online', 'minibatch_shape', 2),
+    ('online', 'minibatch_suff_stat', 3),
+    ('online', 'n_refit', 4),
+    ('online', 'num_times_comp_updated', 1),
+    ('online', 'rval_thr', 1),
+    ('online', 'simultaneously', 2),
+    ('online', 'sniper_mode', 1),
+    ('online', 'test_both', 1),
+    ('online', 'thresh_CNN_noisy', 1),
+    ('online', 'thresh_fitness_delta', 1),
+    ('online', 'thresh_fitness_raw', 1),
+    ('online', 'thresh_overlap', 1),
+    ('online', 'update_freq', 5),
+    ('online', 'update_num_comps', 1),
+    ('online', 'use_corr_img', 3),
+    ('online', 'use_dense', 6),
+    ('online', 'use_peak_max', 1),
+    ('preprocess', 'p', 6),
+    ('temporal', 's_min', 1),
+)
+
+#%%
+def frame_get(params, lookups):
+    for group, key in lookups:
+        params.get(group, key)
+
+
+def frame_snapshot(params, lookups):
+    snapshots = {group: params.snapshot(group) for group in ('data', 'init', 'online', 'preprocess', 'temporal')}
+    for group, key in lookups:
+        getattr(snapshots[group], key)
+
+
+def main(n_frames=100000):
+    params = CNMFParams(params_dict={'fr': 30, 'p': 1})
+    lookups = [(group, key) for group, key, count in LOOKUPS for _ in range(count)]
+    missing = [(group, key) for group, key in lookups if key not in params.get_group(group)]
+    if missing:
+        raise KeyError('Unknown parameters {}, update LOOKUPS'.format(sorted(set(missing))))
+
+    times = {}
+    for method, frame in (('get', frame_get), ('snapshot', frame_snapshot)):
+        t0 = time.perf_counter()
+        for _ in range(n_frames):
+            frame(params, lookups)
+        times[method] = (time.perf_counter() - t0) / n_frames
+
+    print('{} lookups per frame'.format(len(lookups)))
+    print('{:<12}{:>16}'.format('method', 'us per frame'))
+    for method, t in times.items():
+        print('{:<12}{:>16.2f}'.format(method, 1e6 * t))
+
+
+#%%
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
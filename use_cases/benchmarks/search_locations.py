@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Time to build the search locations of the spatial update for K components on
+a d1 x d2 field of view, from scratch and after changing 10% of the footprints.
+
+Usage: python search_locations.py [d1 K]
+"""
+
+import numpy as np
+import scipy.sparse
+import sys
+import time
+
+from caiman.source_extraction.cnmf.spatial import computing_indicator
+
+#%%
+def main(d1=1024, K=2000, T=100):
+    np.random.seed(0)
+    dims = (d1, d1)
+    rows, cols = [], []
+    for k in range(K):
+        x, y = np.random.randint(3, d1 - 3, 2)
+        xx, yy = np.meshgrid(np.arange(x - 3, x + 4), np.arange(y - 3, y + 4))
+        rows.append((xx + d1 * yy).ravel())
+        cols.append(np.full(49, k))
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    A = scipy.sparse.csc_matrix((np.random.rand(len(rows)), (rows, cols)), shape=(d1 * d1, K))
+    C, f, b = np.random.rand(K, T), np.ones((1, T)), np.ones((d1 * d1, 1))
+    expandCore = np.ones((5, 5), dtype=int)
+    cache = {}
+    print('{:<16}{:>12}'.format('', 'time (s)'))
+    for name in ('from scratch', 'incremental'):
+        if name == 'incremental':
+            A = A.tolil()
+            A[:, :K // 10] = A[:, :K // 10] * 1.1
+            A = A.tocsc()
+        t0 = time.time()
+        computing_indicator(None, A, b, C, f, 1, 'dilate', dims, 3, 8, 3, expandCore, None, search_cache=cache)
+        print('{:<16}{:>12.2f}'.format(name, time.time() - t0))
+
+
+#%%
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+End to end time of CNMF.update_spatial on a synthetic movie of K neurons,
+serially and on the multiprocessing and shared_memory clusters.
+
+Usage: python update_spatial.py [K T n_processes]
+"""
+
+import numpy as np
+import os
+import sys
+import tempfile
+import time
+
+import caiman as cm
+from caiman.paths import memmap_frames_filename
+from caiman.source_extraction.cnmf.cnmf import CNMF
+from caiman.source_extraction.cnmf.estimates import Estimates
+from caiman.source_extraction.cnmf.params import CNMFParams
+from caiman.source_extraction.cnmf.pre_processing import get_noise_fft
+from update_temporal import synthetic_data
+
+#%%
+def main(K=400, T=2000, n_processes=None, repeats=2):
+    Y, A, C, b, f, dims = synthetic_data(K, T)
+    sn = get_noise_fft(Y)[0]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, memmap_frames_filename('Yr', (Y.shape[0], 1), T, 'C'))
+        Yr = np.memmap(fname, mode='w+', dtype=np.float32, shape=Y.shape, order='C')
+        Yr[:] = Y
+        Yr.flush()
+        del Yr, Y
+        Yr, _, _ = cm.load_memmap(fname)
+        print('{:<16}{:>12}'.format('backend', 'time (s)'))
+        for backend in ('serial', 'multiprocessing', 'shared_memory'):
+            dview = None
+            if backend != 'serial':
+                _, dview, n_processes = cm.cluster.setup_cluster(backend=backend, n_processes=n_processes)
+            times = []
+            for _ in range(repeats):
+                cnm = CNMF(n_processes or 1, params=CNMFParams(params_dict={'dims': dims, 'n_pixels_per_process': 128}), dview=dview)
+                cnm.estimates = Estimates(A=A.copy(), b=b, C=C, f=f, dims=dims)
+                cnm.estimates.sn, cnm.dims = sn, dims
+                t0 = time.time()
+                cnm.update_spatial(Yr)
+                times.append(time.time() - t0)
+            print('{:<16}{:>12.2f}'.format(backend, min(times)))
+            if dview is not None:
+                cm.stop_server(dview=dview)
+        del Yr
+
+
+#%%
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+End to end time of CNMF.update_temporal on a synthetic movie of K neurons,
+serially and on the multiprocessing and shared_memory clusters.
+
+Usage: python update_temporal.py [K T n_processes]
+"""
+
+import numpy as np
+import scipy.sparse
+import sys
+import time
+
+import caiman as cm
+from caiman.source_extraction.cnmf.cnmf import CNMF
+from caiman.source_extraction.cnmf.estimates import Estimates
+from caiman.source_extraction.cnmf.params import CNMFParams
+
+#%%
+def synthetic_data(K, T, dims=(128, 128)):
+    np.random.seed(0)
+    d = np.prod(dims)
+    yy, xx = np.meshgrid(np.arange(dims[0]), np.arange(dims[1]), indexing='ij')
+    centers = np.random.rand(K, 2) * dims
+    A = np.stack([np.exp(-((yy - y) ** 2 + (xx - x) ** 2) / 8.).ravel(order='F') for y, x in centers], 1)
+    A[A < .05] = 0
+    S = (np.random.rand(K, T) < .02) * np.random.rand(K, T)
+    C = np.zeros((K, T))
+    for t in range(1, T):
+        C[:, t] = .95 * C[:, t - 1] + S[:, t]
+    b, f = np.ones((d, 1)), np.ones((1, T))
+    Y = A.dot(C) + b.dot(f) + .1 * np.random.randn(d, T)
+    return Y.astype(np.float32), scipy.sparse.csc_matrix(A), C, b, f, dims
+
+
+def main(K=400, T=2000, n_processes=None, repeats=2):
+    Y, A, C, b, f, dims = synthetic_data(K, T)
+    print('{:<16}{:>12}'.format('backend', 'time (s)'))
+    for backend in ('serial', 'multiprocessing', 'shared_memory'):
+        dview = None
+        if backend != 'serial':
+            _, dview, n_processes = cm.cluster.setup_cluster(backend=backend, n_processes=n_processes)
+        times = []
+        for _ in range(repeats):
+            cnm = CNMF(n_processes or 1, params=CNMFParams(params_dict={'dims': dims, 'p': 1}), dview=dview)
+            cnm.estimates = Estimates(A=A.copy(), b=b, C=C + np.random.rand(K, T), f=f, dims=dims)
+            t0 = time.time()
+            cnm.update_temporal(Y)
+            times.append(time.time() - t0)
+        print('{:<16}{:>12.2f}'.format(backend, min(times)))
+        if dview is not None:
+            cm.stop_server(dview=dview)
+
+
+#%%
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))